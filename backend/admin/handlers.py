@@ -35,6 +35,15 @@ JWT_ALGORITHM = 'HS256'
 JWT_EXPIRES_SECONDS = 86400 * 7  # 7 天
 
 
+def _invalidate_user_quota(user_id) -> None:
+    """等級變更後丟棄該用戶的配額賬本，下次檢查按新等級加載"""
+    try:
+        from core.quota_service import get_quota_service
+        get_quota_service().invalidate_cache(str(user_id))
+    except Exception as e:
+        logger.warning(f"Failed to invalidate quota ledger for {user_id}: {e}")
+
+
 class AdminHandlers:
     """管理後台 API 處理器集合"""
     
@@ -536,6 +545,8 @@ class AdminHandlers:
                     cursor.execute(query, (new_level, user_id))
             
             conn.commit()
+            if new_level:
+                _invalidate_user_quota(user_id)
             
             # 獲取新數據
             new_user = self.adapter.get_user_by_id(user_id, conn)
@@ -1077,6 +1088,8 @@ class AdminHandlers:
                     cursor.execute(query, (level, user_id))
             
             conn.commit()
+            if user_id:
+                _invalidate_user_quota(user_id)
             
             # 審計日誌
             audit_log.log(
@@ -11,6 +11,9 @@ import json
 from typing import Dict, Any, Optional, Callable, List
 from datetime import datetime
 from database import db
+from core.llm_gateway import get_llm_gateway, build_chat_request
+from core.semantic_cache import get_response_cache
+from core.llm_scheduler import get_message_coalescer, llm_priority
 from ai_context_manager import ai_context
 from ai_response_strategy import AIResponseStrategyManager
 from ai_quality_checker import AIQualityChecker
@@ -33,6 +36,19 @@ except ImportError:
     print("[AIAutoChat] RAG 系統未載入，使用基礎模式", file=__import__('sys').stderr)
 
 
+class _Coalesced:
+    """🆕 P18-24: 消息已合併到同一用戶稍後的消息中（由那一條統一回覆），布爾值為 False"""
+    
+    def __bool__(self):
+        return False
+    
+    def __repr__(self):
+        return 'MESSAGE_COALESCED'
+
+
+MESSAGE_COALESCED = _Coalesced()
+
+
 class AIAutoChatService:
     """Service for AI-powered automatic chat responses"""
     
@@ -393,6 +409,7 @@ class AIAutoChatService:
         Process an incoming message and generate a response if auto-chat is enabled
         
         Returns the response text if auto-reply should be sent, None otherwise
+        (MESSAGE_COALESCED when the message was merged into a later one)
         """
         # Check if auto-chat is enabled (整數 0/1)
         auto_chat_enabled = self.settings.get('auto_chat_enabled', 0) == 1
@@ -403,6 +420,10 @@ class AIAutoChatService:
         mode = self.settings.get('auto_chat_mode', 'semi')
         self.log(f"[AI] 處理來自用戶 {user_id} 的消息，模式: {mode}")
         
+        # 🆕 P18-22: 對話已有新消息，上一條回覆的流式生成作廢
+        if get_llm_gateway().cancel_stream(f"chat:{user_id}"):
+            self.log(f"[AI] 用戶 {user_id} 有新消息，已取消進行中的流式生成")
+        
         # Save incoming message to history
         await ai_context.add_message(
             user_id=user_id,
@@ -420,6 +441,7 @@ class AIAutoChatService:
             'username': username,
             'first_name': first_name or '',
         })
+        ai_context.invalidate(user_id, 'profile')
         
         # 記錄分析結果
         if insights.get('suggested_stage'):
@@ -433,6 +455,13 @@ class AIAutoChatService:
             self.log(f"Auto-reply disabled for user {user_id}")
             return None
         
+        # 🆕 P18-24: 連發的多條消息合併為一次回覆，只有窗口內最後一條負責生成
+        merged = await get_message_coalescer().coalesce(f"chat:{account_phone}:{user_id}", message)
+        if merged is None:
+            self.log(f"[AI] 用戶 {user_id} 的消息已合併到後續回覆")
+            return MESSAGE_COALESCED
+        message = merged
+        
         # 使用策略管理器生成回復
         context = {
             'user_id': user_id,
@@ -442,46 +471,48 @@ class AIAutoChatService:
             'funnel_stage': await self._get_funnel_stage(user_id)
         }
         
-        # 使用策略生成回復
-        response = await self.strategy_manager.generate_response(
-            message, 
-            context, 
-            self
-        )
+        # 🆕 P18-24: 突發時 LLM 請求按線索評分排隊
+        with llm_priority(await self.get_lead_score(user_id)):
+            # 使用策略生成回復
+            response = await self.strategy_manager.generate_response(
+                message, 
+                context, 
+                self
+            )
         
-        if not response:
-            return None
+            if not response:
+                return None
         
-        # 質量檢查
-        quality_result = await self.quality_checker.check_quality(
-            response,
-            context,
-            original_message=message
-        )
+            # 質量檢查
+            quality_result = await self.quality_checker.check_quality(
+                response,
+                context,
+                original_message=message
+            )
         
-        # 如果質量不足，重新生成（最多重試2次）
-        if quality_result['should_regenerate']:
-            self.log(f"回復質量不足（分數: {quality_result['quality_score']}），嘗試重新生成...", "warning")
-            for attempt in range(2):
-                retry_response = await self.strategy_manager.generate_response(
-                    message,
-                    context,
-                    self
-                )
-                if retry_response:
-                    retry_quality = await self.quality_checker.check_quality(
-                        retry_response,
+            # 如果質量不足，重新生成（最多重試2次）
+            if quality_result['should_regenerate']:
+                self.log(f"回復質量不足（分數: {quality_result['quality_score']}），嘗試重新生成...", "warning")
+                for attempt in range(2):
+                    retry_response = await self.strategy_manager.generate_response(
+                        message,
                         context,
-                        original_message=message
+                        self
                     )
-                    if not retry_quality['should_regenerate']:
-                        response = retry_response
-                        self.log(f"重新生成成功（質量分數: {retry_quality['quality_score']}）", "success")
-                        break
-                    elif attempt == 1:
-                        # 最後一次嘗試，使用更好的回復
-                        if retry_quality['quality_score'] > quality_result['quality_score']:
+                    if retry_response:
+                        retry_quality = await self.quality_checker.check_quality(
+                            retry_response,
+                            context,
+                            original_message=message
+                        )
+                        if not retry_quality['should_regenerate']:
                             response = retry_response
+                            self.log(f"重新生成成功（質量分數: {retry_quality['quality_score']}）", "success")
+                            break
+                        elif attempt == 1:
+                            # 最後一次嘗試，使用更好的回復
+                            if retry_quality['quality_score'] > quality_result['quality_score']:
+                                response = retry_response
         
         if not response:
             return None
@@ -513,9 +544,15 @@ class AIAutoChatService:
         user_id: str, 
         user_message: str, 
         custom_prompt: Optional[str] = None,
-        usage_type: str = 'dailyChat'  # 🔧 FIX: 添加用途類型參數
+        usage_type: str = 'dailyChat',  # 🔧 FIX: 添加用途類型參數
+        use_cache: bool = True
     ) -> Optional[str]:
-        """Generate AI response with custom prompt"""
+        """
+        Generate AI response with custom prompt
+        
+        🆕 P18-23: 知識 / FAQ 生成等非日常對話用途走生成結果緩存；
+        日常對話依賴歷史、記憶和防重複提示，不緩存
+        """
         
         # 🆕 AI 自主決策引擎（無劇本化）
         autonomous_decision = None
@@ -584,6 +621,35 @@ class AIAutoChatService:
                 return None
             self.log(f"[生成回覆] ✓ 重新初始化成功")
         
+        if use_cache and usage_type != 'dailyChat':
+            if usage_model_config:
+                model_key = f"{usage_model_config.get('provider')}:{usage_model_config.get('model_name')}"
+            else:
+                model_key = f"{getattr(self, 'provider', 'custom')}:{self.local_ai_model}"
+            generated = False
+            
+            async def generate():
+                nonlocal generated
+                generated = True
+                return await self._generate_response_with_prompt(
+                    user_id, user_message, custom_prompt, usage_type, use_cache=False
+                )
+            
+            text = await get_response_cache().get_or_generate(
+                f"{custom_prompt or ''}\n{user_message}",
+                generate,
+                model=model_key,
+                params={'usage': usage_type},
+                semantic_text=user_message,
+                context=f"{user_id}\n{custom_prompt or ''}",
+            )
+            if text and not generated and self.event_callback and self.settings.get('ai_streaming_enabled', 1):
+                # 緩存命中時前端同樣收到 ai-token 幀和結束幀
+                get_llm_gateway().replay_stream(
+                    f"chat:{user_id}", text, lambda frame: self._emit_event('ai-token', {**frame, 'userId': user_id})
+                )
+            return text
+        
         try:
             # Build base system prompt
             if custom_prompt:
@@ -808,7 +874,11 @@ class AIAutoChatService:
             self.log(f"[生成回覆] 📤 調用 API，消息數: {len(messages)}, prompt長度: {len(full_system_prompt)}")
             
             # 🔧 FIX: 傳遞用途對應的模型配置
-            response_text = await self._call_ai_api(messages, model_config=usage_model_config)
+            # 🆕 P18-22: 前端在線時流式生成，逐塊推送 ai-token 幀
+            if self.event_callback and self.settings.get('ai_streaming_enabled', 1):
+                response_text = await self._stream_ai_api(user_id, messages, model_config=usage_model_config)
+            else:
+                response_text = await self._call_ai_api(messages, model_config=usage_model_config)
             
             # 🔧 診斷：顯示 API 返回結果
             if response_text:
@@ -860,6 +930,16 @@ class AIAutoChatService:
         }
         return prompts.get(stage, '')
     
+    async def get_lead_score(self, user_id: str) -> int:
+        """🆕 P18-24: 用戶的線索評分（unified_contacts.lead_score），用作 LLM 調度優先級"""
+        try:
+            row = await db.fetch_one(
+                'SELECT lead_score FROM unified_contacts WHERE telegram_id = ?', (str(user_id),)
+            )
+            return int((row or {}).get('lead_score') or 0)
+        except Exception:
+            return 0
+    
     async def _get_conversation_count(self, user_id: str) -> int:
         """獲取對話次數"""
         try:
@@ -900,14 +980,59 @@ class AIAutoChatService:
         msg_lower = message.lower()
         for mem_type, kws in keywords.items():
             if any(kw in msg_lower for kw in kws):
-                await db.add_ai_memory(
-                    user_id=user_id,
-                    memory_type=mem_type,
-                    content=message[:200],
-                    importance=0.6
+                await ai_context.extract_and_save_memory(
+                    user_id, message[:200], memory_type=mem_type, importance=0.6
                 )
                 break
     
+    async def _stream_ai_api(
+        self, user_id: str, messages: List[Dict[str, str]], model_config: Optional[Dict[str, Any]] = None
+    ) -> Optional[str]:
+        """
+        🆕 P18-22: 流式調用 AI，增量文本以 ai-token 事件推送到前端
+
+        同一用戶有新消息時流被取消並返回 None；流式失敗（端點不支持流式等）
+        則退回 _call_ai_api 的整段請求
+        """
+        if model_config:
+            provider = model_config.get('provider', 'custom')
+            api_key = model_config.get('api_key', '')
+            endpoint = model_config.get('api_endpoint', '')
+            model_name = model_config.get('model_name', '')
+        else:
+            provider = getattr(self, 'provider', 'custom')
+            api_key = getattr(self, 'api_key', '')
+            endpoint = self.local_ai_endpoint
+            model_name = self.local_ai_model
+        
+        if not endpoint and provider not in ['openai', 'claude', 'gemini']:
+            return await self._call_ai_api(messages, model_config=model_config)
+        
+        # 與整段請求一致：OpenAI 只帶最近 10 條
+        if provider == 'openai':
+            messages = messages[-10:]
+        request = build_chat_request(provider, endpoint, api_key, model_name, messages)
+        
+        def emit(frame: Dict[str, Any]):
+            self._emit_event('ai-token', {**frame, 'userId': user_id})
+        
+        try:
+            text = await get_llm_gateway().relay_stream(
+                f"chat:{user_id}", request, emit,
+                provider=provider, timeout=aiohttp.ClientTimeout(total=60),
+            )
+        except Exception as e:
+            self.log(f"[Stream] 流式調用失敗，改用整段請求: {e}", "warning")
+            return await self._call_ai_api(messages, model_config=model_config)
+        
+        if text is None:
+            self.log(f"[Stream] 用戶 {user_id} 的回覆生成已取消")
+            return None
+        if not text:
+            # 流正常結束但沒有內容（響應格式無法識別），整段請求再試一次
+            return await self._call_ai_api(messages, model_config=model_config)
+        return text
+    
     async def _call_ai_api(self, messages: List[Dict[str, str]], model_config: Optional[Dict[str, Any]] = None) -> Optional[str]:
         """
         Call the AI API endpoint - 支持多種 AI 提供商
@@ -952,7 +1077,8 @@ class AIAutoChatService:
                 self.log("AI endpoint 未配置，使用備用回覆", "warning")
                 return self._get_fallback_response(messages)
             
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60)) as session:
+            # 🆕 P18-21: 經由 LLM 網關的長連接池發出請求
+            async with get_llm_gateway().session(provider, timeout=aiohttp.ClientTimeout(total=60)) as session:
                 
                 # ========== OpenAI API ==========
                 if provider == 'openai':
@@ -1312,6 +1438,7 @@ class AIAutoChatService:
             
             # 更新興趣程度
             await db.update_user_interest(user_id, interest)
+            ai_context.invalidate(user_id, 'profile')
             
             self.log(f"[漏斗] 用戶 {user_id} 階段更新: {new_stage}, 興趣度: {interest}/5")
             
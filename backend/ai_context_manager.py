@@ -1,14 +1,44 @@
 """
 AI Context Manager
 Manages infinite context through intelligent message selection and memory
+
+🆕 P18-25: build_context 的畫像 / 摘要 / 記憶 / 最近消息分段緩存，按 token 預算截斷
 """
+import os
 import json
+import time
 import asyncio
+from collections import OrderedDict
 from typing import List, Dict, Any, Optional
 from datetime import datetime, timedelta
 from database import db
 
 
+# 🆕 P18-25: 分段上下文緩存（按用戶；條目數上限 + TTL 兜底未經本模塊的寫入）
+CONTEXT_CACHE_MAX_USERS = int(os.environ.get('AI_CONTEXT_CACHE_USERS', '1000'))
+CONTEXT_CACHE_TTL = float(os.environ.get('AI_CONTEXT_CACHE_TTL', '300'))
+CONTEXT_SEGMENTS = ('profile', 'summary', 'memories', 'recent')
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 數：CJK 字符約 1 token/字，其餘約 4 字符/token"""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class _Segment:
+    __slots__ = ('version', 'built_at', 'value', 'tokens', 'limit')
+
+    def __init__(self, version: int, built_at: float, value: Any, tokens: int, limit: int = 0):
+        self.version = version
+        self.built_at = built_at
+        self.value = value
+        self.tokens = tokens
+        self.limit = limit
+
+
 class AIContextManager:
     """Manages AI conversation context with infinite history support"""
     
@@ -16,7 +46,106 @@ class AIContextManager:
         self.max_context_tokens = 4000  # Reserve tokens for context
         self.max_recent_messages = 20   # Sliding window size
         self.summary_threshold = 50     # Summarize after this many messages
+        # 🆕 P18-25: 用戶 → 段名 → 已構建的段；段版本號由各自的寫入方遞增
+        self._segments: 'OrderedDict[str, Dict[str, _Segment]]' = OrderedDict()
+        self._versions: Dict[str, Dict[str, int]] = {}
+        self._segment_hits = 0
+        self._segment_builds = 0
+    
+    # ==================== 🆕 P18-25: 分段緩存 ====================
+    
+    def invalidate(self, user_id: str, *segments: str):
+        """
+        標記用戶的上下文段已變更（不傳段名則全部失效）
         
+        寫入方各自失效對應的段：add_message → recent，畫像更新 → profile，
+        記憶寫入 → memories（摘要記憶同時 → summary）
+        """
+        versions = self._versions.setdefault(str(user_id), {})
+        for name in segments or CONTEXT_SEGMENTS:
+            versions[name] = versions.get(name, 0) + 1
+    
+    def _segment_version(self, user_id: str, name: str) -> int:
+        return self._versions.get(user_id, {}).get(name, 0)
+    
+    def _cached_segment(self, user_id: str, name: str, limit: int = 0) -> Optional[_Segment]:
+        segment = self._segments.get(user_id, {}).get(name)
+        if (segment is None
+                or segment.version != self._segment_version(user_id, name)
+                or segment.limit != limit
+                or time.monotonic() - segment.built_at > CONTEXT_CACHE_TTL):
+            return None
+        return segment
+    
+    def _store_segment(self, user_id: str, name: str, segment: _Segment):
+        user_segments = self._segments.get(user_id)
+        if user_segments is None:
+            user_segments = self._segments[user_id] = {}
+            while len(self._segments) > CONTEXT_CACHE_MAX_USERS:
+                old_user, _ = self._segments.popitem(last=False)
+                self._versions.pop(old_user, None)
+            # 只有寫入、從未構建過上下文的用戶不需要保留版本號
+            if len(self._versions) > 2 * CONTEXT_CACHE_MAX_USERS:
+                for uid in [u for u in self._versions if u not in self._segments]:
+                    del self._versions[uid]
+        else:
+            self._segments.move_to_end(user_id)
+        user_segments[name] = segment
+    
+    async def _get_segment(self, user_id: str, name: str, limit: int = 0) -> _Segment:
+        """取緩存段；版本變化、窗口大小變化或過期時只重建這一段"""
+        segment = self._cached_segment(user_id, name, limit)
+        if segment is not None:
+            self._segment_hits += 1
+            self._segments.move_to_end(user_id)
+            return segment
+        
+        # 先記下版本：構建期間有新寫入時，下次仍會重建
+        version = self._segment_version(user_id, name)
+        self._segment_builds += 1
+        if name == 'profile':
+            profile = await db.get_user_profile(user_id)
+            text = self._build_enhanced_profile_context(profile) if profile else ""
+            segment = _Segment(version, time.monotonic(), text, estimate_tokens(text))
+        elif name == 'summary':
+            summaries = await db.get_ai_memories(user_id, memory_type='summary', limit=3)
+            text = self._format_summaries(summaries) if summaries else ""
+            segment = _Segment(version, time.monotonic(), text, estimate_tokens(text))
+        elif name == 'memories':
+            memories = await db.get_ai_memories(user_id, limit=5)
+            key_memories = [m for m in memories if m.get('memory_type') != 'summary']
+            text = self._format_memories(key_memories) if key_memories else ""
+            segment = _Segment(version, time.monotonic(), text, estimate_tokens(text))
+        else:
+            history = await db.get_chat_history(user_id, limit=limit)
+            turns = [(msg['role'], msg['content'], estimate_tokens(msg['content'])) for msg in history]
+            segment = _Segment(version, time.monotonic(), turns, sum(t[2] for t in turns), limit)
+        self._store_segment(user_id, name, segment)
+        return segment
+    
+    @staticmethod
+    def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+        """按行截斷到 token 預算內（保留前面的行）"""
+        if max_tokens <= 0:
+            return ""
+        lines, used = [], 0
+        for line in text.split('\n'):
+            cost = estimate_tokens(line) + 1
+            if used + cost > max_tokens:
+                break
+            lines.append(line)
+            used += cost
+        return '\n'.join(lines)
+    
+    def get_cache_stats(self) -> Dict[str, Any]:
+        lookups = self._segment_hits + self._segment_builds
+        return {
+            'users': len(self._segments),
+            'segment_hits': self._segment_hits,
+            'segment_builds': self._segment_builds,
+            'hit_rate': round(self._segment_hits / lookups, 4) if lookups else 0.0,
+        }
+    
     async def build_context(self, user_id: str, system_prompt: str = None,
                             max_messages: int = None) -> List[Dict[str, str]]:
         """
@@ -28,9 +157,15 @@ class AIContextManager:
         3. 對話摘要（舊對話的精華）
         4. 關鍵記憶點（重要信息）
         5. 最近 N 條原始消息
+        
+        🆕 P18-25: 2-5 為按用戶緩存的版本化分段，只重建有變更的段；
+        總長度受 max_context_tokens 約束：背景段最多佔一半預算（按 畫像 → 記憶 → 摘要 取捨），
+        最近消息從新到舊填滿剩餘預算
         """
+        user_id = str(user_id)
         messages = []
         max_msgs = max_messages or self.max_recent_messages
+        budget = self.max_context_tokens
         
         # 1. System prompt
         if system_prompt:
@@ -38,48 +173,52 @@ class AIContextManager:
                 "role": "system",
                 "content": system_prompt
             })
+            budget -= estimate_tokens(system_prompt)
+        # 系統提示過長時仍給背景和最近消息保留四分之一預算
+        budget = max(budget, self.max_context_tokens // 4)
+        
+        # 2-5. 各段並發取（命中的段不訪問數據庫）
+        profile, summary, memories, recent = await asyncio.gather(
+            self._get_segment(user_id, 'profile'),
+            self._get_segment(user_id, 'summary'),
+            self._get_segment(user_id, 'memories'),
+            self._get_segment(user_id, 'recent', max_msgs),
+        )
         
-        # 2. Get user profile and add as context
-        profile = await db.get_user_profile(user_id)
-        profile_context = ""
-        if profile:
-            profile_context = self._build_enhanced_profile_context(profile)
-        
-        # 3. Get conversation summaries (摘要類型的記憶)
-        summaries = await db.get_ai_memories(user_id, memory_type='summary', limit=3)
-        summary_text = ""
-        if summaries:
-            summary_text = self._format_summaries(summaries)
-        
-        # 4. Get key memories (非摘要類型)
-        memories = await db.get_ai_memories(user_id, limit=5)
-        key_memories = [m for m in memories if m.get('memory_type') != 'summary']
-        memory_text = ""
-        if key_memories:
-            memory_text = self._format_memories(key_memories)
-        
-        # 構建增強的上下文塊
-        context_parts = []
-        if profile_context:
-            context_parts.append(f"【用戶資料】\n{profile_context}")
-        if summary_text:
-            context_parts.append(f"【歷史對話摘要】\n{summary_text}")
-        if memory_text:
-            context_parts.append(f"【重要記憶】\n{memory_text}")
-        
+        # 構建增強的上下文塊（背景段最多佔剩餘預算的一半，超出時按行截斷）
+        background_budget = max(0, budget) // 2
+        sections = {}
+        for name, title, segment in (
+            ('profile', '用戶資料', profile),
+            ('memories', '重要記憶', memories),
+            ('summary', '歷史對話摘要', summary),
+        ):
+            if not segment.value:
+                continue
+            text = segment.value
+            if segment.tokens > background_budget:
+                text = self._truncate_to_tokens(text, background_budget)
+            if text:
+                sections[name] = f"【{title}】\n{text}"
+                background_budget -= estimate_tokens(text)
+        
+        context_parts = [sections[name] for name in ('profile', 'summary', 'memories') if name in sections]
         if context_parts:
+            block = "\n\n".join(context_parts)
             messages.append({
                 "role": "system",
-                "content": "\n\n".join(context_parts)
+                "content": block
             })
+            budget -= estimate_tokens(block)
         
-        # 5. Get recent chat history
-        history = await db.get_chat_history(user_id, limit=max_msgs)
-        for msg in history:
-            messages.append({
-                "role": msg['role'],
-                "content": msg['content']
-            })
+        # 5. 最近消息：從最新往前取，超出預算即停（至少保留最新一條）
+        selected = []
+        for role, content, tokens in reversed(recent.value):
+            if selected and tokens > budget:
+                break
+            selected.append({"role": role, "content": content})
+            budget -= tokens
+        messages.extend(reversed(selected))
         
         return messages
     
@@ -198,6 +337,7 @@ class AIContextManager:
             source_group=source_group,
             message_id=message_id
         )
+        self.invalidate(user_id, 'recent')
         
         # Check if we need to summarize old messages
         await self._check_and_summarize(user_id)
@@ -231,6 +371,7 @@ class AIContextManager:
                         content=summary,
                         importance=0.7
                     )
+                    self.invalidate(user_id, 'summary', 'memories')
     
     def _create_summary(self, messages: List[Dict[str, Any]]) -> str:
         """Create a summary of messages"""
@@ -305,7 +446,12 @@ class AIContextManager:
                                        memory_type: str = 'fact',
                                        importance: float = 0.5):
         """Extract important information and save as memory"""
-        return await db.add_ai_memory(user_id, memory_type, content, importance)
+        memory_id = await db.add_ai_memory(user_id, memory_type, content, importance)
+        if memory_type == 'summary':
+            self.invalidate(user_id, 'summary', 'memories')
+        else:
+            self.invalidate(user_id, 'memories')
+        return memory_id
     
     async def analyze_and_extract_insights(self, user_id: str, message: str, role: str = 'user') -> Dict[str, Any]:
         """
@@ -433,6 +579,8 @@ class AIContextManager:
                 memory_content = f"用戶需求: {need['context']}"
                 mem_id = await db.add_ai_memory(user_id, 'fact', memory_content, insights['importance'])
                 insights['saved_memories'].append(mem_id)
+            if insights['saved_memories']:
+                self.invalidate(user_id, 'memories')
         
         # ========== 7. 自動更新用戶畫像 ==========
         await self._auto_update_profile(user_id, insights)
@@ -475,6 +623,7 @@ class AIContextManager:
                 # 只在階段前進時更新（除非是流失）
                 if suggested_order > current_order or suggested_stage == 'churned' or suggested_stage == 'converted':
                     await db.set_user_funnel_stage(user_id, suggested_stage)
+                    self.invalidate(user_id, 'profile')
             
             # 合併自動標籤
             if insights.get('auto_tags'):
@@ -487,6 +636,7 @@ class AIContextManager:
             # 執行更新
             if update_data:
                 await db.update_user_profile(user_id, update_data)
+                self.invalidate(user_id, 'profile')
                 
         except Exception as e:
             import sys
@@ -644,6 +794,7 @@ class AIContextManager:
         """Update the conversation stage"""
         await db.set_conversation_stage(user_id, stage)
         await db.update_conversation_state(user_id, stage=stage)
+        self.invalidate(user_id, 'profile')
     
     async def get_user_context(self, user_id: str) -> Dict[str, Any]:
         """Get full user context including profile, state, and stats"""
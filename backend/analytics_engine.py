@@ -3,11 +3,87 @@ Analytics Engine
 高級分析引擎 - 轉化漏斗分析、用戶行為分析、預測模型
 """
 import sys
+import time
+from collections import OrderedDict
 from typing import Dict, Any, List, Optional
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from dataclasses import dataclass
 import statistics
 
+from core.tenant_filter import add_tenant_filter, get_owner_user_id
+
+
+# 🆕 P18-18: 漏斗階段與狀態歸一化
+FUNNEL_STAGES = ['new', 'contacted', 'replied', 'interested', 'negotiating', 'follow_up', 'converted', 'churned']
+
+_STAGE_ALIASES = {
+    'lost': 'churned',
+    'blocked': 'churned',
+    'closed-lost': 'churned',
+    'closed-won': 'converted',
+    'follow-up': 'follow_up',
+    'followup': 'follow_up',
+}
+
+FUNNEL_CACHE_SIZE = 256
+FUNNEL_ROLLING_TTL = 60  # 滾動窗口（未指定結束日期）的結果最多緩存 60 秒
+
+_SQL_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# 階段轉換歷史：由 unified_contacts 上的觸發器維護，覆蓋所有寫入路徑
+TRANSITION_TRIGGERS = ('trg_lead_stage_insert', 'trg_lead_stage_update', 'trg_lead_stage_delete')
+
+TRANSITION_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS lead_stage_transitions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        contact_id INTEGER NOT NULL,
+        owner_user_id TEXT,
+        from_status TEXT,
+        to_status TEXT,
+        changed_at TEXT DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_lead_stage_transitions_changed ON lead_stage_transitions(changed_at)",
+    "CREATE INDEX IF NOT EXISTS idx_lead_stage_transitions_contact ON lead_stage_transitions(contact_id, id)",
+    """CREATE TRIGGER IF NOT EXISTS trg_lead_stage_insert AFTER INSERT ON unified_contacts
+    BEGIN
+        INSERT INTO lead_stage_transitions (contact_id, owner_user_id, from_status, to_status)
+        VALUES (NEW.id, NEW.owner_user_id, NULL, NEW.status);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_lead_stage_update AFTER UPDATE OF status ON unified_contacts
+    WHEN OLD.status IS NOT NEW.status
+    BEGIN
+        INSERT INTO lead_stage_transitions (contact_id, owner_user_id, from_status, to_status)
+        VALUES (NEW.id, NEW.owner_user_id, OLD.status, NEW.status);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_lead_stage_delete AFTER DELETE ON unified_contacts
+    BEGIN
+        INSERT INTO lead_stage_transitions (contact_id, owner_user_id, from_status, to_status)
+        VALUES (OLD.id, OLD.owner_user_id, OLD.status, NULL);
+    END""",
+)
+
+# (db_path, owner, range) -> (marker, expires_at, result)
+_funnel_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+_history_installed: set = set()
+
+
+def normalize_funnel_stage(status: Optional[str]) -> str:
+    """將存儲的狀態值映射到漏斗階段"""
+    status = (status or 'new').strip().lower()
+    return _STAGE_ALIASES.get(status, status)
+
+
+def invalidate_funnel_cache() -> None:
+    """清空漏斗緩存（批量導入等繞過觸發器的場景使用）"""
+    _funnel_cache.clear()
+
+
+def _naive_utc(value: datetime) -> datetime:
+    """帶時區的日期轉為 UTC naive，與數據庫中的時間戳格式一致"""
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
 
 @dataclass
 class FunnelStage:
@@ -52,6 +128,10 @@ class AnalyticsEngine:
         """
         分析轉化漏斗
         
+        🆕 P18-18: 計數下推為一條按 created_at 範圍過濾的 GROUP BY status 查詢，
+        停留時間由 lead_stage_transitions 歷史計算；結果按 (用戶, 範圍) 緩存，
+        任何狀態變更（寫入一條轉換記錄）都會使緩存失效。
+        
         Args:
             days: 分析天數（如果未提供日期範圍）
             start_date: 開始日期
@@ -61,30 +141,62 @@ class AnalyticsEngine:
             漏斗分析結果
         """
         # 確定日期範圍
-        if not end_date:
-            end_date = datetime.now()
-        if not start_date:
-            start_date = end_date - timedelta(days=days)
-        
-        # 獲取所有 Lead
-        all_leads = await self.db.get_all_leads()
-        
-        # 過濾日期範圍
-        filtered_leads = [
-            lead for lead in all_leads
-            if start_date <= datetime.fromisoformat(lead['timestamp']) <= end_date
-        ]
-        
-        # 定義漏斗階段
-        stages = ['new', 'contacted', 'replied', 'interested', 'negotiating', 'follow_up', 'converted', 'churned']
+        open_ended = end_date is None
+        rolling = open_ended and start_date is None
+        end_date = _naive_utc(end_date) if end_date else datetime.now()
+        start_date = _naive_utc(start_date) if start_date else end_date - timedelta(days=days)
+        start_key = start_date.strftime(_SQL_TIME_FORMAT)
+        # 未指定結束日期時不設上界，避免本地時間與 UTC 存儲時間的偏差截掉最新數據
+        end_key = '9999-12-31 23:59:59' if open_ended else end_date.strftime(_SQL_TIME_FORMAT)
+        
+        await self._ensure_transition_history()
+        owner = get_owner_user_id()
+        cache_key = (
+            str(getattr(self.db, 'db_path', id(self.db))), owner,
+            ('rolling', days) if rolling else (start_key, end_key),
+        )
+        marker = await self._transition_marker()
+        now = time.time()
+        cached = _funnel_cache.get(cache_key)
+        if cached and cached[0] == marker and (cached[1] is None or cached[1] > now):
+            _funnel_cache.move_to_end(cache_key)
+            result = dict(cached[2])
+        else:
+            result = await self._compute_funnel(start_key, end_key)
+            _funnel_cache[cache_key] = (marker, now + FUNNEL_ROLLING_TTL if open_ended else None, result)
+            _funnel_cache.move_to_end(cache_key)
+            while len(_funnel_cache) > FUNNEL_CACHE_SIZE:
+                _funnel_cache.popitem(last=False)
+            result = dict(result)
+        
+        result['period'] = {
+            'start': start_date.isoformat(),
+            'end': end_date.isoformat(),
+            'days': days
+        }
+        return result
+    
+    async def _compute_funnel(self, start_key: str, end_key: str) -> Dict[str, Any]:
+        """執行漏斗計數與停留時間查詢（不含緩存）"""
+        query, params = add_tenant_filter(
+            "SELECT LOWER(COALESCE(status, 'new')) AS status, COUNT(*) AS cnt "
+            "FROM unified_contacts WHERE contact_type = 'user' "
+            "AND created_at >= ? AND created_at <= ? GROUP BY 1",
+            'unified_contacts', [start_key, end_key]
+        )
+        counts: Dict[str, int] = {}
+        for row in await self.db.fetch_all(query, tuple(params)):
+            stage = normalize_funnel_stage(row['status'])
+            counts[stage] = counts.get(stage, 0) + row['cnt']
+        total_leads = sum(counts.values())
+        durations = await self._stage_durations(start_key, end_key)
         
         # 統計每個階段的數據
         funnel_data = []
-        previous_count = len(filtered_leads)  # 從總數開始
+        previous_count = total_leads  # 從總數開始
         
-        for i, stage in enumerate(stages):
-            stage_leads = [l for l in filtered_leads if l.get('status', 'New') == stage.capitalize()]
-            count = len(stage_leads)
+        for stage in FUNNEL_STAGES:
+            count = counts.get(stage, 0)
             
             # 計算轉化率（相對於上一階段）
             conversion_rate = (count / previous_count * 100) if previous_count > 0 else 0
@@ -92,25 +204,22 @@ class AnalyticsEngine:
             # 計算流失率
             drop_off_rate = ((previous_count - count) / previous_count * 100) if previous_count > 0 else 0
             
-            # 計算平均停留時間（簡化版，實際需要追蹤階段轉換時間）
-            avg_time_hours = 0.0  # 需要從 interaction_history 計算
-            
+            avg_time_hours, total_time_hours = durations.get(stage, (0.0, 0.0))
             funnel_data.append(FunnelStage(
                 stage=stage,
                 count=count,
                 conversion_rate=round(conversion_rate, 2),
                 drop_off_rate=round(drop_off_rate, 2),
-                avg_time_hours=avg_time_hours,
-                total_time_hours=0.0
+                avg_time_hours=round(avg_time_hours, 2),
+                total_time_hours=round(total_time_hours, 2)
             ))
             
             previous_count = count
         
         # 計算總體轉化率
         total_conversion_rate = 0.0
-        if len(filtered_leads) > 0:
-            converted_count = len([l for l in filtered_leads if l.get('status') == 'Converted'])
-            total_conversion_rate = (converted_count / len(filtered_leads)) * 100
+        if total_leads > 0:
+            total_conversion_rate = (counts.get('converted', 0) / total_leads) * 100
         
         return {
             'stages': [
@@ -123,15 +232,80 @@ class AnalyticsEngine:
                 }
                 for fd in funnel_data
             ],
-            'totalLeads': len(filtered_leads),
+            'totalLeads': total_leads,
             'totalConversionRate': round(total_conversion_rate, 2),
-            'period': {
-                'start': start_date.isoformat(),
-                'end': end_date.isoformat(),
-                'days': days
-            }
         }
     
+    async def _stage_durations(self, start_key: str, end_key: str) -> Dict[str, tuple]:
+        """
+        按階段統計停留時間（小時）：(平均, 總計)
+        
+        停留時間 = 進入該階段到同一聯繫人下一次轉換的間隔；
+        仍停留在當前階段的記錄沒有終點，不計入。
+        """
+        if not self._history_ready():
+            return {}
+        # 轉換表與 unified_contacts 同屬一個租戶，按同一規則過濾
+        inner, params = add_tenant_filter(
+            "SELECT contact_id, to_status, changed_at, "
+            "(julianday(LEAD(changed_at) OVER (PARTITION BY contact_id ORDER BY id)) "
+            "- julianday(changed_at)) * 24.0 AS hours "
+            "FROM lead_stage_transitions WHERE changed_at >= ?",
+            'unified_contacts', [start_key]
+        )
+        rows = await self.db.fetch_all(
+            "SELECT LOWER(to_status) AS status, COUNT(*) AS cnt, SUM(hours) AS total_hours "
+            f"FROM ({inner}) WHERE changed_at <= ? AND hours IS NOT NULL "
+            "AND to_status IS NOT NULL GROUP BY 1",
+            tuple(params) + (end_key,)
+        )
+        # 多個原始狀態可能映射到同一階段，先合併總時長和次數再求平均
+        totals: Dict[str, List[float]] = {}
+        for row in rows:
+            acc = totals.setdefault(normalize_funnel_stage(row['status']), [0.0, 0])
+            acc[0] += row['total_hours'] or 0.0
+            acc[1] += row['cnt']
+        durations = {
+            stage: (total / cnt if cnt else 0.0, total)
+            for stage, (total, cnt) in totals.items()
+        }
+        return durations
+    
+    def _history_ready(self) -> bool:
+        return str(getattr(self.db, 'db_path', id(self.db))) in _history_installed
+    
+    async def _ensure_transition_history(self) -> None:
+        """安裝階段轉換歷史表和觸發器（每個數據庫只執行一次）"""
+        if self._history_ready():
+            return
+        existing = await self.db.fetch_one(
+            "SELECT 1 AS ok FROM sqlite_master WHERE type = 'table' AND name = 'lead_stage_transitions'"
+        )
+        table_sql, *rest = TRANSITION_SCHEMA
+        await self.db.execute(table_sql)
+        if not existing:
+            # 首次安裝：先以當前狀態和創建時間作為每個聯繫人的起點，再安裝觸發器
+            await self.db.execute(
+                "INSERT INTO lead_stage_transitions (contact_id, owner_user_id, from_status, to_status, changed_at) "
+                "SELECT id, owner_user_id, NULL, status, created_at FROM unified_contacts"
+            )
+        for statement in rest:
+            await self.db.execute(statement)
+        installed = await self.db.fetch_one(
+            "SELECT COUNT(*) AS cnt FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'trg_lead_stage_%'"
+        )
+        if installed and installed['cnt'] == len(TRANSITION_TRIGGERS):
+            _history_installed.add(str(getattr(self.db, 'db_path', id(self.db))))
+        else:
+            print("[AnalyticsEngine] Stage transition triggers unavailable, avg time disabled", file=sys.stderr)
+    
+    async def _transition_marker(self) -> Optional[int]:
+        """緩存版本號：最新一條轉換記錄的 ID（狀態變更/新增/刪除都會推進）"""
+        if not self._history_ready():
+            return None
+        row = await self.db.fetch_one("SELECT MAX(id) AS marker FROM lead_stage_transitions")
+        return row['marker'] if row else None
+    
     async def analyze_user_journey(self, user_id: str) -> Dict[str, Any]:
         """
         分析用戶旅程
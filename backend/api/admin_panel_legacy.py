@@ -506,6 +506,11 @@ class AdminPanelLegacy:
             msg = f'已延长 {days} 天'
             if new_level:
                 msg += f'，等级升级为 {new_level}'
+                try:
+                    from core.quota_service import get_quota_service
+                    get_quota_service().invalidate_cache(str(user_id))
+                except Exception:
+                    pass
             return web.json_response({'success': True, 'message': msg})
         except Exception as e:
             import traceback
@@ -239,6 +239,8 @@ class AuthCoreMixin:
                                     elif db_exp and not db_sub_exp and _has_sub_exp:
                                         conn.execute("UPDATE users SET subscription_expires = ? WHERE id = ? OR user_id = ?", (db_exp, pk, pk))
                                     conn.commit()
+                                    from core.quota_service import get_quota_service
+                                    get_quota_service().invalidate_cache(user.id)
                                 except Exception as sync_err:
                                     logger.warning("[auth/me] Failed to sync level fields: %s", sync_err)
                             elif not _has_sub_tier and db_membership:
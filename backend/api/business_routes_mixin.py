@@ -11,6 +11,8 @@ import time
 from datetime import datetime, timedelta
 from aiohttp import web
 
+from core.db_executor import run_db
+
 logger = logging.getLogger(__name__)
 
 
@@ -525,64 +527,34 @@ class BusinessRoutesMixin:
             from core.lead_scoring import get_scoring_engine
             engine = get_scoring_engine()
             
-            from core.db_utils import get_connection
-            with get_connection() as conn:
-                conn.row_factory = sqlite3.Row
-                
-                if lead_ids:
-                    placeholders = ','.join('?' * len(lead_ids))
-                    rows = conn.execute(
-                        f'SELECT * FROM unified_contacts WHERE id IN ({placeholders})',
-                        lead_ids
-                    ).fetchall()
-                else:
-                    # 評分最近 100 條未評分的線索
-                    rows = conn.execute(
-                        'SELECT * FROM unified_contacts WHERE lead_score = 0 OR lead_score IS NULL ORDER BY created_at DESC LIMIT 100'
-                    ).fetchall()
-                
-                results = []
-                for row in rows:
-                    lead = dict(row)
-                    score_result = engine.score_lead(lead)
-                    
-                    # 更新數據庫
-                    conn.execute('''
-                        UPDATE unified_contacts SET
-                            lead_score = ?, intent_level = ?, value_level = ?,
-                            intent_score = ?, quality_score = ?, activity_score = ?,
-                            updated_at = CURRENT_TIMESTAMP
-                        WHERE id = ?
-                    ''', (
-                        score_result['lead_score'],
-                        score_result['intent_level'],
-                        score_result['value_level'],
-                        score_result['intent_score'],
-                        score_result['quality_score'],
-                        score_result['activity_score'],
-                        lead['id'],
-                    ))
-                    
-                    results.append({
-                        'id': lead['id'],
-                        'telegram_id': lead.get('telegram_id'),
-                        **score_result,
-                    })
-                
-                conn.commit()
+            from core.db_executor import db_connection
+
+            def _score():
+                # 🆕 P18-19: 列式評分 + 批量回寫（只寫分數有變化的行）
+                with db_connection() as conn:
+                    ids = lead_ids
+                    if not ids:
+                        # 評分最近 100 條未評分的線索
+                        ids = [row[0] for row in conn.execute(
+                            'SELECT id FROM unified_contacts WHERE lead_score = 0 OR lead_score IS NULL ORDER BY created_at DESC LIMIT 100'
+                        )]
+                    return engine.score_contacts(conn, ids=ids, collect=50)
+
+            scored = await run_db(_score)
+            results = scored['results']
             
             response_data = {
-                'scored': len(results),
-                'results': results[:50],  # 限制返回數量
+                'scored': scored['scored'],
+                'results': results,  # 限制返回數量
             }
             
             # P14-4: WebSocket 推送評分完成事件
             try:
                 if hasattr(self, 'ws_service') and self.ws_service:
                     self.ws_service.publish_lead_scoring({
-                        'scored_count': len(results),
-                        'hot': sum(1 for r in results if r.get('intent_level') == 'hot'),
-                        'warm': sum(1 for r in results if r.get('intent_level') == 'warm'),
+                        'scored_count': scored['scored'],
+                        'hot': scored['intent_levels'].get('hot', 0),
+                        'warm': scored['intent_levels'].get('warm', 0),
                     })
             except Exception:
                 pass
@@ -600,11 +572,11 @@ class BusinessRoutesMixin:
         try:
             limit = min(int(request.query.get('limit', '50')), 200)
             
-            from core.lead_dedup import LeadDeduplicationService
-            service = LeadDeduplicationService()
+            from core.lead_dedup import get_lead_dedup_service
+            service = get_lead_dedup_service()
             
-            groups = service.scan_duplicates(limit=limit)
-            stats = service.get_dedup_stats()
+            groups = await run_db(service.scan_duplicates, limit)
+            stats = await run_db(service.get_dedup_stats)
             
             return self._json_response({
                 'success': True,
@@ -631,9 +603,9 @@ class BusinessRoutesMixin:
                     'error': 'primary_id and duplicate_ids are required'
                 }, 400)
             
-            from core.lead_dedup import LeadDeduplicationService
-            service = LeadDeduplicationService()
-            result = service.merge_duplicates(primary_id, duplicate_ids)
+            from core.lead_dedup import get_lead_dedup_service
+            service = get_lead_dedup_service()
+            result = await run_db(service.merge_duplicates, primary_id, duplicate_ids)
             
             return self._json_response({
                 'success': 'error' not in result,
@@ -651,7 +623,7 @@ class BusinessRoutesMixin:
             
             from core.business_analytics import BusinessAnalytics
             analytics = BusinessAnalytics()
-            data = analytics.get_lead_source_analysis(days=days, user_id=user_id or None)
+            data = await run_db(analytics.get_lead_source_analysis, days=days, user_id=user_id or None)
             
             return self._json_response({'success': True, 'data': data})
         except Exception as e:
@@ -665,7 +637,7 @@ class BusinessRoutesMixin:
             
             from core.business_analytics import BusinessAnalytics
             analytics = BusinessAnalytics()
-            data = analytics.get_template_performance(days=days)
+            data = await run_db(analytics.get_template_performance, days=days)
             
             return self._json_response({'success': True, 'data': data})
         except Exception as e:
@@ -680,7 +652,7 @@ class BusinessRoutesMixin:
             
             from core.business_analytics import BusinessAnalytics
             analytics = BusinessAnalytics()
-            data = analytics.get_daily_trends(days=days, user_id=user_id or None)
+            data = await run_db(analytics.get_daily_trends, days=days, user_id=user_id or None)
             
             return self._json_response({'success': True, 'data': data})
         except Exception as e:
@@ -694,7 +666,7 @@ class BusinessRoutesMixin:
             
             from core.business_analytics import BusinessAnalytics
             analytics = BusinessAnalytics()
-            data = analytics.get_funnel_analysis(user_id=user_id or None)
+            data = await run_db(analytics.get_funnel_analysis, user_id=user_id or None)
             
             return self._json_response({'success': True, 'data': data})
         except Exception as e:
@@ -708,7 +680,7 @@ class BusinessRoutesMixin:
             
             from core.business_analytics import BusinessAnalytics
             analytics = BusinessAnalytics()
-            data = analytics.get_summary_dashboard(user_id=user_id or None)
+            data = await run_db(analytics.get_summary_dashboard, user_id=user_id or None)
             
             return self._json_response({'success': True, 'data': data})
         except Exception as e:
@@ -932,6 +904,58 @@ class BusinessRoutesMixin:
             logger.error(f"Get contacts error: {e}")
             return self._json_response({'success': False, 'error': str(e)}, 500)
 
+    async def export_contacts(self, request):
+        """🆕 P18-8: 流式導出統一聯繫人（?format=csv|json|ndjson&gzip=1，無行數上限）"""
+        try:
+            from database import db
+            from unified_contacts import get_unified_contacts_manager
+            from core.streaming_export import export_to_response
+            params = request.rel_url.query
+            manager = get_unified_contacts_manager(db)
+            tags = [t for t in params.get('tags', '').split(',') if t] or None
+            rows = manager.iter_contacts_for_export(
+                contact_type=params.get('contact_type') or None,
+                source_type=params.get('source_type') or None,
+                status=params.get('status') or None,
+                tags=tags,
+                search=params.get('search') or None,
+            )
+            return await export_to_response(
+                request, rows, 'contacts',
+                fmt=params.get('format', 'csv'),
+                compress=params.get('gzip') in ('1', 'true'),
+                json_key='contacts',
+            )
+        except Exception as e:
+            logger.error(f"Export contacts error: {e}")
+            return self._json_response({'success': False, 'error': str(e)}, 500)
+
+    async def export_members(self, request):
+        """🆕 P18-8: 流式導出提取的成員（?format=csv|json|ndjson&gzip=1，無行數上限）"""
+        try:
+            from member_extraction_service import member_extraction_service
+            from core.streaming_export import export_to_response, normalize_format
+            params = request.rel_url.query
+            fmt = normalize_format(params.get('format', 'csv'))
+            filters = {
+                'onlineOnly': params.get('onlineOnly') in ('1', 'true'),
+                'minValueLevel': params.get('minValueLevel') or None,
+                'sourceChatId': params.get('sourceChatId') or None,
+                'notContacted': params.get('notContacted') in ('1', 'true'),
+            }
+            is_csv = fmt == 'csv'
+            return await export_to_response(
+                request, member_extraction_service.iter_members_for_export(filters), 'members',
+                fmt=fmt,
+                compress=params.get('gzip') in ('1', 'true'),
+                columns=member_extraction_service.EXPORT_COLUMNS if is_csv else None,
+                transform=member_extraction_service._export_row_for_csv if is_csv else None,
+                json_key='members',
+            )
+        except Exception as e:
+            logger.error(f"Export members error: {e}")
+            return self._json_response({'success': False, 'error': str(e)}, 500)
+
     async def get_contacts_stats(self, request):
         """🔧 P15-1: 獲取聯繫人統計"""
         try:
@@ -351,6 +351,8 @@ class HttpApiServer(AuthRoutesMixin, QuotaRoutesMixin, PaymentRoutesMixin,
         # === 業務: 聯繫人 / 推薦 / 優惠券 ===
         ('GET',    '/api/v1/contacts',                 'get_contacts'),
         ('GET',    '/api/v1/contacts/stats',           'get_contacts_stats'),
+        ('GET',    '/api/v1/contacts/export',          'export_contacts'),
+        ('GET',    '/api/v1/members/export',           'export_members'),
         ('GET',    '/api/v1/referral/code',            'get_referral_code'),
         ('GET',    '/api/v1/referral/stats',           'get_referral_stats'),
         ('POST',   '/api/v1/referral/track',           'track_referral'),
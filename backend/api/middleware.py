@@ -206,16 +206,14 @@ async def rate_limit_middleware(request, handler):
         # 嘗試從已解析的 tenant 或 token 獲取 user_id
         user_id = None
         user_tier = None
-        auth_header = request.headers.get('Authorization', '')
-        if auth_header.startswith('Bearer '):
-            try:
-                from auth.utils import verify_token
-                payload = verify_token(auth_header[7:])
-                if payload:
-                    user_id = payload.get('sub', '')
-                    user_tier = payload.get('role', 'free')
-            except:
-                pass
+        try:
+            from auth.middleware import get_request_claims
+            payload = get_request_claims(request)
+            if payload:
+                user_id = payload.get('sub', '')
+                user_tier = payload.get('role', 'free')
+        except:
+            pass
         
         # 執行限流檢查
         result = limiter.check(
@@ -419,7 +417,7 @@ def _record_prometheus_metrics(request, status_code: int, duration_ms: float):
 async def tenant_middleware(request, handler):
     """注入租戶上下文"""
     from core.tenant_context import TenantContext, set_current_tenant, clear_current_tenant
-    from auth.utils import verify_token
+    from auth.middleware import get_request_claims
     
     tenant = TenantContext()
     tenant.request_id = request.get('request_id', '')
@@ -428,11 +426,10 @@ async def tenant_middleware(request, handler):
         request.headers.get('X-Real-IP', request.remote or '')
     )
     
-    # 從 Authorization header 獲取用戶信息
+    # 從 Authorization header 獲取用戶信息（🆕 P18-15: 復用本請求已驗證的聲明）
     auth_header = request.headers.get('Authorization', '')
     if auth_header.startswith('Bearer '):
-        token = auth_header[7:]
-        payload = verify_token(token)
+        payload = get_request_claims(request)
         
         if payload:
             tenant.user_id = payload.get('sub', '')
@@ -440,7 +437,7 @@ async def tenant_middleware(request, handler):
             tenant.role = payload.get('role', 'free')
             
             # 獲取用戶訂閱信息
-            await _load_user_subscription(tenant)
+            await _load_user_subscription(tenant, request.get('auth'))
     
     # Electron 模式
     if os.environ.get('ELECTRON_MODE', 'false').lower() == 'true':
@@ -460,12 +457,14 @@ async def tenant_middleware(request, handler):
         clear_current_tenant(token)
 
 
-async def _load_user_subscription(tenant):
-    """加載用戶訂閱信息"""
+async def _load_user_subscription(tenant, auth_ctx=None):
+    """加載用戶訂閱信息（認證中間件已加載同一用戶時直接復用）"""
     try:
-        from auth.service import get_auth_service
-        auth_service = get_auth_service()
-        user = await auth_service.get_user(tenant.user_id)
+        user = getattr(auth_ctx, 'user', None)
+        if not user or str(user.id) != str(tenant.user_id):
+            from auth.service import get_auth_service
+            auth_service = get_auth_service()
+            user = await auth_service.get_user(tenant.user_id)
         
         if user:
             tenant.subscription_tier = user.subscription_tier
@@ -622,10 +621,8 @@ async def quota_check_middleware(request, handler):
     try:
         from core.quota_service import get_quota_service, QuotaExceededException
         service = get_quota_service()
-        # 添加 TG 帳號時強制刷新該用戶配額緩存，避免未先請求 auth/me 導致仍用舊 limit
-        if quota_type == 'tg_accounts':
-            service.invalidate_cache(tenant.user_id)
-        result = service.check_quota(tenant.user_id, quota_type, quota_amount)
+        # 等級變更的寫入點（後台改等級、auth/me 同步）自行失效賬本，這裡不再逐請求丟棄
+        result = await service.check_quota_async(tenant.user_id, quota_type, quota_amount)
         
         # 🔧 P2: 將檢查結果附加到請求，後續處理器可用此跳過重複檢查
         request['quota_check'] = result
@@ -677,6 +674,12 @@ async def quota_check_middleware(request, handler):
 @web.middleware
 async def error_handling_middleware(request, handler):
     """統一錯誤處理"""
+    # 🆕 P18-15: 最內層中間件 → 標記處理器開始時間，用於統計中間件開銷
+    try:
+        from api.perf_metrics import mark_handler_start
+        mark_handler_start(request)
+    except ImportError:
+        pass
     try:
         return await handler(request)
     
@@ -876,7 +879,7 @@ def require_quota(quota_type: str, amount: int = 1, auto_consume: bool = True):
             try:
                 from core.quota_service import get_quota_service
                 service = get_quota_service()
-                result = service.check_quota(tenant.user_id, quota_type, amount)
+                result = await service.check_quota_async(tenant.user_id, quota_type, amount)
                 
                 if not result.allowed:
                     return web.json_response({
@@ -931,7 +934,7 @@ async def consume_quota_for_user(
     try:
         from core.quota_service import get_quota_service
         service = get_quota_service()
-        success, result = service.consume_quota(user_id, quota_type, amount, context)
+        success, result = await service.consume_quota_async(user_id, quota_type, amount, context)
         return success
     except Exception as e:
         logger.warning(f"Failed to consume quota: {e}")
@@ -952,7 +955,7 @@ async def check_quota_for_user(
     try:
         from core.quota_service import get_quota_service
         service = get_quota_service()
-        result = service.check_quota(user_id, quota_type, amount)
+        result = await service.check_quota_async(user_id, quota_type, amount)
         return result.to_dict()
     except Exception as e:
         logger.warning(f"Failed to check quota: {e}")
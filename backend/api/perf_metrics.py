@@ -9,6 +9,7 @@ Features:
 - Request rate per minute
 - Slowest endpoints ranking
 - Slow request tracing with Request-ID correlation
+- P18-15: Middleware overhead (time from request entry to handler start)
 - No external dependencies (pure Python, memory-based)
 """
 
@@ -30,12 +31,21 @@ SLOW_THRESHOLD_MS = 1000       # Mark as slow if > N ms
 REQUEST_ID_KEY = web.AppKey('request_id', str)
 REQUEST_ID_HEADER = 'X-Request-ID'
 
+# P18-15: Monotonic timestamp set by the innermost middleware
+HANDLER_START_KEY = 'perf_handler_start'
+MAX_OVERHEAD_SAMPLES = 2000
+
 
 def get_request_id(request) -> str:
     """Get the X-Request-ID from current request (P14-1)"""
     return request.get(REQUEST_ID_KEY, 'unknown')
 
 
+def mark_handler_start(request):
+    """Mark the moment the middleware chain hands off to the route handler (P18-15)"""
+    request[HANDLER_START_KEY] = time.monotonic()
+
+
 class ApiMetrics:
     """Thread-safe API metrics collector (singleton)"""
 
@@ -59,6 +69,8 @@ class ApiMetrics:
         self._total_errors = 0  # 4xx + 5xx
         # Slow request log
         self._slow_requests = deque(maxlen=50)
+        # P18-15: Middleware overhead samples (ms)
+        self._overheads = deque(maxlen=MAX_OVERHEAD_SAMPLES)
         self._start_time = time.time()
 
     def record(self, method: str, path: str, status: int, duration_ms: float,
@@ -84,6 +96,23 @@ class ApiMetrics:
                 'time': datetime.fromtimestamp(now).isoformat(),
             })
 
+    def record_overhead(self, overhead_ms: float):
+        """Record middleware overhead for one request (P18-15)"""
+        self._overheads.append(overhead_ms)
+
+    def _overhead_summary(self) -> dict:
+        samples = sorted(self._overheads)
+        n = len(samples)
+        if not n:
+            return {'count': 0}
+        return {
+            'count': n,
+            'avg_ms': round(sum(samples) / n, 3),
+            'p50_ms': round(samples[n // 2], 3),
+            'p95_ms': round(samples[int(n * 0.95)] if n >= 20 else samples[-1], 3),
+            'max_ms': round(samples[-1], 3),
+        }
+
     @staticmethod
     def _normalize_path(path: str) -> str:
         """Normalize path parameters for grouping (e.g., /users/123 -> /users/{id})"""
@@ -145,6 +174,7 @@ class ApiMetrics:
             'top_endpoints': top_endpoints,
             'slowest_endpoints': slowest,
             'slow_requests_recent': list(self._slow_requests)[-10:],
+            'middleware_overhead': self._overhead_summary(),
             'collected_at': datetime.now().isoformat(),
         }
 
@@ -170,6 +200,10 @@ def create_perf_middleware():
             duration_ms = (time.monotonic() - start) * 1000
             metrics.record(request.method, request.path, response.status,
                            duration_ms, request_id=req_id)
+            # P18-15: Inbound middleware chain cost (absent when short-circuited)
+            handler_start = request.get(HANDLER_START_KEY)
+            if handler_start is not None:
+                metrics.record_overhead((handler_start - start) * 1000)
             # P14-1: Propagate request ID + timing in response headers
             response.headers[REQUEST_ID_HEADER] = req_id
             response.headers['X-Response-Time'] = f"{duration_ms:.1f}ms"
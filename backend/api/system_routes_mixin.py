@@ -1265,9 +1265,42 @@ class SystemRoutesMixin:
             # P15-1: Rate limiter stats
             try:
                 from core.rate_limiter import get_rate_limiter
-                summary['rate_limiter'] = get_rate_limiter().get_stats()
+                from core.db_executor import run_db
+                # get_stats 會先刷新待寫日誌，放到數據庫線程池執行
+                summary['rate_limiter'] = await run_db(get_rate_limiter().get_stats)
             except Exception:
                 summary['rate_limiter'] = None
+            # 🆕 P18-20: 數據庫線程池隊列 / 延遲統計
+            try:
+                from core.db_executor import get_db_executor, get_bulk_db_executor
+                summary['db_executor'] = get_db_executor().get_stats()
+                summary['db_bulk_executor'] = get_bulk_db_executor().get_stats()
+            except Exception:
+                summary['db_executor'] = None
+            # 🆕 P18-21: LLM 網關按提供商的延遲 / token 統計
+            try:
+                from core.llm_gateway import get_llm_gateway
+                summary['llm_gateway'] = get_llm_gateway().get_stats()
+            except Exception:
+                summary['llm_gateway'] = None
+            # 🆕 P18-23: AI 生成結果緩存命中率
+            try:
+                from core.semantic_cache import get_response_cache
+                summary['ai_response_cache'] = get_response_cache().get_stats()
+            except Exception:
+                summary['ai_response_cache'] = None
+            # 🆕 P18-24: 私信合併窗口統計（LLM 調度隊列見 llm_gateway.scheduler）
+            try:
+                from core.llm_scheduler import get_message_coalescer
+                summary['ai_coalescer'] = get_message_coalescer().get_stats()
+            except Exception:
+                summary['ai_coalescer'] = None
+            # 🆕 P18-25: AI 上下文分段緩存命中率
+            try:
+                from ai_context_manager import ai_context
+                summary['ai_context_cache'] = ai_context.get_cache_stats()
+            except Exception:
+                summary['ai_context_cache'] = None
             # P15-2: Database health stats
             try:
                 from api.db_health import DbHealthMonitor
@@ -6,6 +6,7 @@
 2. 可配置的路由保護
 3. 速率限制
 4. 請求上下文注入
+5. 🆕 P18-15: 請求級 Token 聲明（整條中間件鏈只驗證一次）
 """
 
 import asyncio
@@ -107,6 +108,27 @@ def extract_token(request) -> Optional[str]:
     return None
 
 
+# 🆕 P18-15: 請求內緩存的 Token 聲明鍵
+REQUEST_CLAIMS_KEY = 'auth_claims'
+
+
+def get_request_claims(request) -> Optional[Dict[str, Any]]:
+    """
+    獲取當前請求的 Token 聲明
+    
+    首次調用時提取並驗證 Token，結果保存在請求上；
+    限流、認證、租戶中間件和處理器共用同一份結果。
+    """
+    try:
+        return request[REQUEST_CLAIMS_KEY]
+    except KeyError:
+        pass
+    token = extract_token(request)
+    claims = verify_token(token) if token else None
+    request[REQUEST_CLAIMS_KEY] = claims
+    return claims
+
+
 def extract_api_key(request) -> Optional[str]:
     """從請求中提取 API Key"""
     # 從 X-API-Key header
@@ -140,7 +162,7 @@ async def authenticate_request(request) -> AuthContext:
     logger.info(f"[AuthDebug] {path} - Token extracted: {bool(token)}")
     
     if token:
-        payload = verify_token(token)
+        payload = get_request_claims(request)
         logger.info(f"[AuthDebug] {path} - Token verified: {bool(payload)}, payload: {payload}")
         
         if payload:
@@ -5,6 +5,7 @@
 1. 使用 Argon2 進行密碼哈希（比 bcrypt 更安全）
 2. JWT Token 支持 Access + Refresh 雙 Token
 3. 安全的隨機數生成
+4. 🆕 P18-15: 已驗證 Token 聲明的 LRU 緩存（按 Token 哈希索引，隨 exp 過期）
 """
 
 import os
@@ -13,6 +14,8 @@ import hmac
 import secrets
 import base64
 import json
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any, Tuple
 import logging
@@ -138,8 +141,51 @@ def generate_token(payload: Dict[str, Any], expires_delta: Optional[timedelta] =
     return f"{header_b64}.{payload_b64}.{signature_b64}"
 
 
+# 🆕 P18-15: 已驗證聲明緩存 {sha256(token): (exp, payload)}
+TOKEN_CACHE_SIZE = 4096
+_token_cache: 'OrderedDict[str, Tuple[float, Dict[str, Any]]]' = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+
 def verify_token(token: str) -> Optional[Dict[str, Any]]:
-    """驗證 JWT Token"""
+    """
+    驗證 JWT Token
+    
+    同一會話的重複請求命中緩存，跳過 HMAC 校驗；
+    緩存條目在 Token 的 exp 到期後失效，只緩存驗證成功的結果。
+    """
+    if not token:
+        return None
+    key = hashlib.sha256(token.encode()).hexdigest()
+    now = datetime.utcnow().timestamp()  # 與簽發 / 校驗 exp 使用同一時鐘
+    with _token_cache_lock:
+        cached = _token_cache.get(key)
+        if cached is not None:
+            if now <= cached[0]:
+                _token_cache.move_to_end(key)
+                return dict(cached[1])
+            del _token_cache[key]
+    
+    payload = _verify_token_signature(token)
+    if payload is not None:
+        exp = payload.get('exp', now + ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+        with _token_cache_lock:
+            _token_cache[key] = (exp, payload)
+            _token_cache.move_to_end(key)
+            while len(_token_cache) > TOKEN_CACHE_SIZE:
+                _token_cache.popitem(last=False)
+        return dict(payload)
+    return None
+
+
+def clear_token_cache():
+    """清空聲明緩存（密鑰輪換 / 測試）"""
+    with _token_cache_lock:
+        _token_cache.clear()
+
+
+def _verify_token_signature(token: str) -> Optional[Dict[str, Any]]:
+    """校驗簽名並解碼 payload"""
     try:
         parts = token.split('.')
         if len(parts) != 3:
@@ -18,6 +18,7 @@ import json
 from typing import Dict, Any, Optional, List, Callable
 from datetime import datetime, timedelta
 from database import db
+from ai_context_manager import ai_context
 
 
 class AutoFunnelManager:
@@ -371,6 +372,7 @@ class AutoFunnelManager:
         
         # 更新階段
         await db.update_funnel_stage(user_id, new_stage, reason)
+        ai_context.invalidate(user_id, 'profile')
         
         # 特殊階段處理
         if new_stage == 'converted':
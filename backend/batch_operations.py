@@ -5,9 +5,10 @@ Provides batch operation capabilities for leads, accounts, and other entities
 import asyncio
 import json
 import sys
+import time
 import uuid
 from datetime import datetime
-from typing import Dict, Any, List, Optional, Tuple, Callable
+from typing import Dict, Any, List, Optional, Tuple, Callable, Awaitable
 from dataclasses import dataclass, asdict
 from enum import Enum
 
@@ -59,11 +60,20 @@ class BatchOperationManager:
     
     MAX_HISTORY_SIZE = 50  # Maximum number of operations to keep in history
     MAX_BATCH_SIZE = 1000  # Maximum items per batch operation
+    BULK_CHUNK_SIZE = 500  # Items per transaction in the bulk engine
+    PROGRESS_INTERVAL = 0.5  # Minimum seconds between progress events
+    
+    # extracted_members columns written by DNC / funnel operations
+    LEAD_COLUMNS = {
+        "do_not_contact": "INTEGER DEFAULT 0",
+        "funnel_stage": "TEXT DEFAULT 'new'",
+    }
     
     def __init__(self, db, event_callback: Callable = None):
         self.db = db
         self.event_callback = event_callback
         self.operation_history: List[BatchOperationRecord] = []
+        self._progress_sent_at: Dict[str, float] = {}
         self._initialized = False
     
     async def initialize(self):
@@ -129,6 +139,8 @@ class BatchOperationManager:
                 )
             ''')
             
+            await self._ensure_lead_columns()
+            
         except Exception as e:
             print(f"[BatchOps] Error creating tables: {e}", file=sys.stderr)
     
@@ -203,7 +215,16 @@ class BatchOperationManager:
             self.event_callback(event_name, data)
     
     def _send_progress(self, operation_id: str, current: int, total: int, message: str = ""):
-        """Send progress update to frontend"""
+        """Send progress update to frontend (throttled to one event per PROGRESS_INTERVAL per operation)"""
+        now = time.monotonic()
+        done = current >= total
+        last = self._progress_sent_at.get(operation_id)
+        if not done and last is not None and now - last < self.PROGRESS_INTERVAL:
+            return
+        if done:
+            self._progress_sent_at.pop(operation_id, None)
+        else:
+            self._progress_sent_at[operation_id] = now
         self._send_event("batch-operation-progress", {
             "operationId": operation_id,
             "current": current,
@@ -212,76 +233,162 @@ class BatchOperationManager:
             "message": message
         })
     
-    # ==================== Lead Batch Operations ====================
+    # ==================== Bulk Execution Engine ====================
     
-    async def batch_update_lead_status(
-        self, 
-        lead_ids: List[int], 
-        new_status: str,
-        created_by: str = "user"
-    ) -> Dict[str, Any]:
-        """Batch update status for multiple leads"""
-        if not lead_ids:
-            return {"success": False, "error": "No leads selected"}
-        
-        if len(lead_ids) > self.MAX_BATCH_SIZE:
-            return {"success": False, "error": f"Maximum batch size is {self.MAX_BATCH_SIZE}"}
+    async def _ensure_lead_columns(self):
+        """Add the DNC / funnel columns batch operations write to extracted_members"""
+        rows = await self.db.fetch_all("PRAGMA table_info(extracted_members)")
+        columns = {row['name'] for row in rows}
+        if not columns:
+            return
+        for name, definition in self.LEAD_COLUMNS.items():
+            if name not in columns:
+                print(f"[BatchOps] Adding column: extracted_members.{name}", file=sys.stderr)
+                await self.db.execute(f"ALTER TABLE extracted_members ADD COLUMN {name} {definition}")
+    
+    @staticmethod
+    def _placeholders(values: List[Any]) -> str:
+        return ','.join('?' for _ in values)
+    
+    async def _fetch_leads(self, conn, lead_ids: List[int], columns: str = "id") -> Dict[int, Dict[str, Any]]:
+        """Validate a chunk of ids with one IN query; returns {id: row}"""
+        unique_ids = list(dict.fromkeys(lead_ids))
+        cursor = await conn.execute(
+            f"SELECT {columns} FROM extracted_members WHERE id IN ({self._placeholders(unique_ids)})",
+            unique_ids
+        )
+        return {row['id']: dict(row) for row in await cursor.fetchall()}
+    
+    async def _run_bulk(
+        self,
+        operation_id: str,
+        item_ids: List[int],
+        label: str,
+        apply_chunk: Callable[[Any, List[int]], Awaitable[List[BatchOperationResult]]]
+    ) -> List[BatchOperationResult]:
+        """
+        Run apply_chunk over item_ids in BULK_CHUNK_SIZE chunks.
+        
+        Each chunk is one transaction: apply_chunk validates ids and applies the
+        change with set-based statements, returning one result per input id.
+        A failing chunk is rolled back and all its items are reported as failed.
+        
+        Raises:
+            RuntimeError: the async connection is unavailable (aiosqlite missing);
+                the whole batch fails once instead of every item failing on its own
+        """
+        try:
+            await self.db.connect()
+        except Exception as e:
+            raise RuntimeError(f"Batch operations need the async database connection (aiosqlite): {e}") from e
         
-        operation_id = str(uuid.uuid4())
         results: List[BatchOperationResult] = []
+        total = len(item_ids)
         
-        total = len(lead_ids)
-        for i, lead_id in enumerate(lead_ids):
+        for start in range(0, total, self.BULK_CHUNK_SIZE):
+            chunk = item_ids[start:start + self.BULK_CHUNK_SIZE]
             try:
-                # Get current status for undo
-                lead = await self.db.get_lead(lead_id)
-                if not lead:
-                    results.append(BatchOperationResult(
-                        item_id=lead_id,
-                        success=False,
-                        error="Lead not found"
-                    ))
+                await self.db.begin_transaction()
+            except Exception as e:
+                chunk_results = [BatchOperationResult(item_id=i, success=False, error=str(e)) for i in chunk]
+            else:
+                try:
+                    chunk_results = await apply_chunk(self.db._connection, chunk)
+                    await self.db.commit_transaction()
+                except Exception as e:
+                    await self.db.rollback_transaction()
+                    print(f"[BatchOps] Chunk failed ({label}): {e}", file=sys.stderr)
+                    chunk_results = [BatchOperationResult(item_id=i, success=False, error=str(e)) for i in chunk]
+            
+            results.extend(chunk_results)
+            done = start + len(chunk)
+            self._send_progress(operation_id, done, total, f"{label}: {done}/{total}")
+            # Let other writers use the shared connection between chunks
+            await asyncio.sleep(0)
+        
+        return results
+    
+    async def _bulk_set_column(
+        self,
+        operation_id: str,
+        lead_ids: List[int],
+        column: str,
+        new_value: Any,
+        label: str,
+        default: Any = None,
+        cast: Optional[Callable[[Any], Any]] = None
+    ) -> List[BatchOperationResult]:
+        """Set one extracted_members column for many leads, keeping old values for undo"""
+        async def apply_chunk(conn, chunk: List[int]) -> List[BatchOperationResult]:
+            leads = await self._fetch_leads(conn, chunk, f"id, {column}")
+            if leads:
+                found = list(leads)
+                await conn.execute(
+                    f"UPDATE extracted_members SET {column} = ?, updated_at = CURRENT_TIMESTAMP "
+                    f"WHERE id IN ({self._placeholders(found)})",
+                    [new_value, *found]
+                )
+            results = []
+            for lead_id in chunk:
+                lead = leads.get(lead_id)
+                if lead is None:
+                    results.append(BatchOperationResult(item_id=lead_id, success=False, error="Lead not found"))
                     continue
-                
-                old_status = lead.get('status', 'Unknown')
-                
-                # Update status
-                await self.db.update_lead_status(lead_id, new_status)
-                
+                old_value = lead[column] if lead[column] is not None else default
                 results.append(BatchOperationResult(
                     item_id=lead_id,
                     success=True,
-                    old_value=old_status,
-                    new_value=new_status
-                ))
-                
-            except Exception as e:
-                results.append(BatchOperationResult(
-                    item_id=lead_id,
-                    success=False,
-                    error=str(e)
+                    old_value=cast(old_value) if cast else old_value,
+                    new_value=new_value
                 ))
-            
-            # Send progress update every 10 items or at end
-            if (i + 1) % 10 == 0 or i == total - 1:
-                self._send_progress(operation_id, i + 1, total, f"更新狀態: {i + 1}/{total}")
+            return results
         
-        # Create operation record
+        return await self._run_bulk(operation_id, lead_ids, label, apply_chunk)
+    
+    async def _bulk_restore_column(self, column: str, items: List[Tuple[Any, int]]) -> int:
+        """Write back per-lead old values with chunked executemany (undo)"""
+        sql = f"UPDATE extracted_members SET {column} = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?"
+        return await self._bulk_executemany(sql, items)
+    
+    async def _bulk_executemany(self, sql: str, params: List[Tuple]) -> int:
+        """executemany in BULK_CHUNK_SIZE chunks, one transaction per chunk"""
+        for start in range(0, len(params), self.BULK_CHUNK_SIZE):
+            await self.db.begin_transaction()
+            try:
+                await self.db._connection.executemany(sql, params[start:start + self.BULK_CHUNK_SIZE])
+                await self.db.commit_transaction()
+            except Exception:
+                await self.db.rollback_transaction()
+                raise
+        return len(params)
+    
+    async def _finish_operation(
+        self,
+        operation_id: str,
+        operation_type: BatchOperationType,
+        lead_ids: List[int],
+        parameters: Dict[str, Any],
+        results: List[BatchOperationResult],
+        created_by: str,
+        is_reversible: bool = True
+    ) -> Dict[str, Any]:
+        """Record the operation (results double as undo data) and build the response"""
+        result_dicts = [asdict(r) for r in results]
         success_count = sum(1 for r in results if r.success)
         failure_count = len(results) - success_count
         
         record = BatchOperationRecord(
             id=operation_id,
-            operation_type=BatchOperationType.UPDATE_STATUS.value,
+            operation_type=operation_type.value,
             target_type="lead",
             item_ids=lead_ids,
-            parameters={"new_status": new_status},
-            results=[asdict(r) for r in results],
+            parameters=parameters,
+            results=result_dicts,
             created_at=datetime.now().isoformat(),
             created_by=created_by,
             success_count=success_count,
             failure_count=failure_count,
-            is_reversible=True
+            is_reversible=is_reversible
         )
         
         await self._save_operation(record)
@@ -291,9 +398,33 @@ class BatchOperationManager:
             "operationId": operation_id,
             "successCount": success_count,
             "failureCount": failure_count,
-            "results": [asdict(r) for r in results]
+            "results": result_dicts
         }
     
+    # ==================== Lead Batch Operations ====================
+    
+    async def batch_update_lead_status(
+        self, 
+        lead_ids: List[int], 
+        new_status: str,
+        created_by: str = "user"
+    ) -> Dict[str, Any]:
+        """Batch update status for multiple leads"""
+        if not lead_ids:
+            return {"success": False, "error": "No leads selected"}
+        
+        if len(lead_ids) > self.MAX_BATCH_SIZE:
+            return {"success": False, "error": f"Maximum batch size is {self.MAX_BATCH_SIZE}"}
+        
+        operation_id = str(uuid.uuid4())
+        results = await self._bulk_set_column(
+            operation_id, lead_ids, "response_status", new_status, "更新狀態", default="Unknown"
+        )
+        return await self._finish_operation(
+            operation_id, BatchOperationType.UPDATE_STATUS, lead_ids,
+            {"new_status": new_status}, results, created_by
+        )
+    
     async def batch_add_tag(
         self,
         lead_ids: List[int],
@@ -309,7 +440,6 @@ class BatchOperationManager:
         
         tag = tag.strip()
         operation_id = str(uuid.uuid4())
-        results: List[BatchOperationResult] = []
         
         # Ensure tag exists in tags table
         try:
@@ -319,67 +449,37 @@ class BatchOperationManager:
         except Exception as e:
             print(f"[BatchOps] Error creating tag: {e}", file=sys.stderr)
         
-        total = len(lead_ids)
-        for i, lead_id in enumerate(lead_ids):
-            try:
-                # Check if lead exists
-                lead = await self.db.get_lead(lead_id)
-                if not lead:
-                    results.append(BatchOperationResult(
-                        item_id=lead_id,
-                        success=False,
-                        error="Lead not found"
-                    ))
-                    continue
-                
-                # Add tag
-                await self.db.execute('''
+        async def apply_chunk(conn, chunk: List[int]) -> List[BatchOperationResult]:
+            leads = await self._fetch_leads(conn, chunk)
+            found = list(leads)
+            tagged = set()
+            if found:
+                # Leads that already had the tag keep it on undo (old_value = tag)
+                cursor = await conn.execute(
+                    f"SELECT lead_id FROM lead_tags WHERE tag = ? AND lead_id IN ({self._placeholders(found)})",
+                    [tag, *found]
+                )
+                tagged = {row['lead_id'] for row in await cursor.fetchall()}
+                now = datetime.now().isoformat()
+                await conn.executemany('''
                     INSERT OR IGNORE INTO lead_tags (lead_id, tag, created_at)
                     VALUES (?, ?, ?)
-                ''', (lead_id, tag, datetime.now().isoformat()))
-                
-                results.append(BatchOperationResult(
+                ''', [(lead_id, tag, now) for lead_id in found if lead_id not in tagged])
+            return [
+                BatchOperationResult(
                     item_id=lead_id,
                     success=True,
+                    old_value=tag if lead_id in tagged else None,
                     new_value=tag
-                ))
-                
-            except Exception as e:
-                results.append(BatchOperationResult(
-                    item_id=lead_id,
-                    success=False,
-                    error=str(e)
-                ))
-            
-            if (i + 1) % 10 == 0 or i == total - 1:
-                self._send_progress(operation_id, i + 1, total, f"添加標籤: {i + 1}/{total}")
-        
-        success_count = sum(1 for r in results if r.success)
-        failure_count = len(results) - success_count
-        
-        record = BatchOperationRecord(
-            id=operation_id,
-            operation_type=BatchOperationType.ADD_TAG.value,
-            target_type="lead",
-            item_ids=lead_ids,
-            parameters={"tag": tag},
-            results=[asdict(r) for r in results],
-            created_at=datetime.now().isoformat(),
-            created_by=created_by,
-            success_count=success_count,
-            failure_count=failure_count,
-            is_reversible=True
+                ) if lead_id in leads else
+                BatchOperationResult(item_id=lead_id, success=False, error="Lead not found")
+                for lead_id in chunk
+            ]
+        
+        results = await self._run_bulk(operation_id, lead_ids, "添加標籤", apply_chunk)
+        return await self._finish_operation(
+            operation_id, BatchOperationType.ADD_TAG, lead_ids, {"tag": tag}, results, created_by
         )
-        
-        await self._save_operation(record)
-        
-        return {
-            "success": True,
-            "operationId": operation_id,
-            "successCount": success_count,
-            "failureCount": failure_count,
-            "results": [asdict(r) for r in results]
-        }
     
     async def batch_remove_tag(
         self,
@@ -396,71 +496,24 @@ class BatchOperationManager:
         
         tag = tag.strip()
         operation_id = str(uuid.uuid4())
-        results: List[BatchOperationResult] = []
         
-        total = len(lead_ids)
-        for i, lead_id in enumerate(lead_ids):
-            try:
-                # Check if tag exists on lead
-                row = await self.db.fetch_one('''
-                    SELECT id FROM lead_tags WHERE lead_id = ? AND tag = ?
-                ''', (lead_id, tag))
-                
-                if not row:
-                    results.append(BatchOperationResult(
-                        item_id=lead_id,
-                        success=True,  # Already doesn't have the tag
-                        old_value=None
-                    ))
-                    continue
-                
-                # Remove tag
-                await self.db.execute('''
-                    DELETE FROM lead_tags WHERE lead_id = ? AND tag = ?
-                ''', (lead_id, tag))
-                
-                results.append(BatchOperationResult(
-                    item_id=lead_id,
-                    success=True,
-                    old_value=tag
-                ))
-                
-            except Exception as e:
-                results.append(BatchOperationResult(
-                    item_id=lead_id,
-                    success=False,
-                    error=str(e)
-                ))
-            
-            if (i + 1) % 10 == 0 or i == total - 1:
-                self._send_progress(operation_id, i + 1, total, f"移除標籤: {i + 1}/{total}")
-        
-        success_count = sum(1 for r in results if r.success)
-        failure_count = len(results) - success_count
-        
-        record = BatchOperationRecord(
-            id=operation_id,
-            operation_type=BatchOperationType.REMOVE_TAG.value,
-            target_type="lead",
-            item_ids=lead_ids,
-            parameters={"tag": tag},
-            results=[asdict(r) for r in results],
-            created_at=datetime.now().isoformat(),
-            created_by=created_by,
-            success_count=success_count,
-            failure_count=failure_count,
-            is_reversible=True
+        async def apply_chunk(conn, chunk: List[int]) -> List[BatchOperationResult]:
+            unique_ids = list(dict.fromkeys(chunk))
+            where = f"tag = ? AND lead_id IN ({self._placeholders(unique_ids)})"
+            cursor = await conn.execute(f"SELECT lead_id FROM lead_tags WHERE {where}", [tag, *unique_ids])
+            tagged = {row['lead_id'] for row in await cursor.fetchall()}
+            if tagged:
+                await conn.execute(f"DELETE FROM lead_tags WHERE {where}", [tag, *unique_ids])
+            # Leads without the tag count as success (already doesn't have it)
+            return [
+                BatchOperationResult(item_id=lead_id, success=True, old_value=tag if lead_id in tagged else None)
+                for lead_id in chunk
+            ]
+        
+        results = await self._run_bulk(operation_id, lead_ids, "移除標籤", apply_chunk)
+        return await self._finish_operation(
+            operation_id, BatchOperationType.REMOVE_TAG, lead_ids, {"tag": tag}, results, created_by
         )
-        
-        await self._save_operation(record)
-        
-        return {
-            "success": True,
-            "operationId": operation_id,
-            "successCount": success_count,
-            "failureCount": failure_count,
-            "results": [asdict(r) for r in results]
-        }
     
     async def batch_add_to_dnc(
         self,
@@ -472,68 +525,12 @@ class BatchOperationManager:
             return {"success": False, "error": "No leads selected"}
         
         operation_id = str(uuid.uuid4())
-        results: List[BatchOperationResult] = []
-        
-        total = len(lead_ids)
-        for i, lead_id in enumerate(lead_ids):
-            try:
-                lead = await self.db.get_lead(lead_id)
-                if not lead:
-                    results.append(BatchOperationResult(
-                        item_id=lead_id,
-                        success=False,
-                        error="Lead not found"
-                    ))
-                    continue
-                
-                old_value = lead.get('do_not_contact', False)
-                
-                # Update DNC flag
-                await self.db.update_lead(lead_id, {"do_not_contact": True})
-                
-                results.append(BatchOperationResult(
-                    item_id=lead_id,
-                    success=True,
-                    old_value=old_value,
-                    new_value=True
-                ))
-                
-            except Exception as e:
-                results.append(BatchOperationResult(
-                    item_id=lead_id,
-                    success=False,
-                    error=str(e)
-                ))
-            
-            if (i + 1) % 10 == 0 or i == total - 1:
-                self._send_progress(operation_id, i + 1, total, f"添加到 DNC: {i + 1}/{total}")
-        
-        success_count = sum(1 for r in results if r.success)
-        failure_count = len(results) - success_count
-        
-        record = BatchOperationRecord(
-            id=operation_id,
-            operation_type=BatchOperationType.ADD_TO_DNC.value,
-            target_type="lead",
-            item_ids=lead_ids,
-            parameters={},
-            results=[asdict(r) for r in results],
-            created_at=datetime.now().isoformat(),
-            created_by=created_by,
-            success_count=success_count,
-            failure_count=failure_count,
-            is_reversible=True
+        results = await self._bulk_set_column(
+            operation_id, lead_ids, "do_not_contact", True, "添加到 DNC", default=False, cast=bool
+        )
+        return await self._finish_operation(
+            operation_id, BatchOperationType.ADD_TO_DNC, lead_ids, {}, results, created_by
         )
-        
-        await self._save_operation(record)
-        
-        return {
-            "success": True,
-            "operationId": operation_id,
-            "successCount": success_count,
-            "failureCount": failure_count,
-            "results": [asdict(r) for r in results]
-        }
     
     async def batch_remove_from_dnc(
         self,
@@ -545,68 +542,12 @@ class BatchOperationManager:
             return {"success": False, "error": "No leads selected"}
         
         operation_id = str(uuid.uuid4())
-        results: List[BatchOperationResult] = []
-        
-        total = len(lead_ids)
-        for i, lead_id in enumerate(lead_ids):
-            try:
-                lead = await self.db.get_lead(lead_id)
-                if not lead:
-                    results.append(BatchOperationResult(
-                        item_id=lead_id,
-                        success=False,
-                        error="Lead not found"
-                    ))
-                    continue
-                
-                old_value = lead.get('do_not_contact', False)
-                
-                # Update DNC flag
-                await self.db.update_lead(lead_id, {"do_not_contact": False})
-                
-                results.append(BatchOperationResult(
-                    item_id=lead_id,
-                    success=True,
-                    old_value=old_value,
-                    new_value=False
-                ))
-                
-            except Exception as e:
-                results.append(BatchOperationResult(
-                    item_id=lead_id,
-                    success=False,
-                    error=str(e)
-                ))
-            
-            if (i + 1) % 10 == 0 or i == total - 1:
-                self._send_progress(operation_id, i + 1, total, f"從 DNC 移除: {i + 1}/{total}")
-        
-        success_count = sum(1 for r in results if r.success)
-        failure_count = len(results) - success_count
-        
-        record = BatchOperationRecord(
-            id=operation_id,
-            operation_type=BatchOperationType.REMOVE_FROM_DNC.value,
-            target_type="lead",
-            item_ids=lead_ids,
-            parameters={},
-            results=[asdict(r) for r in results],
-            created_at=datetime.now().isoformat(),
-            created_by=created_by,
-            success_count=success_count,
-            failure_count=failure_count,
-            is_reversible=True
+        results = await self._bulk_set_column(
+            operation_id, lead_ids, "do_not_contact", False, "從 DNC 移除", default=False, cast=bool
+        )
+        return await self._finish_operation(
+            operation_id, BatchOperationType.REMOVE_FROM_DNC, lead_ids, {}, results, created_by
         )
-        
-        await self._save_operation(record)
-        
-        return {
-            "success": True,
-            "operationId": operation_id,
-            "successCount": success_count,
-            "failureCount": failure_count,
-            "results": [asdict(r) for r in results]
-        }
     
     async def batch_update_funnel_stage(
         self,
@@ -619,68 +560,13 @@ class BatchOperationManager:
             return {"success": False, "error": "No leads selected"}
         
         operation_id = str(uuid.uuid4())
-        results: List[BatchOperationResult] = []
-        
-        total = len(lead_ids)
-        for i, lead_id in enumerate(lead_ids):
-            try:
-                lead = await self.db.get_lead(lead_id)
-                if not lead:
-                    results.append(BatchOperationResult(
-                        item_id=lead_id,
-                        success=False,
-                        error="Lead not found"
-                    ))
-                    continue
-                
-                old_stage = lead.get('funnel_stage', 'new')
-                
-                # Update funnel stage
-                await self.db.update_lead(lead_id, {"funnel_stage": new_stage})
-                
-                results.append(BatchOperationResult(
-                    item_id=lead_id,
-                    success=True,
-                    old_value=old_stage,
-                    new_value=new_stage
-                ))
-                
-            except Exception as e:
-                results.append(BatchOperationResult(
-                    item_id=lead_id,
-                    success=False,
-                    error=str(e)
-                ))
-            
-            if (i + 1) % 10 == 0 or i == total - 1:
-                self._send_progress(operation_id, i + 1, total, f"更新漏斗階段: {i + 1}/{total}")
-        
-        success_count = sum(1 for r in results if r.success)
-        failure_count = len(results) - success_count
-        
-        record = BatchOperationRecord(
-            id=operation_id,
-            operation_type=BatchOperationType.UPDATE_FUNNEL_STAGE.value,
-            target_type="lead",
-            item_ids=lead_ids,
-            parameters={"new_stage": new_stage},
-            results=[asdict(r) for r in results],
-            created_at=datetime.now().isoformat(),
-            created_by=created_by,
-            success_count=success_count,
-            failure_count=failure_count,
-            is_reversible=True
+        results = await self._bulk_set_column(
+            operation_id, lead_ids, "funnel_stage", new_stage, "更新漏斗階段", default="new"
+        )
+        return await self._finish_operation(
+            operation_id, BatchOperationType.UPDATE_FUNNEL_STAGE, lead_ids,
+            {"new_stage": new_stage}, results, created_by
         )
-        
-        await self._save_operation(record)
-        
-        return {
-            "success": True,
-            "operationId": operation_id,
-            "successCount": success_count,
-            "failureCount": failure_count,
-            "results": [asdict(r) for r in results]
-        }
     
     async def batch_delete_leads(
         self,
@@ -692,80 +578,39 @@ class BatchOperationManager:
             return {"success": False, "error": "No leads selected"}
         
         operation_id = str(uuid.uuid4())
-        results: List[BatchOperationResult] = []
         deleted_leads_backup = []  # Store deleted leads for record
         
-        total = len(lead_ids)
-        for i, lead_id in enumerate(lead_ids):
-            try:
-                # Get lead data before deletion (for backup)
-                lead = await self.db.fetch_one('SELECT * FROM extracted_members WHERE id = ?', (lead_id,))
-                if not lead:
-                    results.append(BatchOperationResult(
-                        item_id=lead_id,
-                        success=False,
-                        error="Lead not found"
-                    ))
-                    continue
-                
-                # Store backup
-                deleted_leads_backup.append(lead)
-                
-                # Delete lead (正確的表名是 extracted_members)
-                await self.db.execute('DELETE FROM extracted_members WHERE id = ?', (lead_id,))
-                
-                # Delete related data (如果存在這些表)
-                try:
-                    await self.db.execute('DELETE FROM lead_tags WHERE lead_id = ?', (lead_id,))
-                except:
-                    pass
-                try:
-                    await self.db.execute('DELETE FROM interactions WHERE lead_id = ?', (lead_id,))
-                except:
-                    pass
-                
-                results.append(BatchOperationResult(
-                    item_id=lead_id,
-                    success=True,
-                    old_value=lead
-                ))
-                
-            except Exception as e:
-                results.append(BatchOperationResult(
-                    item_id=lead_id,
-                    success=False,
-                    error=str(e)
-                ))
-            
-            if (i + 1) % 10 == 0 or i == total - 1:
-                self._send_progress(operation_id, i + 1, total, f"刪除 Lead: {i + 1}/{total}")
-        
-        success_count = sum(1 for r in results if r.success)
-        failure_count = len(results) - success_count
-        
-        record = BatchOperationRecord(
-            id=operation_id,
-            operation_type=BatchOperationType.DELETE.value,
-            target_type="lead",
-            item_ids=lead_ids,
-            parameters={"backup": deleted_leads_backup},  # Store backup for potential recovery
-            results=[asdict(r) for r in results],
-            created_at=datetime.now().isoformat(),
-            created_by=created_by,
-            success_count=success_count,
-            failure_count=failure_count,
+        # Related tables that may hold per-lead rows (如果存在這些表)
+        rows = await self.db.fetch_all(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('lead_tags', 'interactions')"
+        )
+        related_tables = [row['name'] for row in rows]
+        
+        async def apply_chunk(conn, chunk: List[int]) -> List[BatchOperationResult]:
+            # Get lead data before deletion (for backup)
+            leads = await self._fetch_leads(conn, chunk, "*")
+            found = list(leads)
+            if found:
+                placeholders = self._placeholders(found)
+                # 正確的表名是 extracted_members
+                await conn.execute(f"DELETE FROM extracted_members WHERE id IN ({placeholders})", found)
+                for table in related_tables:
+                    await conn.execute(f"DELETE FROM {table} WHERE lead_id IN ({placeholders})", found)
+            deleted_leads_backup.extend(leads.values())
+            return [
+                BatchOperationResult(item_id=lead_id, success=True, old_value=leads[lead_id])
+                if lead_id in leads else
+                BatchOperationResult(item_id=lead_id, success=False, error="Lead not found")
+                for lead_id in chunk
+            ]
+        
+        results = await self._run_bulk(operation_id, lead_ids, "刪除 Lead", apply_chunk)
+        return await self._finish_operation(
+            operation_id, BatchOperationType.DELETE, lead_ids,
+            {"backup": deleted_leads_backup},  # Store backup for potential recovery
+            results, created_by,
             is_reversible=False  # Delete is not reversible through normal undo
         )
-        
-        await self._save_operation(record)
-        
-        return {
-            "success": True,
-            "operationId": operation_id,
-            "successCount": success_count,
-            "failureCount": failure_count,
-            "results": [asdict(r) for r in results]
-        }
     
     # ==================== Undo Operations ====================
     
@@ -787,60 +632,50 @@ class BatchOperationManager:
         if operation.reversed:
             return {"success": False, "error": "This operation has already been undone"}
         
-        # Perform undo based on operation type
-        undo_results = []
+        succeeded = [r for r in operation.results if r.get('success')]
+        undone_ids: List[int] = []
         
         try:
             if operation.operation_type == BatchOperationType.UPDATE_STATUS.value:
                 # Restore old status values
-                for result in operation.results:
-                    if result.get('success') and result.get('old_value'):
-                        await self.db.update_lead_status(result['item_id'], result['old_value'])
-                        undo_results.append({"item_id": result['item_id'], "success": True})
+                items = [(r['old_value'], r['item_id']) for r in succeeded if r.get('old_value')]
+                await self._bulk_restore_column("response_status", items)
+                undone_ids = [item_id for _, item_id in items]
                         
             elif operation.operation_type == BatchOperationType.ADD_TAG.value:
-                # Remove the added tag
+                # Remove the added tag (leads that already had it keep it)
                 tag = operation.parameters.get('tag')
-                for result in operation.results:
-                    if result.get('success'):
-                        await self.db.execute('''
-                            DELETE FROM lead_tags WHERE lead_id = ? AND tag = ?
-                        ''', (result['item_id'], tag))
-                        undo_results.append({"item_id": result['item_id'], "success": True})
+                undone_ids = [r['item_id'] for r in succeeded if not r.get('old_value')]
+                await self._bulk_executemany(
+                    'DELETE FROM lead_tags WHERE lead_id = ? AND tag = ?',
+                    [(item_id, tag) for item_id in undone_ids]
+                )
                         
             elif operation.operation_type == BatchOperationType.REMOVE_TAG.value:
                 # Add the removed tag back
                 tag = operation.parameters.get('tag')
-                for result in operation.results:
-                    if result.get('success') and result.get('old_value'):
-                        await self.db.execute('''
-                            INSERT OR IGNORE INTO lead_tags (lead_id, tag, created_at)
-                            VALUES (?, ?, ?)
-                        ''', (result['item_id'], tag, datetime.now().isoformat()))
-                        undo_results.append({"item_id": result['item_id'], "success": True})
-                        
-            elif operation.operation_type == BatchOperationType.ADD_TO_DNC.value:
-                # Restore old DNC values
-                for result in operation.results:
-                    if result.get('success'):
-                        old_value = result.get('old_value', False)
-                        await self.db.update_lead(result['item_id'], {"do_not_contact": old_value})
-                        undo_results.append({"item_id": result['item_id'], "success": True})
+                now = datetime.now().isoformat()
+                undone_ids = [r['item_id'] for r in succeeded if r.get('old_value')]
+                await self._bulk_executemany('''
+                    INSERT OR IGNORE INTO lead_tags (lead_id, tag, created_at)
+                    VALUES (?, ?, ?)
+                ''', [(item_id, tag, now) for item_id in undone_ids])
                         
-            elif operation.operation_type == BatchOperationType.REMOVE_FROM_DNC.value:
+            elif operation.operation_type in (
+                BatchOperationType.ADD_TO_DNC.value,
+                BatchOperationType.REMOVE_FROM_DNC.value
+            ):
                 # Restore old DNC values
-                for result in operation.results:
-                    if result.get('success'):
-                        old_value = result.get('old_value', True)
-                        await self.db.update_lead(result['item_id'], {"do_not_contact": old_value})
-                        undo_results.append({"item_id": result['item_id'], "success": True})
+                fallback = operation.operation_type == BatchOperationType.REMOVE_FROM_DNC.value
+                items = [(bool(r.get('old_value', fallback)), r['item_id']) for r in succeeded]
+                await self._bulk_restore_column("do_not_contact", items)
+                undone_ids = [item_id for _, item_id in items]
                         
             elif operation.operation_type == BatchOperationType.UPDATE_FUNNEL_STAGE.value:
                 # Restore old funnel stage values
-                for result in operation.results:
-                    if result.get('success') and result.get('old_value'):
-                        await self.db.update_lead(result['item_id'], {"funnel_stage": result['old_value']})
-                        undo_results.append({"item_id": result['item_id'], "success": True})
+                items = [(r['old_value'], r['item_id']) for r in succeeded if r.get('old_value')]
+                await self._bulk_restore_column("funnel_stage", items)
+                undone_ids = [item_id for _, item_id in items]
             
             # Mark operation as reversed
             operation.reversed = True
@@ -853,7 +688,7 @@ class BatchOperationManager:
             return {
                 "success": True,
                 "operationId": operation_id,
-                "undoResults": undo_results
+                "undoResults": [{"item_id": item_id, "success": True} for item_id in undone_ids]
             }
             
         except Exception as e:
@@ -0,0 +1,357 @@
+"""
+🆕 P18-17: 業務分析預聚合（rollup）
+
+看板不再對 unified_contacts / message_queue 全表 GROUP BY，而是讀取預聚合表：
+1. rollup_leads_daily      — 每日 × 用戶 × 來源群組 的線索數 / 評分和 / 熱溫線索 / 轉化
+2. rollup_messages_hourly  — 每小時 × 發送帳號 的消息總數 / 成功 / 失敗（租戶經 accounts.owner_user_id 過濾）
+3. rollup_funnel           — 用戶 × 漏斗階段 的當前人數
+
+維護方式：
+- 源表上的 INSERT / DELETE / UPDATE 觸發器按「減舊行、加新行」增量更新（UPSERT）
+- 首次安裝（或定義版本變更）時在同一事務中建觸發器並從源表回填，不丟寫入；
+  回填只在啟動任務 / rebuild() 中進行，查詢路徑不會觸發
+- 尚未安裝時查詢直接對源表聚合（只讀，較慢）；源表不存在或缺少列時返回 None 並記錄警告
+
+用法:
+    rollup = get_analytics_rollup()
+    rollup.ensure()                      # 啟動時在線程中調用（回填可能較慢）
+    rows = rollup.lead_trend('2026-01-01', user_id='u1')
+"""
+
+import logging
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from core.db_executor import db_connection
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class RollupSpec:
+    """一張預聚合表的定義；表達式中的 {p} 替換為 NEW / OLD / 源表別名"""
+    name: str
+    source: str
+    table: str
+    keys: Tuple[Tuple[str, str], ...]
+    measures: Tuple[Tuple[str, str], ...]
+    watch: Tuple[str, ...]          # 源表中參與聚合的列（UPDATE OF 觸發）
+
+    def _exprs(self, pairs, prefix: str) -> List[str]:
+        return [expr.format(p=prefix) for _, expr in pairs]
+
+    def upsert_sql(self, prefix: str, sign: int) -> str:
+        key_cols = [c for c, _ in self.keys]
+        measure_cols = [c for c, _ in self.measures]
+        values = self._exprs(self.keys, prefix) + [
+            f"{'-' if sign < 0 else ''}({e})" for e in self._exprs(self.measures, prefix)
+        ]
+        updates = ', '.join(f"{c} = {c} + excluded.{c}" for c in measure_cols)
+        return (
+            f"INSERT INTO {self.table} ({', '.join(key_cols + measure_cols)}) "
+            f"VALUES ({', '.join(values)}) "
+            f"ON CONFLICT({', '.join(key_cols)}) DO UPDATE SET {updates};"
+        )
+
+    def create_table_sql(self) -> str:
+        cols = [f"{c} TEXT NOT NULL" for c, _ in self.keys]
+        cols += [f"{c} REAL NOT NULL DEFAULT 0" if c == 'score_sum' else f"{c} INTEGER NOT NULL DEFAULT 0"
+                 for c, _ in self.measures]
+        pk = ', '.join(c for c, _ in self.keys)
+        return f"CREATE TABLE IF NOT EXISTS {self.table} ({', '.join(cols)}, PRIMARY KEY ({pk})) WITHOUT ROWID"
+
+    def trigger_names(self) -> List[str]:
+        return [f"trg_rollup_{self.name}_{op}" for op in ('ins', 'del', 'upd')]
+
+    def create_triggers_sql(self) -> List[str]:
+        ins, dele, upd = self.trigger_names()
+        return [
+            f"CREATE TRIGGER {ins} AFTER INSERT ON {self.source} BEGIN {self.upsert_sql('NEW', 1)} END",
+            f"CREATE TRIGGER {dele} AFTER DELETE ON {self.source} BEGIN {self.upsert_sql('OLD', -1)} END",
+            f"CREATE TRIGGER {upd} AFTER UPDATE OF {', '.join(self.watch)} ON {self.source} "
+            f"BEGIN {self.upsert_sql('OLD', -1)} {self.upsert_sql('NEW', 1)} END",
+        ]
+
+    def aggregate_sql(self) -> str:
+        """從源表直接聚合，結果列與預聚合表一致"""
+        keys = self._exprs(self.keys, 's')
+        columns = [f"{e} AS {c}" for (c, _), e in zip(self.keys, keys)]
+        columns += [f"SUM({e}) AS {c}" for (c, _), e in zip(self.measures, self._exprs(self.measures, 's'))]
+        return f"SELECT {', '.join(columns)} FROM {self.source} s GROUP BY {', '.join(keys)}"
+
+    def backfill_sql(self) -> str:
+        key_cols = [c for c, _ in self.keys]
+        measure_cols = [c for c, _ in self.measures]
+        return f"INSERT INTO {self.table} ({', '.join(key_cols + measure_cols)}) {self.aggregate_sql()}"
+
+
+def _flag(condition: str) -> str:
+    return f"CASE WHEN {condition} THEN 1 ELSE 0 END"
+
+
+ROLLUP_SPECS: Tuple[RollupSpec, ...] = (
+    RollupSpec(
+        name='leads_daily',
+        source='unified_contacts',
+        table='rollup_leads_daily',
+        keys=(
+            ('day', "COALESCE(DATE({p}.created_at), '')"),
+            ('owner_user_id', "COALESCE({p}.owner_user_id, '')"),
+            ('source_group_title', "COALESCE({p}.source_group_title, '')"),
+            ('source_type', "COALESCE({p}.source_type, '')"),
+        ),
+        measures=(
+            ('total', '1'),
+            ('score_sum', 'COALESCE({p}.lead_score, 0)'),
+            ('hot', _flag("{p}.intent_level = 'hot'")),
+            ('warm', _flag("{p}.intent_level = 'warm'")),
+            ('converted', _flag("{p}.status = 'converted'")),
+        ),
+        watch=('created_at', 'owner_user_id', 'source_group_title', 'source_type',
+               'lead_score', 'intent_level', 'status'),
+    ),
+    RollupSpec(
+        name='funnel',
+        source='unified_contacts',
+        table='rollup_funnel',
+        keys=(
+            ('owner_user_id', "COALESCE({p}.owner_user_id, '')"),
+            ('funnel_stage', "COALESCE({p}.funnel_stage, '')"),
+        ),
+        measures=(('count', '1'),),
+        watch=('owner_user_id', 'funnel_stage'),
+    ),
+    RollupSpec(
+        name='messages_hourly',
+        source='message_queue',
+        table='rollup_messages_hourly',
+        keys=(
+            ('hour', "COALESCE(strftime('%Y-%m-%d %H:00', {p}.created_at), '')"),
+            ('phone', "COALESCE({p}.phone, '')"),
+        ),
+        measures=(
+            ('total', '1'),
+            ('sent', _flag("{p}.status = 'completed'")),
+            ('failed', _flag("{p}.status = 'failed'")),
+        ),
+        watch=('created_at', 'phone', 'status'),
+    ),
+)
+
+# 定義變更時遞增 → 觸發器重建 + 重新回填
+ROLLUP_VERSION = 2
+
+
+class AnalyticsRollup:
+    """預聚合表的安裝與查詢（同步 API，在線程中調用）"""
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path
+        self._ready: Dict[str, bool] = {}
+        self._unavailable_logged: set = set()
+        self._lock = threading.Lock()
+
+    # ==================== 安裝 / 回填 ====================
+
+    def ensure(self) -> Dict[str, bool]:
+        """
+        安裝所有源表已存在的 rollup；返回 {name: 是否可用}
+
+        首次安裝需要全表回填並持有寫鎖，只在啟動任務（批量線程池）或 rebuild() 中調用
+        """
+        if all(self._ready.get(spec.name) for spec in ROLLUP_SPECS):
+            return dict(self._ready)
+        with self._lock, db_connection(self.db_path) as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS rollup_state (
+                    name TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    built_at TEXT DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            conn.commit()
+            for spec in ROLLUP_SPECS:
+                if not self._ready.get(spec.name):
+                    self._ready[spec.name] = self._install(conn, spec)
+        return dict(self._ready)
+
+    @staticmethod
+    def _missing_columns(conn: sqlite3.Connection, spec: RollupSpec) -> Tuple[set, bool]:
+        """返回 (源表缺少的列, 源表是否存在)"""
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({spec.source})")}
+        return set(spec.watch) - columns, bool(columns)
+
+    @staticmethod
+    def _installed(conn: sqlite3.Connection, spec: RollupSpec) -> bool:
+        """當前版本的預聚合表和觸發器是否已安裝"""
+        try:
+            row = conn.execute('SELECT version FROM rollup_state WHERE name = ?', (spec.name,)).fetchone()
+        except sqlite3.OperationalError:
+            return False
+        triggers = {r[0] for r in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?", (spec.source,)
+        )}
+        return bool(row and row[0] == ROLLUP_VERSION and set(spec.trigger_names()) <= triggers)
+
+    def _install(self, conn: sqlite3.Connection, spec: RollupSpec) -> bool:
+        missing, exists = self._missing_columns(conn, spec)
+        if missing:
+            if exists:
+                logger.warning(f"[Rollup] {spec.name}: {spec.source} missing columns {sorted(missing)}")
+            return False
+        if self._installed(conn, spec):
+            return True
+
+        # 觸發器與回填在同一寫事務中完成：回填期間的寫入要麼被回填覆蓋，要麼由觸發器計入
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for name in spec.trigger_names():
+                conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+            conn.execute(f'DROP TABLE IF EXISTS {spec.table}')
+            conn.execute(spec.create_table_sql())
+            for sql in spec.create_triggers_sql():
+                conn.execute(sql)
+            conn.execute(spec.backfill_sql())
+            conn.execute('''
+                INSERT INTO rollup_state (name, version, built_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(name) DO UPDATE SET version = excluded.version, built_at = excluded.built_at
+            ''', (spec.name, ROLLUP_VERSION))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        count = conn.execute(f'SELECT COUNT(*) FROM {spec.table}').fetchone()[0]
+        logger.info(f"[Rollup] {spec.name} installed ({count} aggregate rows)")
+        return True
+
+    def rebuild(self, name: str = None):
+        """強制重建（數據修復用）"""
+        with self._lock:
+            with db_connection(self.db_path) as conn:
+                conn.execute('DELETE FROM rollup_state' + (' WHERE name = ?' if name else ''),
+                             (name,) if name else ())
+                conn.commit()
+            self._ready.clear()
+        return self.ensure()
+
+    # ==================== 查詢 ====================
+
+    def _query(self, spec_name: str, sql: str, params: Sequence[Any]) -> Optional[List[Dict[str, Any]]]:
+        """
+        讀取預聚合表；不會觸發安裝 / 回填
+
+        尚未安裝（啟動任務未完成）時把預聚合表替換為源表上的聚合子查詢；
+        源表不存在或缺列時返回 None，調用方按空結果處理，每個 rollup 只記錄一次警告
+        """
+        spec = next(s for s in ROLLUP_SPECS if s.name == spec_name)
+        with db_connection(self.db_path) as conn:
+            if not self._ready.get(spec_name):
+                missing, _ = self._missing_columns(conn, spec)
+                if missing:
+                    if spec_name not in self._unavailable_logged:
+                        self._unavailable_logged.add(spec_name)
+                        logger.warning(f"[Rollup] {spec_name} unavailable, analytics for it will be empty")
+                    return None
+                if self._installed(conn, spec):
+                    self._ready[spec_name] = True
+                else:
+                    sql = sql.replace(f'FROM {spec.table}', f'FROM ({spec.aggregate_sql()}) AS {spec.table}')
+            return [dict(row) for row in conn.execute(sql, tuple(params)).fetchall()]
+
+    @staticmethod
+    def _user_filter(column: str, user_id: Optional[str], params: List[Any]) -> str:
+        if not user_id:
+            return ''
+        params.append(user_id)
+        return f' AND {column} = ?'
+
+    @staticmethod
+    def _account_filter(user_id: Optional[str], params: List[Any]) -> str:
+        """消息按發送帳號歸屬租戶（message_queue.user_id 是收件人，不是租戶）"""
+        if not user_id:
+            return ''
+        params.append(user_id)
+        return ' AND phone IN (SELECT phone FROM accounts WHERE owner_user_id = ?)'
+
+    def lead_sources(self, since_day: str, user_id: str = None, limit: int = 20):
+        params: List[Any] = [since_day]
+        sql = f'''
+            SELECT source_group_title, source_type,
+                   SUM(total) AS total_leads,
+                   SUM(score_sum) * 1.0 / MAX(SUM(total), 1) AS avg_score,
+                   SUM(hot) AS hot_leads, SUM(warm) AS warm_leads, SUM(converted) AS converted
+            FROM rollup_leads_daily
+            WHERE day >= ? AND source_group_title != ''{self._user_filter('owner_user_id', user_id, params)}
+            GROUP BY source_group_title, source_type
+            HAVING SUM(total) > 0
+            ORDER BY total_leads DESC
+            LIMIT ?
+        '''
+        return self._query('leads_daily', sql, params + [limit])
+
+    def lead_totals(self, since_day: str = '', user_id: str = None) -> Optional[Dict[str, int]]:
+        params: List[Any] = [since_day]
+        sql = f'''
+            SELECT COALESCE(SUM(total), 0) AS total, COALESCE(SUM(hot), 0) AS hot
+            FROM rollup_leads_daily
+            WHERE day >= ?{self._user_filter('owner_user_id', user_id, params)}
+        '''
+        rows = self._query('leads_daily', sql, params)
+        return rows[0] if rows is not None else None
+
+    def lead_trend(self, since_day: str, user_id: str = None):
+        params: List[Any] = [since_day]
+        sql = f'''
+            SELECT day AS date, SUM(total) AS count
+            FROM rollup_leads_daily
+            WHERE day >= ?{self._user_filter('owner_user_id', user_id, params)}
+            GROUP BY day HAVING SUM(total) > 0 ORDER BY day
+        '''
+        return self._query('leads_daily', sql, params)
+
+    def message_trend(self, since_day: str, user_id: str = None):
+        params: List[Any] = [since_day]
+        sql = f'''
+            SELECT substr(hour, 1, 10) AS date,
+                   SUM(total) AS total, SUM(sent) AS sent, SUM(failed) AS failed
+            FROM rollup_messages_hourly
+            WHERE hour >= ?{self._account_filter(user_id, params)}
+            GROUP BY date HAVING SUM(total) > 0 ORDER BY date
+        '''
+        return self._query('messages_hourly', sql, params)
+
+    def messages_by_account(self, since_hour: str, user_id: str = None):
+        params: List[Any] = [since_hour]
+        sql = f'''
+            SELECT phone, SUM(total) AS total, SUM(sent) AS sent, SUM(failed) AS failed
+            FROM rollup_messages_hourly
+            WHERE hour >= ?{self._account_filter(user_id, params)}
+            GROUP BY phone HAVING SUM(total) > 0 ORDER BY total DESC
+        '''
+        return self._query('messages_hourly', sql, params)
+
+    def funnel_counts(self, user_id: str = None) -> Optional[Dict[str, int]]:
+        params: List[Any] = []
+        sql = f'''
+            SELECT funnel_stage, SUM(count) AS count FROM rollup_funnel
+            WHERE 1 = 1{self._user_filter('owner_user_id', user_id, params)}
+            GROUP BY funnel_stage HAVING SUM(count) > 0
+        '''
+        rows = self._query('funnel', sql, params)
+        return {r['funnel_stage']: r['count'] for r in rows} if rows is not None else None
+
+
+# ==================== 單例 ====================
+
+_rollups: Dict[str, AnalyticsRollup] = {}
+_rollups_lock = threading.Lock()
+
+
+def get_analytics_rollup(db_path: str = None) -> AnalyticsRollup:
+    key = db_path or ''
+    with _rollups_lock:
+        if key not in _rollups:
+            _rollups[key] = AnalyticsRollup(db_path)
+        return _rollups[key]
@@ -7,13 +7,19 @@
 3. 活動 ROI 分析
 4. 時間趨勢分析（日/週/月）
 5. 漏斗分析
+
+🆕 P18-17: 線索 / 消息 / 漏斗統計改讀預聚合表（core.analytics_rollup），
+不再對 unified_contacts / message_queue 全表分組；按天統計，user_id 對應聯繫人的 owner_user_id。
+
+🆕 P18-20: 同步 API，由路由通過 core.db_executor.run_db 在數據庫線程池中調用。
 """
 
 import logging
-import sqlite3
 from typing import Dict, Any, List, Optional
 from datetime import datetime, timedelta
 
+from core.db_executor import db_connection
+
 logger = logging.getLogger(__name__)
 
 
@@ -22,66 +28,25 @@ class BusinessAnalytics:
 
     def __init__(self, db_path: str = None):
         self.db_path = db_path
+        from core.analytics_rollup import get_analytics_rollup
+        self.rollup = get_analytics_rollup(db_path)
 
-    def _get_conn(self) -> sqlite3.Connection:
-        if self.db_path:
-            conn = sqlite3.connect(self.db_path)
-        else:
-            from core.db_utils import get_connection
-            conn = get_connection().__enter__()
-        conn.row_factory = sqlite3.Row
-        return conn
+    @staticmethod
+    def _since_day(days: int) -> str:
+        return (datetime.now() - timedelta(days=days)).date().isoformat()
 
     def get_lead_source_analysis(self, days: int = 30, user_id: str = None) -> Dict[str, Any]:
         """
         線索來源分析：哪些群組/渠道帶來最多高質量線索
         """
         try:
-            conn = self._get_conn()
-            cutoff = (datetime.now() - timedelta(days=days)).isoformat()
-
-            # 按來源群組統計
-            query = '''
-                SELECT 
-                    source_group_title,
-                    source_type,
-                    COUNT(*) as total_leads,
-                    AVG(COALESCE(lead_score, 0)) as avg_score,
-                    SUM(CASE WHEN intent_level = 'hot' THEN 1 ELSE 0 END) as hot_leads,
-                    SUM(CASE WHEN intent_level = 'warm' THEN 1 ELSE 0 END) as warm_leads,
-                    SUM(CASE WHEN status = 'converted' THEN 1 ELSE 0 END) as converted
-                FROM unified_contacts
-                WHERE created_at >= ?
-                  AND source_group_title IS NOT NULL
-                  AND source_group_title != ''
-            '''
-            params = [cutoff]
-            if user_id:
-                query += ' AND user_id = ?'
-                params.append(user_id)
-
-            query += '''
-                GROUP BY source_group_title, source_type
-                ORDER BY total_leads DESC
-                LIMIT 20
-            '''
-
-            rows = conn.execute(query, params).fetchall()
-            sources = [dict(row) for row in rows]
-
-            # 總計
-            total_query = 'SELECT COUNT(*) FROM unified_contacts WHERE created_at >= ?'
-            total_params = [cutoff]
-            if user_id:
-                total_query += ' AND user_id = ?'
-                total_params.append(user_id)
-            total = conn.execute(total_query, total_params).fetchone()[0]
-
-            conn.close()
+            since = self._since_day(days)
+            sources = self.rollup.lead_sources(since, user_id) or []
+            totals = self.rollup.lead_totals(since, user_id) or {'total': 0}
 
             return {
                 'period_days': days,
-                'total_leads': total,
+                'total_leads': totals['total'],
                 'sources': sources,
                 'top_source': sources[0]['source_group_title'] if sources else None,
             }
@@ -94,21 +59,20 @@ class BusinessAnalytics:
         模板效果對比
         """
         try:
-            conn = self._get_conn()
-
-            rows = conn.execute('''
-                SELECT 
-                    name,
-                    category,
-                    usage_count,
-                    success_rate,
-                    last_used,
-                    ROUND(usage_count * COALESCE(success_rate, 0) / 100.0, 1) as estimated_successes
-                FROM chat_templates
-                WHERE is_active = 1 AND usage_count > 0
-                ORDER BY usage_count DESC
-                LIMIT 20
-            ''').fetchall()
+            with db_connection(self.db_path) as conn:
+                rows = conn.execute('''
+                    SELECT 
+                        name,
+                        category,
+                        usage_count,
+                        success_rate,
+                        last_used,
+                        ROUND(usage_count * COALESCE(success_rate, 0) / 100.0, 1) as estimated_successes
+                    FROM chat_templates
+                    WHERE is_active = 1 AND usage_count > 0
+                    ORDER BY usage_count DESC
+                    LIMIT 20
+                ''').fetchall()
 
             templates = [dict(row) for row in rows]
 
@@ -119,8 +83,6 @@ class BusinessAnalytics:
                 / max(total_usage, 1)
             ) if templates else 0
 
-            conn.close()
-
             return {
                 'templates': templates,
                 'total_usage': total_usage,
@@ -136,43 +98,9 @@ class BusinessAnalytics:
         每日趨勢：線索數量、消息發送量
         """
         try:
-            conn = self._get_conn()
-            cutoff = (datetime.now() - timedelta(days=days)).isoformat()
-
-            # 線索趨勢
-            lead_query = '''
-                SELECT DATE(created_at) as date, COUNT(*) as count
-                FROM unified_contacts
-                WHERE created_at >= ?
-            '''
-            params = [cutoff]
-            if user_id:
-                lead_query += ' AND user_id = ?'
-                params.append(user_id)
-            lead_query += ' GROUP BY DATE(created_at) ORDER BY date'
-
-            lead_rows = conn.execute(lead_query, params).fetchall()
-            lead_trend = [{'date': row['date'], 'count': row['count']} for row in lead_rows]
-
-            # 消息趨勢
-            msg_query = '''
-                SELECT DATE(created_at) as date,
-                       COUNT(*) as total,
-                       SUM(CASE WHEN status = 'completed' THEN 1 ELSE 0 END) as sent,
-                       SUM(CASE WHEN status = 'failed' THEN 1 ELSE 0 END) as failed
-                FROM message_queue
-                WHERE created_at >= ?
-            '''
-            msg_params = [cutoff]
-            if user_id:
-                msg_query += ' AND user_id = ?'
-                msg_params.append(user_id)
-            msg_query += ' GROUP BY DATE(created_at) ORDER BY date'
-
-            msg_rows = conn.execute(msg_query, msg_params).fetchall()
-            msg_trend = [dict(row) for row in msg_rows]
-
-            conn.close()
+            since = self._since_day(days)
+            lead_trend = self.rollup.lead_trend(since, user_id) or []
+            msg_trend = self.rollup.message_trend(since, user_id) or []
 
             return {
                 'period_days': days,
@@ -188,17 +116,7 @@ class BusinessAnalytics:
         漏斗分析：awareness → interest → consideration → purchase
         """
         try:
-            conn = self._get_conn()
-
-            query = 'SELECT funnel_stage, COUNT(*) as count FROM unified_contacts'
-            params = []
-            if user_id:
-                query += ' WHERE user_id = ?'
-                params.append(user_id)
-            query += ' GROUP BY funnel_stage'
-
-            rows = conn.execute(query, params).fetchall()
-            stages = {row['funnel_stage']: row['count'] for row in rows}
+            stages = self.rollup.funnel_counts(user_id) or {}
 
             # 定義漏斗順序
             funnel_order = ['awareness', 'interest', 'consideration', 'purchase']
@@ -216,8 +134,6 @@ class BusinessAnalytics:
 
             total = sum(stages.values())
 
-            conn.close()
-
             return {
                 'funnel': funnel,
                 'total_contacts': total,
@@ -234,49 +150,18 @@ class BusinessAnalytics:
         儀表板摘要：一個端點返回所有關鍵指標
         """
         try:
-            conn = self._get_conn()
-
-            # 總線索數
-            q = 'SELECT COUNT(*) FROM unified_contacts'
-            p = []
-            if user_id:
-                q += ' WHERE user_id = ?'
-                p.append(user_id)
-            total_leads = conn.execute(q, p).fetchone()[0]
-
-            # 本週新增
-            week_ago = (datetime.now() - timedelta(days=7)).isoformat()
-            wq = 'SELECT COUNT(*) FROM unified_contacts WHERE created_at >= ?'
-            wp = [week_ago]
-            if user_id:
-                wq += ' AND user_id = ?'
-                wp.append(user_id)
-            new_this_week = conn.execute(wq, wp).fetchone()[0]
-
-            # 熱門線索
-            hq = "SELECT COUNT(*) FROM unified_contacts WHERE intent_level = 'hot'"
-            hp = []
-            if user_id:
-                hq += ' AND user_id = ?'
-                hp.append(user_id)
-            hot_leads = conn.execute(hq, hp).fetchone()[0]
+            all_time = self.rollup.lead_totals('', user_id) or {'total': 0, 'hot': 0}
+            this_week = self.rollup.lead_totals(self._since_day(7), user_id) or {'total': 0}
 
             # 消息統計（本週）
-            mq = 'SELECT COUNT(*) as total, SUM(CASE WHEN status = \'completed\' THEN 1 ELSE 0 END) as sent FROM message_queue WHERE created_at >= ?'
-            mp = [week_ago]
-            if user_id:
-                mq += ' AND user_id = ?'
-                mp.append(user_id)
-            msg_row = conn.execute(mq, mp).fetchone()
-            messages_total = msg_row[0] or 0
-            messages_sent = msg_row[1] or 0
-
-            conn.close()
+            msg_rows = self.rollup.messages_by_account(self._since_day(7), user_id) or []
+            messages_total = sum(r['total'] for r in msg_rows)
+            messages_sent = sum(r['sent'] for r in msg_rows)
 
             return {
-                'total_leads': total_leads,
-                'new_this_week': new_this_week,
-                'hot_leads': hot_leads,
+                'total_leads': all_time['total'],
+                'new_this_week': this_week['total'],
+                'hot_leads': all_time['hot'],
                 'messages_this_week': messages_total,
                 'messages_sent': messages_sent,
                 'send_success_rate': round(messages_sent / max(messages_total, 1) * 100, 1),
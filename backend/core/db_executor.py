@@ -0,0 +1,253 @@
+"""
+🆕 P18-20: 同步 SQLite 調用的後台執行池
+
+aiohttp 處理器 / 中間件中調用的同步 sqlite3 代碼統一放到這裡執行：
+1. 小型專用線程池（默認 4 個線程，DB_EXECUTOR_WORKERS 可調），不與 asyncio 默認池爭搶
+2. 每個工作線程按數據庫路徑持有長連接（WAL + 標準 PRAGMA），免去每次打開/關閉
+3. 保留調用方的 contextvars（租戶上下文在線程中仍然可見）
+4. 隊列深度、等待時間、執行時間統計，慢調用告警
+5. 回填 / 全量重評 / 增量去重等後台批量任務走獨立的 run_bulk_db 池（DB_BULK_WORKERS），
+   不佔用請求熱路徑（配額冷加載等）的工作線程
+
+用法:
+    from core.db_executor import run_db, run_bulk_db, db_connection
+
+    def _query(user_id):
+        with db_connection() as conn:   # 工作線程中複用長連接，其他線程中臨時連接
+            return conn.execute('SELECT ...', (user_id,)).fetchall()
+
+    rows = await run_db(_query, user_id)
+    await run_bulk_db(get_analytics_rollup().ensure)   # 後台批量任務
+"""
+
+import asyncio
+import contextvars
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from core.metrics import StreamingHistogram
+
+logger = logging.getLogger(__name__)
+
+DB_EXECUTOR_WORKERS = int(os.environ.get('DB_EXECUTOR_WORKERS', '4'))
+DB_BULK_WORKERS = int(os.environ.get('DB_BULK_WORKERS', '1'))
+SLOW_CALL_SECONDS = float(os.environ.get('DB_EXECUTOR_SLOW_SECONDS', '1.0'))
+MAX_CONNECTIONS_PER_THREAD = 8
+
+_THREAD_PREFIX = 'db-offload'
+_BULK_THREAD_PREFIX = 'db-bulk'
+
+
+class DBExecutor:
+    """數據庫卸載執行器"""
+
+    def __init__(self, max_workers: int = DB_EXECUTOR_WORKERS, name: str = _THREAD_PREFIX):
+        self.max_workers = max(1, max_workers)
+        self.name = name
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._local = threading.local()
+        self._connections: Dict[int, 'OrderedDict[str, sqlite3.Connection]'] = {}
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._started = 0
+        self._completed = 0
+        self._failed = 0
+        self._slow = 0
+        self._max_pending = 0
+        self._wait = StreamingHistogram()
+        self._run = StreamingHistogram()
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(
+                        max_workers=self.max_workers, thread_name_prefix=self.name,
+                        initializer=self._init_worker,
+                    )
+        return self._pool
+
+    def _init_worker(self):
+        self._local.worker = True
+
+    def in_worker(self) -> bool:
+        """當前線程是否為本執行器的工作線程"""
+        return getattr(self._local, 'worker', False)
+
+    # ==================== 連接 ====================
+
+    def thread_connection(self, db_path: str = None) -> sqlite3.Connection:
+        """工作線程的長連接（按路徑緩存，超過上限時關閉最久未用的）"""
+        from core.db_utils import create_connection, get_db_path
+        path = str(db_path or get_db_path())
+        conns = getattr(self._local, 'connections', None)
+        if conns is None:
+            conns = self._local.connections = OrderedDict()
+            with self._lock:
+                self._connections[threading.get_ident()] = conns
+        conn = conns.get(path)
+        if conn is None:
+            conn = create_connection(path)
+            conns[path] = conn
+            while len(conns) > MAX_CONNECTIONS_PER_THREAD:
+                _, old = conns.popitem(last=False)
+                old.close()
+        else:
+            conns.move_to_end(path)
+        return conn
+
+    @contextmanager
+    def connection(
+        self,
+        db_path: str = None,
+        factory: Optional[Callable[[], sqlite3.Connection]] = None,
+    ) -> Iterator[sqlite3.Connection]:
+        """
+        工作線程中返回長連接；未提交的事務在最外層退出時回滾（與關閉連接的語義一致）
+
+        非工作線程（腳本 / 測試 / 其他線程池）中退化為一次性連接，
+        由 factory（服務自己的連接方法）或 create_connection 創建，用完關閉。
+        """
+        if not self.in_worker():
+            if factory is not None:
+                conn = factory()
+            else:
+                from core.db_utils import create_connection
+                conn = create_connection(db_path)
+            try:
+                yield conn
+            finally:
+                conn.close()
+            return
+        conn = self.thread_connection(db_path)
+        depth = self._local.depth = getattr(self._local, 'depth', 0) + 1
+        try:
+            yield conn
+        finally:
+            self._local.depth = depth - 1
+            # 嵌套使用時只在最外層收尾
+            if depth == 1 and conn.in_transaction:
+                conn.rollback()
+
+    # ==================== 提交 ====================
+
+    def _call(self, submitted_at: float, fn: Callable, args, kwargs):
+        started = time.monotonic()
+        with self._lock:
+            self._started += 1
+            self._wait.add(started - submitted_at)
+        ok = False
+        try:
+            result = fn(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self._run.add(elapsed)
+                if ok:
+                    self._completed += 1
+                else:
+                    self._failed += 1
+                if elapsed >= SLOW_CALL_SECONDS:
+                    self._slow += 1
+            if elapsed >= SLOW_CALL_SECONDS:
+                logger.warning(f"[DBExecutor] Slow call {getattr(fn, '__qualname__', fn)}: {elapsed:.2f}s")
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """提交到線程池（同步調用方 / 無需等待結果時使用）"""
+        submitted_at = time.monotonic()
+        ctx = contextvars.copy_context()
+        with self._lock:
+            self._submitted += 1
+            self._max_pending = max(self._max_pending, self._submitted - self._started)
+        return self._get_pool().submit(ctx.run, self._call, submitted_at, fn, args, kwargs)
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """在線程池中執行 fn(*args, **kwargs) 並等待結果"""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    # ==================== 統計 / 關閉 ====================
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'failed': self._failed,
+                'slow_calls': self._slow,
+                'pending': self._submitted - self._started,
+                'running': self._started - self._completed - self._failed,
+                'max_pending': self._max_pending,
+                'connections': sum(len(c) for c in self._connections.values()),
+                'wait_ms': {k: round(v * 1000, 2) if k != 'count' else v for k, v in self._wait.stats().items()},
+                'run_ms': {k: round(v * 1000, 2) if k != 'count' else v for k, v in self._run.stats().items()},
+            }
+
+    def shutdown(self, wait: bool = True):
+        """關閉線程池和所有工作線程的連接"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait)
+        with self._lock:
+            for conns in self._connections.values():
+                for conn in conns.values():
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                conns.clear()
+            self._connections.clear()
+
+
+_db_executor: Optional[DBExecutor] = None
+_bulk_executor: Optional[DBExecutor] = None
+
+
+def get_db_executor() -> DBExecutor:
+    """獲取全局數據庫執行器"""
+    global _db_executor
+    if _db_executor is None:
+        _db_executor = DBExecutor()
+    return _db_executor
+
+
+def get_bulk_db_executor() -> DBExecutor:
+    """獲取後台批量任務的數據庫執行器"""
+    global _bulk_executor
+    if _bulk_executor is None:
+        _bulk_executor = DBExecutor(DB_BULK_WORKERS, _BULK_THREAD_PREFIX)
+    return _bulk_executor
+
+
+async def run_db(fn: Callable, *args, **kwargs) -> Any:
+    """在共享數據庫線程池中執行同步函數"""
+    return await get_db_executor().run(fn, *args, **kwargs)
+
+
+async def run_bulk_db(fn: Callable, *args, **kwargs) -> Any:
+    """在批量任務線程池中執行耗時的同步函數（回填、全量重評等）"""
+    return await get_bulk_db_executor().run(fn, *args, **kwargs)
+
+
+def db_connection(db_path: str = None, factory: Optional[Callable[[], sqlite3.Connection]] = None):
+    """獲取數據庫連接的上下文管理器（見 DBExecutor.connection），批量池的工作線程中使用其自身的長連接"""
+    if _bulk_executor is not None and _bulk_executor.in_worker():
+        return _bulk_executor.connection(db_path, factory)
+    return get_db_executor().connection(db_path, factory)
+
+
+def shutdown_db_executors(wait: bool = True):
+    """關閉所有數據庫執行器"""
+    get_db_executor().shutdown(wait)
+    if _bulk_executor is not None:
+        _bulk_executor.shutdown(wait)
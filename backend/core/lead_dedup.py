@@ -6,22 +6,207 @@
 2. 基於 username + first_name 的模糊去重
 3. 合併策略：保留最新數據 + 累加互動計數
 4. 批量去重掃描
+
+🆕 P18-12: 可擴展去重引擎
+- 規範化鍵（標準化電話 / username / 姓名指紋）預計算到帶索引的 contact_dedup_keys
+- 姓名模糊匹配：字符 3-gram MinHash + LSH 分桶（blocking），桶內再按 Jaccard 估計驗證
+- 增量掃描：unified_contacts 觸發器把變更行寫入 contact_dedup_queue，
+  每次只處理隊列中的行，重複對持久化在 contact_duplicate_pairs
+- run_continuous() 後台持續消費隊列，scan_duplicates() 只讀取已維護的重複對
 """
 
+import asyncio
 import logging
+import random
+import re
 import sqlite3
-from typing import Dict, Any, List, Tuple, Optional
+import threading
+import unicodedata
+import zlib
+from collections import defaultdict
+from typing import Dict, Any, List, Tuple, Optional, Iterable
 from dataclasses import dataclass
 
+from core.db_executor import run_bulk_db
+
 logger = logging.getLogger(__name__)
 
+# 規範化鍵
+_MIN_PHONE_DIGITS = 5
+_MIN_NAME_CHARS = 3
+
+# MinHash / LSH：32 個哈希分 8 個桶（每桶 4 行），相似度約 0.6 以上的姓名大概率同桶
+MINHASH_PERMUTATIONS = 32
+MINHASH_BANDS = 8
+NAME_SIMILARITY_THRESHOLD = 0.8
+
+# 單個分桶最多參與比較的行數（常見姓名 / 髒數據避免平方級爆炸）
+MAX_BLOCK_SIZE = 50
+SCAN_BATCH_SIZE = 500
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(0x1EAD)
+_HASH_PARAMS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(MINHASH_PERMUTATIONS)
+]
+
+# (鍵列, match_type, confidence)
+_EXACT_KEYS = (
+    ('phone_key', 'exact_phone', 0.95),
+    ('username_key', 'fuzzy_username', 0.9),
+)
+
+# 影響去重鍵的 unified_contacts 列
+_KEY_SOURCE_COLUMNS = ('username', 'phone', 'display_name', 'first_name', 'last_name')
+
+_SCHEMA_SQL = '''
+    CREATE TABLE IF NOT EXISTS contact_dedup_keys (
+        contact_id INTEGER PRIMARY KEY,
+        phone_key TEXT,
+        username_key TEXT,
+        name_key TEXT,
+        minhash TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_dedup_keys_phone
+        ON contact_dedup_keys(phone_key) WHERE phone_key IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS idx_dedup_keys_username
+        ON contact_dedup_keys(username_key) WHERE username_key IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS idx_dedup_keys_name
+        ON contact_dedup_keys(name_key) WHERE name_key IS NOT NULL;
+
+    CREATE TABLE IF NOT EXISTS contact_dedup_bands (
+        band TEXT NOT NULL,
+        contact_id INTEGER NOT NULL,
+        PRIMARY KEY (band, contact_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_dedup_bands_contact ON contact_dedup_bands(contact_id);
+
+    CREATE TABLE IF NOT EXISTS contact_dedup_queue (
+        contact_id INTEGER PRIMARY KEY
+    );
+
+    CREATE TABLE IF NOT EXISTS contact_duplicate_pairs (
+        contact_id INTEGER NOT NULL,
+        match_id INTEGER NOT NULL,
+        match_type TEXT NOT NULL,
+        confidence REAL NOT NULL,
+        PRIMARY KEY (contact_id, match_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_duplicate_pairs_match ON contact_duplicate_pairs(match_id);
+
+    CREATE TRIGGER IF NOT EXISTS trg_contact_dedup_insert
+    AFTER INSERT ON unified_contacts
+    BEGIN
+        INSERT OR IGNORE INTO contact_dedup_queue (contact_id) VALUES (NEW.id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_contact_dedup_delete
+    AFTER DELETE ON unified_contacts
+    BEGIN
+        DELETE FROM contact_dedup_keys WHERE contact_id = OLD.id;
+        DELETE FROM contact_dedup_bands WHERE contact_id = OLD.id;
+        DELETE FROM contact_dedup_queue WHERE contact_id = OLD.id;
+        DELETE FROM contact_duplicate_pairs WHERE contact_id = OLD.id OR match_id = OLD.id;
+    END;
+'''
+
+
+# ==================== 規範化 ====================
+
+def normalize_phone(phone: Optional[str]) -> Optional[str]:
+    """只保留數字，去掉國際前綴 00；過短的號碼不參與匹配"""
+    if not phone:
+        return None
+    digits = re.sub(r'\D', '', str(phone))
+    if digits.startswith('00'):
+        digits = digits[2:]
+    return digits if len(digits) >= _MIN_PHONE_DIGITS else None
+
+
+def normalize_username(username: Optional[str]) -> Optional[str]:
+    """去掉 @ / t.me 前綴並轉小寫"""
+    if not username:
+        return None
+    value = str(username).strip().lower()
+    value = re.sub(r'^(https?://)?(www\.)?t\.me/', '', value).lstrip('@').strip('/')
+    return value or None
+
+
+def name_fingerprint(name: Optional[str]) -> Optional[str]:
+    """姓名指紋：NFKC + casefold，去標點，詞序無關（"Smith John" == "john smith"）"""
+    if not name:
+        return None
+    text = unicodedata.normalize('NFKC', str(name)).casefold()
+    tokens = sorted(t for t in re.split(r'[\W_]+', text) if t)
+    fingerprint = ' '.join(tokens)
+    return fingerprint if len(fingerprint.replace(' ', '')) >= _MIN_NAME_CHARS else None
+
+
+def name_shingles(fingerprint: str, k: int = 3) -> set:
+    padded = f' {fingerprint} '
+    if len(padded) <= k:
+        return {padded}
+    return {padded[i:i + k] for i in range(len(padded) - k + 1)}
+
+
+def minhash_signature(shingles: Iterable[str]) -> Tuple[int, ...]:
+    hashes = [zlib.crc32(s.encode('utf-8')) for s in shingles]
+    return tuple(
+        min((a * h + b) % _MERSENNE_PRIME for h in hashes)
+        for a, b in _HASH_PARAMS
+    )
+
+
+def minhash_similarity(sig_a: Tuple[int, ...], sig_b: Tuple[int, ...]) -> float:
+    """MinHash 對 Jaccard 相似度的估計"""
+    if not sig_a or len(sig_a) != len(sig_b):
+        return 0.0
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / len(sig_a)
+
+
+def lsh_bands(signature: Tuple[int, ...]) -> List[str]:
+    rows = len(signature) // MINHASH_BANDS
+    return [
+        f"{b}:{zlib.crc32(repr(signature[b * rows:(b + 1) * rows]).encode()):08x}"
+        for b in range(MINHASH_BANDS)
+    ]
+
+
+def _encode_signature(signature: Tuple[int, ...]) -> str:
+    return ','.join(map(str, signature))
+
+
+def _decode_signature(value: Optional[str]) -> Tuple[int, ...]:
+    return tuple(int(v) for v in value.split(',')) if value else ()
+
+
+def compute_dedup_keys(row: Dict[str, Any]) -> Dict[str, Any]:
+    """從一行聯繫人數據計算規範化鍵 + MinHash 簽名"""
+    name = row.get('display_name') or ' '.join(
+        p for p in (row.get('first_name'), row.get('last_name')) if p
+    )
+    fingerprint = name_fingerprint(name)
+    signature = minhash_signature(name_shingles(fingerprint)) if fingerprint else ()
+    return {
+        'phone_key': normalize_phone(row.get('phone')),
+        'username_key': normalize_username(row.get('username')),
+        'name_key': fingerprint,
+        'signature': signature,
+    }
+
+
+def _placeholders(values) -> str:
+    return ','.join('?' * len(values))
+
 
 @dataclass
 class DuplicateGroup:
     """重複線索組"""
     primary_id: int
     duplicate_ids: List[int]
-    match_type: str  # exact_telegram_id, fuzzy_username
+    match_type: str  # exact_telegram_id, fuzzy_username, exact_phone, fuzzy_name
     confidence: float  # 0-1
     details: Dict[str, Any]
 
@@ -40,86 +225,293 @@ class LeadDeduplicationService:
 
     def __init__(self, db_path: str = None):
         self.db_path = db_path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+        self._schema_ready = False
 
     def _get_conn(self) -> sqlite3.Connection:
-        if self.db_path:
-            conn = sqlite3.connect(self.db_path)
-        else:
-            from core.db_utils import get_connection
-            conn = get_connection().__enter__()
-        conn.row_factory = sqlite3.Row
-        return conn
+        """共享長連接（懶加載；跨線程訪問由 _lock 串行化）"""
+        if self._conn is None:
+            path = self.db_path
+            if not path:
+                from core.db_utils import get_db_path
+                path = get_db_path()
+            conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+                self._schema_ready = False
+
+    # ==================== 鍵表 / 觸發器 ====================
+
+    def _ensure_schema(self, conn: sqlite3.Connection):
+        """創建鍵表、分桶表、變更隊列及觸發器；把尚未建鍵的行補入隊列"""
+        if self._schema_ready:
+            return
+        conn.executescript(_SCHEMA_SQL)
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(unified_contacts)')}
+        watched = ', '.join(c for c in _KEY_SOURCE_COLUMNS if c in columns)
+        if watched:
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_contact_dedup_update
+                AFTER UPDATE OF {watched} ON unified_contacts
+                BEGIN
+                    INSERT OR IGNORE INTO contact_dedup_queue (contact_id) VALUES (NEW.id);
+                END
+            ''')
+        # 觸發器創建之前已存在的行
+        conn.execute('''
+            INSERT OR IGNORE INTO contact_dedup_queue (contact_id)
+            SELECT c.id FROM unified_contacts c
+            LEFT JOIN contact_dedup_keys k ON k.contact_id = c.id
+            WHERE k.contact_id IS NULL
+        ''')
+        conn.commit()
+        self._schema_ready = True
+
+    # ==================== 增量掃描 ====================
+
+    def scan_incremental(self, batch_size: int = SCAN_BATCH_SIZE, max_batches: Optional[int] = None) -> Dict[str, Any]:
+        """
+        消費變更隊列：重算變更行的鍵和分桶，並只為這些行重新查找重複對
+
+        每批一個事務；返回 {'processed', 'pairs', 'pending'}
+        """
+        processed = 0
+        pairs = 0
+        batches = 0
+        with self._lock:
+            conn = self._get_conn()
+            self._ensure_schema(conn)
+            while max_batches is None or batches < max_batches:
+                ids = [row[0] for row in conn.execute(
+                    'SELECT contact_id FROM contact_dedup_queue ORDER BY contact_id LIMIT ?', (batch_size,)
+                )]
+                if not ids:
+                    break
+                try:
+                    pairs += self._process_batch(conn, ids)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                processed += len(ids)
+                batches += 1
+            pending = conn.execute('SELECT COUNT(*) FROM contact_dedup_queue').fetchone()[0]
+        if processed:
+            logger.debug(f"Lead dedup scanned {processed} changed contacts, {pairs} duplicate pairs")
+        return {'processed': processed, 'pairs': pairs, 'pending': pending}
+
+    def _process_batch(self, conn: sqlite3.Connection, ids: List[int]) -> int:
+        ph = _placeholders(ids)
+        rows = conn.execute(f'SELECT * FROM unified_contacts WHERE id IN ({ph})', ids).fetchall()
+
+        key_params = []
+        band_params = []
+        for row in rows:
+            keys = compute_dedup_keys(dict(row))
+            key_params.append((
+                row['id'], keys['phone_key'], keys['username_key'], keys['name_key'],
+                _encode_signature(keys['signature']) or None,
+            ))
+            if keys['signature']:
+                band_params.extend((band, row['id']) for band in lsh_bands(keys['signature']))
+
+        # 舊鍵 / 舊重複對作廢（已刪除的行也一併清理）
+        conn.execute(f'DELETE FROM contact_dedup_keys WHERE contact_id IN ({ph})', ids)
+        conn.execute(f'DELETE FROM contact_dedup_bands WHERE contact_id IN ({ph})', ids)
+        conn.execute(
+            f'DELETE FROM contact_duplicate_pairs WHERE contact_id IN ({ph}) OR match_id IN ({ph})', ids + ids
+        )
+        conn.executemany('''
+            INSERT INTO contact_dedup_keys (contact_id, phone_key, username_key, name_key, minhash)
+            VALUES (?, ?, ?, ?, ?)
+        ''', key_params)
+        conn.executemany('INSERT OR IGNORE INTO contact_dedup_bands (band, contact_id) VALUES (?, ?)', band_params)
+
+        found = self._find_pairs(conn, [p[0] for p in key_params])
+        conn.executemany('''
+            INSERT INTO contact_duplicate_pairs (contact_id, match_id, match_type, confidence)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(contact_id, match_id) DO UPDATE SET
+                match_type = excluded.match_type, confidence = excluded.confidence
+            WHERE excluded.confidence > contact_duplicate_pairs.confidence
+        ''', [(a, b, match_type, confidence) for (a, b), (match_type, confidence) in found.items()])
+        conn.execute(f'DELETE FROM contact_dedup_queue WHERE contact_id IN ({ph})', ids)
+        return len(found)
+
+    def _find_pairs(self, conn: sqlite3.Connection, ids: List[int]) -> Dict[Tuple[int, int], Tuple[str, float]]:
+        """為變更行查找候選：精確鍵走索引，姓名走 LSH 分桶 + MinHash 驗證"""
+        pairs: Dict[Tuple[int, int], Tuple[str, float]] = {}
+        if not ids:
+            return pairs
+
+        def keep(a: int, b: int, match_type: str, confidence: float):
+            key = (a, b) if a < b else (b, a)
+            if key not in pairs or confidence > pairs[key][1]:
+                pairs[key] = (match_type, confidence)
+
+        ph = _placeholders(ids)
+        for column, match_type, confidence in _EXACT_KEYS:
+            # 每個變更行只與同鍵中 id 最小的 MAX_BLOCK_SIZE 行配對，連通分量不變
+            rows = conn.execute(f'''
+                SELECT a.contact_id AS a, b.contact_id AS b
+                FROM contact_dedup_keys a
+                JOIN (
+                    SELECT contact_id, {column},
+                           ROW_NUMBER() OVER (PARTITION BY {column} ORDER BY contact_id) AS rn
+                    FROM contact_dedup_keys
+                    WHERE {column} IN (
+                        SELECT {column} FROM contact_dedup_keys
+                        WHERE contact_id IN ({ph}) AND {column} IS NOT NULL
+                    )
+                ) b ON b.{column} = a.{column} AND b.contact_id != a.contact_id AND b.rn <= ?
+                WHERE a.contact_id IN ({ph})
+            ''', ids + [MAX_BLOCK_SIZE] + ids)
+            for row in rows:
+                keep(row['a'], row['b'], match_type, confidence)
+
+        bands = conn.execute(f'''
+            SELECT b.band, b.contact_id FROM (
+                SELECT band, contact_id,
+                       ROW_NUMBER() OVER (PARTITION BY band ORDER BY contact_id) AS rn
+                FROM contact_dedup_bands
+                WHERE band IN (SELECT band FROM contact_dedup_bands WHERE contact_id IN ({ph}))
+            ) b WHERE b.rn <= ?
+        ''', ids + [MAX_BLOCK_SIZE]).fetchall()
+        members = defaultdict(set)
+        for row in bands:
+            members[row['band']].add(row['contact_id'])
+
+        changed = set(ids)
+        candidates: Dict[int, set] = defaultdict(set)
+        for block in members.values():
+            for contact_id in block & changed:
+                candidates[contact_id] |= block - {contact_id}
+        if not candidates:
+            return pairs
+
+        needed = list(set(candidates) | set().union(*candidates.values()))
+        signatures: Dict[int, Tuple[int, ...]] = {}
+        for start in range(0, len(needed), SCAN_BATCH_SIZE):
+            chunk = needed[start:start + SCAN_BATCH_SIZE]
+            for row in conn.execute(
+                f'SELECT contact_id, minhash FROM contact_dedup_keys WHERE contact_id IN ({_placeholders(chunk)})',
+                chunk
+            ):
+                signatures[row['contact_id']] = _decode_signature(row['minhash'])
+
+        for contact_id, others in candidates.items():
+            signature = signatures.get(contact_id)
+            for other in others:
+                similarity = minhash_similarity(signature, signatures.get(other, ()))
+                if similarity >= NAME_SIMILARITY_THRESHOLD:
+                    keep(contact_id, other, 'fuzzy_name', round(0.8 * similarity, 3))
+        return pairs
+
+    async def run_continuous(self, interval: float = 60.0, stop_event: Optional[asyncio.Event] = None):
+        """後台持續消費變更隊列（在數據庫線程池中執行，不阻塞事件循環）"""
+        while not (stop_event and stop_event.is_set()):
+            try:
+                stats = await run_bulk_db(self.scan_incremental)
+                if stats['processed']:
+                    logger.info(
+                        f"Lead dedup: {stats['processed']} contacts rescanned, "
+                        f"{stats['pairs']} duplicate pairs, {stats['pending']} pending"
+                    )
+                if stats['pending']:
+                    continue
+            except Exception as e:
+                logger.error(f"Continuous dedup error: {e}")
+            await asyncio.sleep(interval)
+
+    # ==================== 查詢 / 合併 ====================
 
     def scan_duplicates(self, limit: int = 100) -> List[DuplicateGroup]:
         """
         掃描重複線索
 
+        先增量處理變更隊列，再從 contact_duplicate_pairs 按匹配類型聚合連通分量
+
         Returns:
             重複組列表
         """
         groups = []
 
         try:
-            conn = self._get_conn()
-
-            # 1. 精確重複：相同 telegram_id 出現多次（理論上不應該，因為 UNIQUE）
-            # 但舊數據可能在 extracted_members 和 unified_contacts 都有
-
-            # 2. 模糊重複：相同 username（忽略大小寫）
-            rows = conn.execute('''
-                SELECT LOWER(username) as norm_username, GROUP_CONCAT(id) as ids, COUNT(*) as cnt
-                FROM unified_contacts
-                WHERE username IS NOT NULL AND username != ''
-                GROUP BY LOWER(username)
-                HAVING COUNT(*) > 1
-                ORDER BY cnt DESC
-                LIMIT ?
-            ''', (limit,)).fetchall()
-
-            for row in rows:
-                ids = [int(i) for i in row['ids'].split(',')]
-                groups.append(DuplicateGroup(
-                    primary_id=ids[0],
-                    duplicate_ids=ids[1:],
-                    match_type='fuzzy_username',
-                    confidence=0.9,
-                    details={
-                        'username': row['norm_username'],
-                        'count': row['cnt'],
-                    }
-                ))
-
-            # 3. 模糊重複：相同 phone
-            rows = conn.execute('''
-                SELECT phone, GROUP_CONCAT(id) as ids, COUNT(*) as cnt
-                FROM unified_contacts
-                WHERE phone IS NOT NULL AND phone != ''
-                GROUP BY phone
-                HAVING COUNT(*) > 1
-                ORDER BY cnt DESC
-                LIMIT ?
-            ''', (limit,)).fetchall()
-
-            for row in rows:
-                ids = [int(i) for i in row['ids'].split(',')]
-                groups.append(DuplicateGroup(
-                    primary_id=ids[0],
-                    duplicate_ids=ids[1:],
-                    match_type='exact_phone',
-                    confidence=0.95,
-                    details={
-                        'phone': row['phone'],
-                        'count': row['cnt'],
-                    }
-                ))
-
-            conn.close()
+            self.scan_incremental()
+            with self._lock:
+                conn = self._get_conn()
+                rows = conn.execute(
+                    'SELECT contact_id, match_id, match_type, confidence FROM contact_duplicate_pairs'
+                ).fetchall()
+
+                by_type: Dict[str, List[sqlite3.Row]] = defaultdict(list)
+                for row in rows:
+                    by_type[row['match_type']].append(row)
+
+                for match_type in ('fuzzy_username', 'exact_phone', 'fuzzy_name'):
+                    components = self._components(by_type.get(match_type, []))
+                    components.sort(key=lambda c: (-len(c[0]), min(c[0])))
+                    for ids, confidence in components[:limit]:
+                        ids = sorted(ids)
+                        groups.append(DuplicateGroup(
+                            primary_id=ids[0],
+                            duplicate_ids=ids[1:],
+                            match_type=match_type,
+                            confidence=confidence,
+                            details=self._group_details(conn, match_type, ids),
+                        ))
 
         except Exception as e:
             logger.error(f"Duplicate scan error: {e}")
 
         return groups
 
+    @staticmethod
+    def _components(pair_rows: List[sqlite3.Row]) -> List[Tuple[set, float]]:
+        """並查集聚合重複對；組置信度取組內最低值"""
+        parent: Dict[int, int] = {}
+
+        def find(x: int) -> int:
+            parent.setdefault(x, x)
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        for row in pair_rows:
+            ra, rb = find(row['contact_id']), find(row['match_id'])
+            if ra != rb:
+                parent[max(ra, rb)] = min(ra, rb)
+
+        members: Dict[int, set] = defaultdict(set)
+        confidence: Dict[int, float] = {}
+        for row in pair_rows:
+            root = find(row['contact_id'])
+            members[root].update((row['contact_id'], row['match_id']))
+            confidence[root] = min(confidence.get(root, 1.0), row['confidence'])
+        return [(ids, confidence[root]) for root, ids in members.items()]
+
+    @staticmethod
+    def _group_details(conn: sqlite3.Connection, match_type: str, ids: List[int]) -> Dict[str, Any]:
+        column, label = {
+            'fuzzy_username': ('username_key', 'username'),
+            'exact_phone': ('phone_key', 'phone'),
+            'fuzzy_name': ('name_key', 'name'),
+        }[match_type]
+        row = conn.execute(
+            f'SELECT {column} FROM contact_dedup_keys WHERE contact_id = ?', (ids[0],)
+        ).fetchone()
+        return {label: row[0] if row else None, 'count': len(ids)}
+
     def merge_duplicates(self, primary_id: int, duplicate_ids: List[int]) -> Dict[str, Any]:
         """
         合併重複線索
@@ -134,122 +526,138 @@ class LeadDeduplicationService:
         if not duplicate_ids:
             return {'merged': 0, 'kept': primary_id}
 
-        try:
+        with self._lock:
             conn = self._get_conn()
+            try:
+                # 獲取所有相關記錄
+                all_ids = [primary_id] + duplicate_ids
+                placeholders = ','.join('?' * len(all_ids))
+                rows = conn.execute(
+                    f'SELECT * FROM unified_contacts WHERE id IN ({placeholders})',
+                    all_ids
+                ).fetchall()
+
+                if not rows:
+                    return {'error': 'Records not found'}
+
+                # 構建合併數據
+                merged_data = {}
+                total_messages = 0
+                total_interactions = 0
+                all_tags = set()
+
+                for row in rows:
+                    row_dict = dict(row)
+                    # 取最新的非空值
+                    for field in ('display_name', 'first_name', 'last_name', 'bio', 'phone'):
+                        if row_dict.get(field) and not merged_data.get(field):
+                            merged_data[field] = row_dict[field]
+
+                    # 累加計數（安全處理可能不存在的列）
+                    total_messages += (row_dict.get('message_count') or 0)
+                    if 'interactions_count' in row_dict:
+                        total_interactions += (row_dict.get('interactions_count') or 0)
+
+                    # 合併標籤
+                    tags_str = row_dict.get('tags') or ''
+                    if tags_str:
+                        for tag in tags_str.split(','):
+                            tag = tag.strip()
+                            if tag:
+                                all_tags.add(tag)
+
+                # 更新 primary 記錄
+                update_fields = []
+                update_values = []
+                for field, value in merged_data.items():
+                    update_fields.append(f"{field} = COALESCE(?, {field})")
+                    update_values.append(value)
+
+                update_fields.append("message_count = ?")
+                update_values.append(total_messages)
+
+                # interactions_count 列可能不存在（舊版本 schema）
+                try:
+                    conn.execute('SELECT interactions_count FROM unified_contacts LIMIT 0')
+                    update_fields.append("interactions_count = ?")
+                    update_values.append(total_interactions)
+                except sqlite3.OperationalError:
+                    pass  # 列不存在，跳過
+
+                if all_tags:
+                    update_fields.append("tags = ?")
+                    update_values.append(','.join(sorted(all_tags)))
+
+                update_fields.append("updated_at = CURRENT_TIMESTAMP")
+                update_values.append(primary_id)
+
+                conn.execute(
+                    f"UPDATE unified_contacts SET {', '.join(update_fields)} WHERE id = ?",
+                    update_values
+                )
 
-            # 獲取所有相關記錄
-            all_ids = [primary_id] + duplicate_ids
-            placeholders = ','.join('?' * len(all_ids))
-            rows = conn.execute(
-                f'SELECT * FROM unified_contacts WHERE id IN ({placeholders})',
-                all_ids
-            ).fetchall()
-
-            if not rows:
-                return {'error': 'Records not found'}
+                # 刪除重複記錄（觸發器同步清理鍵表和重複對）
+                dup_placeholders = ','.join('?' * len(duplicate_ids))
+                conn.execute(
+                    f"DELETE FROM unified_contacts WHERE id IN ({dup_placeholders})",
+                    duplicate_ids
+                )
 
-            # 構建合併數據
-            merged_data = {}
-            total_messages = 0
-            total_interactions = 0
-            all_tags = set()
+                conn.commit()
 
-            for row in rows:
-                row_dict = dict(row)
-                # 取最新的非空值
-                for field in ('display_name', 'first_name', 'last_name', 'bio', 'phone'):
-                    if row_dict.get(field) and not merged_data.get(field):
-                        merged_data[field] = row_dict[field]
-
-                # 累加計數（安全處理可能不存在的列）
-                total_messages += (row_dict.get('message_count') or 0)
-                if 'interactions_count' in row_dict:
-                    total_interactions += (row_dict.get('interactions_count') or 0)
-
-                # 合併標籤
-                tags_str = row_dict.get('tags') or ''
-                if tags_str:
-                    for tag in tags_str.split(','):
-                        tag = tag.strip()
-                        if tag:
-                            all_tags.add(tag)
-
-            # 更新 primary 記錄
-            update_fields = []
-            update_values = []
-            for field, value in merged_data.items():
-                update_fields.append(f"{field} = COALESCE(?, {field})")
-                update_values.append(value)
-
-            update_fields.append("message_count = ?")
-            update_values.append(total_messages)
-
-            # interactions_count 列可能不存在（舊版本 schema）
-            try:
-                conn.execute('SELECT interactions_count FROM unified_contacts LIMIT 0')
-                update_fields.append("interactions_count = ?")
-                update_values.append(total_interactions)
-            except sqlite3.OperationalError:
-                pass  # 列不存在，跳過
-
-            if all_tags:
-                update_fields.append("tags = ?")
-                update_values.append(','.join(sorted(all_tags)))
-
-            update_fields.append("updated_at = CURRENT_TIMESTAMP")
-            update_values.append(primary_id)
-
-            conn.execute(
-                f"UPDATE unified_contacts SET {', '.join(update_fields)} WHERE id = ?",
-                update_values
-            )
-
-            # 刪除重複記錄
-            dup_placeholders = ','.join('?' * len(duplicate_ids))
-            conn.execute(
-                f"DELETE FROM unified_contacts WHERE id IN ({dup_placeholders})",
-                duplicate_ids
-            )
-
-            conn.commit()
-            conn.close()
+                return {
+                    'merged': len(duplicate_ids),
+                    'kept': primary_id,
+                    'total_messages': total_messages,
+                    'tags': list(all_tags),
+                }
 
-            return {
-                'merged': len(duplicate_ids),
-                'kept': primary_id,
-                'total_messages': total_messages,
-                'tags': list(all_tags),
-            }
-
-        except Exception as e:
-            logger.error(f"Merge error: {e}")
-            return {'error': str(e)}
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Merge error: {e}")
+                return {'error': str(e)}
 
     def get_dedup_stats(self) -> Dict[str, Any]:
-        """獲取去重統計"""
+        """獲取去重統計（基於索引鍵表，不再對全表 GROUP BY LOWER(username)）"""
         try:
-            conn = self._get_conn()
-            total = conn.execute('SELECT COUNT(*) FROM unified_contacts').fetchone()[0]
-            with_username = conn.execute(
-                "SELECT COUNT(*) FROM unified_contacts WHERE username IS NOT NULL AND username != ''"
-            ).fetchone()[0]
-
-            # 重複 username 計數
-            dup_username = conn.execute('''
-                SELECT COUNT(*) FROM (
-                    SELECT LOWER(username) FROM unified_contacts
-                    WHERE username IS NOT NULL AND username != ''
-                    GROUP BY LOWER(username) HAVING COUNT(*) > 1
-                )
-            ''').fetchone()[0]
-
-            conn.close()
+            self.scan_incremental()
+            with self._lock:
+                conn = self._get_conn()
+                total = conn.execute('SELECT COUNT(*) FROM unified_contacts').fetchone()[0]
+                with_username = conn.execute(
+                    "SELECT COUNT(*) FROM contact_dedup_keys WHERE username_key IS NOT NULL"
+                ).fetchone()[0]
+
+                # 重複 username 計數（走 idx_dedup_keys_username）
+                dup_username = conn.execute('''
+                    SELECT COUNT(*) FROM (
+                        SELECT username_key FROM contact_dedup_keys
+                        WHERE username_key IS NOT NULL
+                        GROUP BY username_key HAVING COUNT(*) > 1
+                    )
+                ''').fetchone()[0]
+                pairs = conn.execute('SELECT COUNT(*) FROM contact_duplicate_pairs').fetchone()[0]
+                pending = conn.execute('SELECT COUNT(*) FROM contact_dedup_queue').fetchone()[0]
 
             return {
                 'total_contacts': total,
                 'with_username': with_username,
                 'duplicate_username_groups': dup_username,
                 'estimated_duplicates': dup_username * 2,  # 粗略估計
+                'duplicate_pairs': pairs,
+                'pending_scan': pending,
             }
         except Exception as e:
             return {'error': str(e)}
+
+
+# 全局實例
+_dedup_service: Optional[LeadDeduplicationService] = None
+
+
+def get_lead_dedup_service() -> LeadDeduplicationService:
+    """獲取全局去重服務實例（共享連接與鍵表狀態）"""
+    global _dedup_service
+    if _dedup_service is None:
+        _dedup_service = LeadDeduplicationService()
+    return _dedup_service
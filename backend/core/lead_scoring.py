@@ -12,13 +12,29 @@
 
 總分 0-100 → 自動映射意向等級：
   hot(>75) / warm(50-75) / neutral(25-50) / cold(<25)
+
+🆕 P18-19: 列式批量評分
+  每條規則對應一個 SQL 謂詞表達式，一次查詢得到 (行 × 規則) 0/1 矩陣，
+  再用 NumPy 矩陣乘法按分類匯總；只回寫分數有變化的行。
+  unified_contacts 上的觸發器把評分輸入列有變更的聯繫人寫入 lead_score_queue，
+  增量重評只處理隊列中的行和跨過時效窗口的行。
 """
 
+import hashlib
+import json
 import logging
+import sqlite3
 import time
-from typing import Dict, Any, List, Optional, Tuple
+from datetime import datetime, timedelta
+from typing import Dict, Any, Callable, List, Optional, Sequence, Tuple
 from dataclasses import dataclass, field
 
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
 logger = logging.getLogger(__name__)
 
 
@@ -66,6 +82,156 @@ DEFAULT_RULES: List[Dict[str, Any]] = [
 ]
 
 
+_TRUE_FLAGS = (True, 1, '1', 'true')
+
+CATEGORIES = ('profile', 'engagement', 'intent', 'quality', 'recency')
+CATEGORY_CAPS = {'profile': 20, 'engagement': 25, 'intent': 30, 'quality': 15, 'recency': 10}
+
+# 時效規則：(字段, 時間列候選, 窗口)
+RECENCY_WINDOWS = {
+    'recent_online': (('last_seen', 'last_online'), timedelta(days=7)),
+    'recent_capture': (('created_at', 'captured_at'), timedelta(days=14)),
+}
+
+SCORE_CHUNK_SIZE = 5000
+
+
+# ==================== 單條規則謂詞 ====================
+
+def _is_recent(lead: Dict[str, Any], rule: str) -> bool:
+    (primary, fallback), window = RECENCY_WINDOWS[rule]
+    value = lead.get(primary) or lead.get(fallback, '')
+    if not value:
+        return False
+    try:
+        dt = datetime.fromisoformat(value.replace('Z', '+00:00')) if isinstance(value, str) else value
+        return (datetime.now(dt.tzinfo) if dt.tzinfo else datetime.now()) - dt < window
+    except Exception:
+        return False
+
+
+def _multi_keyword(lead: Dict[str, Any]) -> bool:
+    kw = lead.get('matched_keywords', '')
+    if isinstance(kw, str) and kw.startswith('['):
+        try:
+            return len(json.loads(kw)) > 1
+        except Exception:
+            return False
+    return False
+
+
+def _keyword_match(lead: Dict[str, Any]) -> bool:
+    kw = lead.get('matched_keywords') or lead.get('triggered_keyword', '')
+    return bool(kw and kw != '[]' and kw != 'null')
+
+
+RULE_PREDICATES: Dict[str, Callable[[Dict[str, Any]], bool]] = {
+    'has_username':     lambda l: bool(l.get('username') or l.get('telegram_username')),
+    'has_display_name': lambda l: bool(l.get('display_name') or l.get('first_name')),
+    'has_phone':        lambda l: bool(l.get('phone')),
+    'has_bio':          lambda l: bool(l.get('bio')),
+    'has_photo':        lambda l: l.get('has_photo', False) in _TRUE_FLAGS,
+    'is_premium':       lambda l: l.get('is_premium', False) in _TRUE_FLAGS,
+    'has_messages':     lambda l: (l.get('message_count', 0) or 0) > 0,
+    'high_interaction': lambda l: (l.get('interactions_count', 0) or 0) > 5,
+    'has_response':     lambda l: (l.get('messages_received', 0) or 0) > 0,
+    'keyword_match':    _keyword_match,
+    'multi_keyword':    _multi_keyword,
+    'in_target_group':  lambda l: bool(l.get('source_group_id') or l.get('source_group_title')),
+    'not_bot':          lambda l: l.get('is_bot', False) not in _TRUE_FLAGS,
+    'low_risk':         lambda l: float(l.get('ad_risk_score', 0) or 0) < 0.3,
+    'verified':         lambda l: l.get('is_verified', False) in _TRUE_FLAGS,
+    'mature_account':   lambda l: int(l.get('account_age_days', 0) or 0) > 30,
+    'recent_online':    lambda l: _is_recent(l, 'recent_online'),
+    'recent_capture':   lambda l: _is_recent(l, 'recent_capture'),
+}
+
+
+# ==================== 規則的 SQL 謂詞 ====================
+
+def _truthy(expr: str) -> str:
+    """Python bool() 語義：NULL / 空串 / 0 為假"""
+    return f"(COALESCE({expr}, '') NOT IN ('', 0))"
+
+
+def _flag(expr: str) -> str:
+    return f"(COALESCE({expr}, 0) IN (1, '1', 'true'))"
+
+
+def _first_truthy(primary: str, fallback: str) -> str:
+    """Python `a or b` 語義"""
+    return f"(CASE WHEN {_truthy(primary)} THEN {primary} ELSE {fallback} END)"
+
+
+def rule_sql_expressions(columns: Sequence[str]) -> Dict[str, str]:
+    """
+    生成每條規則對應的 SQL 謂詞（結果為 0/1）
+
+    不存在的列按 NULL 處理，與字典缺鍵時 lead.get() 的行為一致。
+    時效規則以 UTC 的 'now' 為基準（數據庫時間戳均為 UTC）。
+    """
+    present = set(columns)
+
+    def c(name: str) -> str:
+        return name if name in present else 'NULL'
+
+    keywords = c('matched_keywords')
+    expressions = {
+        'has_username':     f"({_truthy(c('username'))} OR {_truthy(c('telegram_username'))})",
+        'has_display_name': f"({_truthy(c('display_name'))} OR {_truthy(c('first_name'))})",
+        'has_phone':        _truthy(c('phone')),
+        'has_bio':          _truthy(c('bio')),
+        'has_photo':        _flag(c('has_photo')),
+        'is_premium':       _flag(c('is_premium')),
+        'has_messages':     f"(COALESCE({c('message_count')}, 0) > 0)",
+        'high_interaction': f"(COALESCE({c('interactions_count')}, 0) > 5)",
+        'has_response':     f"(COALESCE({c('messages_received')}, 0) > 0)",
+        'keyword_match':    f"(COALESCE({_first_truthy(keywords, c('triggered_keyword'))}, '') NOT IN ('', 0, '[]', 'null'))",
+        'multi_keyword':    (f"(CASE WHEN substr({keywords}, 1, 1) = '[' AND json_valid({keywords}) "
+                             f"THEN json_array_length({keywords}) > 1 ELSE 0 END)"),
+        'in_target_group':  f"({_truthy(c('source_group_id'))} OR {_truthy(c('source_group_title'))})",
+        'not_bot':          f"(COALESCE({c('is_bot')}, 0) NOT IN (1, '1', 'true'))",
+        'low_risk':         f"(COALESCE(NULLIF({c('ad_risk_score')}, ''), 0) < 0.3)",
+        'verified':         _flag(c('is_verified')),
+        'mature_account':   f"(CAST(COALESCE({c('account_age_days')}, 0) AS INTEGER) > 30)",
+    }
+    for rule, ((primary, fallback), window) in RECENCY_WINDOWS.items():
+        expressions[rule] = (
+            f"(julianday({_first_truthy(c(primary), c(fallback))}) "
+            f"> julianday('now') - {window.days})"
+        )
+    return {name: f"COALESCE({expr}, 0)" for name, expr in expressions.items()}
+
+
+# 影響評分的 unified_contacts 列（變更時觸發重評）
+SCORE_SOURCE_COLUMNS = (
+    'username', 'telegram_username', 'display_name', 'first_name', 'phone', 'bio',
+    'has_photo', 'is_premium', 'message_count', 'interactions_count', 'messages_received',
+    'matched_keywords', 'triggered_keyword', 'source_group_id', 'source_group_title',
+    'is_bot', 'ad_risk_score', 'is_verified', 'account_age_days',
+    'last_seen', 'last_online', 'created_at', 'captured_at',
+)
+
+# 回寫的評分列（順序與 _score_tuple 一致）
+SCORE_COLUMNS = ('lead_score', 'intent_level', 'value_level', 'intent_score', 'quality_score', 'activity_score')
+
+_SCHEMA_SQL = '''
+    CREATE TABLE IF NOT EXISTS lead_score_queue (
+        contact_id INTEGER PRIMARY KEY
+    );
+    CREATE TABLE IF NOT EXISTS lead_score_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        rules_hash TEXT,
+        last_run TEXT
+    );
+    CREATE TRIGGER IF NOT EXISTS trg_lead_score_insert
+    AFTER INSERT ON unified_contacts
+    BEGIN
+        INSERT OR IGNORE INTO lead_score_queue (contact_id) VALUES (NEW.id);
+    END;
+'''
+
+
 class LeadScoringEngine:
     """線索評分引擎"""
 
@@ -84,6 +250,18 @@ class LeadScoringEngine:
 
     def __init__(self, rules: List[Dict[str, Any]] = None):
         self.rules = rules or DEFAULT_RULES
+        # 規則涉及的字段（去重、保序）及其在各分類上的分值
+        self._fields = list(dict.fromkeys(rule['field'] for rule in self.rules))
+        field_index = {name: i for i, name in enumerate(self._fields)}
+        self._rule_fields = [field_index[rule['field']] for rule in self.rules]
+        self._weights = [[0.0] * len(CATEGORIES) for _ in self._fields]
+        for rule in self.rules:
+            self._weights[field_index[rule['field']]][CATEGORIES.index(rule['category'])] += rule['points']
+        self._integral = all(float(rule['points']).is_integer() for rule in self.rules)
+        self.rules_hash = hashlib.md5(
+            json.dumps(self.rules, sort_keys=True, ensure_ascii=False).encode('utf-8')
+        ).hexdigest()
+        self._schema_ready = False
 
     def score_lead(self, lead: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -115,9 +293,8 @@ class LeadScoringEngine:
                 matched_rules.append(rule.get('desc', field_name))
 
         # 確保各分類不超過上限
-        caps = {'profile': 20, 'engagement': 25, 'intent': 30, 'quality': 15, 'recency': 10}
         for cat in breakdown:
-            breakdown[cat] = min(breakdown[cat], caps.get(cat, 100))
+            breakdown[cat] = min(breakdown[cat], CATEGORY_CAPS.get(cat, 100))
 
         total_score = sum(breakdown.values())
         total_score = min(total_score, 100)
@@ -136,79 +313,13 @@ class LeadScoringEngine:
             'matched_rules': matched_rules,
         }
 
-    def _evaluate_rule(self, field: str, lead: Dict[str, Any]) -> bool:
+    def _evaluate_rule(self, field_name: str, lead: Dict[str, Any]) -> bool:
         """評估單條規則"""
+        predicate = RULE_PREDICATES.get(field_name)
+        if predicate is None:
+            return False
         try:
-            if field == 'has_username':
-                return bool(lead.get('username') or lead.get('telegram_username'))
-            elif field == 'has_display_name':
-                return bool(lead.get('display_name') or lead.get('first_name'))
-            elif field == 'has_phone':
-                return bool(lead.get('phone'))
-            elif field == 'has_bio':
-                return bool(lead.get('bio'))
-            elif field == 'has_photo':
-                return lead.get('has_photo', False) in (True, 1, '1', 'true')
-            elif field == 'is_premium':
-                return lead.get('is_premium', False) in (True, 1, '1', 'true')
-            elif field == 'has_messages':
-                return (lead.get('message_count', 0) or 0) > 0
-            elif field == 'high_interaction':
-                return (lead.get('interactions_count', 0) or 0) > 5
-            elif field == 'has_response':
-                return (lead.get('messages_received', 0) or 0) > 0
-            elif field == 'keyword_match':
-                kw = lead.get('matched_keywords') or lead.get('triggered_keyword', '')
-                return bool(kw and kw != '[]' and kw != 'null')
-            elif field == 'multi_keyword':
-                kw = lead.get('matched_keywords', '')
-                if isinstance(kw, str) and kw.startswith('['):
-                    import json
-                    try:
-                        return len(json.loads(kw)) > 1
-                    except Exception:
-                        return False
-                return False
-            elif field == 'in_target_group':
-                return bool(lead.get('source_group_id') or lead.get('source_group_title'))
-            elif field == 'not_bot':
-                return lead.get('is_bot', False) not in (True, 1, '1', 'true')
-            elif field == 'low_risk':
-                risk = lead.get('ad_risk_score', 0) or 0
-                return float(risk) < 0.3
-            elif field == 'verified':
-                return lead.get('is_verified', False) in (True, 1, '1', 'true')
-            elif field == 'mature_account':
-                age = lead.get('account_age_days', 0) or 0
-                return int(age) > 30
-            elif field == 'recent_online':
-                last_seen = lead.get('last_seen') or lead.get('last_online', '')
-                if not last_seen:
-                    return False
-                from datetime import datetime, timedelta
-                try:
-                    if isinstance(last_seen, str):
-                        dt = datetime.fromisoformat(last_seen.replace('Z', '+00:00'))
-                    else:
-                        dt = last_seen
-                    return (datetime.now(dt.tzinfo) if dt.tzinfo else datetime.now()) - dt < timedelta(days=7)
-                except Exception:
-                    return False
-            elif field == 'recent_capture':
-                captured = lead.get('created_at') or lead.get('captured_at', '')
-                if not captured:
-                    return False
-                from datetime import datetime, timedelta
-                try:
-                    if isinstance(captured, str):
-                        dt = datetime.fromisoformat(captured.replace('Z', '+00:00'))
-                    else:
-                        dt = captured
-                    return (datetime.now(dt.tzinfo) if dt.tzinfo else datetime.now()) - dt < timedelta(days=14)
-                except Exception:
-                    return False
-            else:
-                return False
+            return predicate(lead)
         except Exception:
             return False
 
@@ -225,8 +336,231 @@ class LeadScoringEngine:
         return 'C'
 
     def batch_score(self, leads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """批量評分"""
-        return [self.score_lead(lead) for lead in leads]
+        """批量評分（每個字段只求值一次，分類匯總向量化）"""
+        flags = [[self._evaluate_rule(name, lead) for name in self._fields] for lead in leads]
+        breakdowns = self._aggregate(flags)
+        return [self._result(row_flags, row_breakdown) for row_flags, row_breakdown in zip(flags, breakdowns)]
+
+    # ==================== 列式評分 ====================
+
+    def _aggregate(self, flags: List[Sequence[int]]) -> List[List[float]]:
+        """(行 × 字段) 0/1 矩陣 → 每行各分類得分（已封頂）"""
+        caps = [CATEGORY_CAPS[cat] for cat in CATEGORIES]
+        if not flags:
+            return []
+        if HAS_NUMPY and self._fields:
+            matrix = np.asarray(flags, dtype=np.float64).reshape(len(flags), len(self._fields))
+            totals = np.minimum(matrix @ np.asarray(self._weights, dtype=np.float64), caps)
+            return totals.tolist()
+        breakdowns = []
+        for row in flags:
+            totals = [0.0] * len(CATEGORIES)
+            for i, hit in enumerate(row):
+                if hit:
+                    totals = [t + w for t, w in zip(totals, self._weights[i])]
+            breakdowns.append([min(t, cap) for t, cap in zip(totals, caps)])
+        return breakdowns
+
+    @staticmethod
+    def _as_number(value: float):
+        return int(value) if float(value).is_integer() else value
+
+    def _score_tuple(self, breakdown: Sequence[float]) -> Tuple:
+        """分類得分 → SCORE_COLUMNS 對應的回寫值"""
+        by_cat = dict(zip(CATEGORIES, breakdown))
+        total = self._as_number(min(sum(breakdown), 100))
+        return (
+            total,
+            self._score_to_intent(total),
+            self._score_to_value(total),
+            self._as_number(by_cat['intent']),
+            self._as_number(by_cat['quality']),
+            round(by_cat['engagement'] / 25.0, 2),
+        )
+
+    def _score_tuples(self, breakdowns: List[List[float]]) -> List[Tuple]:
+        """批量版 _score_tuple：總分、等級映射和活躍度在 NumPy 中按列計算"""
+        if not HAS_NUMPY or not breakdowns:
+            return [self._score_tuple(b) for b in breakdowns]
+        matrix = np.asarray(breakdowns, dtype=np.float64)
+        totals = np.minimum(matrix.sum(axis=1), 100)
+        # 與 _score_to_intent 相同：按定義順序取第一個命中的區間
+        intent = np.full(len(totals), 'cold', dtype=object)
+        for level, (low, high) in reversed(list(self.INTENT_LEVELS.items())):
+            intent[(totals >= low) & (totals <= high)] = level
+        # 與 _score_to_value 相同：取滿足條件的最高閾值
+        value = np.full(len(totals), 'C', dtype=object)
+        for level, threshold in sorted(self.VALUE_LEVELS.items(), key=lambda x: x[1]):
+            value[totals >= threshold] = level
+        activity = np.round(matrix[:, CATEGORIES.index('engagement')] / 25.0, 2)
+
+        def column(values):
+            return [self._as_number(v) for v in values.tolist()] if not self._integral else values.astype(np.int64).tolist()
+
+        return list(zip(
+            column(totals),
+            intent.tolist(),
+            value.tolist(),
+            column(matrix[:, CATEGORIES.index('intent')]),
+            column(matrix[:, CATEGORIES.index('quality')]),
+            activity.tolist(),
+        ))
+
+    def _result(self, flags: Sequence[int], breakdown: Sequence[float]) -> Dict[str, Any]:
+        """與 score_lead 相同結構的結果字典"""
+        values = dict(zip(SCORE_COLUMNS, self._score_tuple(breakdown)))
+        values['breakdown'] = {cat: self._as_number(v) for cat, v in zip(CATEGORIES, breakdown)}
+        values['matched_rules'] = [
+            rule.get('desc', rule['field'])
+            for rule, index in zip(self.rules, self._rule_fields) if flags[index]
+        ]
+        return values
+
+    def ensure_schema(self, conn: sqlite3.Connection):
+        """創建重評隊列、狀態表和觸發器"""
+        if self._schema_ready:
+            return
+        conn.executescript(_SCHEMA_SQL)
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(unified_contacts)')}
+        watched = ', '.join(c for c in SCORE_SOURCE_COLUMNS if c in columns)
+        if watched:
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_lead_score_update
+                AFTER UPDATE OF {watched} ON unified_contacts
+                BEGIN
+                    INSERT OR IGNORE INTO lead_score_queue (contact_id) VALUES (NEW.id);
+                END
+            ''')
+        conn.commit()
+        self._schema_ready = True
+
+    def score_contacts(
+        self,
+        conn: sqlite3.Connection,
+        ids: Optional[Sequence[int]] = None,
+        chunk_size: int = SCORE_CHUNK_SIZE,
+        collect: int = 0,
+    ) -> Dict[str, Any]:
+        """
+        列式評分 unified_contacts 並批量回寫
+
+        Args:
+            conn: sqlite3 連接
+            ids: 只評分這些聯繫人；None 表示全表（按 id 鍵集分頁）
+            chunk_size: 每批行數（每批一次查詢 + 一次 executemany + 一次提交）
+            collect: 返回前 N 條詳細結果（含 breakdown / matched_rules）
+
+        Returns:
+            {'scored', 'updated', 'intent_levels': {level: count}, 'results': [...]}
+        """
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(unified_contacts)')]
+        expressions = rule_sql_expressions(columns)
+        flag_sql = ', '.join(expressions.get(name, '0') for name in self._fields) or '0'
+        select = (
+            f"SELECT id, telegram_id, {', '.join(SCORE_COLUMNS)}, {flag_sql} "
+            f"FROM unified_contacts"
+        )
+        offset = 2 + len(SCORE_COLUMNS)
+        update_sql = (
+            f"UPDATE unified_contacts SET {', '.join(f'{c} = ?' for c in SCORE_COLUMNS)}, "
+            f"updated_at = CURRENT_TIMESTAMP WHERE id = ?"
+        )
+
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        stats = {'scored': 0, 'updated': 0, 'intent_levels': {level: 0 for level in self.INTENT_LEVELS}, 'results': []}
+        pending_ids = list(ids) if ids is not None else None
+        last_id = None
+        while True:
+            if pending_ids is not None:
+                if not pending_ids:
+                    break
+                batch, pending_ids = pending_ids[:chunk_size], pending_ids[chunk_size:]
+                rows = cursor.execute(
+                    f"{select} WHERE id IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+            else:
+                rows = cursor.execute(
+                    f"{select} WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id if last_id is not None else -1, chunk_size)
+                ).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+            if not rows:
+                continue
+
+            flags = [row[offset:] if self._fields else () for row in rows]
+            breakdowns = self._aggregate(flags)
+            updates = []
+            for row, row_flags, breakdown, values in zip(rows, flags, breakdowns, self._score_tuples(breakdowns)):
+                stats['intent_levels'][values[1]] = stats['intent_levels'].get(values[1], 0) + 1
+                if tuple(row[2:offset]) != values:
+                    updates.append(values + (row[0],))
+                if len(stats['results']) < collect:
+                    stats['results'].append({'id': row[0], 'telegram_id': row[1], **self._result(row_flags, breakdown)})
+            if updates:
+                cursor.executemany(update_sql, updates)
+            conn.commit()
+            stats['scored'] += len(rows)
+            stats['updated'] += len(updates)
+        return stats
+
+    def rescore_changed(self, conn: sqlite3.Connection, chunk_size: int = SCORE_CHUNK_SIZE) -> Dict[str, Any]:
+        """
+        增量重評：只處理隊列中的變更行和跨出時效窗口的行
+
+        首次運行或規則變化（rules_hash 不同）時全表重評。
+        """
+        self.ensure_schema(conn)
+        now = conn.execute("SELECT strftime('%Y-%m-%d %H:%M:%S', 'now')").fetchone()[0]
+        state = conn.execute('SELECT rules_hash, last_run FROM lead_score_state WHERE id = 1').fetchone()
+
+        if state is None or state[0] != self.rules_hash:
+            conn.execute('DELETE FROM lead_score_queue')
+            stats = self.score_contacts(conn, chunk_size=chunk_size)
+            stats['mode'] = 'full'
+        else:
+            self._enqueue_expired_recency(conn, state[1], now)
+            stats = {'scored': 0, 'updated': 0, 'intent_levels': {}, 'results': [], 'mode': 'incremental'}
+            while True:
+                ids = [row[0] for row in conn.execute(
+                    'SELECT contact_id FROM lead_score_queue ORDER BY contact_id LIMIT ?', (chunk_size,)
+                )]
+                if not ids:
+                    break
+                batch = self.score_contacts(conn, ids=ids, chunk_size=chunk_size)
+                conn.execute(f"DELETE FROM lead_score_queue WHERE contact_id IN ({','.join('?' * len(ids))})", ids)
+                stats['scored'] += batch['scored']
+                stats['updated'] += batch['updated']
+                for level, count in batch['intent_levels'].items():
+                    stats['intent_levels'][level] = stats['intent_levels'].get(level, 0) + count
+
+        conn.execute(
+            'INSERT OR REPLACE INTO lead_score_state (id, rules_hash, last_run) VALUES (1, ?, ?)',
+            (self.rules_hash, now)
+        )
+        conn.commit()
+        stats.pop('results', None)
+        if stats['updated']:
+            logger.info(f"Lead rescoring ({stats['mode']}): scored {stats['scored']}, updated {stats['updated']}")
+        return stats
+
+    def _enqueue_expired_recency(self, conn: sqlite3.Connection, last_run: Optional[str], now: str):
+        """上次運行以來跨出時效窗口（最近在線 / 最近捕獲）的聯繫人入隊"""
+        if not last_run:
+            return
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(unified_contacts)')}
+        for rule, ((primary, fallback), window) in RECENCY_WINDOWS.items():
+            if rule not in self._fields or primary not in columns:
+                continue
+            moment = _first_truthy(primary, fallback if fallback in columns else 'NULL')
+            conn.execute(
+                f"INSERT OR IGNORE INTO lead_score_queue (contact_id) "
+                f"SELECT id FROM unified_contacts WHERE julianday({moment}) > julianday(?) - ? "
+                f"AND julianday({moment}) <= julianday(?) - ?",
+                (last_run, window.days, now, window.days)
+            )
 
 
 _scoring_engine: Optional[LeadScoringEngine] = None
@@ -0,0 +1,645 @@
+"""
+🆕 P18-21: 統一 LLM 網關
+
+所有 AI 提供商的 HTTP 調用（ai_auto_chat / ai_service_mixin / domain/ai 處理器）經由這裡發出：
+1. 每個提供商一個長期存活的 ClientSession（TCPConnector keep-alive + DNS 緩存），
+   不再每次調用都新建會話、重新握手 TLS
+2. 按端點（scheme://host:port）的並發上限，超出時排隊而非壓垮本地 Ollama / 觸發 429
+3. 按提供商統計請求數、錯誤、排隊/響應延遲、prompt/completion token 用量
+4. 🆕 P18-22: 流式補全（OpenAI/DeepSeek SSE、Claude SSE、Gemini SSE、Ollama NDJSON），
+   逐塊轉發為 ai-token 事件幀，支持按會話提前取消，統計首 token 延遲（TTFT）
+5. 🆕 P18-24: 所有請求先經過 LLMScheduler 的全局在途上限，排隊時按 llm_priority()（線索評分）出隊
+
+用法（與 aiohttp.ClientSession 寫法一致，只是會話不由調用方創建/關閉）:
+    from core.llm_gateway import get_llm_gateway
+
+    async with get_llm_gateway().session('openai', timeout=aiohttp.ClientTimeout(total=60)) as session:
+        async with session.post(url, headers=headers, json=body) as resp:
+            data = await resp.json()   # usage 字段自動計入 token 統計
+
+    # 流式：逐塊回調，同一 key 的新請求 / cancel_stream() 會取消舊流
+    req = build_chat_request(provider, endpoint, api_key, model, messages)
+    text = await get_llm_gateway().relay_stream(f"chat:{user_id}", req, emit, provider=provider)
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+import weakref
+from contextlib import aclosing, asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from core.llm_scheduler import LLMScheduler, get_llm_scheduler
+from core.metrics import StreamingHistogram
+
+logger = logging.getLogger(__name__)
+
+LLM_POOL_SIZE = int(os.environ.get('LLM_POOL_SIZE', '32'))
+LLM_ENDPOINT_CONCURRENCY = int(os.environ.get('LLM_ENDPOINT_CONCURRENCY', '8'))
+LLM_LOCAL_CONCURRENCY = int(os.environ.get('LLM_LOCAL_CONCURRENCY', '2'))
+LLM_KEEPALIVE_SECONDS = float(os.environ.get('LLM_KEEPALIVE_SECONDS', '60'))
+DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=60)
+
+# 提供商別名 → 連接池名稱
+_PROVIDER_ALIASES = {
+    'openai': 'openai', 'gpt': 'openai',
+    'claude': 'claude', 'anthropic': 'claude',
+    'gemini': 'gemini', 'google': 'gemini',
+    'ollama': 'ollama', 'local': 'ollama',
+    'deepseek': 'deepseek',
+}
+# 自部署服務（Ollama / OpenAI 兼容代理）的端點地址可能不帶 /v1 前綴
+_SELF_HOSTED_POOLS = {'ollama', 'custom'}
+_LOCAL_HOSTS = {'localhost', '127.0.0.1', '::1', '0.0.0.0'}
+
+_DEFAULT_BASES = {
+    'openai': 'https://api.openai.com/v1',
+    'deepseek': 'https://api.deepseek.com/v1',
+    'gemini': 'https://generativelanguage.googleapis.com/v1beta',
+    'ollama': 'http://localhost:11434',
+}
+_DEFAULT_MODELS = {
+    'openai': 'gpt-4o-mini',
+    'deepseek': 'deepseek-chat',
+    'claude': 'claude-3-5-sonnet-latest',
+    'gemini': 'gemini-1.5-flash-latest',
+    'ollama': 'llama3',
+}
+
+
+def normalize_provider(provider: Optional[str]) -> str:
+    """提供商名稱歸一化，未知名稱歸入 custom（OpenAI 兼容的自定義端點）"""
+    return _PROVIDER_ALIASES.get((provider or '').strip().lower(), 'custom')
+
+
+def is_local_endpoint(pool: str, endpoint: str) -> bool:
+    """
+    本地推理服務一次只能跑少量請求，使用更低的並發上限：
+    Ollama，或指向本機的端點；custom 通常是遠程 OpenAI 兼容代理，不受此限制
+    """
+    if pool == 'ollama':
+        return True
+    host = (urlsplit(endpoint).hostname or '').lower()
+    return host in _LOCAL_HOSTS or host.startswith('127.')
+
+
+def endpoint_key(url: str) -> str:
+    """並發限制的粒度：scheme://host:port"""
+    parts = urlsplit(url)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    return f"{parts.scheme}://{parts.hostname}:{port}"
+
+
+def extract_usage(data: Any) -> Tuple[int, int]:
+    """從各提供商的響應體中提取 (prompt_tokens, completion_tokens)"""
+    if not isinstance(data, dict):
+        return 0, 0
+    usage = data.get('usage')
+    if isinstance(usage, dict):
+        # OpenAI / DeepSeek / OpenAI 兼容端點
+        if 'prompt_tokens' in usage or 'completion_tokens' in usage:
+            return int(usage.get('prompt_tokens') or 0), int(usage.get('completion_tokens') or 0)
+        # Claude
+        return int(usage.get('input_tokens') or 0), int(usage.get('output_tokens') or 0)
+    meta = data.get('usageMetadata')
+    if isinstance(meta, dict):
+        # Gemini
+        return int(meta.get('promptTokenCount') or 0), int(meta.get('candidatesTokenCount') or 0)
+    # Ollama /api/chat、/api/generate
+    return int(data.get('prompt_eval_count') or 0), int(data.get('eval_count') or 0)
+
+
+# ==================== 流式解析 ====================
+
+def stream_format(provider: Optional[str], url: str) -> str:
+    """流式響應格式：ollama（NDJSON）/ claude / gemini / openai（SSE，OpenAI 兼容端點通用）"""
+    if '/api/chat' in url or '/api/generate' in url:
+        return 'ollama'
+    pool = normalize_provider(provider)
+    return pool if pool in ('claude', 'gemini') else 'openai'
+
+
+def parse_stream_chunk(fmt: str, data: Dict[str, Any]) -> Tuple[str, int, int, bool]:
+    """解析一個流式數據塊 → (增量文本, prompt_tokens, completion_tokens, 是否結束)"""
+    if fmt == 'ollama':
+        message = data.get('message')
+        text = message.get('content', '') if isinstance(message, dict) else data.get('response', '')
+        prompt, completion = extract_usage(data)
+        return text or '', prompt, completion, bool(data.get('done'))
+    if fmt == 'claude':
+        kind = data.get('type')
+        if kind == 'content_block_delta':
+            return data.get('delta', {}).get('text', '') or '', 0, 0, False
+        if kind == 'message_start':
+            prompt, completion = extract_usage(data.get('message'))
+            return '', prompt, completion, False
+        if kind == 'message_delta':
+            prompt, completion = extract_usage(data)
+            return '', prompt, completion, False
+        return '', 0, 0, kind == 'message_stop'
+    if fmt == 'gemini':
+        candidates = data.get('candidates') or [{}]
+        parts = candidates[0].get('content', {}).get('parts', [])
+        prompt, completion = extract_usage(data)
+        return ''.join(p.get('text', '') for p in parts), prompt, completion, False
+    choices = data.get('choices') or [{}]
+    delta = choices[0].get('delta') or {}
+    prompt, completion = extract_usage(data)
+    return delta.get('content') or '', prompt, completion, False
+
+
+async def _iter_stream_events(content: aiohttp.StreamReader, fmt: str) -> AsyncIterator[Optional[Dict[str, Any]]]:
+    """按行讀取 SSE（data: ...）或 NDJSON，產出 JSON 對象；OpenAI 的 [DONE] 產出 None"""
+    async for raw in content:
+        line = raw.decode('utf-8', errors='replace').strip()
+        if not line:
+            continue
+        if fmt != 'ollama':
+            if not line.startswith('data:'):
+                continue  # event: / id: / 註釋行
+            line = line[5:].strip()
+            if line == '[DONE]':
+                yield None
+                return
+        try:
+            data = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(data, dict):
+            yield data
+
+
+def build_chat_request(
+    provider: Optional[str],
+    endpoint: Optional[str],
+    api_key: Optional[str],
+    model: Optional[str],
+    messages: List[Dict[str, str]],
+    max_tokens: int = 500,
+    temperature: float = 0.7,
+) -> Dict[str, Any]:
+    """
+    構建流式聊天請求 → {'url', 'headers', 'json', 'fmt'}
+
+    endpoint 可以是 API 根地址或完整的 chat 路徑；本地 / 自定義端點
+    （Ollama 端口或 /api/* 路徑）走 Ollama /api/chat，其餘走 OpenAI 兼容格式
+    """
+    pool = normalize_provider(provider)
+    endpoint = (endpoint or '').rstrip('/')
+    headers = {'Content-Type': 'application/json'}
+
+    if pool == 'claude':
+        body = {
+            'model': model or _DEFAULT_MODELS['claude'],
+            'max_tokens': max_tokens,
+            'messages': [{'role': m['role'], 'content': m['content']} for m in messages if m['role'] != 'system'],
+            'stream': True,
+        }
+        system = next((m['content'] for m in messages if m['role'] == 'system'), None)
+        if system:
+            body['system'] = system
+        headers.update({'x-api-key': api_key or '', 'anthropic-version': '2023-06-01'})
+        return {'url': 'https://api.anthropic.com/v1/messages', 'headers': headers, 'json': body, 'fmt': 'claude'}
+
+    if pool == 'gemini':
+        # Gemini 不支持 system role，system 內容作為首條 user 消息
+        contents = [
+            {'role': 'model' if m['role'] == 'assistant' else 'user', 'parts': [{'text': m['content']}]}
+            for m in messages
+        ]
+        base = endpoint if endpoint and '/models/' not in endpoint else _DEFAULT_BASES['gemini']
+        url = f"{base}/models/{model or _DEFAULT_MODELS['gemini']}:streamGenerateContent?alt=sse&key={api_key or ''}"
+        body = {'contents': contents, 'generationConfig': {'maxOutputTokens': max_tokens, 'temperature': temperature}}
+        return {'url': url, 'headers': headers, 'json': body, 'fmt': 'gemini'}
+
+    is_ollama = pool == 'ollama' or ':11434' in endpoint or '/api/chat' in endpoint or '/api/generate' in endpoint
+    if pool in _SELF_HOSTED_POOLS and is_ollama:
+        base = endpoint or _DEFAULT_BASES['ollama']
+        for suffix in ('/api/chat', '/api/generate'):
+            if suffix in base:
+                base = base[:base.index(suffix)]
+        body = {
+            'model': model or _DEFAULT_MODELS['ollama'],
+            'messages': messages,
+            'stream': True,
+            'options': {'num_predict': max_tokens},
+        }
+        return {'url': f"{base}/api/chat", 'headers': headers, 'json': body, 'fmt': 'ollama'}
+
+    # OpenAI / DeepSeek / OpenAI 兼容的自定義端點
+    base = endpoint or _DEFAULT_BASES.get(pool, _DEFAULT_BASES['openai'])
+    if 'chat/completions' in base:
+        url = base
+    elif pool in _SELF_HOSTED_POOLS and not base.endswith('/v1'):
+        url = f"{base}/v1/chat/completions"
+    else:
+        url = f"{base}/chat/completions"
+    body = {
+        'model': model or _DEFAULT_MODELS.get(pool, 'default'),
+        'messages': messages,
+        'max_tokens': max_tokens,
+        'temperature': temperature,
+        'stream': True,
+    }
+    if pool in ('openai', 'deepseek'):
+        body['stream_options'] = {'include_usage': True}
+    if api_key:
+        headers['Authorization'] = f'Bearer {api_key}'
+    return {'url': url, 'headers': headers, 'json': body, 'fmt': 'openai'}
+
+
+class LLMStreamCancelled(Exception):
+    """流式生成被取消（供需要區分「取消」與「空結果」的調用方拋出）"""
+
+
+class LLMStreamError(Exception):
+    """流式請求失敗（HTTP 錯誤狀態）"""
+
+    def __init__(self, status: int, detail: str = ''):
+        super().__init__(f"HTTP {status}: {detail}")
+        self.status = status
+
+
+class _ProviderStats:
+    """單個提供商的調用統計"""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.streams = 0
+        self.cancelled = 0
+        self.status: Dict[int, int] = {}
+        self.wait = StreamingHistogram()
+        self.latency = StreamingHistogram()
+        self.ttft = StreamingHistogram()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'streams': self.streams,
+            'cancelled': self.cancelled,
+            'status': dict(self.status),
+            'wait_ms': {k: round(v * 1000, 2) if k != 'count' else v for k, v in self.wait.stats().items()},
+            'latency_ms': {k: round(v * 1000, 2) if k != 'count' else v for k, v in self.latency.stats().items()},
+            'ttft_ms': {k: round(v * 1000, 2) if k != 'count' else v for k, v in self.ttft.stats().items()},
+        }
+
+
+class _TrackedResponse:
+    """ClientResponse 代理：讀取響應體時順帶記錄 token 用量，其餘屬性原樣轉發"""
+
+    def __init__(self, response: aiohttp.ClientResponse, stats: _ProviderStats):
+        self._response = response
+        self._stats = stats
+        self._counted = False
+
+    def _count(self, data: Any):
+        if self._counted:
+            return
+        self._counted = True
+        prompt, completion = extract_usage(data)
+        self._stats.prompt_tokens += prompt
+        self._stats.completion_tokens += completion
+
+    async def json(self, *args, **kwargs):
+        data = await self._response.json(*args, **kwargs)
+        self._count(data)
+        return data
+
+    async def text(self, *args, **kwargs):
+        # 部分調用方先取原始文本再自行 json.loads
+        text = await self._response.text(*args, **kwargs)
+        if not self._counted and self._response.status < 400 and text.lstrip().startswith('{'):
+            try:
+                self._count(json.loads(text))
+            except ValueError:
+                pass
+        return text
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+class _LoopState:
+    """會話和信號量都綁定事件循環，每個循環各持一份"""
+
+    def __init__(self):
+        self.sessions: Dict[str, aiohttp.ClientSession] = {}
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+class GatewaySession:
+    """
+    提供商會話視圖，post/get 與 aiohttp.ClientSession 用法一致；
+    退出 async with 時不關閉底層連接池
+    """
+
+    def __init__(self, gateway: 'LLMGateway', provider: str, timeout: Optional[aiohttp.ClientTimeout]):
+        self._gateway = gateway
+        self.provider = provider
+        self.timeout = timeout
+
+    async def __aenter__(self) -> 'GatewaySession':
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def request(self, method: str, url: str, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self._gateway.request(method, url, provider=self.provider, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def get(self, url: str, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+
+class LLMGateway:
+    """LLM 調用網關：按提供商複用連接池、按端點限流、統一統計"""
+
+    def __init__(
+        self,
+        pool_size: int = LLM_POOL_SIZE,
+        endpoint_concurrency: int = LLM_ENDPOINT_CONCURRENCY,
+        local_concurrency: int = LLM_LOCAL_CONCURRENCY,
+        keepalive: float = LLM_KEEPALIVE_SECONDS,
+        scheduler: Optional[LLMScheduler] = None,
+    ):
+        self.pool_size = pool_size
+        self.endpoint_concurrency = max(1, endpoint_concurrency)
+        self.local_concurrency = max(1, local_concurrency)
+        self.keepalive = keepalive
+        self._scheduler = scheduler
+        self._loops: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _LoopState]' = weakref.WeakKeyDictionary()
+        self._stats: Dict[str, _ProviderStats] = {}
+        self._endpoint_waiting: Dict[str, int] = {}
+        self._active_streams: Dict[str, asyncio.Task] = {}
+        self._cancelled_streams: set = set()
+
+    @property
+    def scheduler(self) -> LLMScheduler:
+        """全局在途請求上限和優先級排隊（默認共享 get_llm_scheduler()）"""
+        if self._scheduler is None:
+            self._scheduler = get_llm_scheduler()
+        return self._scheduler
+
+    # ==================== 連接池 ====================
+
+    def _state(self) -> _LoopState:
+        loop = asyncio.get_running_loop()
+        state = self._loops.get(loop)
+        if state is None:
+            state = self._loops[loop] = _LoopState()
+        return state
+
+    def _session(self, pool: str) -> aiohttp.ClientSession:
+        state = self._state()
+        session = state.sessions.get(pool)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=self.keepalive,
+                ttl_dns_cache=300,
+            )
+            session = aiohttp.ClientSession(connector=connector, timeout=DEFAULT_TIMEOUT)
+            state.sessions[pool] = session
+        return session
+
+    def _semaphore(self, pool: str, endpoint: str) -> asyncio.Semaphore:
+        state = self._state()
+        sem = state.semaphores.get(endpoint)
+        if sem is None:
+            limit = self.local_concurrency if is_local_endpoint(pool, endpoint) else self.endpoint_concurrency
+            sem = state.semaphores[endpoint] = asyncio.Semaphore(limit)
+        return sem
+
+    def _provider_stats(self, pool: str) -> _ProviderStats:
+        stats = self._stats.get(pool)
+        if stats is None:
+            stats = self._stats[pool] = _ProviderStats()
+        return stats
+
+    # ==================== 請求 ====================
+
+    def session(self, provider: Optional[str], timeout: Optional[aiohttp.ClientTimeout] = None) -> GatewaySession:
+        """取得提供商的會話視圖（可用 async with，也可直接調用 post/get）"""
+        return GatewaySession(self, normalize_provider(provider), timeout)
+
+    @asynccontextmanager
+    async def request(
+        self, method: str, url: str, *, provider: Optional[str] = None, **kwargs,
+    ) -> AsyncIterator[_TrackedResponse]:
+        """發出請求並產出響應；並發上限、延遲、狀態碼、token 用量在這裡統一記錄"""
+        pool = normalize_provider(provider)
+        endpoint = endpoint_key(url)
+        stats = self._provider_stats(pool)
+        if kwargs.get('timeout') is None:
+            kwargs.pop('timeout', None)
+
+        queued = time.monotonic()
+        # 🆕 P18-24: 先取全局名額（按 llm_priority 排隊），再取端點名額
+        async with self.scheduler.slot():
+            sem = self._semaphore(pool, endpoint)
+            self._endpoint_waiting[endpoint] = self._endpoint_waiting.get(endpoint, 0) + 1
+            try:
+                await sem.acquire()
+            finally:
+                self._endpoint_waiting[endpoint] -= 1
+            started = time.monotonic()
+            stats.wait.add(started - queued)
+            stats.requests += 1
+            stats.in_flight += 1
+            failed = True
+            try:
+                async with self._session(pool).request(method, url, **kwargs) as response:
+                    stats.status[response.status] = stats.status.get(response.status, 0) + 1
+                    yield _TrackedResponse(response, stats)
+                    failed = response.status >= 400
+            except (asyncio.CancelledError, GeneratorExit):
+                # 調用方主動放棄（流被取消），不計為錯誤
+                failed = False
+                raise
+            finally:
+                stats.in_flight -= 1
+                stats.latency.add(time.monotonic() - started)
+                if failed:
+                    stats.errors += 1
+                sem.release()
+
+    # ==================== 流式 ====================
+
+    async def stream(
+        self, method: str, url: str, *, provider: Optional[str] = None, fmt: Optional[str] = None, **kwargs,
+    ) -> AsyncIterator[str]:
+        """
+        流式請求，逐塊產出增量文本
+
+        消費方提前退出時請用 contextlib.aclosing 包裹，確保連接立即釋放（服務端隨之停止生成）
+        """
+        pool = normalize_provider(provider)
+        fmt = fmt or stream_format(pool, url)
+        stats = self._provider_stats(pool)
+        stats.streams += 1
+        started = time.monotonic()
+        first_token = True
+        prompt = completion = 0
+        try:
+            async with self.request(method, url, provider=pool, **kwargs) as resp:
+                if resp.status >= 400:
+                    detail = await resp.text()
+                    raise LLMStreamError(resp.status, detail[:200])
+                async with aclosing(_iter_stream_events(resp.content, fmt)) as events:
+                    async for data in events:
+                        if data is None:
+                            break
+                        text, p, c, done = parse_stream_chunk(fmt, data)
+                        # 各提供商的 usage 都是累計值，取最大即可
+                        prompt, completion = max(prompt, p), max(completion, c)
+                        if text:
+                            if first_token:
+                                first_token = False
+                                stats.ttft.add(time.monotonic() - started)
+                            yield text
+                        if done:
+                            break
+        except (asyncio.CancelledError, GeneratorExit):
+            stats.cancelled += 1
+            raise
+        finally:
+            stats.prompt_tokens += prompt
+            stats.completion_tokens += completion
+
+    async def relay_stream(
+        self,
+        key: str,
+        request: Dict[str, Any],
+        emit: Callable[[Dict[str, Any]], Any],
+        *,
+        provider: Optional[str] = None,
+        timeout: Optional[aiohttp.ClientTimeout] = None,
+    ) -> Optional[str]:
+        """
+        執行 build_chat_request() 構建的流式請求，把每個增量塊以事件幀交給 emit
+
+        幀格式: {'streamId', 'seq', 'token', 'done': False}
+        結束幀: {'streamId', 'done': True, 'cancelled', 'ttftMs', 'elapsedMs'[, 'error']}
+
+        同一 key（通常是一段會話）上只保留最新的流：新的 relay_stream 或 cancel_stream(key)
+        會取消舊流，被取消的流返回 None。首個增量之前的失敗原樣拋出，調用方可退回非流式請求。
+        """
+        self.cancel_stream(key)
+        started = time.monotonic()
+        state = {'seq': 0, 'ttft': None}
+
+        async def consume() -> str:
+            chunks = []
+            async with aclosing(self.stream(
+                'POST', request['url'], provider=provider, fmt=request.get('fmt'),
+                headers=request.get('headers'), json=request['json'], timeout=timeout,
+            )) as tokens:
+                async for token in tokens:
+                    if state['ttft'] is None:
+                        state['ttft'] = time.monotonic() - started
+                    chunks.append(token)
+                    emit({'streamId': key, 'seq': state['seq'], 'token': token, 'done': False})
+                    state['seq'] += 1
+            return ''.join(chunks)
+
+        def finish(**extra):
+            ttft = state['ttft']
+            emit({
+                'streamId': key,
+                'done': True,
+                'cancelled': False,
+                'ttftMs': round(ttft * 1000, 1) if ttft is not None else None,
+                'elapsedMs': round((time.monotonic() - started) * 1000, 1),
+                **extra,
+            })
+
+        task = asyncio.ensure_future(consume())
+        self._active_streams[key] = task
+        try:
+            text = await task
+        except asyncio.CancelledError:
+            if task not in self._cancelled_streams:
+                raise
+            finish(cancelled=True)
+            return None
+        except Exception as e:
+            if state['seq']:
+                finish(error=str(e))
+            raise
+        finally:
+            self._cancelled_streams.discard(task)
+            if self._active_streams.get(key) is task:
+                del self._active_streams[key]
+        finish()
+        return text
+
+    def replay_stream(self, key: str, text: str, emit: Callable[[Dict[str, Any]], Any]):
+        """
+        把已有的完整文本（如緩存命中）按 relay_stream 的幀格式發出：一個 token 幀 + 結束幀，
+        等待該 streamId 的前端照常收尾
+        """
+        self.cancel_stream(key)
+        emit({'streamId': key, 'seq': 0, 'token': text, 'done': False})
+        emit({'streamId': key, 'done': True, 'cancelled': False, 'ttftMs': 0.0, 'elapsedMs': 0.0, 'cached': True})
+
+    def cancel_stream(self, key: str) -> bool:
+        """取消 key 上正在進行的流（會話已有新消息 / 用戶停止生成）"""
+        task = self._active_streams.pop(key, None)
+        if task is None or task.done():
+            return False
+        self._cancelled_streams.add(task)
+        task.cancel()
+        return True
+
+    # ==================== 統計 / 關閉 ====================
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'providers': {name: s.to_dict() for name, s in self._stats.items()},
+            'endpoints_waiting': {k: v for k, v in self._endpoint_waiting.items() if v},
+            'active_streams': len(self._active_streams),
+            'scheduler': self.scheduler.get_stats(),
+            'sessions': sum(
+                1 for state in list(self._loops.values())
+                for s in state.sessions.values() if not s.closed
+            ),
+        }
+
+    async def close(self):
+        """關閉當前事件循環上的所有提供商會話"""
+        state = self._loops.pop(asyncio.get_running_loop(), None)
+        if state is None:
+            return
+        for session in state.sessions.values():
+            try:
+                await session.close()
+            except Exception as e:
+                logger.warning(f"[LLMGateway] Error closing session: {e}")
+
+
+_llm_gateway: Optional[LLMGateway] = None
+
+
+def get_llm_gateway() -> LLMGateway:
+    """獲取全局 LLM 網關"""
+    global _llm_gateway
+    if _llm_gateway is None:
+        _llm_gateway = LLMGateway()
+    return _llm_gateway
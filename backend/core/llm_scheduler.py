@@ -0,0 +1,272 @@
+"""
+🆕 P18-24: 私信突發時的 AI 回覆合併與 LLM 調度
+
+多個帳號同時湧入私信時，每條消息都各自構建上下文、檢索 RAG、發一次 LLM 請求：
+1. MessageCoalescer：同一用戶在短窗口內連發的多條消息合併為一次回覆
+   （窗口內每來一條新消息就順延，但從第一條起最多等待 max_wait 秒）
+2. LLMScheduler：全局在途 LLM 請求上限，排隊者按優先級（線索評分）出隊，
+   隊列長度有上限，滿時淘汰優先級最低的等待者，突發流量不會耗盡提供商限額或事件循環內存；
+   在途計數和等待隊列按事件循環各持一份（future 只能由所屬循環完成）
+3. llm_priority()：在調用鏈上設置當前請求的優先級（contextvar），
+   LLMGateway 發請求時自動讀取，調用方無需層層傳參
+
+用法:
+    from core.llm_scheduler import get_message_coalescer, llm_priority
+
+    merged = await get_message_coalescer().coalesce(f"chat:{user_id}", text)
+    if merged is None:
+        return   # 已合併到同一用戶稍後的消息中，由那一條統一回覆
+
+    with llm_priority(lead_score):
+        reply = await generate(merged)   # 網關內的請求按 lead_score 排隊
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import time
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from core.metrics import StreamingHistogram
+
+logger = logging.getLogger(__name__)
+
+LLM_MAX_IN_FLIGHT = int(os.environ.get('LLM_MAX_IN_FLIGHT', '16'))
+LLM_MAX_QUEUED = int(os.environ.get('LLM_MAX_QUEUED', '200'))
+AI_COALESCE_WINDOW = float(os.environ.get('AI_COALESCE_WINDOW', '1.5'))
+AI_COALESCE_MAX_WAIT = float(os.environ.get('AI_COALESCE_MAX_WAIT', '6'))
+
+_priority: contextvars.ContextVar[float] = contextvars.ContextVar('llm_priority', default=0.0)
+
+
+@contextmanager
+def llm_priority(priority: Optional[float]) -> Iterator[None]:
+    """設置當前調用鏈上 LLM 請求的優先級（數值越大越先執行）"""
+    token = _priority.set(float(priority or 0))
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> float:
+    return _priority.get()
+
+
+class LLMSchedulerFull(Exception):
+    """調度隊列已滿，請求被拒絕或被更高優先級的請求擠出"""
+
+
+# ==================== 消息合併 ====================
+
+class _Batch:
+    __slots__ = ('texts', 'version', 'started_at')
+
+    def __init__(self, started_at: float):
+        self.texts: List[str] = []
+        self.version = 0
+        self.started_at = started_at
+
+
+class MessageCoalescer:
+    """按 key（通常是帳號 + 用戶）合併短時間內連發的消息"""
+
+    def __init__(self, window: float = AI_COALESCE_WINDOW, max_wait: float = AI_COALESCE_MAX_WAIT):
+        self.window = max(0.0, window)
+        self.max_wait = max(self.window, max_wait)
+        self._batches: Dict[str, _Batch] = {}
+        self._messages = 0
+        self._flushes = 0
+
+    async def coalesce(self, key: str, text: str, separator: str = '\n') -> Optional[str]:
+        """
+        加入 key 的當前批次並等待窗口結束
+
+        窗口內最後到達的調用返回合併後的全部文本，其餘調用返回 None（不需要單獨回覆）。
+        window 為 0 時不合併，直接返回 text。
+        """
+        self._messages += 1
+        if self.window <= 0:
+            self._flushes += 1
+            return text
+
+        now = time.monotonic()
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = _Batch(now)
+        batch.texts.append(text)
+        batch.version += 1
+        version = batch.version
+
+        delay = min(self.window, batch.started_at + self.max_wait - now)
+        try:
+            if delay > 0:
+                await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            # 負責回覆的調用被取消，整批作廢（消息已各自寫入聊天歷史）
+            if batch.version == version and self._batches.get(key) is batch:
+                del self._batches[key]
+            raise
+
+        if batch.version != version or self._batches.get(key) is not batch:
+            return None
+        del self._batches[key]
+        self._flushes += 1
+        return separator.join(batch.texts)
+
+    def pending(self, key: str) -> int:
+        """key 當前批次中等待合併的消息數"""
+        batch = self._batches.get(key)
+        return len(batch.texts) if batch else 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'window': self.window,
+            'max_wait': self.max_wait,
+            'messages': self._messages,
+            'replies': self._flushes,
+            'merged': self._messages - self._flushes - sum(len(b.texts) for b in self._batches.values()),
+            'open_batches': len(self._batches),
+        }
+
+
+# ==================== 優先級調度 ====================
+
+class _LoopQueue:
+    """一個事件循環的在途計數和等待隊列"""
+
+    __slots__ = ('in_flight', 'queue')
+
+    def __init__(self):
+        self.in_flight = 0
+        # 堆元素: (-priority, seq, future)，同優先級先到先得
+        self.queue: List[tuple] = []
+
+
+class LLMScheduler:
+    """全局 LLM 在途請求上限 + 按優先級排隊（每個事件循環各自計數）"""
+
+    def __init__(self, max_in_flight: int = LLM_MAX_IN_FLIGHT, max_queued: int = LLM_MAX_QUEUED):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queued = max(0, max_queued)
+        self._loops: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _LoopQueue]' = weakref.WeakKeyDictionary()
+        self._seq = itertools.count()
+        self._granted = 0
+        self._rejected = 0
+        self._max_queue_seen = 0
+        self._wait = StreamingHistogram()
+
+    def _state(self) -> _LoopQueue:
+        loop = asyncio.get_running_loop()
+        state = self._loops.get(loop)
+        if state is None:
+            state = self._loops[loop] = _LoopQueue()
+        return state
+
+    def _queued(self) -> int:
+        return sum(
+            1 for state in list(self._loops.values()) for _, _, fut in state.queue if not fut.done()
+        )
+
+    def _grant_next(self, state: _LoopQueue):
+        while state.queue and state.in_flight < self.max_in_flight:
+            _, _, fut = heapq.heappop(state.queue)
+            if fut.done():
+                continue
+            state.in_flight += 1
+            fut.set_result(None)
+
+    def _shed(self, state: _LoopQueue, priority: float):
+        """隊列已滿：擠出優先級最低（同優先級中最晚到達）的等待者，新請求更低時拒絕新請求"""
+        waiting = [item for item in state.queue if not item[2].done()]
+        if len(waiting) != len(state.queue):
+            state.queue = waiting
+            heapq.heapify(state.queue)
+        if len(state.queue) < self.max_queued:
+            return
+        victim = max(state.queue, key=lambda item: (item[0], item[1])) if state.queue else None
+        self._rejected += 1
+        if victim is None or -victim[0] >= priority:
+            raise LLMSchedulerFull(f"LLM queue full ({self.max_queued})")
+        state.queue.remove(victim)
+        heapq.heapify(state.queue)
+        victim[2].set_exception(LLMSchedulerFull('Preempted by higher-priority LLM request'))
+
+    async def acquire(self, priority: Optional[float] = None):
+        if priority is None:
+            priority = current_priority()
+        state = self._state()
+        if state.in_flight < self.max_in_flight and not state.queue:
+            state.in_flight += 1
+            self._granted += 1
+            self._wait.add(0.0)
+            return
+
+        if len(state.queue) >= self.max_queued:
+            self._shed(state, priority)
+        queued = time.monotonic()
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(state.queue, (-priority, next(self._seq), fut))
+        self._max_queue_seen = max(self._max_queue_seen, len(state.queue))
+        self._grant_next(state)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # 已分配到名額但調用方同時被取消：把名額還回去
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                self.release()
+            raise
+        self._granted += 1
+        self._wait.add(time.monotonic() - queued)
+
+    def release(self):
+        """歸還當前事件循環的一個在途名額"""
+        state = self._state()
+        state.in_flight = max(0, state.in_flight - 1)
+        self._grant_next(state)
+
+    @asynccontextmanager
+    async def slot(self, priority: Optional[float] = None) -> AsyncIterator[None]:
+        """占用一個在途名額，未指定優先級時讀取 llm_priority() 設置的值"""
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'max_in_flight': self.max_in_flight,
+            'max_queued': self.max_queued,
+            'in_flight': sum(state.in_flight for state in list(self._loops.values())),
+            'queued': self._queued(),
+            'max_queue_seen': self._max_queue_seen,
+            'granted': self._granted,
+            'rejected': self._rejected,
+            'wait_ms': {k: round(v * 1000, 2) if k != 'count' else v for k, v in self._wait.stats().items()},
+        }
+
+
+_llm_scheduler: Optional[LLMScheduler] = None
+_message_coalescer: Optional[MessageCoalescer] = None
+
+
+def get_llm_scheduler() -> LLMScheduler:
+    """獲取全局 LLM 調度器"""
+    global _llm_scheduler
+    if _llm_scheduler is None:
+        _llm_scheduler = LLMScheduler()
+    return _llm_scheduler
+
+
+def get_message_coalescer() -> MessageCoalescer:
+    """獲取全局消息合併器"""
+    global _message_coalescer
+    if _message_coalescer is None:
+        _message_coalescer = MessageCoalescer()
+    return _message_coalescer
@@ -0,0 +1,170 @@
+"""
+消息去重緩存
+
+用於輪詢器和消息處理器的「已處理消息」去重：
+1. 整數元組鍵（如 (phone, chat_id, message_id)），比拼接字符串更緊湊
+2. OrderedDict 實現，插入/查詢/淘汰均為 O(1)
+3. 按插入順序淘汰最舊的鍵，不會誤刪最近處理的消息（避免重複 AI 回覆）
+4. 可選持久化到 JSON 文件，重啟後仍能去重
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+DedupKey = Tuple[int, ...]
+
+
+def phone_key(phone: Union[str, int]) -> int:
+    """將電話號碼轉為整數鍵（只保留數字）"""
+    if isinstance(phone, int):
+        return phone
+    digits = ''.join(ch for ch in str(phone) if ch.isdigit())
+    return int(digits) if digits else 0
+
+
+class MessageDedupCache:
+    """
+    有界、有序的消息去重緩存
+
+    用法:
+        cache = MessageDedupCache(max_size=10000)
+        if cache.check_and_add(phone_key(phone), chat_id, message_id):
+            return  # 已處理過
+    """
+
+    def __init__(
+        self,
+        max_size: int = 10000,
+        persist_path: Optional[Union[str, Path]] = None,
+        autosave_interval: float = 60.0,
+    ):
+        self.max_size = max_size
+        self.persist_path = Path(persist_path) if persist_path else None
+        self.autosave_interval = autosave_interval
+        self._keys: "OrderedDict[DedupKey, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._last_save = time.time()
+
+        # 統計
+        self._hits = 0
+        self._evictions = 0
+
+        if self.persist_path:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: DedupKey) -> bool:
+        return key in self._keys
+
+    def contains(self, *key: int) -> bool:
+        """檢查鍵是否已存在"""
+        return key in self._keys
+
+    def add(self, *key: int) -> None:
+        """添加鍵（已存在則刷新為最新）"""
+        with self._lock:
+            self._add_locked(key)
+        self._maybe_autosave()
+
+    def check_and_add(self, *key: int) -> bool:
+        """
+        原子地檢查並添加
+
+        Returns:
+            True 表示鍵已存在（重複消息），False 表示首次出現並已記錄
+        """
+        with self._lock:
+            if key in self._keys:
+                self._hits += 1
+                return True
+            self._add_locked(key)
+        self._maybe_autosave()
+        return False
+
+    def _add_locked(self, key: DedupKey) -> None:
+        if key in self._keys:
+            self._keys.move_to_end(key)
+        else:
+            self._keys[key] = None
+        self._dirty = True
+        while len(self._keys) > self.max_size:
+            self._keys.popitem(last=False)
+            self._evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._keys.clear()
+            self._dirty = True
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'size': len(self._keys),
+            'max_size': self.max_size,
+            'hits': self._hits,
+            'evictions': self._evictions,
+            'persistent': self.persist_path is not None,
+        }
+
+    # ==================== 持久化 ====================
+
+    def _maybe_autosave(self) -> None:
+        if (self.persist_path and self._dirty
+                and time.time() - self._last_save >= self.autosave_interval):
+            self.save()
+
+    def save(self) -> bool:
+        """保存到文件（原子替換）"""
+        if not self.persist_path:
+            return False
+        with self._lock:
+            snapshot = [list(k) for k in self._keys]
+            self._dirty = False
+            self._last_save = time.time()
+        try:
+            self.persist_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.persist_path.with_suffix(self.persist_path.suffix + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, separators=(',', ':'))
+            os.replace(tmp_path, self.persist_path)
+            return True
+        except Exception as e:
+            logger.warning(f"Failed to persist dedup cache {self.persist_path}: {e}")
+            return False
+
+    def load(self) -> int:
+        """從文件載入（保留最近的 max_size 條）"""
+        if not self.persist_path or not self.persist_path.exists():
+            return 0
+        try:
+            with open(self.persist_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.warning(f"Failed to load dedup cache {self.persist_path}: {e}")
+            return 0
+        with self._lock:
+            for item in data[-self.max_size:]:
+                self._keys[tuple(int(v) for v in item)] = None
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+            self._dirty = False
+        return len(self._keys)
+
+
+def default_dedup_path(name: str) -> Optional[Path]:
+    """默認持久化路徑：數據目錄下的 dedup/<name>.json"""
+    try:
+        from config import DATABASE_DIR
+        return Path(DATABASE_DIR) / 'dedup' / f'{name}.json'
+    except Exception:
+        return None
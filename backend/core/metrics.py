@@ -8,11 +8,18 @@ Phase A: SRE & Performance - 指標收集與健康檢查
 3. 業務指標收集（發送成功率、在線帳號數）
 4. 健康檢查
 5. 告警閾值監控
+
+🆕 P18-16: 低開銷指標後端
+- StreamingHistogram：DDSketch 式對數分桶，固定內存、可合併，分位數相對誤差 1%
+- 計數器 / 分佈按線程分片，寫入不持鎖，讀取時合併
+- 原始歷史記錄可按比例採樣
 """
 
 import os
 import sys
+import math
 import time
+import random
 import asyncio
 import psutil
 from datetime import datetime, timedelta
@@ -139,47 +146,173 @@ class Alert:
         }
 
 
+class StreamingHistogram:
+    """
+    🆕 P18-16: 可合併的流式分佈（DDSketch 式對數分桶）
+    
+    值 v > 0 落入桶 ceil(log_γ(v))，γ = (1+α)/(1-α)；
+    分位數的相對誤差不超過 α，count / sum / min / max 精確。
+    桶數超過 max_buckets 時合併最小的桶（只影響最低分位數）。
+    """
+    
+    __slots__ = ('relative_accuracy', 'max_buckets', '_gamma_log', '_gamma',
+                 '_positive', '_negative', 'zero_count', 'count', 'total', 'min', 'max')
+    
+    MIN_INDEXABLE = 1e-9
+    
+    def __init__(self, relative_accuracy: float = 0.01, max_buckets: int = 2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._gamma_log = math.log(self._gamma)
+        self._positive: Dict[int, int] = {}
+        self._negative: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+    
+    def _index(self, value: float) -> int:
+        return math.ceil(math.log(value) / self._gamma_log)
+    
+    def _bucket_value(self, index: int) -> float:
+        return 2 * self._gamma ** index / (self._gamma + 1)
+    
+    def add(self, value: float, count: int = 1):
+        if value > self.MIN_INDEXABLE:
+            store = self._positive
+            index = self._index(value)
+        elif value < -self.MIN_INDEXABLE:
+            store = self._negative
+            index = self._index(-value)
+        else:
+            store = None
+            self.zero_count += count
+        if store is not None:
+            store[index] = store.get(index, 0) + count
+            if len(store) > self.max_buckets:
+                self._collapse(store)
+        self.count += count
+        self.total += value * count
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+    
+    def _collapse(self, store: Dict[int, int]):
+        """合併最低的兩個桶"""
+        lowest, second = sorted(store)[:2]
+        store[second] += store.pop(lowest)
+    
+    def merge(self, other: 'StreamingHistogram'):
+        """合併另一個分佈（相同精度）"""
+        for src, dst in ((other._positive, self._positive), (other._negative, self._negative)):
+            for index, n in list(src.items()):
+                dst[index] = dst.get(index, 0) + n
+            while len(dst) > self.max_buckets:
+                self._collapse(dst)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+    
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self._negative, reverse=True):
+            seen += self._negative[index]
+            if seen > rank:
+                return max(self.min, -self._bucket_value(index))
+        seen += self.zero_count
+        if seen > rank:
+            return 0
+        for index in sorted(self._positive):
+            seen += self._positive[index]
+            if seen > rank:
+                return min(self.max, max(self.min, self._bucket_value(index)))
+        return self.max
+    
+    def stats(self) -> Dict[str, float]:
+        if not self.count:
+            return {"count": 0, "min": 0, "max": 0, "avg": 0, "p50": 0, "p95": 0, "p99": 0}
+        return {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "avg": self.total / self.count,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
 class MetricsCollector:
-    """指標收集器"""
+    """
+    指標收集器
     
-    def __init__(self, max_history: int = 1000):
+    🆕 P18-16: 計數器和分佈寫入各線程自己的分片（無鎖），讀取時合併；
+    歷史記錄按 history_sample_rate 採樣。
+    """
+    
+    def __init__(self, max_history: int = 1000, history_sample_rate: float = 1.0,
+                 relative_accuracy: float = 0.01):
         self.max_history = max_history
+        self.history_sample_rate = history_sample_rate
+        self.relative_accuracy = relative_accuracy
         self._metrics: Dict[str, deque] = {}
-        self._counters: Dict[str, float] = {}
         self._gauges: Dict[str, float] = {}
-        self._histograms: Dict[str, List[float]] = {}
+        self._local = threading.local()
+        # 所有線程分片：[(counters, histograms)]，僅在新線程首次寫入時加鎖登記
+        self._shards: List[tuple] = []
         self._lock = threading.Lock()
     
+    def _shard(self) -> tuple:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = ({}, {})
+            self._local.shard = shard
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+    
     def increment(self, name: str, value: float = 1, labels: Dict[str, str] = None):
         """增加計數器"""
         key = self._make_key(name, labels)
-        with self._lock:
-            self._counters[key] = self._counters.get(key, 0) + value
-            self._record_metric(name, MetricType.COUNTER, self._counters[key], labels)
+        counters = self._shard()[0]
+        counters[key] = counters.get(key, 0) + value
+        if self._should_record():
+            self._record_metric(name, MetricType.COUNTER, self.get_counter(name, labels), labels)
     
     def gauge(self, name: str, value: float, labels: Dict[str, str] = None):
         """設置即時值"""
         key = self._make_key(name, labels)
-        with self._lock:
-            self._gauges[key] = value
+        self._gauges[key] = value
+        if self._should_record():
             self._record_metric(name, MetricType.GAUGE, value, labels)
     
     def histogram(self, name: str, value: float, labels: Dict[str, str] = None):
-        """記錄分佈值"""
+        """記錄分佈值（固定內存，覆蓋全部樣本）"""
         key = self._make_key(name, labels)
-        with self._lock:
-            if key not in self._histograms:
-                self._histograms[key] = []
-            self._histograms[key].append(value)
-            # 只保留最近 1000 個值
-            if len(self._histograms[key]) > 1000:
-                self._histograms[key] = self._histograms[key][-1000:]
+        histograms = self._shard()[1]
+        hist = histograms.get(key)
+        if hist is None:
+            hist = histograms[key] = StreamingHistogram(self.relative_accuracy)
+        hist.add(value)
+        if self._should_record():
             self._record_metric(name, MetricType.HISTOGRAM, value, labels)
     
     def timer(self, name: str):
         """創建計時器上下文管理器"""
         return TimerContext(self, name)
     
+    def _should_record(self) -> bool:
+        rate = self.history_sample_rate
+        return rate >= 1.0 or (rate > 0 and random.random() < rate)
+    
     def _make_key(self, name: str, labels: Dict[str, str] = None) -> str:
         """生成指標鍵"""
         if not labels:
@@ -190,50 +323,56 @@ class MetricsCollector:
     def _record_metric(self, name: str, type: MetricType, value: float, labels: Dict[str, str] = None):
         """記錄指標"""
         key = self._make_key(name, labels)
-        if key not in self._metrics:
-            self._metrics[key] = deque(maxlen=self.max_history)
-        self._metrics[key].append(Metric(
+        history = self._metrics.get(key)
+        if history is None:
+            history = self._metrics.setdefault(key, deque(maxlen=self.max_history))
+        history.append(Metric(
             name=name,
             type=type,
             value=value,
             labels=labels or {}
         ))
     
+    def get_history(self, name: str, labels: Dict[str, str] = None) -> List[Metric]:
+        """獲取（採樣後的）原始歷史"""
+        return list(self._metrics.get(self._make_key(name, labels), ()))
+    
     def get_counter(self, name: str, labels: Dict[str, str] = None) -> float:
         """獲取計數器值"""
         key = self._make_key(name, labels)
-        return self._counters.get(key, 0)
+        return sum(counters.get(key, 0) for counters, _ in list(self._shards))
     
     def get_gauge(self, name: str, labels: Dict[str, str] = None) -> float:
         """獲取即時值"""
         key = self._make_key(name, labels)
         return self._gauges.get(key, 0)
     
+    def get_histogram(self, name: str, labels: Dict[str, str] = None) -> StreamingHistogram:
+        """合併各分片得到完整分佈"""
+        key = self._make_key(name, labels)
+        merged = StreamingHistogram(self.relative_accuracy)
+        for _, histograms in list(self._shards):
+            hist = histograms.get(key)
+            if hist is not None:
+                merged.merge(hist)
+        return merged
+    
     def get_histogram_stats(self, name: str, labels: Dict[str, str] = None) -> Dict[str, float]:
         """獲取分佈統計"""
-        key = self._make_key(name, labels)
-        values = self._histograms.get(key, [])
-        if not values:
-            return {"count": 0, "min": 0, "max": 0, "avg": 0, "p50": 0, "p95": 0, "p99": 0}
-        
-        sorted_values = sorted(values)
-        count = len(sorted_values)
-        return {
-            "count": count,
-            "min": sorted_values[0],
-            "max": sorted_values[-1],
-            "avg": sum(sorted_values) / count,
-            "p50": sorted_values[int(count * 0.5)],
-            "p95": sorted_values[int(count * 0.95)],
-            "p99": sorted_values[int(count * 0.99)]
-        }
+        return self.get_histogram(name, labels).stats()
     
     def get_all_metrics(self) -> Dict[str, Any]:
         """獲取所有指標"""
+        counters: Dict[str, float] = {}
+        histogram_keys = set()
+        for shard_counters, histograms in list(self._shards):
+            for key, value in list(shard_counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            histogram_keys.update(list(histograms))
         return {
-            "counters": dict(self._counters),
+            "counters": counters,
             "gauges": dict(self._gauges),
-            "histograms": {k: self.get_histogram_stats(k) for k in self._histograms}
+            "histograms": {k: self.get_histogram_stats(k) for k in histogram_keys}
         }
 
 
@@ -426,7 +565,8 @@ class MonitoringService:
     """監控服務"""
     
     def __init__(self):
-        self.metrics = MetricsCollector()
+        # 請求級指標量大：原始歷史只採樣 10%，分佈與計數不受影響
+        self.metrics = MetricsCollector(history_sample_rate=0.1)
         self.system_metrics = SystemMetricsCollector(self.metrics)
         self.health_checker = HealthChecker()
         self.alert_manager = AlertManager(self.metrics)
@@ -591,6 +731,7 @@ __all__ = [
     'HealthStatus',
     'AlertSeverity',
     'Metric',
+    'StreamingHistogram',
     'HealthCheck',
     'AlertRule',
     'Alert',
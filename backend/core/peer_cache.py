@@ -0,0 +1,473 @@
+"""
+群組/頻道 Peer 解析緩存
+
+所有帳號共享的「群組引用 → chat」映射：
+1. 鍵為標準化的引用（用戶名 / 邀請鏈接 hash / 數字 ID）
+2. 值為 chat_id、標題、類型、成員數，以及各帳號的 access_hash
+3. 正向緩存長 TTL（用戶名 → chat_id 很少變化），負向緩存短 TTL（不存在的用戶名、過期邀請）
+4. 內存為主，批量寫回 SQLite，重啟後無需重新通過網絡解析
+5. 事件循環中的寫回在數據庫線程池執行（core.db_executor）；批量遍歷用 batch() 暫停
+   自動寫回，結束後 await flush_async() 一次寫入
+
+用法:
+    from core.peer_cache import get_peer_cache
+    chat = await get_peer_cache().resolve(client, phone, "https://t.me/some_group")
+    chat.id, chat.title
+
+    with peer_cache.batch():
+        async for dialog in client.get_dialogs():
+            await peer_cache.remember(client, phone, dialog.chat.id, dialog.chat)
+    await peer_cache.flush_async()
+"""
+
+import re
+import asyncio
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+# 可負向緩存的錯誤（目標確定不存在或鏈接已失效）
+_NEGATIVE_ERROR_MARKERS = (
+    'username_not_occupied', 'usernamenotoccupied',
+    'username_invalid', 'usernameinvalid',
+    'invite_hash_expired', 'invitehashexpired',
+    'invite_hash_invalid', 'invitehashinvalid',
+)
+
+_TME_PATTERN = re.compile(r'(?:https?://)?(?:t\.me|telegram\.me)/(joinchat/)?([^/\s?]+)', re.IGNORECASE)
+
+
+class PeerNotFound(Exception):
+    """負向緩存命中：目標此前已確認無法解析（消息保留原始錯誤文本）"""
+
+
+@dataclass
+class PeerEntry:
+    """緩存的 chat 信息（字段與 pyrogram Chat 同名，可直接替代使用）"""
+    ref: str
+    id: Optional[int] = None
+    title: str = ""
+    type: str = ""
+    username: str = ""
+    members_count: int = 0
+    access_hashes: Dict[str, int] = field(default_factory=dict)
+    negative: bool = False
+    error: str = ""
+    updated_at: float = field(default_factory=time.time)
+
+    @property
+    def is_invite(self) -> bool:
+        return self.ref.startswith('+')
+
+
+def normalize_peer_ref(ref: Union[str, int]) -> str:
+    """
+    標準化群組引用
+
+    - https://t.me/Name、@Name、Name → name（用戶名不區分大小寫）
+    - t.me/+hash、t.me/joinchat/hash → +hash（邀請 hash 區分大小寫）
+    - 數字 ID → 原樣字符串
+    """
+    if isinstance(ref, int):
+        return str(ref)
+    value = str(ref).strip()
+    if value.lstrip('-').isdigit():
+        return value
+    match = _TME_PATTERN.search(value)
+    if match:
+        joinchat, value = match.group(1), match.group(2)
+        if joinchat and not value.startswith('+'):
+            value = '+' + value
+    if value.startswith('+'):
+        return value
+    return value.lstrip('@').lower()
+
+
+def chat_type_name(chat: Any) -> str:
+    """chat.type 統一為小寫名稱（ChatType.SUPERGROUP → 'supergroup'），緩存和網絡結果一致"""
+    chat_type = getattr(chat, 'type', '')
+    chat_type = getattr(chat_type, 'name', chat_type) or ''
+    return str(chat_type).lower()
+
+
+def is_negative_error(error: BaseException) -> bool:
+    """判斷錯誤是否表示目標確定不存在（可負向緩存）"""
+    text = f"{type(error).__name__} {error}".lower()
+    return any(marker in text for marker in _NEGATIVE_ERROR_MARKERS)
+
+
+class PeerCache:
+    """共享 Peer 解析緩存（內存 LRU + SQLite 寫回）"""
+
+    def __init__(
+        self,
+        db_path: Optional[Union[str, Path]] = None,
+        ttl: float = 7 * 86400,
+        negative_ttl: float = 3600,
+        max_entries: int = 20000,
+        flush_interval: float = 30.0,
+        flush_batch: int = 50,
+    ):
+        self.db_path = Path(db_path) if db_path else None
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+
+        self._entries: "OrderedDict[str, PeerEntry]" = OrderedDict()
+        self._by_chat_id: Dict[int, str] = {}
+        self._pending: Dict[str, Optional[PeerEntry]] = {}  # ref -> entry（None 表示刪除）
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._last_flush = time.time()
+        self._batch_depth = 0
+        self._flush_task: Optional[asyncio.Task] = None
+
+        self._stats = {'hits': 0, 'misses': 0, 'negative_hits': 0, 'network_resolves': 0}
+
+    # ==================== 查詢與寫入 ====================
+
+    def get(self, ref: Union[str, int]) -> Optional[PeerEntry]:
+        """獲取未過期的緩存條目（可能是負向條目）"""
+        self._ensure_loaded()
+        key = normalize_peer_ref(ref)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and key.lstrip('-').isdigit():
+                alias = self._by_chat_id.get(int(key))
+                entry = self._entries.get(alias) if alias else None
+            if entry is None:
+                return None
+            ttl = self.negative_ttl if entry.negative else self.ttl
+            if time.time() - entry.updated_at > ttl:
+                self._remove_locked(entry.ref)
+                return None
+            self._entries.move_to_end(entry.ref)
+            return entry
+
+    def put(
+        self,
+        ref: Union[str, int],
+        chat: Any,
+        phone: Optional[str] = None,
+        access_hash: Optional[int] = None,
+    ) -> PeerEntry:
+        """
+        記錄成功解析的 chat
+
+        Args:
+            ref: 原始引用（URL / 用戶名 / 邀請鏈接 / ID）
+            chat: pyrogram Chat 或 PeerEntry（需有 id/title/type）
+            phone: 解析該 chat 的帳號
+            access_hash: 該帳號的 access_hash（access_hash 按帳號區分）
+        """
+        self._ensure_loaded()
+        key = normalize_peer_ref(ref)
+        with self._lock:
+            existing = self._entries.get(key)
+            hashes = dict(existing.access_hashes) if existing and not existing.negative else {}
+            if phone and access_hash is not None:
+                hashes[phone] = int(access_hash)
+            entry = PeerEntry(
+                ref=key,
+                id=int(chat.id),
+                title=getattr(chat, 'title', '') or '',
+                type=chat_type_name(chat),
+                username=(getattr(chat, 'username', '') or '').lower(),
+                members_count=getattr(chat, 'members_count', 0) or 0,
+                access_hashes=hashes,
+            )
+            self._store_locked(entry)
+            # 用戶名和數字 ID 也作為別名，方便後續用任一形式命中
+            if entry.username and entry.username != key:
+                self._store_locked(PeerEntry(**{**entry.__dict__, 'ref': entry.username}))
+        self._maybe_flush()
+        return entry
+
+    def put_negative(self, ref: Union[str, int], error: Union[str, BaseException]) -> None:
+        """記錄無法解析的引用（短 TTL）"""
+        self._ensure_loaded()
+        key = normalize_peer_ref(ref)
+        with self._lock:
+            self._store_locked(PeerEntry(ref=key, negative=True, error=str(error)))
+        self._maybe_flush()
+
+    def invalidate(self, ref: Union[str, int]) -> None:
+        """使條目失效（例如 chat_id 解析出錯時）"""
+        self._ensure_loaded()
+        key = normalize_peer_ref(ref)
+        with self._lock:
+            if key.lstrip('-').isdigit() and key not in self._entries:
+                key = self._by_chat_id.get(int(key), key)
+            self._remove_locked(key)
+        self._maybe_flush()
+
+    def get_access_hash(self, phone: str, ref: Union[str, int]) -> Optional[int]:
+        entry = self.get(ref)
+        if entry and not entry.negative:
+            return entry.access_hashes.get(phone)
+        return None
+
+    def has_access(self, phone: str, ref: Union[str, int]) -> bool:
+        """帳號是否曾成功解析過該群組"""
+        return self.get_access_hash(phone, ref) is not None
+
+    def _store_locked(self, entry: PeerEntry) -> None:
+        self._entries[entry.ref] = entry
+        self._entries.move_to_end(entry.ref)
+        if entry.id is not None:
+            self._by_chat_id[entry.id] = entry.ref
+        self._pending[entry.ref] = entry
+        while len(self._entries) > self.max_entries:
+            old_ref, old = self._entries.popitem(last=False)
+            if old.id is not None and self._by_chat_id.get(old.id) == old_ref:
+                del self._by_chat_id[old.id]
+            self._pending[old_ref] = None
+
+    def _remove_locked(self, ref: str) -> None:
+        entry = self._entries.pop(ref, None)
+        if entry and entry.id is not None and self._by_chat_id.get(entry.id) == ref:
+            del self._by_chat_id[entry.id]
+        self._pending[ref] = None
+
+    # ==================== 網絡解析 ====================
+
+    async def resolve(
+        self,
+        client: Any,
+        phone: str,
+        ref: Union[str, int],
+        force: bool = False,
+        require_access: bool = True,
+    ) -> Any:
+        """
+        解析群組引用：優先使用緩存，未命中時調用 client.get_chat 並寫入緩存
+
+        Args:
+            require_access: 只有該帳號曾解析過（本地 session 已有 peer）才使用緩存，
+                保證返回的 chat.id 可直接用於該帳號的後續 API 調用；
+                只需要元數據（標題、chat_id）時可設為 False
+
+        Returns:
+            PeerEntry（緩存命中）或 pyrogram Chat（網絡解析）；兩者均有 id/title/type/members_count
+
+        Raises:
+            PeerNotFound: 負向緩存命中
+            其他異常: 與 client.get_chat 相同
+        """
+        if not force:
+            entry = self.get(ref)
+            if entry is not None:
+                if entry.negative:
+                    self._stats['negative_hits'] += 1
+                    raise PeerNotFound(entry.error or f"peer not found: {ref}")
+                if phone in entry.access_hashes or not require_access:
+                    self._stats['hits'] += 1
+                    return entry
+
+        self._stats['misses'] += 1
+        key = normalize_peer_ref(ref)
+        target: Union[str, int] = key
+        if key.lstrip('-').isdigit():
+            target = int(key)
+        elif key.startswith('+'):
+            target = f"https://t.me/{key}"
+
+        try:
+            self._stats['network_resolves'] += 1
+            chat = await client.get_chat(target)
+        except Exception as e:
+            if is_negative_error(e):
+                self.put_negative(ref, e)
+            raise
+
+        # 未加入的邀請鏈接返回 ChatPreview（無 id），不緩存
+        if getattr(chat, 'id', None) is None:
+            return chat
+        await self.remember(client, phone, ref, chat)
+        return chat
+
+    async def remember(self, client: Any, phone: str, ref: Union[str, int], chat: Any) -> PeerEntry:
+        """記錄帳號已解析/加入的 chat（讀取本地 access_hash 後寫入緩存）"""
+        return self.put(ref, chat, phone=phone, access_hash=await self._read_access_hash(client, chat.id))
+
+    @staticmethod
+    async def _read_access_hash(client: Any, chat_id: int) -> Optional[int]:
+        """從客戶端本地 session 讀取 access_hash（不發網絡請求）"""
+        try:
+            peer = await client.storage.get_peer_by_id(chat_id)
+            # 基礎群組（InputPeerChat）沒有 access_hash，記為 0 表示該帳號可直接使用
+            return int(getattr(peer, 'access_hash', 0) or 0)
+        except Exception:
+            return None
+
+    # ==================== 持久化 ====================
+
+    def _connect(self) -> sqlite3.Connection:
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.db_path), timeout=5)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS peer_cache (
+                ref TEXT PRIMARY KEY,
+                chat_id INTEGER,
+                title TEXT,
+                chat_type TEXT,
+                username TEXT,
+                members_count INTEGER DEFAULT 0,
+                access_hashes TEXT,
+                negative INTEGER DEFAULT 0,
+                error TEXT,
+                updated_at REAL
+            )
+        ''')
+        return conn
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+            if not self.db_path:
+                return
+            try:
+                conn = self._connect()
+                try:
+                    now = time.time()
+                    rows = conn.execute(
+                        "SELECT ref, chat_id, title, chat_type, username, members_count, access_hashes, "
+                        "negative, error, updated_at FROM peer_cache "
+                        "WHERE (negative = 0 AND updated_at > ?) OR (negative = 1 AND updated_at > ?) "
+                        "ORDER BY updated_at DESC LIMIT ?",
+                        (now - self.ttl, now - self.negative_ttl, self.max_entries)
+                    ).fetchall()
+                finally:
+                    conn.close()
+            except Exception as e:
+                logger.warning(f"Failed to load peer cache: {e}")
+                return
+            for row in reversed(rows):
+                entry = PeerEntry(
+                    ref=row[0], id=row[1], title=row[2] or '', type=row[3] or '',
+                    username=row[4] or '', members_count=row[5] or 0,
+                    access_hashes={k: int(v) for k, v in json.loads(row[6] or '{}').items()},
+                    negative=bool(row[7]), error=row[8] or '', updated_at=row[9] or 0,
+                )
+                self._entries[entry.ref] = entry
+                if entry.id is not None:
+                    self._by_chat_id[entry.id] = entry.ref
+
+    @contextmanager
+    def batch(self):
+        """批量寫入期間暫停自動寫回（結束後由調用方 await flush_async() 一次寫入）"""
+        with self._lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+
+    def _maybe_flush(self) -> None:
+        if self._batch_depth or not self.db_path or not self._pending:
+            return
+        if len(self._pending) < self.flush_batch and time.time() - self._last_flush < self.flush_interval:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        # 事件循環中不做同步 SQLite 寫入，交給數據庫線程池（同一時間只排一個）
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self.flush_async())
+
+    async def flush_async(self) -> int:
+        """在數據庫線程池中寫回待寫入的變更（事件循環中使用）"""
+        if not self.db_path or not self._pending:
+            return 0
+        from core.db_executor import run_db
+        return await run_db(self.flush)
+
+    def flush(self) -> int:
+        """將待寫入的變更批量寫回 SQLite（單個事務）"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+        if not self.db_path or not pending:
+            return 0
+        upserts: List[tuple] = []
+        deletes: List[tuple] = []
+        for ref, entry in pending.items():
+            if entry is None:
+                deletes.append((ref,))
+            else:
+                upserts.append((
+                    entry.ref, entry.id, entry.title, entry.type, entry.username, entry.members_count,
+                    json.dumps(entry.access_hashes), int(entry.negative), entry.error, entry.updated_at,
+                ))
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    if deletes:
+                        conn.executemany("DELETE FROM peer_cache WHERE ref = ?", deletes)
+                    if upserts:
+                        conn.executemany(
+                            "INSERT OR REPLACE INTO peer_cache (ref, chat_id, title, chat_type, username, "
+                            "members_count, access_hashes, negative, error, updated_at) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            upserts
+                        )
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.warning(f"Failed to flush peer cache: {e}")
+            with self._lock:
+                for ref, entry in pending.items():
+                    self._pending.setdefault(ref, entry)
+            return 0
+        return len(pending)
+
+    def clear(self) -> None:
+        with self._lock:
+            for ref in list(self._entries.keys()):
+                self._remove_locked(ref)
+        self.flush()
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self._stats['hits'] + self._stats['misses'] + self._stats['negative_hits']
+        return {
+            **self._stats,
+            'entries': len(self._entries),
+            'pending_writes': len(self._pending),
+            'hit_rate': round((self._stats['hits'] + self._stats['negative_hits']) / lookups, 3) if lookups else 0,
+        }
+
+
+_peer_cache: Optional[PeerCache] = None
+
+
+def get_peer_cache() -> PeerCache:
+    """獲取全局 Peer 緩存（持久化到數據目錄下的 peer_cache.db）"""
+    global _peer_cache
+    if _peer_cache is None:
+        db_path = None
+        try:
+            from config import DATABASE_DIR
+            db_path = Path(DATABASE_DIR) / 'peer_cache.db'
+        except Exception:
+            pass
+        _peer_cache = PeerCache(db_path=db_path)
+    return _peer_cache
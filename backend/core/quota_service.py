@@ -15,6 +15,12 @@
 - 異步配額記錄
 - 智能告警去重
 - 配額使用趨勢分析
+
+🆕 P18-13: 內存配額賬本
+- 每用戶一條賬本（等級 + 全部配額上限 + 使用量），首次訪問時用單個連接一次性加載
+- 帳號/群組增刪等領域事件、每日消耗直接更新賬本，check_quota 為 O(1) 內存讀取
+- 消耗記錄 / 日誌 / 告警寫入待刷隊列，由 run_write_behind() 分批寫回
+- 異步調用方使用 check_quota_async / consume_quota_async，冷加載在線程中執行
 """
 
 import sqlite3
@@ -28,6 +34,9 @@ from enum import Enum
 from contextlib import contextmanager
 import logging
 import threading
+import time
+
+from core.db_executor import db_connection, get_db_executor, run_db
 
 logger = logging.getLogger(__name__)
 
@@ -106,6 +115,16 @@ class QuotaUsageSummary:
         }
 
 
+@dataclass
+class QuotaLedgerEntry:
+    """🆕 P18-13: 單個用戶的內存配額賬本"""
+    tier: str
+    limits: Dict[str, int]
+    usage: Dict[str, int]
+    day: str                     # 每日配額所屬日期
+    loaded_at: float             # time.monotonic()
+
+
 # ==================== 核心配額服務 ====================
 
 class QuotaService:
@@ -130,6 +149,15 @@ class QuotaService:
     WARNING_THRESHOLD = 80   # 80% 警告
     CRITICAL_THRESHOLD = 95  # 95% 臨界
     
+    # 🆕 P18-13: 賬本覆蓋的配額類型
+    LEDGER_QUOTA_TYPES = (
+        'tg_accounts', 'daily_messages', 'ai_calls', 'devices', 'groups',
+        'keyword_sets', 'auto_reply_rules', 'scheduled_tasks',
+        'data_retention_days', 'platform_api_quota', 'platform_api_max_accounts',
+    )
+    LEDGER_TTL = 300            # 賬本過期後在後台重新加載（兜底跨進程/漏發事件的漂移）
+    FLUSH_INTERVAL = 1.0        # 寫回間隔（秒）
+    
     def __new__(cls, db_path: str = None):
         if cls._instance is None:
             with cls._lock:
@@ -168,6 +196,17 @@ class QuotaService:
         # 🔧 P6-3: 配額變更回調（用於 WebSocket 推送）
         self._change_callbacks: list = []
         
+        # 🆕 P18-13: 內存賬本 + 寫回隊列
+        self._ledger: Dict[str, QuotaLedgerEntry] = {}
+        self._ledger_lock = threading.RLock()
+        # 寫回與冷加載互斥：加載要麼在增量寫入前讀庫（從隊列合併），要麼在提交後讀庫
+        self._flush_lock = threading.RLock()
+        self._refreshing: set = set()
+        self._pending_usage: Dict[Tuple[str, str, str], int] = {}  # (user_id, quota_type, date) -> delta
+        self._pending_logs: List[tuple] = []
+        self._pending_alerts: List[tuple] = []
+        self._write_behind_active = False
+        
         self._init_db()
         self._initialized = True
         logger.info("QuotaService initialized")
@@ -281,9 +320,13 @@ class QuotaService:
     
     # ==================== 配額限制獲取 ====================
     
-    def _get_user_tier(self, user_id: str) -> str:
+    def _get_user_tier(self, user_id: str, db: sqlite3.Connection = None) -> str:
         """獲取用戶等級（優先 users.membership_level，與後台/卡密一致）"""
-        db = self._get_db()
+        entry = self._ledger.get(user_id) if db is None else None
+        if entry is not None:
+            return entry.tier
+        own_db = db is None
+        db = db or self._get_db()
         try:
             # 1. 優先從 users 表取 membership_level（與 auth/me、後台一致）
             row = db.execute('''
@@ -305,9 +348,16 @@ class QuotaService:
             logger.warning(f"[QuotaService] _get_user_tier user_id={user_id} error={e}, fallback=bronze")
             return 'bronze'
         finally:
-            db.close()
+            if own_db:
+                db.close()
     
-    def _get_quota_limit(self, user_id: str, quota_type: str) -> int:
+    def _get_quota_limit(
+        self,
+        user_id: str,
+        quota_type: str,
+        db: sqlite3.Connection = None,
+        tier: str = None
+    ) -> int:
         """
         獲取配額上限
         
@@ -322,10 +372,11 @@ class QuotaService:
                 if user_id in self._quota_cache and quota_type in self._quota_cache[user_id]:
                     return self._quota_cache[user_id][quota_type]
         
-        db = self._get_db()
+        own_db = db is None
+        db = db or self._get_db()
         try:
             # 先取 tier，用於 king 的 tg_accounts 不採信自定義配額
-            tier = self._get_user_tier(user_id)
+            tier = tier or self._get_user_tier(user_id, db)
             
             # 1. 檢查自定義配額（管理員調整）；king 的 tg_accounts 強制用等級 -1，不覆蓋
             try:
@@ -379,7 +430,8 @@ class QuotaService:
             logger.info(f"[QuotaService] _get_quota_limit user_id={user_id} {quota_type} limit={limit} source=default")
             return limit
         finally:
-            db.close()
+            if own_db:
+                db.close()
     
     def _get_default_limit(self, quota_type: str) -> int:
         """獲取默認配額限制"""
@@ -408,23 +460,26 @@ class QuotaService:
     def invalidate_cache(self, user_id: str = None):
         """清除緩存"""
         if user_id:
+            self._ledger.pop(user_id, None)
             self._quota_cache.pop(user_id, None)
             self._usage_cache.pop(user_id, None)
             keys_to_remove = [k for k in self._cache_timestamps if k.startswith(f"{user_id}:")]
             for k in keys_to_remove:
                 del self._cache_timestamps[k]
         else:
+            self._ledger.clear()
             self._quota_cache.clear()
             self._usage_cache.clear()
             self._cache_timestamps.clear()
     
     # ==================== 使用量查詢 ====================
     
-    def _get_current_usage(self, user_id: str, quota_type: str) -> int:
-        """獲取當前使用量"""
+    def _get_current_usage(self, user_id: str, quota_type: str, db: sqlite3.Connection = None) -> int:
+        """獲取當前使用量（直接查庫；熱路徑請用賬本 _ledger_usage）"""
         today = date.today().isoformat()
         
-        db = self._get_db()
+        own_db = db is None
+        db = db or self._get_db()
         try:
             # 對於每日重置的配額，查詢今日使用量
             if quota_type in self.DAILY_RESET_QUOTAS:
@@ -503,7 +558,8 @@ class QuotaService:
             logger.warning(f"Failed to get usage for {quota_type}: {e}")
             return 0
         finally:
-            db.close()
+            if own_db:
+                db.close()
     
     def _get_reserved(self, user_id: str, quota_type: str) -> int:
         """獲取預留配額"""
@@ -511,6 +567,188 @@ class QuotaService:
             return self._reservations[user_id].get(quota_type, 0)
         return 0
     
+    # ==================== 🆕 P18-13: 內存配額賬本 ====================
+    
+    # 按業務表實時計數的配額；其餘配額的使用量按日期記錄在 quota_usage
+    COUNTED_QUOTAS = frozenset({
+        'tg_accounts', 'groups', 'devices', 'keyword_sets', 'auto_reply_rules', 'scheduled_tasks'
+    })
+    
+    def _load_ledger_entry(self, user_id: str) -> QuotaLedgerEntry:
+        """用單個連接加載用戶等級、全部配額上限和使用量"""
+        today = date.today().isoformat()
+        with self._flush_lock:
+            with db_connection(self.db_path, self._get_db) as db:
+                tier = self._get_user_tier(user_id, db)
+                limits = {qt: self._get_quota_limit(user_id, qt, db, tier) for qt in self.LEDGER_QUOTA_TYPES}
+                usage = {qt: self._get_current_usage(user_id, qt, db) for qt in self.LEDGER_QUOTA_TYPES}
+            
+            with self._ledger_lock:
+                # 已消耗但尚未寫回的部分數據庫裡還看不到
+                for (uid, qt, day), delta in self._pending_usage.items():
+                    if uid == user_id and day == today:
+                        usage[qt] = usage.get(qt, 0) + delta
+                entry = QuotaLedgerEntry(tier=tier, limits=limits, usage=usage, day=today, loaded_at=time.monotonic())
+                self._ledger[user_id] = entry
+        return entry
+    
+    def _ledger_entry(self, user_id: str) -> QuotaLedgerEntry:
+        """獲取賬本：冷用戶同步加載；過期條目先返回舊值並在後台刷新"""
+        entry = self._ledger.get(user_id)
+        if entry is None:
+            return self._load_ledger_entry(user_id)
+        if time.monotonic() - entry.loaded_at > self.LEDGER_TTL:
+            self._schedule_refresh(user_id)
+        today = date.today().isoformat()
+        if entry.day != today:
+            with self._ledger_lock:
+                if entry.day != today:
+                    for qt in entry.usage:
+                        if qt not in self.COUNTED_QUOTAS:
+                            entry.usage[qt] = 0
+                    entry.day = today
+        return entry
+    
+    def _schedule_refresh(self, user_id: str):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 同步調用方（線程 / 腳本）：直接重新加載
+            self._load_ledger_entry(user_id)
+            return
+        with self._ledger_lock:
+            if user_id in self._refreshing:
+                return
+            self._refreshing.add(user_id)
+        
+        async def _refresh():
+            try:
+                await run_db(self._load_ledger_entry, user_id)
+            except Exception as e:
+                logger.warning(f"[QuotaLedger] Refresh failed for {user_id}: {e}")
+            finally:
+                self._refreshing.discard(user_id)
+        
+        loop.create_task(_refresh())
+    
+    def _ledger_value(self, entry: QuotaLedgerEntry, user_id: str, quota_type: str) -> Tuple[int, int]:
+        """從賬本讀取 (limit, used)；賬本外的配額類型首次訪問時補入"""
+        if quota_type not in entry.limits:
+            limit = self._get_quota_limit(user_id, quota_type)
+            used = self._get_current_usage(user_id, quota_type)
+            with self._ledger_lock:
+                entry.limits[quota_type] = limit
+                entry.usage.setdefault(quota_type, used)
+        return entry.limits[quota_type], entry.usage.get(quota_type, 0)
+    
+    def apply_usage_event(self, user_id: str, quota_type: str, delta: int = 1):
+        """
+        領域事件（帳號/群組新增或刪除）直接調整賬本中的計數
+        
+        用戶賬本未加載時忽略：下次訪問會從數據庫讀取最新值
+        """
+        if not user_id:
+            return
+        with self._ledger_lock:
+            entry = self._ledger.get(user_id)
+            if entry is None or quota_type not in entry.usage:
+                return
+            entry.usage[quota_type] = max(0, entry.usage[quota_type] + delta)
+        self._notify_change(user_id, quota_type, 'usage_event')
+    
+    async def check_quota_async(self, user_id: str, quota_type: str, amount: int = 1) -> 'QuotaCheckResult':
+        """事件循環內使用：冷加載放到線程中，熱路徑為純內存讀取"""
+        if user_id not in self._ledger:
+            await run_db(self._load_ledger_entry, user_id)
+        return self.check_quota(user_id, quota_type, amount)
+    
+    async def consume_quota_async(
+        self,
+        user_id: str,
+        quota_type: str,
+        amount: int = 1,
+        context: str = None,
+        check_first: bool = True
+    ) -> Tuple[bool, 'QuotaCheckResult']:
+        if user_id not in self._ledger:
+            await run_db(self._load_ledger_entry, user_id)
+        return self.consume_quota(user_id, quota_type, amount, context, check_first)
+    
+    # ==================== 🆕 P18-13: 寫回（write-behind） ====================
+    
+    def _has_pending(self) -> bool:
+        return bool(self._pending_usage or self._pending_logs or self._pending_alerts)
+    
+    def _request_flush(self):
+        """未啟動後台寫回時：有事件循環則提交到數據庫線程池，否則同步刷新"""
+        if self._write_behind_active:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_pending()
+            return
+        get_db_executor().submit(self.flush_pending)
+    
+    def flush_pending(self) -> int:
+        """
+        把待刷的使用量增量、操作日誌和告警一次性寫入數據庫
+        
+        取出→寫入→提交全程持有 _flush_lock，冷加載不會在兩者之間讀庫而漏算增量
+        
+        Returns:
+            寫入的記錄數；失敗時增量放回隊列，等待下次重試
+        """
+        with self._flush_lock:
+            with self._ledger_lock:
+                usage, logs, alerts = self._pending_usage, self._pending_logs, self._pending_alerts
+                self._pending_usage, self._pending_logs, self._pending_alerts = {}, [], []
+            if not (usage or logs or alerts):
+                return 0
+        
+            with db_connection(self.db_path, self._get_db) as db:
+                try:
+                    db.executemany('''
+                        INSERT INTO quota_usage (user_id, quota_type, date, used)
+                        VALUES (?, ?, ?, ?)
+                        ON CONFLICT(user_id, quota_type, date) DO UPDATE SET
+                            used = used + excluded.used,
+                            updated_at = CURRENT_TIMESTAMP
+                    ''', [(uid, qt, day, delta) for (uid, qt, day), delta in usage.items()])
+                    db.executemany('''
+                        INSERT INTO quota_logs 
+                        (user_id, quota_type, action, amount, before_value, after_value, context)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ''', logs)
+                    db.executemany('''
+                        INSERT INTO quota_alerts_v2 
+                        (user_id, quota_type, alert_level, threshold, current_value, limit_value, message)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ''', alerts)
+                    db.commit()
+                except Exception as e:
+                    db.rollback()
+                    logger.error(f"[QuotaLedger] Write-behind flush failed, will retry: {e}")
+                    with self._ledger_lock:
+                        for key, delta in usage.items():
+                            self._pending_usage[key] = self._pending_usage.get(key, 0) + delta
+                        self._pending_logs[:0] = logs
+                        self._pending_alerts[:0] = alerts
+                    return 0
+            return len(usage) + len(logs) + len(alerts)
+    
+    async def run_write_behind(self, interval: float = None):
+        """後台寫回循環（啟動時創建任務）；退出時刷新剩餘數據"""
+        self._write_behind_active = True
+        try:
+            while True:
+                await asyncio.sleep(interval or self.FLUSH_INTERVAL)
+                if self._has_pending():
+                    await run_db(self.flush_pending)
+        finally:
+            self._write_behind_active = False
+            self.flush_pending()
+    
     # ==================== 核心配額操作 ====================
     
     def check_quota(
@@ -530,8 +768,8 @@ class QuotaService:
         Returns:
             QuotaCheckResult 包含檢查結果和狀態
         """
-        limit = self._get_quota_limit(user_id, quota_type)
-        used = self._get_current_usage(user_id, quota_type)
+        entry = self._ledger_entry(user_id)
+        limit, used = self._ledger_value(entry, user_id, quota_type)
         reserved = self._get_reserved(user_id, quota_type)
         if quota_type == 'tg_accounts':
             logger.info(f"[QuotaService] check_quota tg_accounts user_id={user_id} limit={limit} used={used} reserved={reserved}")
@@ -629,34 +867,21 @@ class QuotaService:
             result = self.check_quota(user_id, quota_type, amount)
             return result.allowed, result
         
-        # 記錄消耗
+        # 記錄消耗：更新內存賬本，數據庫寫入進入寫回隊列
         today = date.today().isoformat()
-        db = self._get_db()
         try:
-            # 獲取當前值
-            before_value = self._get_current_usage(user_id, quota_type)
-            after_value = before_value + amount
-            
-            # 更新使用量
-            db.execute('''
-                INSERT INTO quota_usage (user_id, quota_type, date, used)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(user_id, quota_type, date) DO UPDATE SET
-                    used = used + ?,
-                    updated_at = CURRENT_TIMESTAMP
-            ''', (user_id, quota_type, today, amount, amount))
-            
-            # 記錄日誌
-            db.execute('''
-                INSERT INTO quota_logs 
-                (user_id, quota_type, action, amount, before_value, after_value, context)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                user_id, quota_type, QuotaAction.CONSUME.value, 
-                amount, before_value, after_value, context
-            ))
-            
-            db.commit()
+            entry = self._ledger_entry(user_id)
+            self._ledger_value(entry, user_id, quota_type)
+            with self._ledger_lock:
+                before_value = entry.usage.get(quota_type, 0)
+                after_value = before_value + amount
+                entry.usage[quota_type] = after_value
+                key = (user_id, quota_type, today)
+                self._pending_usage[key] = self._pending_usage.get(key, 0) + amount
+                self._pending_logs.append((
+                    user_id, quota_type, QuotaAction.CONSUME.value,
+                    amount, before_value, after_value, context
+                ))
             
             # 清除緩存
             if user_id in self._usage_cache:
@@ -670,12 +895,11 @@ class QuotaService:
             # 🔧 P6-3: 通知配額變更
             self._notify_change(user_id, quota_type, 'consume', result)
             
+            self._request_flush()
             return True, result
         except Exception as e:
             logger.error(f"Failed to consume quota: {e}")
             return False, self.check_quota(user_id, quota_type)
-        finally:
-            db.close()
     
     def reserve_quota(
         self, 
@@ -838,16 +1062,14 @@ class QuotaService:
         """
         with self._lock:
             if commit:
-                # 成功：釋放預留（業務操作已增加實際帳號數，配額自然遞增）
+                # 成功：釋放預留，業務操作已新增實際記錄 → 賬本使用量同步遞增
                 self.release_reservation(user_id, quota_type, amount, consume=False)
+                self.apply_usage_event(user_id, quota_type, amount)
                 logger.info(f"[AtomicQuota] Committed {amount} {quota_type} for user {user_id}")
             else:
-                # 失敗：回滾預留
+                # 失敗：回滾預留（使用量未變）
                 self.release_reservation(user_id, quota_type, amount, consume=False)
                 logger.info(f"[AtomicQuota] Rolled back {amount} {quota_type} for user {user_id}")
-            
-            # 清除緩存
-            self.invalidate_cache(user_id)
         
         # 🔧 P6-3: 通知配額變更（提交或回滾都需通知前端刷新）
         action = 'commit' if commit else 'rollback'
@@ -934,7 +1156,7 @@ class QuotaService:
     
     def get_usage_summary(self, user_id: str) -> QuotaUsageSummary:
         """獲取用戶配額使用摘要"""
-        tier = self._get_user_tier(user_id)
+        tier = self._ledger_entry(user_id).tier
         
         # 獲取等級名稱
         tier_name = tier
@@ -995,8 +1217,24 @@ class QuotaService:
         today = date.today().isoformat()
         yesterday = (date.today() - timedelta(days=1)).isoformat()
         
-        db = self._get_db()
+        # 先寫回昨日尚未落庫的消耗，保證日誌中的 before_value 準確
+        await run_db(self.flush_pending)
+        
         try:
+            reset_count = await run_db(self._log_daily_reset, yesterday)
+            logger.info(f"Reset daily quotas for {reset_count} users")
+            
+            # 清除緩存
+            self._usage_cache.clear()
+            
+            return reset_count
+        except Exception as e:
+            logger.error(f"Failed to reset daily quotas: {e}")
+            return 0
+    
+    def _log_daily_reset(self, yesterday: str) -> int:
+        """為昨日有使用記錄的用戶寫入重置日誌（在數據庫線程池中執行）"""
+        with db_connection(self.db_path, self._get_db) as db:
             # 獲取昨日有使用記錄的用戶
             rows = db.execute('''
                 SELECT DISTINCT user_id FROM quota_usage 
@@ -1021,17 +1259,7 @@ class QuotaService:
                 reset_count += 1
             
             db.commit()
-            logger.info(f"Reset daily quotas for {reset_count} users")
-            
-            # 清除緩存
-            self._usage_cache.clear()
-            
             return reset_count
-        except Exception as e:
-            logger.error(f"Failed to reset daily quotas: {e}")
-            return 0
-        finally:
-            db.close()
     
     # ==================== 告警機制 ====================
     
@@ -1049,44 +1277,34 @@ class QuotaService:
             if datetime.now() - self._alert_cooldown[alert_key] < timedelta(seconds=self._alert_cooldown_seconds):
                 return  # 在冷卻期內，不重複發送
         
-        # 記錄告警
-        db = self._get_db()
-        try:
-            db.execute('''
-                INSERT INTO quota_alerts_v2 
-                (user_id, quota_type, alert_level, threshold, current_value, limit_value, message)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
+        # 記錄告警（進入寫回隊列）
+        with self._ledger_lock:
+            self._pending_alerts.append((
                 user_id, quota_type, result.status.value,
                 int(result.percentage), result.used, result.limit, result.message
             ))
-            db.commit()
-            
-            # 更新冷卻時間
-            self._alert_cooldown[alert_key] = datetime.now()
-            
-            # 發送實時通知（如果有 WebSocket 連接）
-            try:
-                from .realtime import notify_user, EventType
-                asyncio.create_task(notify_user(
-                    user_id, 
-                    EventType.QUOTA_WARNING,
-                    {
-                        'quota_type': quota_type,
-                        'status': result.status.value,
-                        'message': result.message,
-                        'percentage': result.percentage,
-                        'upgrade_suggestion': result.upgrade_suggestion
-                    }
-                ))
-            except:
-                pass
-            
-            logger.info(f"Quota alert sent: {user_id} - {quota_type} - {result.status.value}")
-        except Exception as e:
-            logger.error(f"Failed to send quota alert: {e}")
-        finally:
-            db.close()
+        
+        # 更新冷卻時間
+        self._alert_cooldown[alert_key] = datetime.now()
+        
+        # 發送實時通知（如果有 WebSocket 連接）
+        try:
+            from .realtime import notify_user, EventType
+            asyncio.create_task(notify_user(
+                user_id, 
+                EventType.QUOTA_WARNING,
+                {
+                    'quota_type': quota_type,
+                    'status': result.status.value,
+                    'message': result.message,
+                    'percentage': result.percentage,
+                    'upgrade_suggestion': result.upgrade_suggestion
+                }
+            ))
+        except:
+            pass
+        
+        logger.info(f"Quota alert sent: {user_id} - {quota_type} - {result.status.value}")
     
     def get_user_alerts(
         self, 
@@ -6,19 +6,31 @@ API 速率限制服務
 2. 滑動窗口算法
 3. 令牌桶算法
 4. 動態限流配置
+
+🆕 P18-14: 熱路徑優化
+- 滑動窗口改為「雙桶加權」計數：每個鍵 O(1) 狀態、O(1) 檢查
+- 空閒鍵（窗口計數 / 令牌桶）定期過期，內存不再隨訪問 IP 數無限增長
+- 規則預編譯（路徑正則 / 方法 / 等級集合），請求時不再逐條 fnmatch
+- 拒絕日誌進入隊列，由後台線程批量寫入
 """
 
 import os
+import re
+import atexit
+import asyncio
 import sqlite3
+import fnmatch
 import logging
 import time
 import hashlib
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List, Tuple
+from typing import Optional, Dict, Any, List, Tuple, Pattern, FrozenSet
 from dataclasses import dataclass, field
 from enum import Enum
 import threading
-from collections import defaultdict
+from collections import defaultdict, deque
+
+from core.db_executor import db_connection, get_db_executor
 
 logger = logging.getLogger(__name__)
 
@@ -215,13 +227,77 @@ DEFAULT_RULES = [
 ]
 
 
+@dataclass(frozen=True)
+class CompiledRule:
+    """🆕 P18-14: 預編譯的規則匹配條件"""
+    rule: RateLimitRule
+    path_regex: Optional[Pattern] = None
+    exact_path: Optional[str] = None
+    methods: FrozenSet[str] = frozenset()
+    user_tiers: FrozenSet[str] = frozenset()
+    
+    @classmethod
+    def compile(cls, rule: RateLimitRule) -> 'CompiledRule':
+        pattern = rule.path_pattern
+        path_regex = exact_path = None
+        if pattern != '*':
+            if any(c in pattern for c in '*?['):
+                path_regex = re.compile(fnmatch.translate(pattern))
+            else:
+                exact_path = pattern
+        return cls(
+            rule=rule,
+            path_regex=path_regex,
+            exact_path=exact_path,
+            methods=frozenset(m.upper() for m in rule.methods),
+            user_tiers=frozenset(rule.user_tiers),
+        )
+    
+    def matches(self, path: str, method: str, user_tier: str) -> bool:
+        if self.exact_path is not None and path != self.exact_path:
+            return False
+        if self.path_regex is not None and not self.path_regex.match(path):
+            return False
+        if self.methods and method.upper() not in self.methods:
+            return False
+        if self.user_tiers and user_tier and user_tier not in self.user_tiers:
+            return False
+        return True
+
+
 class SlidingWindowCounter:
-    """滑動窗口計數器"""
+    """
+    滑動窗口計數器（🆕 P18-14: 雙桶加權近似）
+    
+    每個 (鍵, 窗口) 只保存上一窗口計數、當前窗口計數和窗口序號：
+        估算值 = 上一窗口計數 × (1 - 當前窗口已過比例) + 當前窗口計數
+    """
     
     def __init__(self):
-        self._windows: Dict[str, List[Tuple[float, int]]] = defaultdict(list)
+        # key -> {window_seconds: [window_index, prev_count, curr_count, last_seen]}
+        self._windows: Dict[str, Dict[int, List[float]]] = defaultdict(dict)
         self._lock = threading.RLock()
     
+    @staticmethod
+    def _roll(state: List[float], window_index: int):
+        if state[0] == window_index:
+            return
+        # 相鄰窗口：當前計數變為上一窗口；間隔更久則全部清零
+        state[1] = state[2] if state[0] == window_index - 1 else 0
+        state[2] = 0
+        state[0] = window_index
+    
+    def _state(self, key: str, window_seconds: int, now: float) -> Tuple[List[float], float]:
+        window_index = int(now // window_seconds)
+        windows = self._windows[key]
+        state = windows.get(window_seconds)
+        if state is None:
+            state = windows[window_seconds] = [window_index, 0, 0, now]
+        else:
+            self._roll(state, window_index)
+        elapsed = (now - window_index * window_seconds) / window_seconds
+        return state, elapsed
+    
     def check_and_increment(
         self,
         key: str,
@@ -234,25 +310,24 @@ class SlidingWindowCounter:
         """
         with self._lock:
             now = time.time()
-            window_start = now - window_seconds
-            
-            # 清理過期記錄
-            self._windows[key] = [
-                (ts, count) for ts, count in self._windows[key]
-                if ts > window_start
-            ]
-            
-            # 計算當前計數
-            current_count = sum(count for _, count in self._windows[key])
+            state, elapsed = self._state(key, window_seconds, now)
+            state[3] = now
+            prev, curr = state[1], state[2]
+            current_count = int(prev * (1 - elapsed) + curr)
             
             if current_count >= limit:
-                # 計算需要等待的時間
-                oldest = min((ts for ts, _ in self._windows[key]), default=now)
-                reset_at = int(oldest + window_seconds)
-                return False, 0, reset_at
+                window_end = (state[0] + 1) * window_seconds
+                if curr >= limit:
+                    # 當前窗口已滿：等到下一窗口中 curr 的權重降到限額以下
+                    wait_fraction = 1 - (limit - 1) / curr if curr > 0 else 0
+                    reset_at = window_end + wait_fraction * window_seconds
+                else:
+                    # 等上一窗口的權重衰減到足夠低
+                    wait_fraction = 1 - (limit - 1 - curr) / prev if prev > 0 else 0
+                    reset_at = state[0] * window_seconds + wait_fraction * window_seconds
+                return False, 0, int(max(reset_at, now + 1))
             
-            # 增加計數
-            self._windows[key].append((now, 1))
+            state[2] = curr + 1
             remaining = limit - current_count - 1
             reset_at = int(now + window_seconds)
             
@@ -261,19 +336,33 @@ class SlidingWindowCounter:
     def get_count(self, key: str, window_seconds: int) -> int:
         """獲取當前計數"""
         with self._lock:
-            now = time.time()
-            window_start = now - window_seconds
-            
-            return sum(
-                count for ts, count in self._windows.get(key, [])
-                if ts > window_start
-            )
+            if window_seconds not in self._windows.get(key, {}):
+                return 0
+            state, elapsed = self._state(key, window_seconds, time.time())
+            return int(state[1] * (1 - elapsed) + state[2])
     
     def reset(self, key: str):
         """重置計數"""
         with self._lock:
             if key in self._windows:
                 del self._windows[key]
+    
+    def expire(self, now: float = None) -> int:
+        """移除兩個窗口內無請求的狀態（此時估算值必為 0）"""
+        now = now or time.time()
+        removed = 0
+        with self._lock:
+            for key in list(self._windows):
+                windows = self._windows[key]
+                for window_seconds in [w for w, st in windows.items() if now - st[3] >= 2 * w]:
+                    del windows[window_seconds]
+                    removed += 1
+                if not windows:
+                    del self._windows[key]
+        return removed
+    
+    def __len__(self) -> int:
+        return len(self._windows)
 
 
 class TokenBucket:
@@ -300,7 +389,8 @@ class TokenBucket:
             if key not in self._buckets:
                 self._buckets[key] = {
                     'tokens': capacity,
-                    'last_update': now
+                    'last_update': now,
+                    'full_at': now
                 }
             
             bucket = self._buckets[key]
@@ -311,8 +401,13 @@ class TokenBucket:
             bucket['tokens'] = min(capacity, bucket['tokens'] + new_tokens)
             bucket['last_update'] = now
             
-            if bucket['tokens'] >= tokens:
+            allowed = bucket['tokens'] >= tokens
+            if allowed:
                 bucket['tokens'] -= tokens
+            # 🆕 P18-14: 記錄桶重新填滿的時間，之後可安全回收
+            bucket['full_at'] = now + (capacity - bucket['tokens']) / max(rate, 1e-9)
+            
+            if allowed:
                 return True, int(bucket['tokens'])
             
             return False, 0
@@ -322,6 +417,18 @@ class TokenBucket:
         with self._lock:
             if key in self._buckets:
                 del self._buckets[key]
+    
+    def expire(self, now: float = None) -> int:
+        """移除已重新填滿的桶（與新建桶等價）"""
+        now = now or time.time()
+        with self._lock:
+            idle = [k for k, b in self._buckets.items() if b['full_at'] <= now]
+            for key in idle:
+                del self._buckets[key]
+        return len(idle)
+    
+    def __len__(self) -> int:
+        return len(self._buckets)
 
 
 class RateLimiter:
@@ -330,6 +437,12 @@ class RateLimiter:
     _instance: Optional['RateLimiter'] = None
     _lock = threading.Lock()
     
+    # 🆕 P18-14: 空閒鍵回收與日誌批量寫入
+    EXPIRE_INTERVAL = 60.0
+    LOG_FLUSH_INTERVAL = 2.0
+    LOG_BATCH_SIZE = 200
+    LOG_QUEUE_MAX = 10000
+    
     def __new__(cls, db_path: str = None):
         with cls._lock:
             if cls._instance is None:
@@ -348,6 +461,8 @@ class RateLimiter:
         
         # 限流規則
         self._rules: List[RateLimitRule] = DEFAULT_RULES.copy()
+        self._compiled_rules: List[CompiledRule] = []
+        self._compile_rules()
         
         # 滑動窗口計數器
         self._counter = SlidingWindowCounter()
@@ -361,6 +476,15 @@ class RateLimiter:
         # 黑名單（封禁）
         self._blacklist: Dict[str, datetime] = {}
         
+        self._last_expire = time.time()
+        
+        # 🆕 P18-14: 拒絕日誌隊列（批量寫入）
+        # 🆕 P18-20: 刷新提交到共享數據庫線程池，不再單獨佔用寫線程
+        self._log_queue: deque = deque(maxlen=self.LOG_QUEUE_MAX)
+        self._log_flush_scheduled = False
+        self._log_flush_lock = threading.Lock()
+        atexit.register(self.flush_logs)
+        
         self._init_db()
         self._initialized = True
         logger.info("RateLimiter initialized")
@@ -441,10 +565,15 @@ class RateLimiter:
             else:
                 del self._blacklist[ban_key]
         
+        now = time.time()
+        if now - self._last_expire >= self.EXPIRE_INTERVAL:
+            self._expire_idle(now)
+        
         # 匹配規則並檢查
-        for rule in self._rules:
-            if not self._match_rule(rule, path, method, user_tier):
+        for compiled in self._compiled_rules:
+            if not compiled.matches(path, method, user_tier):
                 continue
+            rule = compiled.rule
             
             # 構建限流鍵
             key = self._build_key(rule.scope, ip, user_id, api_key, path)
@@ -488,29 +617,17 @@ class RateLimiter:
         # 所有規則通過
         return RateLimitResult(allowed=True, remaining=999, reset_at=int(time.time()) + 60)
     
-    def _match_rule(
-        self,
-        rule: RateLimitRule,
-        path: str,
-        method: str,
-        user_tier: str
-    ) -> bool:
-        """檢查規則是否匹配"""
-        # 路徑匹配
-        if rule.path_pattern != '*':
-            import fnmatch
-            if not fnmatch.fnmatch(path, rule.path_pattern):
-                return False
-        
-        # 方法匹配
-        if rule.methods and method.upper() not in rule.methods:
-            return False
-        
-        # 用戶等級匹配
-        if rule.user_tiers and user_tier and user_tier not in rule.user_tiers:
-            return False
-        
-        return True
+    def _compile_rules(self):
+        """🆕 P18-14: 規則變更時重新預編譯"""
+        self._compiled_rules = [CompiledRule.compile(rule) for rule in self._rules]
+    
+    def _expire_idle(self, now: float):
+        """🆕 P18-14: 回收空閒的窗口計數與令牌桶"""
+        self._last_expire = now
+        windows = self._counter.expire(now)
+        buckets = self._token_bucket.expire(now)
+        if windows or buckets:
+            logger.debug(f"[RateLimiter] Expired {windows} windows, {buckets} buckets")
     
     def _build_key(
         self,
@@ -539,29 +656,61 @@ class RateLimiter:
         rule_name: str,
         allowed: bool
     ):
-        """記錄限流日誌"""
+        """記錄限流日誌（🆕 P18-14: 入隊，批量寫入）"""
+        self._log_queue.append((
+            scope, identifier, path, rule_name, 1 if allowed else 0, datetime.utcnow().isoformat()
+        ))
+        if len(self._log_queue) >= self.LOG_BATCH_SIZE:
+            self._submit_log_flush()
+        elif not self._log_flush_scheduled:
+            self._schedule_log_flush()
+    
+    def _schedule_log_flush(self):
+        """事件循環中延遲 LOG_FLUSH_INTERVAL 提交一次刷新；無事件循環時只按批量觸發（退出時兜底）"""
         try:
-            db = self._get_db()
-            db.execute('''
-                INSERT INTO rate_limit_logs
-                (scope, identifier, path, rule_name, allowed, count, created_at)
-                VALUES (?, ?, ?, ?, ?, 1, ?)
-            ''', (scope, identifier, path, rule_name, 1 if allowed else 0, datetime.utcnow().isoformat()))
-            db.commit()
-            db.close()
-        except Exception as e:
-            logger.warning(f"Log rate limit error: {e}")
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._log_flush_scheduled = True
+        loop.call_later(self.LOG_FLUSH_INTERVAL, self._submit_log_flush)
+    
+    def _submit_log_flush(self):
+        self._log_flush_scheduled = False
+        get_db_executor().submit(self.flush_logs)
+    
+    def flush_logs(self) -> int:
+        """把隊列中的限流日誌一次性寫入數據庫，返回寫入條數"""
+        with self._log_flush_lock:
+            batch = []
+            while self._log_queue:
+                batch.append(self._log_queue.popleft())
+            if not batch:
+                return 0
+            try:
+                with db_connection(self.db_path) as db:
+                    db.executemany('''
+                        INSERT INTO rate_limit_logs
+                        (scope, identifier, path, rule_name, allowed, count, created_at)
+                        VALUES (?, ?, ?, ?, ?, 1, ?)
+                    ''', batch)
+                    db.commit()
+            except Exception as e:
+                logger.warning(f"Log rate limit error: {e}")
+                return 0
+            return len(batch)
     
     # ==================== 規則管理 ====================
     
     def add_rule(self, rule: RateLimitRule):
         """添加規則"""
         self._rules.append(rule)
+        self._compile_rules()
         logger.info(f"Added rate limit rule: {rule.name}")
     
     def remove_rule(self, name: str):
         """移除規則"""
         self._rules = [r for r in self._rules if r.name != name]
+        self._compile_rules()
     
     def get_rules(self) -> List[Dict]:
         """獲取所有規則"""
@@ -614,6 +763,7 @@ class RateLimiter:
     
     def get_stats(self) -> Dict[str, Any]:
         """獲取統計"""
+        self.flush_logs()
         try:
             db = self._get_db()
             
@@ -645,7 +795,9 @@ class RateLimiter:
                 'block_rate': round((row['blocked'] or 0) / max(row['total'] or 1, 1) * 100, 2),
                 'by_rule': {r['rule_name']: r['count'] for r in by_rule},
                 'active_bans': len(self._blacklist),
-                'whitelist_size': len(self._whitelist)
+                'whitelist_size': len(self._whitelist),
+                'tracked_keys': len(self._counter),
+                'tracked_buckets': len(self._token_bucket)
             }
         except:
             return {}
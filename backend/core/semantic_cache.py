@@ -0,0 +1,271 @@
+"""
+🆕 P18-23: AI 生成結果緩存
+
+文案、打招呼消息、知識庫/FAQ 生成經常發送幾乎相同的 prompt，每次都付出完整的 LLM 延遲和費用。
+1. 精確層：歸一化 prompt（NFKC、去首尾空白、合併空白、小寫）+ 模型 + 生成參數 → 結果
+2. 語義層（可選，AI_SEMANTIC_CACHE=1 開啟）：同一租戶 / 模型 / 參數 / 上下文下，
+   向量相似度 ≥ 閾值且數字一致（條數、金額不同的請求不復用）時復用結果，
+   嵌入復用 vector_memory 的嵌入實現
+3. TTL + 條目數上限（LRU），按租戶（owner_user_id）隔離
+4. temperature 高於閾值、或調用方要求「重新生成」時自動繞過
+5. 精確/語義命中、未命中、繞過次數及節省的生成時間統計
+
+用法:
+    from core.semantic_cache import get_response_cache
+
+    text = await get_response_cache().get_or_generate(
+        prompt, lambda: call_llm(prompt),
+        model=model_name, params={'max_tokens': 500, 'temperature': 0.7},
+        semantic_text=prompt,
+    )
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    np = None
+    HAS_NUMPY = False
+
+AI_CACHE_MAX_ENTRIES = int(os.environ.get('AI_CACHE_MAX_ENTRIES', '2000'))
+AI_CACHE_TTL_SECONDS = int(os.environ.get('AI_CACHE_TTL_SECONDS', '3600'))
+AI_CACHE_MAX_TEMPERATURE = float(os.environ.get('AI_CACHE_MAX_TEMPERATURE', '0.9'))
+AI_SEMANTIC_CACHE = os.environ.get('AI_SEMANTIC_CACHE', '0').lower() in ('1', 'true', 'yes')
+AI_SEMANTIC_THRESHOLD = float(os.environ.get('AI_SEMANTIC_THRESHOLD', '0.95'))
+
+_WHITESPACE = re.compile(r'\s+')
+_NUMBERS = re.compile(r'\d+(?:\.\d+)?')
+
+
+def normalize_prompt(text: str) -> str:
+    """緩存鍵使用的 prompt 歸一化"""
+    text = unicodedata.normalize('NFKC', text or '')
+    return _WHITESPACE.sub(' ', text).strip().lower()
+
+
+def _default_embedder(text: str):
+    """復用 vector_memory 的嵌入（神經模型已加載時用模型，否則為 n-gram 哈希嵌入）"""
+    from vector_memory import vector_memory
+    return vector_memory._get_embedding(text)
+
+
+class _Entry:
+    __slots__ = ('value', 'expires_at', 'bucket', 'embedding', 'numbers', 'cost')
+
+    def __init__(self, value: str, expires_at: float, bucket: str, embedding, numbers: Tuple[str, ...], cost: float):
+        self.value = value
+        self.expires_at = expires_at
+        self.bucket = bucket
+        self.embedding = embedding
+        self.numbers = numbers
+        self.cost = cost
+
+
+class SemanticResponseCache:
+    """AI 生成結果緩存（精確 + 可選語義層）"""
+
+    def __init__(
+        self,
+        max_entries: int = AI_CACHE_MAX_ENTRIES,
+        ttl: int = AI_CACHE_TTL_SECONDS,
+        max_temperature: float = AI_CACHE_MAX_TEMPERATURE,
+        semantic: bool = AI_SEMANTIC_CACHE,
+        threshold: float = AI_SEMANTIC_THRESHOLD,
+        embedder: Optional[Callable[[str], Any]] = None,
+    ):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.max_temperature = max_temperature
+        self.semantic = semantic and HAS_NUMPY
+        self.threshold = threshold
+        self._embedder = embedder or _default_embedder
+        self._entries: 'OrderedDict[str, _Entry]' = OrderedDict()
+        # 語義層索引：bucket → 條目鍵（bucket 相同才比較相似度）
+        self._buckets: Dict[str, List[str]] = {}
+        self._exact_hits = 0
+        self._semantic_hits = 0
+        self._misses = 0
+        self._bypassed = 0
+        self._saved_seconds = 0.0
+
+    # ==================== 鍵 ====================
+
+    @staticmethod
+    def _tenant(tenant: Optional[str]) -> str:
+        if tenant:
+            return tenant
+        try:
+            from core.tenant_filter import get_owner_user_id
+            return get_owner_user_id()
+        except Exception:
+            return 'local_user'
+
+    @staticmethod
+    def _hash(*parts: str) -> str:
+        return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+    def should_bypass(self, params: Optional[Dict[str, Any]]) -> bool:
+        """temperature 超過閾值的請求要的是多樣性，不走緩存"""
+        temperature = (params or {}).get('temperature')
+        return temperature is not None and float(temperature) > self.max_temperature
+
+    # ==================== 讀寫 ====================
+
+    def _evict(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry.embedding is not None:
+            keys = self._buckets.get(entry.bucket)
+            if keys is not None:
+                try:
+                    keys.remove(key)
+                except ValueError:
+                    pass
+                if not keys:
+                    del self._buckets[entry.bucket]
+
+    def _get_exact(self, key: str, now: float) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= now:
+            self._evict(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _get_similar(self, bucket: str, embedding, numbers: Tuple[str, ...], now: float) -> Optional[_Entry]:
+        keys = self._buckets.get(bucket)
+        if not keys:
+            return None
+        for key in [k for k in keys if self._entries[k].expires_at <= now]:
+            self._evict(key)
+        keys = self._buckets.get(bucket)
+        if not keys:
+            return None
+        matrix = np.stack([self._entries[k].embedding for k in keys])
+        scores = matrix @ embedding
+        for idx in np.argsort(-scores):
+            if scores[idx] < self.threshold:
+                break
+            entry = self._entries[keys[idx]]
+            if entry.numbers == numbers:
+                self._entries.move_to_end(keys[idx])
+                return entry
+        return None
+
+    def _embed(self, text: str):
+        try:
+            vec = np.asarray(self._embedder(text), dtype=np.float32)
+        except Exception as e:
+            logger.debug(f"[ResponseCache] Embedding failed: {e}")
+            return None
+        norm = float(np.linalg.norm(vec))
+        return vec / norm if norm > 0 else None
+
+    async def get_or_generate(
+        self,
+        prompt: str,
+        generate: Callable[[], Awaitable[Optional[str]]],
+        *,
+        model: str = '',
+        params: Optional[Dict[str, Any]] = None,
+        semantic_text: Optional[str] = None,
+        context: str = '',
+        tenant: Optional[str] = None,
+        bypass: bool = False,
+    ) -> Optional[str]:
+        """
+        命中則直接返回緩存結果，否則調用 generate() 並緩存非空結果
+
+        prompt 參與精確鍵；semantic_text（通常是 prompt 中可變的那部分，如用戶問題）
+        參與語義層，context 是語義層必須完全一致的其餘部分（如系統提示）
+        """
+        if bypass or self.should_bypass(params):
+            self._bypassed += 1
+            return await generate()
+
+        tenant = self._tenant(tenant)
+        params_key = json.dumps(params or {}, sort_keys=True, default=str)
+        bucket = self._hash(tenant, model or '', params_key, normalize_prompt(context))
+        key = self._hash(bucket, normalize_prompt(prompt))
+        now = time.time()
+
+        entry = self._get_exact(key, now)
+        if entry is not None:
+            self._exact_hits += 1
+            self._saved_seconds += entry.cost
+            return entry.value
+
+        embedding = None
+        numbers: Tuple[str, ...] = ()
+        if self.semantic and semantic_text:
+            normalized = normalize_prompt(semantic_text)
+            numbers = tuple(_NUMBERS.findall(normalized))
+            embedding = self._embed(normalized)
+            if embedding is not None:
+                entry = self._get_similar(bucket, embedding, numbers, now)
+                if entry is not None:
+                    self._semantic_hits += 1
+                    self._saved_seconds += entry.cost
+                    return entry.value
+
+        self._misses += 1
+        started = time.monotonic()
+        value = await generate()
+        if value:
+            self._store(key, _Entry(value, time.time() + self.ttl, bucket, embedding, numbers,
+                                    time.monotonic() - started))
+        return value
+
+    def _store(self, key: str, entry: _Entry):
+        self._evict(key)
+        while len(self._entries) >= self.max_entries:
+            self._evict(next(iter(self._entries)))
+        self._entries[key] = entry
+        if entry.embedding is not None:
+            self._buckets.setdefault(entry.bucket, []).append(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._buckets.clear()
+
+    # ==================== 統計 ====================
+
+    def get_stats(self) -> Dict[str, Any]:
+        hits = self._exact_hits + self._semantic_hits
+        lookups = hits + self._misses
+        return {
+            'size': len(self._entries),
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'semantic': self.semantic,
+            'exact_hits': self._exact_hits,
+            'semantic_hits': self._semantic_hits,
+            'misses': self._misses,
+            'bypassed': self._bypassed,
+            'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+            'saved_seconds': round(self._saved_seconds, 2),
+        }
+
+
+_response_cache: Optional[SemanticResponseCache] = None
+
+
+def get_response_cache() -> SemanticResponseCache:
+    """獲取全局 AI 生成結果緩存"""
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = SemanticResponseCache()
+    return _response_cache
@@ -0,0 +1,288 @@
+"""
+🔧 P18-8: 流式數據導出引擎
+
+用於成員/聯繫人等大表導出：
+1. 獨立只讀連接 + 服務端游標（fetchmany 分塊），不設行數上限
+2. CSV / JSON / NDJSON 增量編碼，可選 gzip 壓縮
+3. 輸出到文件或 aiohttp 分塊響應，內存佔用與導出行數無關
+
+用法:
+    rows = iter_query_rows(db.db_path, "SELECT * FROM extracted_members", ())
+    count = await export_to_file(rows, '/tmp/members.ndjson.gz', fmt='ndjson', compress=True)
+
+    # HTTP 分塊響應
+    return await export_to_response(request, rows, 'members', fmt='csv')
+"""
+
+import csv
+import io
+import json
+import zlib
+import sqlite3
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence, Union
+
+try:
+    import aiosqlite
+    HAS_AIOSQLITE = True
+except ImportError:
+    HAS_AIOSQLITE = False
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('csv', 'json', 'ndjson')
+
+_CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'json': 'application/json; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+Row = Dict[str, Any]
+RowTransform = Callable[[Row], Row]
+Sink = Callable[[bytes], Awaitable[Any]]
+
+
+def normalize_format(fmt: Optional[str]) -> str:
+    """規範化導出格式，未知格式回退為 csv"""
+    fmt = (fmt or 'csv').lower().lstrip('.')
+    if fmt == 'jsonl':
+        fmt = 'ndjson'
+    return fmt if fmt in EXPORT_FORMATS else 'csv'
+
+
+def content_type_for(fmt: str, compress: bool = False) -> str:
+    if compress:
+        return 'application/gzip'
+    return _CONTENT_TYPES[normalize_format(fmt)]
+
+
+def export_filename(prefix: str, fmt: str, compress: bool = False) -> str:
+    """生成導出文件名，如 members_export_20260101_120000.csv.gz"""
+    name = f"{prefix}_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{normalize_format(fmt)}"
+    return name + '.gz' if compress else name
+
+
+# ==================== 數據源 ====================
+
+async def iter_query_rows(
+    db_path: Union[str, Path],
+    query: str,
+    params: Sequence[Any] = (),
+    chunk_size: int = 1000,
+) -> AsyncIterator[Row]:
+    """
+    使用獨立的只讀連接逐塊讀取查詢結果
+
+    不佔用共享寫連接；WAL 模式下與寫入並發，導出期間看到一致快照。
+    """
+    uri = f"file:{Path(db_path).as_posix()}?mode=ro"
+    if HAS_AIOSQLITE:
+        async with aiosqlite.connect(uri, uri=True, timeout=30.0) as conn:
+            conn.row_factory = aiosqlite.Row
+            async with conn.execute(query, tuple(params)) as cursor:
+                while True:
+                    rows = await cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield dict(row)
+        return
+
+    conn = sqlite3.connect(uri, uri=True, timeout=30.0)
+    conn.row_factory = sqlite3.Row
+    try:
+        cursor = conn.execute(query, tuple(params))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(row)
+    finally:
+        conn.close()
+
+
+# ==================== 編碼器 ====================
+
+class ExportEncoder:
+    """
+    增量編碼器：begin() / encode(row) / end() 各自返回可直接寫出的字節
+
+    JSON 格式輸出 {"exported_at": ..., "members": [...], "total_count": N}，
+    total_count 放在末尾（流式導出時行數事先未知）。
+    """
+
+    def __init__(
+        self,
+        fmt: str = 'csv',
+        columns: Optional[List[str]] = None,
+        compress: bool = False,
+        json_key: str = 'items',
+    ):
+        self.fmt = normalize_format(fmt)
+        self.columns = list(columns) if columns else None
+        self.json_key = json_key
+        self.count = 0
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        self._text = io.StringIO()
+        self._csv = None
+
+    def _bytes(self, text: str) -> bytes:
+        data = text.encode('utf-8')
+        if self._compressor:
+            return self._compressor.compress(data)
+        return data
+
+    def _project(self, row: Row) -> Row:
+        if self.columns:
+            return {c: row.get(c) for c in self.columns}
+        return row
+
+    def begin(self) -> bytes:
+        if self.fmt == 'json':
+            header = json.dumps(datetime.now().isoformat())
+            return self._bytes(f'{{"exported_at": {header}, "{self.json_key}": [')
+        return b''
+
+    def encode(self, row: Row) -> bytes:
+        row = self._project(row)
+        if self.fmt == 'csv':
+            if self._csv is None:
+                self.columns = self.columns or list(row.keys())
+                self._csv = csv.DictWriter(self._text, fieldnames=self.columns, extrasaction='ignore')
+                self._csv.writeheader()
+            self._csv.writerow(row)
+            text = self._text.getvalue()
+            self._text.seek(0)
+            self._text.truncate()
+        elif self.fmt == 'ndjson':
+            text = json.dumps(row, ensure_ascii=False, default=str) + '\n'
+        else:
+            prefix = ',' if self.count else ''
+            text = prefix + json.dumps(row, ensure_ascii=False, default=str)
+        self.count += 1
+        return self._bytes(text)
+
+    def end(self) -> bytes:
+        tail = b''
+        if self.fmt == 'json':
+            tail = self._bytes(f'], "total_count": {self.count}}}')
+        elif self.fmt == 'csv' and self._csv is None and self.columns:
+            # 空結果仍輸出表頭
+            tail = self._bytes(','.join(self.columns) + '\r\n')
+        if self._compressor:
+            tail += self._compressor.flush()
+        return tail
+
+
+# ==================== 輸出 ====================
+
+async def stream_export(
+    rows: AsyncIterator[Row],
+    sink: Sink,
+    fmt: str = 'csv',
+    columns: Optional[List[str]] = None,
+    compress: bool = False,
+    transform: Optional[RowTransform] = None,
+    json_key: str = 'items',
+    flush_bytes: int = 64 * 1024,
+) -> int:
+    """
+    將行流編碼後分塊寫入 sink
+
+    Args:
+        rows: 異步行迭代器（如 iter_query_rows）
+        sink: 接收字節塊的協程函數（文件寫入 / StreamResponse.write）
+        transform: 行轉換（如把 JSON 字段轉為可讀字符串）
+        flush_bytes: 累積多少字節後寫出一次
+
+    Returns:
+        導出的行數
+    """
+    encoder = ExportEncoder(fmt, columns=columns, compress=compress, json_key=json_key)
+    pending = bytearray(encoder.begin())
+    async for row in rows:
+        if transform:
+            row = transform(row)
+        pending += encoder.encode(row)
+        if len(pending) >= flush_bytes:
+            await sink(bytes(pending))
+            pending.clear()
+    pending += encoder.end()
+    if pending:
+        await sink(bytes(pending))
+    return encoder.count
+
+
+async def export_to_file(
+    rows: AsyncIterator[Row],
+    path: Union[str, Path],
+    fmt: str = 'csv',
+    **options: Any,
+) -> int:
+    """流式導出到文件（先寫臨時文件，完成後原子替換）"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.part')
+    with open(tmp_path, 'wb') as f:
+        async def _write(chunk: bytes):
+            f.write(chunk)
+        try:
+            count = await stream_export(rows, _write, fmt=fmt, **options)
+        except BaseException:
+            f.close()
+            tmp_path.unlink(missing_ok=True)
+            raise
+    tmp_path.replace(path)
+    logger.info(f"Exported {count} rows to {path}")
+    return count
+
+
+async def export_to_buffer(rows: AsyncIterator[Row], fmt: str = 'csv', **options: Any) -> bytes:
+    """導出到內存（僅用於需要一次性返回內容的舊接口）"""
+    buffer = bytearray()
+
+    async def _write(chunk: bytes):
+        buffer.extend(chunk)
+
+    await stream_export(rows, _write, fmt=fmt, **options)
+    return bytes(buffer)
+
+
+async def export_to_response(
+    request,
+    rows: AsyncIterator[Row],
+    prefix: str,
+    fmt: str = 'csv',
+    compress: bool = False,
+    **options: Any,
+):
+    """
+    以 HTTP 分塊傳輸（chunked）返回導出內容
+
+    響應頭發出後出錯無法再改狀態碼：記錄錯誤並直接斷開連接，
+    客戶端看到的是未完成的傳輸，而不是被截斷卻"成功"的文件
+    """
+    from aiohttp import web
+
+    fmt = normalize_format(fmt)
+    response = web.StreamResponse(headers={
+        'Content-Type': content_type_for(fmt, compress),
+        'Content-Disposition': f'attachment; filename="{export_filename(prefix, fmt, compress)}"',
+    })
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    try:
+        count = await stream_export(rows, response.write, fmt=fmt, compress=compress, **options)
+    except Exception as e:
+        logger.error(f"Streaming {prefix} export aborted: {e}")
+        response.force_close()
+        if request.transport is not None:
+            request.transport.close()
+        return response
+    await response.write_eof()
+    logger.info(f"Streamed {count} {prefix} rows ({fmt}{'.gz' if compress else ''})")
+    return response
@@ -15,6 +15,7 @@ TG-AI智控王 數據庫模塊
 - announcements: 公告表
 """
 
+import sys
 import sqlite3
 import json
 from datetime import datetime, timedelta
@@ -1308,6 +1309,18 @@ class Database(UserAdminMixin, AccountMixin, KeywordGroupMixin, CampaignQueueMix
             )
         ''')
         
+        # ============ 成員提取斷點表 ============
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS member_extraction_checkpoints (
+                chat_id TEXT NOT NULL,
+                phone TEXT NOT NULL,
+                member_offset INTEGER DEFAULT 0,
+                counters TEXT DEFAULT '{}',
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (chat_id, phone)
+            )
+        ''')
+        
         # ============ 營銷活動表 ============
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS marketing_campaigns (
@@ -1436,6 +1449,16 @@ class Database(UserAdminMixin, AccountMixin, KeywordGroupMixin, CampaignQueueMix
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_members_extracted_at ON extracted_members(extracted_at DESC)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_members_contacted ON extracted_members(contacted)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_members_composite ON extracted_members(online_status, value_level, contacted)')
+        # 🆕 P18-9: user_id 唯一索引（舊庫可能有重複行：只記錄並跳過，由成員去重維護命令處理）
+        try:
+            cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_members_user_id_unique ON extracted_members(user_id)')
+        except sqlite3.IntegrityError:
+            dup_users, dup_rows = cursor.execute(
+                'SELECT COUNT(*), COALESCE(SUM(n - 1), 0) FROM '
+                '(SELECT COUNT(*) AS n FROM extracted_members WHERE user_id IS NOT NULL GROUP BY user_id HAVING n > 1)'
+            ).fetchone()
+            print(f"[Database] extracted_members has {dup_rows} duplicate rows for {dup_users} users; "
+                  f"unique index skipped, run member deduplication to merge them", file=sys.stderr)
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_extraction_logs_phone ON member_extraction_logs(account_phone)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_extraction_logs_status ON member_extraction_logs(status)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_extraction_logs_created ON member_extraction_logs(created_at DESC)')
@@ -440,16 +440,18 @@ async def handle_add_account(self, payload: Dict[str, Any]):
             except Exception as e:
                 print(f"[Backend] Quota commit error (non-fatal): {e}", file=sys.stderr)
         
-        # 🔧 P3-3: 帳號新增後立即失效配額緩存
+        # 🔧 P3-3: 帳號新增後同步配額（🆕 P18-13: 已知用戶直接更新內存賬本）
         try:
             from core.quota_service import get_quota_service
             qs = get_quota_service()
             owner_id = payload.get('owner_user_id') or payload.get('ownerUserId')
             if owner_id:
-                qs.invalidate_cache(owner_id)
+                if not (quota_reserved and owner_id == owner_user_id):
+                    # 預留提交時賬本已 +1
+                    qs.apply_usage_event(owner_id, 'tg_accounts', 1)
             else:
                 qs.invalidate_cache()  # 無法確定用戶，全量失效
-            print(f"[Backend] Quota cache invalidated after add-account for user {owner_id}", file=sys.stderr)
+            print(f"[Backend] Quota ledger updated after add-account for user {owner_id}", file=sys.stderr)
         except Exception as e:
             print(f"[Backend] Quota cache invalidation error: {e}", file=sys.stderr)
         
@@ -1927,10 +1929,10 @@ async def handle_remove_account(self, payload: Dict[str, Any]):
             # 嘗試從帳號信息獲取 owner_user_id（account 在刪除前已獲取）
             owner_id = account.get('owner_user_id') if account else None
             if owner_id:
-                qs.invalidate_cache(owner_id)
+                qs.apply_usage_event(owner_id, 'tg_accounts', -1)  # 🆕 P18-13
             else:
                 qs.invalidate_cache()
-            print(f"[Backend] Quota cache invalidated after remove-account", file=sys.stderr)
+            print(f"[Backend] Quota ledger updated after remove-account", file=sys.stderr)
         except Exception as qe:
             print(f"[Backend] Quota cache invalidation error: {qe}", file=sys.stderr)
     
@@ -12,6 +12,7 @@ from typing import Any, Dict, List, Optional
 
 from service_context import get_service_context
 from database import db
+from core.llm_gateway import LLMStreamCancelled
 
 import re
 from service_locator import ai_auto_chat, ai_context
@@ -149,7 +150,9 @@ async def handle_generate_ai_response(self, payload: Dict[str, Any]):
         # 如果提供了端點，直接調用本地 AI
         if endpoint:
             print(f"[AI] Calling local AI service at {endpoint}...", file=sys.stderr)
-            response = await self._call_local_ai(endpoint, model, system_prompt, message)
+            # 🆕 P18-22: 默認流式生成，增量通過 ai-token 事件推送（payload.stream=false 關閉）
+            stream_key = f"chat:{user_id}" if payload.get('stream', True) else None
+            response = await self._call_local_ai(endpoint, model, system_prompt, message, stream_key=stream_key)
         else:
             # 使用 ai_auto_chat 服務
             print(f"[AI] Using ai_auto_chat service...", file=sys.stderr)
@@ -172,6 +175,13 @@ async def handle_generate_ai_response(self, payload: Dict[str, Any]):
                 "success": False,
                 "error": "AI 生成失敗，返回為空。請檢查服務配置和日誌"
             })
+    except LLMStreamCancelled:
+        print(f"[AI] Streaming generation cancelled for user {payload.get('userId', '')}", file=sys.stderr)
+        self.send_event("ai-response", {
+            "success": False,
+            "cancelled": True,
+            "userId": payload.get('userId', '')
+        })
     except asyncio.TimeoutError:
         elapsed = time.time() - start_time
         error_msg = f"AI 生成超時（{elapsed:.1f}秒），請檢查服務連接"
@@ -204,7 +214,7 @@ async def handle_add_ai_memory(self, payload: Dict[str, Any]):
             self.send_event("ai-memory-added", {"success": False, "error": "Missing userId or content"})
             return
         
-        memory_id = await db.add_ai_memory(user_id, memory_type, content, importance)
+        memory_id = await ai_context.extract_and_save_memory(user_id, content, memory_type, importance)
         
         self.send_event("ai-memory-added", {
             "success": True,
@@ -12,6 +12,7 @@ from typing import Any, Dict, List, Optional
 
 from service_context import get_service_context
 from database import db
+from core.llm_gateway import get_llm_gateway, LLMStreamCancelled
 
 from service_locator import ai_auto_chat, vector_memory
 # All handlers receive (self, payload) where self is BackendService instance.
@@ -108,6 +109,10 @@ async def handle_ai_generate_text(self, payload: Dict[str, Any]):
         callback = payload.get('callback', 'ai:generate-text-result')
         response_format = payload.get('responseFormat', 'text')  # text 或 json
         owner_user_id = payload.get('ownerUserId')
+        # 🆕 P18-22: 傳入 streamId 時流式生成，增量通過 ai-token 事件推送
+        stream_key = payload.get('streamId')
+        # 🆕 P18-23: 批量文案（count > 1）求多樣性，不走精確緩存
+        use_cache = not payload.get('regenerate') and int(payload.get('count') or 1) <= 1
         
         # 配額檢查
         quota_check = await self.check_quota('ai_calls', 1, owner_user_id)
@@ -153,7 +158,13 @@ async def handle_ai_generate_text(self, payload: Dict[str, Any]):
                 print(f"[AI] 重試第 {attempt} 次...", file=sys.stderr)
                 await asyncio.sleep(AIConfig.RETRY_DELAY_SECONDS)
             
-            result_text = await self._call_ai_for_text(ai_model, prompt, max_tokens)
+            try:
+                result_text = await self._call_ai_for_text(
+                    ai_model, prompt, max_tokens, stream_key=stream_key, use_cache=use_cache
+                )
+            except LLMStreamCancelled:
+                self.send_event(callback, {"success": False, "cancelled": True, "text": None})
+                return
             
             if result_text:
                 break
@@ -363,7 +374,7 @@ async def handle_test_local_ai(self, payload: Dict[str, Any]):
         
         # 步驟 2: 測試 HTTP 連接
         timeout = aiohttp.ClientTimeout(total=30, connect=5)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
+        async with get_llm_gateway().session('custom', timeout=timeout) as session:
             # 嘗試 GET 請求（Ollama 健康檢查）
             try:
                 health_url = endpoint.rstrip('/')
@@ -752,7 +763,7 @@ async def handle_generate_with_local_ai(self, payload: Dict[str, Any]):
             "temperature": 0.7
         }
         
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60)) as session:
+        async with get_llm_gateway().session('custom', timeout=aiohttp.ClientTimeout(total=60)) as session:
             async with session.post(f"{endpoint}/v1/chat/completions", json=request_data) as response:
                 if response.status == 200:
                     result = await response.json()
@@ -777,6 +788,16 @@ async def handle_generate_with_local_ai(self, payload: Dict[str, Any]):
         })
 
 
+async def handle_ai_stream_cancel(self, payload: Dict[str, Any]):
+    """🆕 P18-22: 停止流式生成（streamId，或 userId 對應的會話流）"""
+    stream_key = payload.get('streamId') or (f"chat:{payload['userId']}" if payload.get('userId') else None)
+    cancelled = bool(stream_key) and get_llm_gateway().cancel_stream(stream_key)
+    self.send_event("ai-stream-cancelled", {
+        "success": cancelled,
+        "streamId": stream_key
+    })
+
+
 async def handle_summarize_conversation(self, payload: Dict[str, Any]):
     """生成對話摘要"""
     try:
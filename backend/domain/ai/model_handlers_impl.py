@@ -10,8 +10,14 @@ import traceback
 from datetime import datetime, timedelta
 from typing import Any, Dict, List, Optional
 
+import aiohttp
+
 from service_context import get_service_context
 from database import db
+from core.llm_gateway import get_llm_gateway
+
+# 測試連接沿用 aiohttp 默認的 300 秒總超時（本地模型首次加載可能很慢）
+_TEST_TIMEOUT = aiohttp.ClientTimeout(total=300)
 
 # All handlers receive (self, payload) where self is BackendService instance.
 # They are called via: await handler_impl(self, payload)
@@ -296,7 +302,7 @@ async def handle_test_ai_model(self, payload: Dict[str, Any]):
                 test_url = api_endpoint or 'http://localhost:11434/api/chat'
                 print(f"[AI Test] 測試 URL: {test_url}", file=sys.stderr)
                 
-                async with aiohttp.ClientSession() as session:
+                async with get_llm_gateway().session(provider or 'ollama', timeout=_TEST_TIMEOUT) as session:
                     # 🔧 P2 優化：先查詢可用模型列表（僅 Ollama）
                     available_models = []
                     is_ollama = ':11434' in test_url or '.ts.net' in test_url or provider == 'ollama'
@@ -445,7 +451,7 @@ async def handle_test_ai_model(self, payload: Dict[str, Any]):
                 actual_model = model_name_map.get(normalized_model.replace(' ', '').replace('-', ''), normalized_model)
                 print(f"[AI Test] OpenAI 模型名稱映射: {model_name} -> {actual_model}", file=sys.stderr)
                 
-                async with aiohttp.ClientSession() as session:
+                async with get_llm_gateway().session('openai', timeout=_TEST_TIMEOUT) as session:
                     async with session.post(
                         'https://api.openai.com/v1/chat/completions',
                         headers={
@@ -509,7 +515,7 @@ async def handle_test_ai_model(self, payload: Dict[str, Any]):
                 actual_model = claude_model_map.get(normalized_model.replace(' ', '').replace('-', '').replace('.', ''), model_name)
                 print(f"[AI Test] Claude 模型名稱映射: {model_name} -> {actual_model}", file=sys.stderr)
                 
-                async with aiohttp.ClientSession() as session:
+                async with get_llm_gateway().session('claude', timeout=_TEST_TIMEOUT) as session:
                     async with session.post(
                         'https://api.anthropic.com/v1/messages',
                         headers={
@@ -569,7 +575,7 @@ async def handle_test_ai_model(self, payload: Dict[str, Any]):
                 gemini_models_to_try = list(dict.fromkeys(gemini_models_to_try))
                 print(f"[AI Test] Gemini 將嘗試模型列表: {gemini_models_to_try}", file=sys.stderr)
                 
-                async with aiohttp.ClientSession() as session:
+                async with get_llm_gateway().session('gemini', timeout=_TEST_TIMEOUT) as session:
                     for try_model in gemini_models_to_try:
                         url = f'https://generativelanguage.googleapis.com/v1beta/models/{try_model}:generateContent?key={api_key}'
                         print(f"[AI Test] 嘗試 Gemini 模型: {try_model}", file=sys.stderr)
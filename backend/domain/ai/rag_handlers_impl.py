@@ -12,6 +12,7 @@ from typing import Any, Dict, List, Optional
 
 from service_context import get_service_context
 from database import db
+from core.llm_gateway import get_llm_gateway
 
 import os
 import re
@@ -1842,7 +1843,7 @@ async def handle_get_ollama_models(self, payload: Dict[str, Any]):
         
         endpoint = payload.get('endpoint', 'http://localhost:11434')
         
-        async with aiohttp.ClientSession() as session:
+        async with get_llm_gateway().session('ollama') as session:
             async with session.get(f"{endpoint}/api/tags", timeout=aiohttp.ClientTimeout(total=10)) as resp:
                 if resp.status == 200:
                     data = await resp.json()
@@ -1871,7 +1872,7 @@ async def handle_test_ollama_connection(self, payload: Dict[str, Any]):
         
         endpoint = payload.get('endpoint', 'http://localhost:11434')
         
-        async with aiohttp.ClientSession() as session:
+        async with get_llm_gateway().session('ollama') as session:
             async with session.get(f"{endpoint}/api/version", timeout=aiohttp.ClientTimeout(total=5)) as resp:
                 if resp.status == 200:
                     data = await resp.json()
@@ -1915,7 +1916,7 @@ async def handle_ollama_generate(self, payload: Dict[str, Any]):
         if system:
             request_data["system"] = system
         
-        async with aiohttp.ClientSession() as session:
+        async with get_llm_gateway().session('ollama') as session:
             async with session.post(
                 f"{endpoint}/api/generate",
                 json=request_data,
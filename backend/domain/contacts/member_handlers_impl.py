@@ -1217,7 +1217,9 @@ async def handle_extract_members(self, payload: Dict[str, Any]):
                 filtered_members.append(member)
             
             result['members'] = filtered_members
-            result['extracted'] = len(filtered_members)
+            # 🆕 P18-7: 大群組只返回預覽列表，完整成員已流式入庫，保留服務端統計
+            if not result.get('members_truncated'):
+                result['extracted'] = len(filtered_members)
             
             self.send_log(f"✅ 提取完成: {len(filtered_members)} 成員 (總計: {len(members)})", "success")
             
@@ -1803,22 +1805,51 @@ async def handle_export_members(self, payload: Dict[str, Any]):
     print(f"[Backend] handle_export_members called: {payload}", file=sys.stderr)
     
     try:
-        format_type = payload.get('format', 'csv')  # csv 或 json
+        format_type = payload.get('format', 'csv')  # csv / json / ndjson
         filters = payload.get('filters', {})
+        compress = bool(payload.get('compress', False))
+        
+        # 🆕 P18-8: 大量數據流式寫入文件（ndjson / gzip / toFile），不經內存與 WebSocket
+        if payload.get('toFile') or compress or format_type == 'ndjson':
+            from config import DATABASE_DIR
+            from core.streaming_export import export_filename
+            filename = export_filename('members', format_type, compress)
+            file_path = DATABASE_DIR / 'exports' / filename
+            count = await member_extraction_service.export_members_to_file(
+                str(file_path), format_type, filters, compress=compress
+            )
+            self.send_log(f"✅ 導出完成: {filename} ({count} 條)", "success")
+            self.send_event("members-exported", {
+                "success": True,
+                "filePath": str(file_path),
+                "filename": filename,
+                "format": format_type,
+                "count": count
+            })
+            return
+        
+        # 🆕 P18-8: 按塊推送（members-export-chunk），前端拼接後下載，不在後端整體構建
+        ext = 'json' if format_type == 'json' else 'csv'
+        filename = f"members_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{ext}"
+        
+        async def send_chunk(chunk: bytes):
+            self.send_event("members-export-chunk", {
+                "filename": filename,
+                "chunk": chunk.decode('utf-8')
+            })
         
         if format_type == 'json':
-            content = await member_extraction_service.export_members_json(filters)
-            filename = f"members_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+            count = await member_extraction_service.export_members_json(send_chunk, filters)
         else:
-            content = await member_extraction_service.export_members_csv(filters)
-            filename = f"members_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+            count = await member_extraction_service.export_members_csv(send_chunk, filters)
         
-        self.send_log(f"✅ 導出完成: {filename}", "success")
+        self.send_log(f"✅ 導出完成: {filename} ({count} 條)", "success")
         self.send_event("members-exported", {
             "success": True,
-            "content": content,
+            "chunked": True,
             "filename": filename,
-            "format": format_type
+            "format": format_type,
+            "count": count
         })
         
     except Exception as e:
@@ -2099,9 +2130,20 @@ async def handle_deduplicate_members(self, payload: Dict[str, Any]):
     print(f"[Backend] handle_deduplicate_members called", file=sys.stderr)
     
     try:
-        result = await member_extraction_service.deduplicate_members()
+        # 🆕 P18-9: 默認只預覽，確認後前端以 dryRun=False 再次調用
+        dry_run = bool(payload.get('dryRun', True)) if payload else True
+        
+        def _on_progress(progress: Dict[str, Any]):
+            self.send_event("members-dedup-progress", progress)
         
-        self.send_log(f"✅ 去重完成: 合併 {result['merged']} 個，刪除 {result['deleted']} 條", "success")
+        result = await member_extraction_service.deduplicate_members(
+            dry_run=dry_run, progress_callback=_on_progress
+        )
+        
+        if dry_run:
+            self.send_log(f"🔍 去重預覽: {result['duplicate_users']} 個用戶，{result['duplicate_rows']} 條重複", "info")
+        else:
+            self.send_log(f"✅ 去重完成: 合併 {result['merged']} 個，刪除 {result['deleted']} 條", "success")
         self.send_event("members-deduplicated", {
             "success": True,
             **result
@@ -12,6 +12,7 @@ from typing import Any, Dict, List, Optional
 
 from service_context import get_service_context
 from database import db
+from ai_context_manager import ai_context
 
 from service_locator import (
     auto_funnel,
@@ -227,6 +228,7 @@ async def handle_update_user_profile(self, payload: Dict[str, Any]):
         # 如果有階段更新，使用專門的方法
         if 'funnel_stage' in data:
             await db.set_user_funnel_stage(user_id, data['funnel_stage'])
+        ai_context.invalidate(user_id, 'profile')
         
         self.send_log(f"已更新用戶 {user_id} 的畫像", "success")
         self.send_event("user-profile-updated", {
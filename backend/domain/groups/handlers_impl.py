@@ -670,6 +670,17 @@ async def handle_group_monitor_messages(self, payload: Dict[str, Any]):
         print(f"[GroupCollab] 啟動群組監控失敗: {traceback.format_exc()}", file=sys.stderr)
         return {"success": False, "error": str(e)}
 
+def _apply_group_quota_event(owner_user_id: Optional[str], delta: int):
+    """🆕 P18-13: 群組增刪後同步配額賬本（未知用戶時取當前租戶）"""
+    try:
+        from core.quota_service import get_quota_service
+        if not owner_user_id:
+            from core.tenant_filter import get_owner_user_id
+            owner_user_id = get_owner_user_id()
+        get_quota_service().apply_usage_event(owner_user_id, 'groups', delta)
+    except Exception as e:
+        print(f"[Backend] Group quota ledger update error: {e}", file=sys.stderr)
+
 async def handle_add_group(self, payload: Dict[str, Any]):
     """Handle add-group command. Returns {'success': True/False, 'error': ...} for caller inspection."""
     try:
@@ -802,6 +813,7 @@ async def handle_add_group(self, payload: Dict[str, Any]):
             # Add new group
             group_id = await db.add_group(url, group_title, keyword_set_ids)
             await db.add_log(f"Group '{group_title}' added", "success")
+            _apply_group_quota_event(owner_user_id, 1)
         await self.send_groups_update()
         return {'success': True, 'group_title': group_title}
     
@@ -1649,6 +1661,7 @@ async def handle_remove_group(self, payload: Dict[str, Any]):
                 self.send_log(f"✅ 已按 name 刪除: {group_id}", "success")
         
         if deleted:
+            _apply_group_quota_event(None, -1)
             await db.add_log(f"監控群組已移除: {group_id}", "success")
             self.send_event("remove-group-result", {"success": True, "groupId": group_id})
         else:
@@ -12,6 +12,7 @@ from typing import Any, Dict, List, Optional
 
 from service_context import get_service_context
 from database import db
+from ai_context_manager import ai_context
 
 # All handlers receive (self, payload) where self is BackendService instance.
 # They are called via: await handler_impl(self, payload)
@@ -252,6 +253,7 @@ async def handle_send_ai_response(self, payload: Dict[str, Any]):
                 account_phone=account_phone,
                 source_group=source_group
             )
+            ai_context.invalidate(user_id, 'recent')
             
             # 更新每日計數（僅未互動用戶）
             if not has_interacted:
@@ -1,14 +1,17 @@
 """
 Group Message Poller - 群組消息輪詢服務
 🔧 Phase 1: 使用輪詢模式替代事件驅動，確保群組 AI 回覆可靠性
+🔧 水位線增量拉取: 每個群組記錄已見最大 message_id，只拉取更新的消息；
+   輪詢間隔隨群組活躍度自適應（活躍時縮短，安靜時逐步放寬）
 """
 import sys
 import asyncio
 import random
-from typing import Dict, Set, Optional, Callable, Any, List
+from typing import Dict, Optional, Callable, Any, List
 from datetime import datetime, timedelta
 from pyrogram import Client
 from pyrogram.enums import ChatType
+from core.message_dedup import MessageDedupCache
 
 
 class GroupMessagePoller:
@@ -17,11 +20,22 @@ class GroupMessagePoller:
     def __init__(self, event_callback: Optional[Callable] = None):
         self.event_callback = event_callback
         self._polling_tasks: Dict[str, asyncio.Task] = {}  # group_id -> task
-        self._processed_message_ids: Set[str] = set()
         self._max_processed_cache = 5000
-        self._polling_interval = 3  # 群聊輪詢間隔（秒）
+        # 有序去重：(group_id, message_id)，按插入順序淘汰最舊的記錄
+        self._processed = MessageDedupCache(self._max_processed_cache)
+        self._polling_interval = 3  # 群聊輪詢間隔（秒，活躍時的基準值）
+        self._max_polling_interval = 30  # 安靜群組的最大輪詢間隔（秒）
+        self._interval_backoff = 1.5  # 無新消息時間隔放大倍數
+        self._fetch_batch = 20  # 每次拉取的消息數
+        self._max_catchup = 100  # 突發時單輪最多補拉的消息數
+        self._bootstrap_max_age = timedelta(minutes=5)  # 首次拉取時忽略更舊的消息
         self._running = False
         
+        # group_id -> 已見過的最大 message_id
+        self._watermarks: Dict[str, int] = {}
+        # group_id -> 當前輪詢間隔（秒）
+        self._intervals: Dict[str, float] = {}
+        
         # 活躍的群組協作配置
         self._active_collabs: Dict[str, Dict[str, Any]] = {}
         # group_id -> {
@@ -42,24 +56,27 @@ class GroupMessagePoller:
                 "type": level
             })
     
-    def _make_message_key(self, group_id: str, message_id: int) -> str:
-        """生成消息唯一鍵"""
-        return f"{group_id}:{message_id}"
-    
     def _is_processed(self, group_id: str, message_id: int) -> bool:
         """檢查消息是否已處理"""
-        return self._make_message_key(group_id, message_id) in self._processed_message_ids
+        return self._processed.contains(int(group_id), message_id)
     
     def _mark_processed(self, group_id: str, message_id: int):
-        """標記消息為已處理"""
-        key = self._make_message_key(group_id, message_id)
-        self._processed_message_ids.add(key)
-        
-        # 防止內存溢出
-        if len(self._processed_message_ids) > self._max_processed_cache:
-            to_remove = list(self._processed_message_ids)[:self._max_processed_cache // 2]
-            for item in to_remove:
-                self._processed_message_ids.discard(item)
+        """標記消息為已處理（超出容量時淘汰最舊的記錄）"""
+        self._processed.add(int(group_id), message_id)
+    
+    def get_watermark(self, group_id: str) -> int:
+        """獲取群組水位線（已見過的最大 message_id，未知為 0）"""
+        return self._watermarks.get(str(group_id), 0)
+    
+    def _next_interval(self, group_id: str, new_count: int) -> float:
+        """根據本輪新消息數計算下次輪詢間隔"""
+        if new_count > 0:
+            interval = self._polling_interval
+        else:
+            current = self._intervals.get(group_id, self._polling_interval)
+            interval = min(current * self._interval_backoff, self._max_polling_interval)
+        self._intervals[group_id] = interval
+        return interval
     
     async def start_group_collab(
         self,
@@ -132,6 +149,7 @@ class GroupMessagePoller:
         
         if group_id in self._active_collabs:
             del self._active_collabs[group_id]
+        self._intervals.pop(group_id, None)
         
         self.log(f"🛑 群組 {group_id} 協作監控已停止")
     
@@ -151,8 +169,9 @@ class GroupMessagePoller:
         self.log(f"📡 開始輪詢群組 {group_id}")
         
         while self._running and group_id in self._active_collabs:
+            new_count = 0
             try:
-                await self._check_group_messages(group_id)
+                new_count = await self._check_group_messages(group_id)
             except asyncio.CancelledError:
                 break
             except Exception as e:
@@ -168,15 +187,45 @@ class GroupMessagePoller:
                     import traceback
                     traceback.print_exc(file=sys.stderr)
             
-            await asyncio.sleep(self._polling_interval)
+            await asyncio.sleep(self._next_interval(group_id, new_count or 0))
         
         self.log(f"📡 群組 {group_id} 輪詢已結束")
     
-    async def _check_group_messages(self, group_id: str):
-        """檢查群組的新消息"""
+    async def _fetch_new_messages(self, client: Client, chat_id: int, watermark: int) -> List[Any]:
+        """
+        拉取水位線之後的消息（從新到舊）
+        
+        突發時按 offset_id 向前翻頁直到觸及水位線或達到 _max_catchup；
+        首次拉取（無水位線）只取一頁。
+        """
+        messages: List[Any] = []
+        offset_id = 0
+        while len(messages) < self._max_catchup:
+            page_size = 0
+            reached = False
+            async for message in client.get_chat_history(
+                chat_id, limit=self._fetch_batch, offset_id=offset_id
+            ):
+                page_size += 1
+                if message.id <= watermark:
+                    reached = True
+                    break
+                messages.append(message)
+                offset_id = message.id
+            if reached or page_size < self._fetch_batch or not watermark:
+                break
+        return messages
+    
+    async def _check_group_messages(self, group_id: str) -> int:
+        """
+        檢查群組的新消息
+        
+        Returns:
+            本輪發現的新消息數（用於自適應輪詢間隔）
+        """
         collab = self._active_collabs.get(group_id)
         if not collab:
-            return
+            return 0
         
         clients = collab.get('clients', {})
         own_user_ids = collab.get('own_user_ids', set())
@@ -193,14 +242,21 @@ class GroupMessagePoller:
                     break
         
         if not client or not client.is_connected:
-            return
+            return 0
         
         try:
-            # 獲取最近的群組消息
+            # 獲取水位線之後的群組消息
             group_id_int = int(group_id)
-            messages = []
+            watermark = self._watermarks.get(group_id, 0)
+            fetched = await self._fetch_new_messages(client, group_id_int, watermark)
+            if not fetched:
+                return 0
+            
+            # 所有拉取到的消息（包括自己發送的）都推進水位線
+            self._watermarks[group_id] = max(watermark, max(m.id for m in fetched))
             
-            async for message in client.get_chat_history(group_id_int, limit=10):
+            messages = []
+            for message in fetched:
                 # 只處理文本消息
                 if not message.text and not message.caption:
                     continue
@@ -209,10 +265,10 @@ class GroupMessagePoller:
                 if message.from_user and message.from_user.id in own_user_ids:
                     continue
                 
-                # 跳過太舊的消息（超過 5 分鐘）
-                if message.date:
+                # 首次拉取時跳過太舊的消息（超過 5 分鐘），之後由水位線保證不遺漏
+                if not watermark and message.date:
                     msg_time = message.date
-                    if datetime.now(msg_time.tzinfo) - msg_time > timedelta(minutes=5):
+                    if datetime.now(msg_time.tzinfo) - msg_time > self._bootstrap_max_age:
                         continue
                 
                 messages.append(message)
@@ -222,11 +278,14 @@ class GroupMessagePoller:
             
             for message in messages:
                 await self._process_group_message(group_id, collab, message)
+            
+            return len(fetched)
                 
         except Exception as e:
             error_str = str(e).lower()
             if 'peer_id_invalid' in error_str or 'chat_not_found' in error_str:
                 self.log(f"群組 {group_id} 不存在或無權訪問", "warning")
+                return 0
             else:
                 raise
     
@@ -238,13 +297,10 @@ class GroupMessagePoller:
     ):
         """處理單條群組消息"""
         try:
-            # 去重檢查
-            if self._is_processed(group_id, message.id):
+            # 去重檢查並標記為已處理
+            if self._processed.check_and_add(int(group_id), message.id):
                 return
             
-            # 標記為已處理
-            self._mark_processed(group_id, message.id)
-            
             # 獲取消息內容
             text = message.text or message.caption or ""
             if not text.strip():
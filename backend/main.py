@@ -621,7 +621,7 @@ _HANDLER_REGISTRY = {
         'handle_ai_generate_message handle_ai_generate_text handle_ai_generate_group_names '
         'handle_ai_generate_welcome handle_test_local_ai handle_test_tts_service '
         'handle_test_stt_service handle_get_ai_settings handle_save_ai_settings '
-        'handle_set_autonomous_mode handle_generate_with_local_ai '
+        'handle_set_autonomous_mode handle_generate_with_local_ai handle_ai_stream_cancel '
         'handle_summarize_conversation handle_ai_analyze_interest handle_ai_execution_save '
         'handle_ai_execution_get_active'
     ),
@@ -1101,7 +1101,21 @@ class BackendService(InitStartupMixin, SendQueueMixin, AiServiceMixin, ConfigExe
                 await self._db_health_guard.stop()
         except Exception as e:
             print(f"[Backend] Error stopping DB health guard: {e}", file=sys.stderr)
-        
+
+        # 🆕 P18-20: 等待數據庫線程池中的寫入完成並關閉連接
+        try:
+            from core.db_executor import shutdown_db_executors
+            await asyncio.to_thread(shutdown_db_executors)
+        except Exception as e:
+            print(f"[Backend] Error stopping DB executor: {e}", file=sys.stderr)
+
+        # 🆕 P18-21: 關閉 LLM 網關的提供商連接池
+        try:
+            from core.llm_gateway import get_llm_gateway
+            await get_llm_gateway().close()
+        except Exception as e:
+            print(f"[Backend] Error closing LLM gateway: {e}", file=sys.stderr)
+
         # Try to log shutdown (only if database is still connected)
         try:
             if db._connection is not None:
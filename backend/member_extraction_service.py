@@ -14,21 +14,33 @@ import asyncio
 import time
 import random
 import json
+import inspect
+import sqlite3
 from datetime import datetime, timedelta
 from typing import Dict, Any, List, Optional, Callable, Tuple
 from dataclasses import dataclass, field, asdict
 from enum import Enum
 from collections import defaultdict
 
-from pyrogram import Client
+from pyrogram import Client, raw
 from pyrogram.types import User, ChatMember
 from pyrogram.errors import (
     FloodWait, ChannelPrivate, ChatAdminRequired,
     PeerIdInvalid, UserNotParticipant, ChannelInvalid
 )
-from pyrogram.enums import UserStatus, ChatMemberStatus
+from pyrogram.enums import UserStatus, ChatMemberStatus, ChatMembersFilter
 
-from database import db
+try:
+    # 公開的 get_chat_members 不支持 offset，斷點續傳使用其內部分頁函數；版本不兼容時退回公開 API
+    from pyrogram.methods.chats.get_chat_members import get_chunk as _get_members_chunk
+except ImportError:
+    _get_members_chunk = None
+
+from database import db, HAS_AIOSQLITE
+from core.peer_cache import get_peer_cache
+from core.streaming_export import (
+    iter_query_rows, export_to_file, stream_export, normalize_format, Sink
+)
 from text_utils import sanitize_text, safe_get_username
 
 
@@ -113,6 +125,137 @@ class ExtractedMember:
     groups: List[str] = field(default_factory=list)
 
 
+async def _maybe_await(value):
+    """aiosqlite 調用返回 awaitable，sqlite3 直接返回結果"""
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+# 🆕 P18-9: extracted_members 集合式去重 — 每個重複 user_id 保留最近更新的一行，
+# 其餘行的用戶可編輯數據合併進來後再刪除（列按實際表結構生成，兼容舊庫）
+_DEDUP_JSON_LIST_COLUMNS = {'groups', 'tags', 'auto_tags'}
+_DEDUP_MAX_COLUMNS = {
+    'contacted', 'contacted_at', 'invited', 'invited_at', 'last_online', 'extracted_at', 'updated_at',
+    'activity_score', 'intent_score', 'is_premium', 'is_verified', 'has_photo',
+}
+_DEDUP_MIN_COLUMNS = {'created_at'}
+_DEDUP_TEXT_CONCAT_COLUMNS = {'notes'}
+# 列默認值視同空值，不覆蓋其他行中真正設置過的值
+_DEDUP_EMPTY_DEFAULTS = {'response_status': 'none'}
+
+
+def _member_dedup_sql(columns: List[str]) -> Tuple[str, str, str]:
+    """
+    按表的實際列生成 (計劃, 合併, 刪除) SQL；合併 / 刪除按計劃 rowid 範圍 [?, ?] 分塊執行
+
+    合併規則：groups/tags/auto_tags 取並集（groups 另含 source_chat_id），
+    contacted/invited/評分/時間取最大值，notes 去重拼接，
+    其餘列取最近更新的一行中的值（為空時依次取其他行的非空值）
+    """
+    order = "COALESCE(e2.updated_at, '') DESC, e2.id" if 'updated_at' in columns else 'e2.id'
+    merged = [c for c in columns if c not in ('id', 'user_id')]
+    exprs = []
+    for col in merged:
+        if col in _DEDUP_JSON_LIST_COLUMNS:
+            values = (
+                f"SELECT CAST(je.value AS TEXT) AS v FROM extracted_members e2, json_each("
+                f"CASE WHEN json_valid(e2.{col}) THEN e2.{col} "
+                f"WHEN e2.{col} IS NULL OR e2.{col} = '' THEN '[]' ELSE json_array(e2.{col}) END) je "
+                f"WHERE e2.user_id = d.user_id"
+            )
+            if col == 'groups' and 'source_chat_id' in columns:
+                values += (" UNION SELECT e2.source_chat_id FROM extracted_members e2 WHERE e2.user_id = d.user_id"
+                           " AND e2.source_chat_id IS NOT NULL AND e2.source_chat_id != ''")
+            expr = f"COALESCE((SELECT json_group_array(DISTINCT v) FROM ({values})), '[]')"
+        elif col in _DEDUP_MAX_COLUMNS:
+            expr = f"(SELECT MAX(e2.{col}) FROM extracted_members e2 WHERE e2.user_id = d.user_id)"
+        elif col in _DEDUP_MIN_COLUMNS:
+            expr = f"(SELECT MIN(e2.{col}) FROM extracted_members e2 WHERE e2.user_id = d.user_id)"
+        elif col in _DEDUP_TEXT_CONCAT_COLUMNS:
+            expr = (
+                f"(SELECT group_concat(v, char(10)) FROM (SELECT e2.{col} AS v FROM extracted_members e2 "
+                f"WHERE e2.user_id = d.user_id AND e2.{col} IS NOT NULL AND e2.{col} != '' "
+                f"GROUP BY e2.{col} ORDER BY MIN(e2.id)))"
+            )
+        else:
+            empty = f" AND e2.{col} != '{_DEDUP_EMPTY_DEFAULTS[col]}'" if col in _DEDUP_EMPTY_DEFAULTS else ''
+            expr = (
+                f"COALESCE((SELECT e2.{col} FROM extracted_members e2 WHERE e2.user_id = d.user_id "
+                f"AND e2.{col} IS NOT NULL AND e2.{col} != ''{empty} ORDER BY {order} LIMIT 1), "
+                f"(SELECT e2.{col} FROM extracted_members e2 WHERE e2.user_id = d.user_id ORDER BY {order} LIMIT 1))"
+            )
+        exprs.append(f"{expr} AS {col}")
+
+    plan = f"""
+        CREATE TEMP TABLE member_dedup_plan AS
+        WITH dups AS (
+            SELECT user_id, COUNT(*) AS row_count
+            FROM extracted_members
+            WHERE user_id IS NOT NULL
+            GROUP BY user_id
+            HAVING COUNT(*) > 1
+        )
+        SELECT d.user_id, d.row_count,
+               (SELECT e2.id FROM extracted_members e2 WHERE e2.user_id = d.user_id ORDER BY {order} LIMIT 1) AS keep_id,
+               {', '.join(exprs)}
+        FROM dups d
+        ORDER BY d.user_id
+    """
+    assignments = ', '.join(
+        f"{col} = (SELECT p.{col} FROM temp.member_dedup_plan p WHERE p.keep_id = extracted_members.id)"
+        for col in merged
+    )
+    merge = f"""
+        UPDATE extracted_members SET {assignments}
+        WHERE id IN (SELECT keep_id FROM temp.member_dedup_plan WHERE rowid BETWEEN ? AND ?)
+    """
+    delete = """
+        DELETE FROM extracted_members
+        WHERE id IN (
+            SELECT em.id FROM extracted_members em
+            JOIN temp.member_dedup_plan p ON p.user_id = em.user_id
+            WHERE p.rowid BETWEEN ? AND ? AND em.id != p.keep_id
+        )
+    """
+    return plan, merge, delete
+
+
+# 🆕 P18-6: 集合式 UPSERT — groups 在 SQL 中合併（已存在則不重複追加）
+
+_MEMBER_COLUMNS = (
+    'user_id', 'username', 'first_name', 'last_name', 'phone',
+    'online_status', 'last_online', 'is_bot', 'is_premium', 'is_verified',
+    'source_chat_id', 'source_chat_title', 'extracted_at', 'extracted_by_phone',
+    'value_level', 'activity_score', 'groups', 'created_at', 'updated_at',
+)
+
+_MEMBER_UPSERT_SQL = f"""
+    INSERT INTO extracted_members ({', '.join(_MEMBER_COLUMNS)})
+    VALUES ({', '.join('?' for _ in _MEMBER_COLUMNS)})
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = excluded.username,
+        first_name = excluded.first_name,
+        last_name = excluded.last_name,
+        online_status = excluded.online_status,
+        last_online = excluded.last_online,
+        activity_score = excluded.activity_score,
+        value_level = excluded.value_level,
+        is_premium = excluded.is_premium,
+        groups = CASE
+            WHEN extracted_members.groups IS NULL
+                 OR json_valid(extracted_members.groups) = 0
+                THEN excluded.groups
+            WHEN EXISTS (
+                SELECT 1 FROM json_each(extracted_members.groups)
+                WHERE CAST(json_each.value AS TEXT) = excluded.source_chat_id
+            ) THEN extracted_members.groups
+            ELSE json_insert(extracted_members.groups, '$[#]', excluded.source_chat_id)
+        END,
+        updated_at = excluded.updated_at
+"""
+
+
 class MemberExtractionService:
     """成員提取服務"""
     
@@ -122,10 +265,6 @@ class MemberExtractionService:
         self._extraction_lock = asyncio.Lock()
         self._current_extraction: Dict[str, Any] = {}
         
-        # 🆕 P1 優化：Peer 緩存
-        self._peer_cache: Dict[str, Dict] = {}  # key: f"{phone}:{chat_id}"
-        self._peer_cache_ttl = 300  # 緩存有效期 5 分鐘
-        
         # 🆕 P1 優化：提取隊列
         self._extraction_queue: List[Dict] = []
         self._queue_processing = False
@@ -148,6 +287,16 @@ class MemberExtractionService:
         # 🆕 P2 優化：背景任務
         self._background_tasks: Dict[str, Dict] = {}
         
+        # 🆕 P18-6: 批量寫入統計（None 表示尚未探測 ON CONFLICT 是否可用）
+        self._bulk_upsert_supported: Optional[bool] = None
+        self._save_stats: Dict[str, Any] = {
+            'rows': 0,
+            'batches': 0,
+            'seconds': 0.0,
+            'fallback_batches': 0,
+            'last_rows_per_sec': 0.0,
+        }
+        
         # 提取配置
         self.config = {
             'batch_size': 200,           # 每批提取數量
@@ -155,6 +304,9 @@ class MemberExtractionService:
             'max_members_per_group': 10000,  # 每群最大提取數
             'flood_wait_multiplier': 1.2,    # FloodWait 等待倍數
             'save_interval': 100,        # 每多少個保存一次
+            'result_preview_limit': 2000,  # 🆕 P18-7: 返回結果中保留的成員預覽數（完整數據已入庫）
+            'checkpoint_ttl': 86400,     # 🆕 P18-7: 斷點有效期（秒）
+            'upsert_chunk_size': 500,    # 🆕 P18-6: 批量 UPSERT 每個事務的行數
             'pre_extraction_delay': 2,   # 🆕 提取前延遲（確保 Telegram 同步）
             'result_cache_enabled': True,  # 🆕 P2: 啟用結果緩存
             'smart_account_selection': True,  # 🆕 P2: 智能帳號選擇
@@ -169,50 +321,16 @@ class MemberExtractionService:
         self._clients = clients
     
     # ==================== P1 優化：Peer 緩存 ====================
-    
-    def _get_cache_key(self, phone: str, chat_id: str) -> str:
-        """生成緩存鍵"""
-        return f"{phone}:{chat_id}"
-    
-    def _get_cached_peer(self, phone: str, chat_id: str) -> Optional[Dict]:
-        """從緩存獲取 peer 信息"""
-        key = self._get_cache_key(phone, chat_id)
-        if key in self._peer_cache:
-            cache_entry = self._peer_cache[key]
-            # 檢查是否過期
-            if time.time() - cache_entry['cached_at'] < self._peer_cache_ttl:
-                self.log(f"📦 使用緩存的 peer: {chat_id}", "debug")
-                return cache_entry['data']
-            else:
-                # 過期，刪除
-                del self._peer_cache[key]
+    # 使用 core.peer_cache 共享緩存（與監控、加群、成員檢查共用，持久化跨重啟）
+    
+    def _get_cached_peer(self, phone: str, chat_id: str):
+        """從共享緩存獲取該帳號可用的 peer（PeerEntry，字段與 Chat 相同）"""
+        entry = get_peer_cache().get(chat_id)
+        if entry and not entry.negative and phone in entry.access_hashes:
+            self.log(f"📦 使用緩存的 peer: {chat_id}", "debug")
+            return entry
         return None
     
-    def _cache_peer(self, phone: str, chat_id: str, chat_data: Dict):
-        """緩存 peer 信息"""
-        key = self._get_cache_key(phone, chat_id)
-        self._peer_cache[key] = {
-            'data': chat_data,
-            'cached_at': time.time()
-        }
-        self.log(f"💾 已緩存 peer: {chat_id}", "debug")
-        
-        # 清理過期緩存（超過 100 個時）
-        if len(self._peer_cache) > 100:
-            self._cleanup_peer_cache()
-    
-    def _cleanup_peer_cache(self):
-        """清理過期的緩存條目"""
-        now = time.time()
-        expired_keys = [
-            k for k, v in self._peer_cache.items() 
-            if now - v['cached_at'] > self._peer_cache_ttl
-        ]
-        for key in expired_keys:
-            del self._peer_cache[key]
-        if expired_keys:
-            self.log(f"🧹 清理了 {len(expired_keys)} 個過期緩存", "debug")
-    
     def log(self, message: str, level: str = "info"):
         """記錄日誌"""
         formatted = f"[MemberExtraction] {message}"
@@ -404,6 +522,7 @@ class MemberExtractionService:
         
         start_time = time.time()
         max_members = limit or self.config['max_members_per_group']
+        stream: Optional[Dict[str, Any]] = None  # 🆕 P18-7: 流式提取狀態（異常時用於落盤）
         
         # 🆕 P2 優化：檢查結果緩存（只對非強制刷新的請求使用）
         cached = self.get_cached_result(chat_id)
@@ -444,17 +563,9 @@ class MemberExtractionService:
             if pre_delay > 0:
                 await asyncio.sleep(pre_delay)
             
-            # 🆕 P1 優化：嘗試從緩存獲取群組信息
-            cached_peer = self._get_cached_peer(phone, str(chat_id))
-            chat = None
-            
-            if cached_peer:
-                # 使用緩存的 chat_id 直接獲取（更快）
-                try:
-                    chat = await client.get_chat(cached_peer['chat_id'])
-                except Exception:
-                    # 緩存失效，重新獲取
-                    chat = None
+            # 🆕 P1 優化：命中共享緩存時直接使用（無需 get_chat 網絡請求）
+            chat = self._get_cached_peer(phone, str(chat_id))
+            original_chat_ref = chat_id
             
             if not chat:
                 # 獲取群組信息 — 🆕 支持自動 -100 前綴（正整數 ID → Pyrogram 超級群組格式）
@@ -480,23 +591,43 @@ class MemberExtractionService:
                     else:
                         raise resolve_err
                 
-                # 緩存成功解析的 peer（用實際解析成功的 chat_id）
-                self._cache_peer(phone, str(chat_id), {
-                    'chat_id': chat.id,
-                    'title': chat.title,
-                    'type': str(chat.type)
-                })
+                # 緩存成功解析的 peer（原始引用和實際解析成功的 chat_id 都可命中）
+                await get_peer_cache().remember(client, phone, original_chat_ref, chat)
             
             result['chat_title'] = sanitize_text(chat.title) if chat.title else str(chat_id)
             result['total_members'] = getattr(chat, 'members_count', 0) or 0
             
             self.log(f"📊 群組: {result['chat_title']}, 成員數: {result['total_members']}")
             
-            # 開始提取
-            members = []
-            batch_count = 0
+            # 🆕 P18-7: 流式提取 — 邊拉取邊過濾/評分/分塊保存，按 (chat_id, phone) 記錄斷點
+            chat_key = str(chat.id)
+            checkpoint = await self._load_checkpoint(chat_key, phone) if save_to_db else None
+            stream = {
+                'chat_key': chat_key,
+                'phone': phone,
+                'save_to_db': save_to_db,
+                'consumed': 0,   # 已處理的原始參與者數（含被過濾的），即續傳 offset
+                'buffer': [],
+                'result': result,
+            }
+            if checkpoint:
+                stream['consumed'] = checkpoint['offset']
+                for key, value in checkpoint['counters'].items():
+                    if key in result:
+                        result[key] = value
+                result['resumed_from'] = checkpoint['offset']
+                self.log(f"⏯️ 從斷點續傳: {chat_key} offset={checkpoint['offset']}, 已提取 {result['extracted']}")
+            
+            # 只保留有限的預覽列表，內存與群組大小無關（完整數據在數據庫中）
+            preview_limit = self.config['result_preview_limit'] if save_to_db else max_members
+            members: List[ExtractedMember] = []
+            batch_count = result['extracted']
+            progress_total = min(result['total_members'], max_members) if result['total_members'] else max_members
             
-            async for member in client.get_chat_members(chat.id, limit=max_members):
+            async for consumed, member in self._iter_chat_members(
+                client, chat.id, stream['consumed'], max_members - stream['consumed']
+            ):
+                stream['consumed'] = consumed
                 try:
                     user = member.user
                     if not user:
@@ -588,7 +719,10 @@ class MemberExtractionService:
                     # 計算價值等級
                     extracted.value_level = self._calculate_value_level(extracted)
                     
-                    members.append(extracted)
+                    if len(members) < preview_limit:
+                        members.append(extracted)
+                    if save_to_db:
+                        stream['buffer'].append(extracted)
                     
                     # 統計在線狀態 - 🔧 修復：使用 user_online_status
                     if user_online_status == OnlineStatus.ONLINE.value:
@@ -597,21 +731,20 @@ class MemberExtractionService:
                         result['recently_count'] += 1
                     
                     batch_count += 1
+                    result['extracted'] = batch_count
                     
                     # 發送進度 - 🆕 P3：包含預估時間
                     if batch_count % 50 == 0:
                         self._emit_progress(
                             str(chat.id), 
-                            batch_count, 
-                            min(result['total_members'], max_members),
+                            min(consumed, progress_total), 
+                            progress_total,
                             start_time=start_time
                         )
                     
-                    # 批次保存
-                    if save_to_db and batch_count % self.config['save_interval'] == 0:
-                        new, updated = await self._save_members_batch(members[-self.config['save_interval']:])
-                        result['new_members'] += new
-                        result['updated_members'] += updated
+                    # 批次保存 + 記錄斷點
+                    if len(stream['buffer']) >= self.config['save_interval']:
+                        await self._flush_member_stream(stream)
                     
                     # 批次延遲
                     if batch_count % self.config['batch_size'] == 0:
@@ -621,16 +754,15 @@ class MemberExtractionService:
                     self.log(f"⚠️ 處理成員時出錯: {e}", "warning")
                     continue
             
-            # 保存剩餘成員
-            if save_to_db and members:
-                remaining = batch_count % self.config['save_interval']
-                if remaining > 0:
-                    new, updated = await self._save_members_batch(members[-remaining:])
-                    result['new_members'] += new
-                    result['updated_members'] += updated
+            # 保存剩餘成員，完成後清除斷點
+            if save_to_db:
+                await self._flush_member_stream(stream)
+                await self._clear_checkpoint(chat_key)
+            stream = None
             
             result['success'] = True
-            result['extracted'] = len(members)
+            result['extracted'] = batch_count
+            result['members_truncated'] = batch_count > len(members)
             result['duration_ms'] = int((time.time() - start_time) * 1000)
             
             # 返回提取的成員列表 - 包含所有字段
@@ -685,7 +817,7 @@ class MemberExtractionService:
                 for m in members
             ]
             
-            self._emit_progress(str(chat.id), len(members), len(members), "completed")
+            self._emit_progress(str(chat.id), batch_count, batch_count, "completed")
             
             self.log(f"✅ 提取完成: {result['extracted']} 成員, "
                     f"在線 {result['online_count']}, 最近 {result['recently_count']}")
@@ -701,6 +833,8 @@ class MemberExtractionService:
             
         except FloodWait as e:
             wait_time = int(e.value * self.config['flood_wait_multiplier'])
+            # 🆕 P18-7: 先把已拉取的成員落盤並記錄斷點，之後（含輪換帳號）可續傳
+            await self._flush_member_stream(stream)
             # 🆕 Phase4: 記錄 FloodWait 到全局 handler（跨操作共享冷卻期）
             try:
                 from flood_wait_handler import flood_handler
@@ -712,7 +846,7 @@ class MemberExtractionService:
             rotation_attempted = False
             try:
                 from flood_wait_handler import flood_handler as fh
-                alt_accounts = fh.get_available_accounts(self.telegram_manager.clients, 'get_participants')
+                alt_accounts = fh.get_available_accounts(self._clients, 'get_participants')
                 for alt_phone, alt_cooldown in alt_accounts:
                     if alt_phone == phone or alt_cooldown > 0:
                         continue
@@ -721,13 +855,16 @@ class MemberExtractionService:
                     rotation_attempted = True
                     # 遞迴調用，但用新帳號
                     alt_result = await self.extract_members(
-                        chat_id=effective_chat_id,
+                        chat_id=chat_id,
                         phone=alt_phone,
-                        save_to_db=self.config.get('auto_save', True),
-                        emit_progress=True
+                        limit=limit,
+                        filter_bots=filter_bots,
+                        filter_offline=filter_offline,
+                        online_status=online_status,
+                        save_to_db=save_to_db
                     )
-                    if alt_result.get('members_count', 0) > 0:
-                        self.log(f"✓ 帳號輪換成功: {alt_phone[:4]}**** 提取 {alt_result.get('members_count', 0)} 成員", "success")
+                    if alt_result.get('success'):
+                        self.log(f"✓ 帳號輪換成功: {alt_phone[:4]}**** 提取 {alt_result.get('extracted', 0)} 成員", "success")
                         alt_result['rotated_from'] = phone
                         alt_result['rotation_reason'] = f"FloodWait {wait_time}s"
                         return alt_result
@@ -807,6 +944,7 @@ class MemberExtractionService:
         except Exception as e:
             error_str = str(e)
             self.log(f"❌ 提取失敗: {error_str}", "error")
+            await self._flush_member_stream(stream)
             
             # 解析常見錯誤
             if 'PEER_ID_INVALID' in error_str:
@@ -908,22 +1046,26 @@ class MemberExtractionService:
         self.log(f"🔍 開始從消息歷史提取活躍用戶: {chat_id}")
         
         try:
-            # 🆕 支持自動 -100 前綴
-            try:
-                chat = await client.get_chat(chat_id)
-            except (PeerIdInvalid, ChannelInvalid):
-                chat_id_int = None
-                if isinstance(chat_id, int) and chat_id > 1000000000:
-                    chat_id_int = chat_id
-                elif isinstance(chat_id, str) and chat_id.isdigit() and int(chat_id) > 1000000000:
-                    chat_id_int = int(chat_id)
-                if chat_id_int:
-                    alt_id = int(f"-100{chat_id_int}")
-                    self.log(f"🔄 PeerIdInvalid → 嘗試: {alt_id}", "info")
-                    chat = await client.get_chat(alt_id)
-                    chat_id = alt_id
-                else:
-                    raise
+            # 🆕 支持自動 -100 前綴（優先使用共享 Peer 緩存）
+            chat = self._get_cached_peer(phone, str(chat_id))
+            if not chat:
+                original_chat_ref = chat_id
+                try:
+                    chat = await client.get_chat(chat_id)
+                except (PeerIdInvalid, ChannelInvalid):
+                    chat_id_int = None
+                    if isinstance(chat_id, int) and chat_id > 1000000000:
+                        chat_id_int = chat_id
+                    elif isinstance(chat_id, str) and chat_id.isdigit() and int(chat_id) > 1000000000:
+                        chat_id_int = int(chat_id)
+                    if chat_id_int:
+                        alt_id = int(f"-100{chat_id_int}")
+                        self.log(f"🔄 PeerIdInvalid → 嘗試: {alt_id}", "info")
+                        chat = await client.get_chat(alt_id)
+                        chat_id = alt_id
+                    else:
+                        raise
+                await get_peer_cache().remember(client, phone, original_chat_ref, chat)
             result['chat_title'] = sanitize_text(chat.title) if chat.title else str(chat_id)
             
             # 已提取的用戶 ID 集合（避免與 get_chat_members 結果重複）
@@ -993,30 +1135,28 @@ class MemberExtractionService:
                 reverse=True
             )
             
-            # 保存新用戶到 DB
+            # 保存新用戶到 DB - 🆕 P18-6：一次批量 UPSERT
             new_count = 0
-            for user_data in sorted_users:
-                if not user_data['is_new']:
-                    continue
-                
-                if save_to_db:
-                    try:
-                        member = ExtractedMember(
-                            user_id=user_data['user_id'],
-                            username=user_data['username'],
-                            first_name=user_data['first_name'],
-                            last_name=user_data['last_name'],
-                            is_premium=user_data['is_premium'],
-                            online_status='recently',  # 在歷史中出現說明有活動
-                            source_chat_id=str(chat.id),
-                            source_chat_title=result['chat_title'],
-                            activity_score=min(100, user_data['message_count'] * 10),
-                            value_level='high' if user_data['message_count'] >= 5 else 'medium'
-                        )
-                        n, _ = await self._save_members_batch([member])
-                        new_count += n
-                    except Exception as save_err:
-                        self.log(f"⚠ Save error for {user_data['user_id']}: {save_err}", "warning")
+            if save_to_db:
+                new_members = [
+                    ExtractedMember(
+                        user_id=user_data['user_id'],
+                        username=user_data['username'],
+                        first_name=user_data['first_name'],
+                        last_name=user_data['last_name'],
+                        is_premium=user_data['is_premium'],
+                        online_status='recently',  # 在歷史中出現說明有活動
+                        source_chat_id=str(chat.id),
+                        source_chat_title=result['chat_title'],
+                        activity_score=min(100, user_data['message_count'] * 10),
+                        value_level='high' if user_data['message_count'] >= 5 else 'medium'
+                    )
+                    for user_data in sorted_users if user_data['is_new']
+                ]
+                try:
+                    new_count, _ = await self._save_members_batch(new_members)
+                except Exception as save_err:
+                    self.log(f"⚠ Save error: {save_err}", "warning")
             
             result['success'] = True
             result['extracted'] = len(sorted_users)
@@ -1052,8 +1192,213 @@ class MemberExtractionService:
             self.log(f"❌ 歷史提取失敗: {e}", "error")
             return result
     
+    # ==================== P18-7: 流式提取 + 斷點續傳 ====================
+    
+    _CHECKPOINT_COUNTERS = (
+        'extracted', 'online_count', 'recently_count', 'filtered_bots',
+        'filtered_offline', 'new_members', 'updated_members',
+    )
+    
+    async def _iter_chat_members(self, client: Client, chat_id: int, offset: int, limit: int):
+        """
+        按 offset 分頁拉取成員，產出 (已消費的原始參與者數, ChatMember)
+        
+        超級群組/頻道直接從 offset 開始請求（續傳無需重新拉取）；
+        基礎群組只能一次返回完整列表，跳過 offset 之前的部分。
+        """
+        if limit <= 0:
+            return
+        
+        use_chunks = _get_members_chunk is not None and isinstance(
+            await client.resolve_peer(chat_id), raw.types.InputPeerChannel
+        )
+        
+        if not use_chunks:
+            consumed = 0
+            async for member in client.get_chat_members(chat_id, limit=offset + limit):
+                consumed += 1
+                if consumed > offset:
+                    yield consumed, member
+            return
+        
+        fetched = 0
+        while fetched < limit:
+            chunk = await _get_members_chunk(
+                client=client,
+                chat_id=chat_id,
+                offset=offset,
+                filter=ChatMembersFilter.SEARCH,
+                limit=min(200, limit - fetched),
+                query=""
+            )
+            if not chunk:
+                return
+            for member in chunk:
+                offset += 1
+                fetched += 1
+                yield offset, member
+                if fetched >= limit:
+                    return
+    
+    async def _load_checkpoint(self, chat_key: str, phone: str) -> Optional[Dict[str, Any]]:
+        """
+        讀取未完成的斷點：優先本帳號，其次同群組其他帳號（FloodWait 輪換後續傳）
+        """
+        ttl = f"-{int(self.config.get('checkpoint_ttl', 86400))} seconds"
+        row = await db.fetch_one("""
+            SELECT chat_id, phone, member_offset, counters FROM member_extraction_checkpoints
+            WHERE chat_id = ? AND updated_at >= datetime('now', ?)
+            ORDER BY (phone = ?) DESC, updated_at DESC
+            LIMIT 1
+        """, (chat_key, ttl, phone))
+        if not row or not row.get('member_offset'):
+            return None
+        try:
+            counters = json.loads(row.get('counters') or '{}')
+        except (TypeError, ValueError):
+            counters = {}
+        return {
+            'offset': int(row['member_offset']),
+            'phone': row['phone'],
+            'counters': {k: int(counters.get(k, 0) or 0) for k in self._CHECKPOINT_COUNTERS},
+        }
+    
+    async def _flush_member_stream(self, stream: Optional[Dict[str, Any]]):
+        """保存緩衝區中的成員，並把當前 offset 記錄為斷點"""
+        if not stream or not stream['save_to_db']:
+            return
+        result = stream['result']
+        buffer = stream['buffer']
+        if buffer:
+            new, updated = await self._save_members_batch(buffer)
+            result['new_members'] += new
+            result['updated_members'] += updated
+            buffer.clear()
+        
+        counters = {k: result.get(k, 0) for k in self._CHECKPOINT_COUNTERS}
+        await db.execute("""
+            INSERT INTO member_extraction_checkpoints (chat_id, phone, member_offset, counters, updated_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(chat_id, phone) DO UPDATE SET
+                member_offset = excluded.member_offset,
+                counters = excluded.counters,
+                updated_at = excluded.updated_at
+        """, (stream['chat_key'], stream['phone'], stream['consumed'], json.dumps(counters)))
+    
+    async def _clear_checkpoint(self, chat_key: str):
+        """提取完成後清除該群組的所有斷點"""
+        await db.execute(
+            "DELETE FROM member_extraction_checkpoints WHERE chat_id = ?", (chat_key,)
+        )
+    
     async def _save_members_batch(self, members: List[ExtractedMember]) -> Tuple[int, int]:
-        """批量保存成員"""
+        """
+        批量保存成員 - 🆕 P18-6：集合式 UPSERT
+        
+        每個分塊只需一次 IN 查詢（區分新增/更新）+ 一次 executemany
+        （INSERT ... ON CONFLICT(user_id) DO UPDATE），並在同一事務中提交。
+        表缺少 user_id 唯一約束時自動回退到逐條保存。
+        
+        Returns:
+            (新增數, 更新數)
+        """
+        if not members:
+            return 0, 0
+        
+        started = time.time()
+        new_count = 0
+        updated_count = 0
+        chunk_size = max(1, int(self.config.get('upsert_chunk_size', 500)))
+        
+        for i in range(0, len(members), chunk_size):
+            chunk = members[i:i + chunk_size]
+            if self._bulk_upsert_supported is not False:
+                try:
+                    n, u = await self._upsert_members_chunk(chunk)
+                    self._bulk_upsert_supported = True
+                    new_count += n
+                    updated_count += u
+                    continue
+                except sqlite3.OperationalError as e:
+                    if 'ON CONFLICT' in str(e):
+                        # 舊表（如 tenant_schema）沒有 UNIQUE(user_id)，之後直接走逐條路徑
+                        self._bulk_upsert_supported = False
+                    self.log(f"⚠️ 批量保存失敗，回退逐條保存: {e}", "warning")
+                except Exception as e:
+                    self.log(f"⚠️ 批量保存失敗，回退逐條保存: {e}", "warning")
+            
+            self._save_stats['fallback_batches'] += 1
+            n, u = await self._save_members_rowwise(chunk)
+            new_count += n
+            updated_count += u
+        
+        elapsed = time.time() - started
+        rate = len(members) / elapsed if elapsed > 0 else float(len(members))
+        self._save_stats['rows'] += len(members)
+        self._save_stats['batches'] += 1
+        self._save_stats['seconds'] += elapsed
+        self._save_stats['last_rows_per_sec'] = round(rate, 1)
+        self.log(
+            f"💾 保存 {len(members)} 成員 (新增 {new_count}, 更新 {updated_count}) "
+            f"耗時 {elapsed * 1000:.0f}ms, {rate:.0f} 行/秒",
+            "debug"
+        )
+        
+        return new_count, updated_count
+    
+    @staticmethod
+    def _member_upsert_params(member: ExtractedMember, now: str) -> tuple:
+        """將成員轉為 _MEMBER_COLUMNS 順序的參數元組"""
+        return (
+            member.user_id, member.username, member.first_name, member.last_name,
+            member.phone, member.online_status,
+            member.last_online.isoformat() if member.last_online else None,
+            1 if member.is_bot else 0,
+            1 if member.is_premium else 0,
+            1 if member.is_verified else 0,
+            member.source_chat_id, member.source_chat_title,
+            member.extracted_at.isoformat() if member.extracted_at else None,
+            member.extracted_by_phone, member.value_level, member.activity_score,
+            json.dumps([member.source_chat_id]),
+            now, now
+        )
+    
+    async def _upsert_members_chunk(self, members: List[ExtractedMember]) -> Tuple[int, int]:
+        """單個分塊：一次查詢已存在 ID + 一次 executemany，單事務提交"""
+        now = datetime.now().isoformat()
+        params = [self._member_upsert_params(m, now) for m in members]
+        user_ids = list({m.user_id for m in members})
+        placeholders = ','.join('?' for _ in user_ids)
+        exists_sql = f"SELECT user_id FROM extracted_members WHERE user_id IN ({placeholders})"
+        
+        if not HAS_AIOSQLITE:
+            conn = sqlite3.connect(str(db.db_path))
+            try:
+                existing = {row[0] for row in conn.execute(exists_sql, user_ids).fetchall()}
+                conn.executemany(_MEMBER_UPSERT_SQL, params)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+        else:
+            await db.connect()
+            conn = db._connection
+            try:
+                cursor = await conn.execute(exists_sql, user_ids)
+                existing = {row[0] for row in await cursor.fetchall()}
+                await conn.executemany(_MEMBER_UPSERT_SQL, params)
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+        
+        new_count = len(set(user_ids) - existing)
+        return new_count, len(members) - new_count
+    
+    async def _save_members_rowwise(self, members: List[ExtractedMember]) -> Tuple[int, int]:
+        """逐條保存成員（舊表缺少 user_id 唯一約束時的回退路徑）"""
         new_count = 0
         updated_count = 0
         
@@ -1206,6 +1551,14 @@ class MemberExtractionService:
                 'total': last_24h_total,
                 'success': last_24h_success,
                 'members': last_24h_members
+            },
+            'db_write': {
+                'rows': self._save_stats['rows'],
+                'batches': self._save_stats['batches'],
+                'fallback_batches': self._save_stats['fallback_batches'],
+                'rows_per_sec': round(self._save_stats['rows'] / self._save_stats['seconds'], 1)
+                    if self._save_stats['seconds'] > 0 else 0,
+                'last_rows_per_sec': self._save_stats['last_rows_per_sec'],
             }
         }
     
@@ -1287,8 +1640,7 @@ class MemberExtractionService:
             
             # 檢查是否有目標群組的緩存（表示之前成功過）
             if target_chat_id:
-                cache_key = self._get_cache_key(phone, str(target_chat_id))
-                if cache_key in self._peer_cache:
+                if get_peer_cache().has_access(phone, str(target_chat_id)):
                     score += 50  # 已知可用，大幅加分
             
             account_scores[phone] = max(0, score)
@@ -1404,8 +1756,38 @@ class MemberExtractionService:
             limit: 數量限制
             offset: 偏移量
         """
+        where_clause, params = self._member_filter_clause(
+            online_only, min_value_level, source_chat_id, not_contacted
+        )
+        
+        query = f"""
+            SELECT * FROM extracted_members
+            WHERE {where_clause}
+            ORDER BY 
+                CASE online_status 
+                    WHEN 'online' THEN 1 
+                    WHEN 'recently' THEN 2 
+                    WHEN 'last_week' THEN 3
+                    ELSE 4 
+                END,
+                activity_score DESC
+            LIMIT ? OFFSET ?
+        """
+        params.extend([limit, offset])
+        
+        results = await db.fetch_all(query, tuple(params))
+        return [dict(r) for r in results]
+    
+    @staticmethod
+    def _member_filter_clause(
+        online_only: bool = False,
+        min_value_level: str = None,
+        source_chat_id: str = None,
+        not_contacted: bool = False
+    ) -> Tuple[str, List[Any]]:
+        """構建成員查詢的 WHERE 子句與參數"""
         conditions = []
-        params = []
+        params: List[Any] = []
         
         if online_only:
             conditions.append("online_status IN ('online', 'recently')")
@@ -1426,24 +1808,7 @@ class MemberExtractionService:
             conditions.append("contacted = 0")
         
         where_clause = " AND ".join(conditions) if conditions else "1=1"
-        
-        query = f"""
-            SELECT * FROM extracted_members
-            WHERE {where_clause}
-            ORDER BY 
-                CASE online_status 
-                    WHEN 'online' THEN 1 
-                    WHEN 'recently' THEN 2 
-                    WHEN 'last_week' THEN 3
-                    ELSE 4 
-                END,
-                activity_score DESC
-            LIMIT ? OFFSET ?
-        """
-        params.extend([limit, offset])
-        
-        results = await db.fetch_all(query, tuple(params))
-        return [dict(r) for r in results]
+        return where_clause, params
     
     async def get_online_members(self, limit: int = 100) -> List[Dict]:
         """獲取當前在線成員"""
@@ -1683,125 +2048,205 @@ class MemberExtractionService:
     
     # ==================== P4 優化：數據導出 ====================
     
+    EXPORT_COLUMNS = [
+        'user_id', 'username', 'first_name', 'last_name', 'phone',
+        'online_status', 'value_level', 'source_chat_title',
+        'contacted', 'response_status', 'tags', 'extracted_at'
+    ]
+    
+    def iter_members_for_export(self, filters: Dict = None):
+        """
+        🆕 P18-8: 按篩選條件流式讀取全部成員（無行數上限，獨立只讀游標）
+        """
+        filters = filters or {}
+        where_clause, params = self._member_filter_clause(
+            online_only=filters.get('onlineOnly', False),
+            min_value_level=filters.get('minValueLevel'),
+            source_chat_id=filters.get('sourceChatId'),
+            not_contacted=filters.get('notContacted', False)
+        )
+        return iter_query_rows(
+            db.db_path,
+            f"SELECT * FROM extracted_members WHERE {where_clause} ORDER BY id",
+            params
+        )
+    
+    @staticmethod
+    def _export_row_for_csv(member: Dict) -> Dict:
+        """CSV 導出時把 tags JSON 轉為逗號分隔字符串"""
+        tags = member.get('tags')
+        if isinstance(tags, str) and tags.startswith('['):
+            try:
+                tags = json.loads(tags)
+            except ValueError:
+                pass
+        if isinstance(tags, list):
+            member['tags'] = ', '.join(str(t) for t in tags)
+        return member
+    
+    async def export_members_to_file(
+        self,
+        path: str,
+        fmt: str = 'csv',
+        filters: Dict = None,
+        columns: List[str] = None,
+        compress: bool = False
+    ) -> int:
+        """🆕 P18-8: 流式導出成員到文件（支持 csv/json/ndjson + gzip），返回行數"""
+        fmt = normalize_format(fmt)
+        count = await export_to_file(
+            self.iter_members_for_export(filters), path, fmt=fmt,
+            columns=(columns or self.EXPORT_COLUMNS) if fmt == 'csv' else columns,
+            compress=compress,
+            transform=self._export_row_for_csv if fmt == 'csv' else None,
+            json_key='members'
+        )
+        self.log(f"📤 導出 {count} 條成員數據 → {path}", "success")
+        return count
+    
     async def export_members_csv(
         self,
+        sink: Sink,
         filters: Dict = None,
         columns: List[str] = None
-    ) -> str:
-        """導出成員數據為 CSV 格式"""
-        import csv
-        from io import StringIO
-        
-        # 默認列
-        default_columns = [
-            'user_id', 'username', 'first_name', 'last_name', 'phone',
-            'online_status', 'value_level', 'source_chat_title',
-            'contacted', 'response_status', 'tags', 'extracted_at'
-        ]
-        columns = columns or default_columns
-        
-        # 獲取成員
-        members = await self.get_members(
-            online_only=filters.get('onlineOnly', False) if filters else False,
-            min_value_level=filters.get('minValueLevel') if filters else None,
-            source_chat_id=filters.get('sourceChatId') if filters else None,
-            not_contacted=filters.get('notContacted', False) if filters else False,
-            limit=10000  # 最大導出 10000 條
+    ) -> int:
+        """導出成員數據為 CSV 格式，按塊寫入 sink（每塊都是完整行），返回行數"""
+        count = await stream_export(
+            self.iter_members_for_export(filters), sink, fmt='csv',
+            columns=columns or self.EXPORT_COLUMNS,
+            transform=self._export_row_for_csv
         )
-        
-        # 生成 CSV
-        output = StringIO()
-        writer = csv.DictWriter(output, fieldnames=columns, extrasaction='ignore')
-        writer.writeheader()
-        
-        for member in members:
-            # 處理 tags 字段（轉換為字符串）
-            if 'tags' in member and isinstance(member['tags'], list):
-                member['tags'] = ', '.join(member['tags'])
-            writer.writerow(member)
-        
-        csv_content = output.getvalue()
-        self.log(f"📤 導出 {len(members)} 條成員數據", "success")
-        
-        return csv_content
-    
-    async def export_members_json(self, filters: Dict = None) -> str:
-        """導出成員數據為 JSON 格式"""
-        members = await self.get_members(
-            online_only=filters.get('onlineOnly', False) if filters else False,
-            min_value_level=filters.get('minValueLevel') if filters else None,
-            source_chat_id=filters.get('sourceChatId') if filters else None,
-            not_contacted=filters.get('notContacted', False) if filters else False,
-            limit=10000
+        self.log(f"📤 導出 {count} 條成員數據 (CSV)", "success")
+        return count
+    
+    async def export_members_json(self, sink: Sink, filters: Dict = None) -> int:
+        """導出成員數據為 JSON 格式，按塊寫入 sink，返回行數"""
+        count = await stream_export(
+            self.iter_members_for_export(filters), sink, fmt='json', json_key='members'
         )
-        
-        export_data = {
-            'exported_at': datetime.now().isoformat(),
-            'total_count': len(members),
-            'members': members
-        }
-        
-        self.log(f"📤 導出 {len(members)} 條成員數據 (JSON)", "success")
-        return json.dumps(export_data, ensure_ascii=False, indent=2, default=str)
+        self.log(f"📤 導出 {count} 條成員數據 (JSON)", "success")
+        return count
     
     # ==================== P4 優化：智能去重 ====================
     
-    async def deduplicate_members(self) -> Dict[str, int]:
-        """跨群組成員去重合併"""
-        self.log("🔄 開始成員去重...", "info")
-        
-        # 查找重複的 user_id
-        query = """
-            SELECT user_id, COUNT(*) as count, 
-                   GROUP_CONCAT(id) as ids,
-                   GROUP_CONCAT(source_chat_id) as sources
-            FROM extracted_members
-            GROUP BY user_id
-            HAVING count > 1
+    async def deduplicate_members(
+        self,
+        dry_run: bool = True,
+        chunk_size: int = 500,
+        progress_callback: Optional[Callable[[Dict[str, Any]], Any]] = None
+    ) -> Dict[str, Any]:
         """
-        duplicates = await db.fetch_all(query)
+        跨群組成員去重合併 - 🆕 P18-9：集合式去重（維護命令，默認只預覽）
         
-        merged_count = 0
-        deleted_count = 0
+        1. 一條 SQL 生成計劃（臨時表）：每個重複 user_id 保留最近更新的一行，
+           並算出合併後的值（見 _member_dedup_sql：群組 / 標籤取並集，聯繫狀態取最大，備註拼接）
+        2. 按 chunk_size 個用戶分塊應用（UPDATE + DELETE 同一事務），塊間讓出事件循環
+        3. 完成後創建 user_id 唯一索引，之後插入即可防止重複
         
-        for dup in duplicates:
-            user_id = dup['user_id']
-            ids = dup['ids'].split(',')
-            sources = dup['sources'].split(',') if dup['sources'] else []
-            
-            if len(ids) <= 1:
-                continue
-            
-            # 保留第一條記錄，合併來源群組
-            keep_id = ids[0]
-            delete_ids = ids[1:]
-            
-            # 合併群組列表
-            unique_sources = list(set(sources))
-            groups_json = json.dumps(unique_sources)
-            
-            # 更新保留的記錄
-            await db.execute(
-                "UPDATE extracted_members SET groups = ? WHERE id = ?",
-                (groups_json, keep_id)
-            )
-            
-            # 刪除重複記錄
-            for del_id in delete_ids:
-                await db.execute(
-                    "DELETE FROM extracted_members WHERE id = ?",
-                    (del_id,)
-                )
-                deleted_count += 1
-            
-            merged_count += 1
+        Args:
+            dry_run: 只生成計劃並返回統計，不修改數據（默認）
+            chunk_size: 每個事務處理的用戶數
+            progress_callback: 每塊完成後回調 {'processed', 'total', 'deleted'}
+        """
+        self.log(f"🔄 開始成員去重{'（試運行）' if dry_run else ''}...", "info")
+        started = time.time()
+        
+        # aiosqlite 不可用時退回同步連接（與批量保存一致），兩者經 _maybe_await 共用同一流程
+        if HAS_AIOSQLITE:
+            await db.connect()
+            conn = db._connection
+        else:
+            conn = sqlite3.connect(str(db.db_path))
+            conn.row_factory = sqlite3.Row
         
-        self.log(f"✅ 去重完成: 合併 {merged_count} 個用戶，刪除 {deleted_count} 條重複記錄", "success")
+        try:
+            result = await self._run_member_dedup(conn, dry_run, chunk_size, progress_callback)
+        finally:
+            if not HAS_AIOSQLITE:
+                conn.close()
         
-        return {
-            'merged': merged_count,
-            'deleted': deleted_count
+        result['duration_ms'] = int((time.time() - started) * 1000)
+        if dry_run:
+            self.log(f"🔍 去重試運行: {result['duplicate_users']} 個用戶有 {result['duplicate_rows']} 條重複記錄", "info")
+        else:
+            self.log(f"✅ 去重完成: 合併 {result['merged']} 個用戶，刪除 {result['deleted']} 條重複記錄", "success")
+        return result
+    
+    async def _run_member_dedup(
+        self,
+        conn,
+        dry_run: bool,
+        chunk_size: int,
+        progress_callback: Optional[Callable[[Dict[str, Any]], Any]]
+    ) -> Dict[str, Any]:
+        """生成去重計劃並分塊應用（conn 為 aiosqlite 或 sqlite3 連接）"""
+        cursor = await _maybe_await(conn.execute("PRAGMA table_info(extracted_members)"))
+        columns = [row[1] for row in await _maybe_await(cursor.fetchall())]
+        plan_sql, merge_sql, delete_sql = _member_dedup_sql(columns)
+        await _maybe_await(conn.execute("DROP TABLE IF EXISTS temp.member_dedup_plan"))
+        await _maybe_await(conn.execute(plan_sql))
+        await _maybe_await(conn.commit())
+        
+        cursor = await _maybe_await(conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(row_count - 1), 0), COALESCE(MAX(rowid), 0) FROM temp.member_dedup_plan"
+        ))
+        total_users, total_extra, max_rowid = await _maybe_await(cursor.fetchone())
+        
+        result: Dict[str, Any] = {
+            'merged': 0,
+            'deleted': 0,
+            'duplicate_users': total_users,
+            'duplicate_rows': total_extra,
+            'dry_run': dry_run,
+            'unique_index': False,
         }
+        
+        if dry_run:
+            sample_columns = 'user_id, keep_id, row_count' + (', groups' if 'groups' in columns else '')
+            cursor = await _maybe_await(conn.execute(
+                f"SELECT {sample_columns} FROM temp.member_dedup_plan LIMIT 20"
+            ))
+            result['sample'] = [dict(row) for row in await _maybe_await(cursor.fetchall())]
+        else:
+            chunk_size = max(1, chunk_size)
+            for low in range(1, max_rowid + 1, chunk_size):
+                high = low + chunk_size - 1
+                try:
+                    await _maybe_await(conn.execute(merge_sql, (low, high)))
+                    cursor = await _maybe_await(conn.execute(delete_sql, (low, high)))
+                    await _maybe_await(conn.commit())
+                except Exception:
+                    await _maybe_await(conn.rollback())
+                    raise
+                
+                result['deleted'] += max(cursor.rowcount, 0)
+                result['merged'] = min(high, total_users)
+                if progress_callback:
+                    progress_callback({
+                        'processed': result['merged'],
+                        'total': total_users,
+                        'deleted': result['deleted'],
+                    })
+                await asyncio.sleep(0)  # 讓出事件循環，寫入方不被長時間阻塞
+            
+            result['unique_index'] = await self._ensure_member_unique_index(conn)
+        
+        await _maybe_await(conn.execute("DROP TABLE IF EXISTS temp.member_dedup_plan"))
+        await _maybe_await(conn.commit())
+        return result
+    
+    async def _ensure_member_unique_index(self, conn) -> bool:
+        """創建 user_id 唯一索引（去重後調用），成功後批量 UPSERT 可用"""
+        try:
+            await _maybe_await(conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_members_user_id_unique ON extracted_members(user_id)"
+            ))
+            await _maybe_await(conn.commit())
+        except Exception as e:
+            self.log(f"⚠️ 創建 user_id 唯一索引失敗: {e}", "warning")
+            return False
+        self._bulk_upsert_supported = None
+        return True
     
     # ==================== P4 優化：批量標籤管理 ====================
     
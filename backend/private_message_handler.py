@@ -10,7 +10,9 @@ from pyrogram.types import Message
 from pyrogram.handlers import MessageHandler
 from pyrogram import filters
 from database import db
-from ai_auto_chat import ai_auto_chat
+from core.message_dedup import MessageDedupCache, phone_key
+from ai_auto_chat import ai_auto_chat, MESSAGE_COALESCED
+from ai_context_manager import ai_context
 from auto_funnel_manager import auto_funnel
 from vector_memory import vector_memory
 from text_utils import sanitize_text, safe_get_name, safe_get_username
@@ -23,6 +25,8 @@ class PrivateMessageHandler:
         self.event_callback = event_callback
         self.private_handlers: Dict[str, MessageHandler] = {}
         self._initialized = False
+        # 去重：重連後 Telegram 可能重複推送同一條 update
+        self._processed = MessageDedupCache(max_size=10000)
     
     async def initialize(self):
         """初始化處理器"""
@@ -90,6 +94,14 @@ class PrivateMessageHandler:
                     print(f"[PrivateMessageHandler] 跳過：自己發送的消息", file=sys.stderr)
                     return
                 
+                # 跳過重複推送的消息
+                if self._processed.check_and_add(phone_key(phone), message.chat.id, message.id):
+                    print(f"[PrivateMessageHandler] 跳過：重複消息 {message.id}", file=sys.stderr)
+                    return
+                
+                # 通知輪詢服務：推進水位線並去重，避免事件/對賬重複處理
+                self._notify_poller_seen(phone, message)
+                
                 # 獲取用戶信息
                 user = message.from_user
                 if not user:
@@ -136,6 +148,7 @@ class PrivateMessageHandler:
                     account_phone=phone,
                     message_id=str(message.id)
                 )
+                ai_context.invalidate(user_id, 'recent')
                 
                 # 記錄互動
                 await self._record_interaction(user_id, message_text, phone, 'inbound')
@@ -161,6 +174,7 @@ class PrivateMessageHandler:
                     'first_name': first_name,
                     'last_name': last_name,
                 })
+                ai_context.invalidate(user_id, 'profile')
                 
                 # 分析消息並更新漏斗階段
                 analysis = await auto_funnel.analyze_message(
@@ -194,7 +208,11 @@ class PrivateMessageHandler:
                         first_name=first_name
                     )
                     
-                    print(f"[PrivateMessageHandler] AI 回復生成結果: {'成功' if ai_response else '失敗'}", file=sys.stderr)
+                    if ai_response is MESSAGE_COALESCED:
+                        result = '已合併到後續消息'
+                    else:
+                        result = '成功' if ai_response else '失敗'
+                    print(f"[PrivateMessageHandler] AI 回復生成結果: {result}", file=sys.stderr)
                     if ai_response:
                         self.log(f"[AI] ✓ 已生成回復: {ai_response[:50]}...")
                 
@@ -222,6 +240,7 @@ class PrivateMessageHandler:
                                 content=ai_response,
                                 account_phone=phone
                             )
+                            ai_context.invalidate(user_id, 'recent')
                             
                             # 更新漏斗階段
                             if analysis.get('should_advance'):
@@ -229,6 +248,7 @@ class PrivateMessageHandler:
                                 await db.update_user_profile(user_id, {
                                     'funnel_stage': new_stage
                                 })
+                                ai_context.invalidate(user_id, 'profile')
                                 self.log(f"[漏斗] 用戶 @{username} 階段更新為: {new_stage}")
                             
                             # 發送事件通知前端
@@ -306,6 +326,14 @@ class PrivateMessageHandler:
             except Exception as e:
                 self.log(f"移除處理器錯誤: {e}", "warning")
     
+    def _notify_poller_seen(self, phone: str, message: Message):
+        """將已處理的私信同步給 PrivateMessagePoller 的水位線"""
+        try:
+            from private_message_poller import private_message_poller
+            private_message_poller.note_message_seen(phone, message.chat.id, message.id)
+        except Exception as e:
+            print(f"[PrivateMessageHandler] 同步水位線失敗: {e}", file=sys.stderr)
+    
     async def _record_interaction(self, user_id: str, content: str, 
                                   account_phone: str, direction: str = 'inbound'):
         """記錄用戶互動"""
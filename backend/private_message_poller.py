@@ -2,29 +2,61 @@
 Private Message Poller - 私信輪詢服務
 雙重保險機制：事件驅動 + 輪詢備份
 確保 100% 接收用戶私信並觸發 AI 自動回覆
+
+🔧 事件驅動模式（默認）:
+  - 通過客戶端 update handler 即時接收私信，不再每 5 秒掃描對話列表
+  - 每個私聊維護 last-seen message_id 水位線
+  - 輪詢降級為低頻對賬（reconciliation），只拉取水位線之後的消息
+
+🆕 P18-24: 同一用戶短時間內連發的私信合併為一次 AI 回覆，回覆在後台任務中生成
 """
 import sys
+import random
 import asyncio
-from typing import Dict, Set, Optional, Callable, Any
+from typing import Dict, Set, Optional, Callable, Any, Tuple
 from datetime import datetime, timedelta
-from pyrogram import Client
+from pyrogram import Client, filters
 from pyrogram.enums import ChatType
+from pyrogram.handlers import MessageHandler
 from database import db
+from core.message_dedup import MessageDedupCache, default_dedup_path, phone_key
+from core.llm_scheduler import MessageCoalescer, get_message_coalescer, llm_priority
 from ai_auto_chat import ai_auto_chat
+from ai_context_manager import ai_context
 from auto_funnel_manager import auto_funnel
 
 
 class PrivateMessagePoller:
     """私信輪詢服務 - 確保不遺漏任何用戶私信"""
     
-    def __init__(self, event_callback: Optional[Callable] = None):
+    # 事件處理器分組：PrivateMessageHandler 使用 group=0，這裡排在其後，
+    # 這樣同一條消息若已被主處理器處理（並通知水位線），此處直接跳過
+    EVENT_HANDLER_GROUP = 1
+    
+    def __init__(
+        self,
+        event_callback: Optional[Callable] = None,
+        event_driven: bool = True,
+        dedup_path: Optional[str] = None,
+        coalescer: Optional[MessageCoalescer] = None
+    ):
         self.event_callback = event_callback
         self._polling_tasks: Dict[str, asyncio.Task] = {}
-        self._processed_message_ids: Set[str] = set()  # 去重：已處理的消息 ID
         self._max_processed_cache = 10000  # 最多緩存 10000 個消息 ID
-        self._polling_interval = 5  # 輪詢間隔（秒）
+        # 去重：已處理的消息 (phone, chat_id, message_id)，可持久化以跨重啟去重
+        self._processed = MessageDedupCache(self._max_processed_cache, persist_path=dedup_path)
+        self._polling_interval = 5  # 輪詢間隔（秒，純輪詢模式）
+        self._reconcile_interval = 300  # 對賬間隔（秒，事件驅動模式）
+        self._event_driven = event_driven
         self._running = False
         self._clients: Dict[str, Client] = {}
+        self._event_handlers: Dict[str, MessageHandler] = {}
+        # 水位線：(phone, chat_id) -> 已見過的最大 message_id
+        self._watermarks: Dict[Tuple[str, int], int] = {}
+        self._stats = {'event_messages': 0, 'reconciled_messages': 0, 'sweeps': 0, 'coalesced_messages': 0}
+        # 🆕 P18-24: 連發消息合併窗口 + 後台回覆任務
+        self._coalescer = coalescer or get_message_coalescer()
+        self._reply_tasks: Set[asyncio.Task] = set()
     
     def log(self, message: str, level: str = "info"):
         """記錄日誌"""
@@ -36,26 +68,88 @@ class PrivateMessagePoller:
                 "type": level
             })
     
-    def _make_message_key(self, phone: str, chat_id: int, message_id: int) -> str:
-        """生成消息唯一鍵（用於去重）"""
-        return f"{phone}:{chat_id}:{message_id}"
-    
     def _is_processed(self, phone: str, chat_id: int, message_id: int) -> bool:
         """檢查消息是否已處理"""
-        key = self._make_message_key(phone, chat_id, message_id)
-        return key in self._processed_message_ids
+        return self._processed.contains(phone_key(phone), chat_id, message_id)
     
     def _mark_processed(self, phone: str, chat_id: int, message_id: int):
-        """標記消息為已處理"""
-        key = self._make_message_key(phone, chat_id, message_id)
-        self._processed_message_ids.add(key)
+        """標記消息為已處理（超出容量時淘汰最舊的記錄）"""
+        self._processed.add(phone_key(phone), chat_id, message_id)
+    
+    # ==================== 水位線 ====================
+    
+    def get_watermark(self, phone: str, chat_id: int) -> int:
+        """獲取私聊的水位線（已見過的最大 message_id，未知為 0）"""
+        return self._watermarks.get((phone, chat_id), 0)
+    
+    def _advance_watermark(self, phone: str, chat_id: int, message_id: int):
+        """推進水位線（只增不減）"""
+        key = (phone, chat_id)
+        if message_id > self._watermarks.get(key, 0):
+            self._watermarks[key] = message_id
+    
+    def note_message_seen(self, phone: str, chat_id: int, message_id: int):
+        """
+        記錄某條私信已由其他處理器（如 PrivateMessageHandler）處理
+        
+        推進水位線並標記去重，避免對賬時重複處理和重複 AI 回覆
+        """
+        self._advance_watermark(phone, chat_id, message_id)
+        self._mark_processed(phone, chat_id, message_id)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """獲取輪詢統計"""
+        return {
+            **self._stats,
+            'mode': 'event' if self._event_driven else 'poll',
+            'accounts': len(self._clients),
+            'event_handlers': len(self._event_handlers),
+            'tracked_chats': len(self._watermarks),
+            'pending_replies': len(self._reply_tasks),
+            'dedup': self._processed.get_stats(),
+            'interval': self._reconcile_interval if self._event_driven else self._polling_interval,
+        }
+    
+    # ==================== 事件驅動接收 ====================
+    
+    def _register_event_handler(self, phone: str, client: Client):
+        """為帳號註冊私信 update handler（事件驅動接收）"""
+        if not self._event_driven or phone in self._event_handlers:
+            return
         
-        # 防止內存溢出：清理過舊的記錄
-        if len(self._processed_message_ids) > self._max_processed_cache:
-            # 移除一半的舊記錄
-            to_remove = list(self._processed_message_ids)[:self._max_processed_cache // 2]
-            for item in to_remove:
-                self._processed_message_ids.discard(item)
+        async def on_private_message(client_instance: Client, message):
+            if not self._running:
+                return
+            try:
+                self._stats['event_messages'] += 1
+                await self._process_message(phone, client_instance, message)
+            except Exception as e:
+                self.log(f"事件處理錯誤 ({phone}): {e}", "error")
+        
+        handler = MessageHandler(on_private_message, filters.private & ~filters.me)
+        try:
+            client.add_handler(handler, group=self.EVENT_HANDLER_GROUP)
+            self._event_handlers[phone] = handler
+        except Exception as e:
+            # 註冊失敗時退回純輪詢，不影響接收
+            self.log(f"註冊事件處理器失敗 ({phone})，退回輪詢: {e}", "warning")
+    
+    def _unregister_event_handler(self, phone: str):
+        """移除帳號的私信 update handler"""
+        handler = self._event_handlers.pop(phone, None)
+        client = self._clients.get(phone)
+        if handler and client:
+            try:
+                client.remove_handler(handler, group=self.EVENT_HANDLER_GROUP)
+            except Exception:
+                pass
+    
+    def _start_account(self, phone: str, client: Client):
+        """啟動單個帳號的接收（事件處理器 + 輪詢/對賬任務）"""
+        self._register_event_handler(phone, client)
+        if phone not in self._polling_tasks or self._polling_tasks[phone].done():
+            task = asyncio.create_task(self._poll_account(phone, client))
+            self._polling_tasks[phone] = task
     
     async def start_polling(self, clients: Dict[str, Client]):
         """
@@ -71,19 +165,24 @@ class PrivateMessagePoller:
         self._running = True
         self._clients = clients
         
-        self.log(f"🚀 啟動私信輪詢服務，監控 {len(clients)} 個帳號，間隔 {self._polling_interval} 秒")
+        if self._event_driven:
+            self.log(f"🚀 啟動私信接收服務（事件驅動），監控 {len(clients)} 個帳號，對賬間隔 {self._reconcile_interval} 秒")
+        else:
+            self.log(f"🚀 啟動私信輪詢服務，監控 {len(clients)} 個帳號，間隔 {self._polling_interval} 秒")
         
-        # 為每個帳號啟動輪詢任務
+        # 為每個帳號註冊事件處理器並啟動輪詢/對賬任務
         for phone, client in clients.items():
-            if phone not in self._polling_tasks or self._polling_tasks[phone].done():
-                task = asyncio.create_task(self._poll_account(phone, client))
-                self._polling_tasks[phone] = task
-                self.log(f"✓ 帳號 {phone} 輪詢任務已啟動")
+            self._start_account(phone, client)
+            self.log(f"✓ 帳號 {phone} 接收任務已啟動")
     
     async def stop_polling(self):
         """停止輪詢服務"""
         self._running = False
         
+        # 移除事件處理器
+        for phone in list(self._event_handlers.keys()):
+            self._unregister_event_handler(phone)
+        
         # 取消所有輪詢任務
         for phone, task in self._polling_tasks.items():
             if not task.done():
@@ -95,6 +194,13 @@ class PrivateMessagePoller:
                 self.log(f"✓ 帳號 {phone} 輪詢任務已停止")
         
         self._polling_tasks.clear()
+        
+        # 取消尚未完成的回覆任務
+        for task in list(self._reply_tasks):
+            task.cancel()
+        if self._reply_tasks:
+            await asyncio.gather(*self._reply_tasks, return_exceptions=True)
+        self._processed.save()
         self.log("🛑 私信輪詢服務已停止")
     
     async def add_client(self, phone: str, client: Client):
@@ -105,12 +211,13 @@ class PrivateMessagePoller:
         self._clients[phone] = client
         
         if phone not in self._polling_tasks or self._polling_tasks[phone].done():
-            task = asyncio.create_task(self._poll_account(phone, client))
-            self._polling_tasks[phone] = task
+            self._start_account(phone, client)
             self.log(f"✓ 動態添加帳號 {phone} 到輪詢")
     
     async def remove_client(self, phone: str):
         """從輪詢移除客戶端"""
+        self._unregister_event_handler(phone)
+        
         if phone in self._polling_tasks:
             task = self._polling_tasks[phone]
             if not task.done():
@@ -134,6 +241,13 @@ class PrivateMessagePoller:
         """
         self.log(f"開始輪詢帳號 {phone} 的私信...")
         
+        # 事件驅動模式下，輪詢只是對賬：錯開各帳號的首次掃描，避免同時打 API
+        if self._event_driven and phone in self._event_handlers:
+            try:
+                await asyncio.sleep(random.uniform(0, self._reconcile_interval))
+            except asyncio.CancelledError:
+                return
+        
         while self._running:
             try:
                 await self._check_private_messages(phone, client)
@@ -142,8 +256,15 @@ class PrivateMessagePoller:
             except Exception as e:
                 self.log(f"輪詢錯誤 ({phone}): {e}", "error")
             
-            # 等待下次輪詢
-            await asyncio.sleep(self._polling_interval)
+            # 等待下次輪詢（有事件處理器時使用低頻對賬間隔）
+            if self._event_driven and phone in self._event_handlers:
+                interval = self._reconcile_interval
+            else:
+                interval = self._polling_interval
+            try:
+                await asyncio.sleep(interval)
+            except asyncio.CancelledError:
+                break
     
     async def _check_private_messages(self, phone: str, client: Client):
         """
@@ -167,6 +288,14 @@ class PrivateMessagePoller:
                     if dialog.unread_messages_count > 0:
                         dialogs.append(dialog)
             
+            self._stats['sweeps'] += 1
+            
+            # 水位線過濾：最新消息已見過的對話（事件已處理）無需再拉歷史
+            dialogs = [
+                d for d in dialogs
+                if not (d.top_message and d.top_message.id <= self.get_watermark(phone, d.chat.id))
+            ]
+            
             if not dialogs:
                 return  # 沒有未讀私信
             
@@ -176,14 +305,17 @@ class PrivateMessagePoller:
             for dialog in dialogs:
                 chat = dialog.chat
                 unread_count = dialog.unread_messages_count
+                watermark = self.get_watermark(phone, chat.id)
                 
                 try:
-                    # 獲取未讀消息
+                    # 獲取未讀消息（從新到舊，遇到水位線即停止）
                     messages = []
                     async for message in client.get_chat_history(
                         chat.id, 
                         limit=min(unread_count, 10)  # 最多處理 10 條
                     ):
+                        if message.id <= watermark:
+                            break
                         # 只處理對方發送的消息（非自己發送的）
                         if not message.outgoing:
                             messages.append(message)
@@ -192,6 +324,8 @@ class PrivateMessagePoller:
                     messages.reverse()
                     
                     for message in messages:
+                        if not self._is_processed(phone, chat.id, message.id):
+                            self._stats['reconciled_messages'] += 1
                         await self._process_message(phone, client, message)
                     
                     # 標記消息已讀
@@ -224,12 +358,10 @@ class PrivateMessagePoller:
             message: 消息對象
         """
         try:
-            # 去重檢查
-            if self._is_processed(phone, message.chat.id, message.id):
+            # 去重檢查並標記為已處理
+            if self._processed.check_and_add(phone_key(phone), message.chat.id, message.id):
                 return  # 已處理過，跳過
-            
-            # 標記為已處理
-            self._mark_processed(phone, message.chat.id, message.id)
+            self._advance_watermark(phone, message.chat.id, message.id)
             
             # 獲取消息內容
             text = message.text or message.caption or ""
@@ -283,6 +415,7 @@ class PrivateMessagePoller:
                     content=text,
                     account_phone=phone
                 )
+                ai_context.invalidate(user_id, 'recent')
             except Exception as save_err:
                 self.log(f"保存消息錯誤: {save_err}", "warning")
             
@@ -315,23 +448,46 @@ class PrivateMessagePoller:
                 if analysis.get('should_advance') and user_profile:
                     new_stage = analysis.get('suggested_stage', user_profile.get('funnel_stage', 'new'))
                     await db.update_funnel_stage(user_id, new_stage)
+                    ai_context.invalidate(user_id, 'profile')
                     self.log(f"✓ 用戶 @{display_name} 漏斗階段更新: {new_stage}")
             except Exception as funnel_err:
                 self.log(f"漏斗分析錯誤: {funnel_err}", "warning")
             
-            # 根據模式處理
-            if auto_chat_mode == 'full':
-                # 全自動模式：直接生成並發送回覆
-                await self._send_ai_reply(phone, client, user, text, message.chat.id)
-            else:
-                # 半自動模式：只生成回覆，不發送
-                await self._generate_ai_suggestion(phone, user, text)
+            # 🆕 P18-24: 回覆在後台任務中合併生成，連發消息只回覆一次，也不阻塞接收和對賬
+            self._schedule_reply(phone, client, user, text, message.chat.id, auto_chat_mode)
                 
         except Exception as e:
             self.log(f"處理消息錯誤: {e}", "error")
             import traceback
             traceback.print_exc(file=sys.stderr)
     
+    def _schedule_reply(self, phone: str, client: Client, user, text: str, chat_id: int, mode: str):
+        """在後台任務中生成回覆（任務集合保留引用，停止服務時統一取消）"""
+        task = asyncio.create_task(self._coalesced_reply(phone, client, user, text, chat_id, mode))
+        self._reply_tasks.add(task)
+        task.add_done_callback(self._reply_tasks.discard)
+    
+    async def _coalesced_reply(self, phone: str, client: Client, user, text: str, chat_id: int, mode: str):
+        """
+        🆕 P18-24: 合併同一用戶連發的消息後生成一次回覆
+        
+        窗口內較早的消息直接返回，由最後一條帶上合併文本生成；
+        生成過程中的 LLM 請求按用戶線索評分排隊
+        """
+        user_id = str(user.id)
+        merged = await self._coalescer.coalesce(f"poller:{phone}:{user_id}", text)
+        if merged is None:
+            self._stats['coalesced_messages'] += 1
+            return
+        
+        with llm_priority(await ai_auto_chat.get_lead_score(user_id)):
+            if mode == 'full':
+                # 全自動模式：直接生成並發送回覆
+                await self._send_ai_reply(phone, client, user, merged, chat_id)
+            else:
+                # 半自動模式：只生成回覆，不發送
+                await self._generate_ai_suggestion(phone, user, merged)
+    
     async def _send_ai_reply(self, phone: str, client: Client, user, user_message: str, chat_id: int):
         """
         生成並發送 AI 回覆（全自動模式）
@@ -394,6 +550,7 @@ class PrivateMessagePoller:
                         content=reply_text,
                         account_phone=phone
                     )
+                    ai_context.invalidate(user_id, 'recent')
                 except Exception as save_err:
                     self.log(f"保存 AI 回覆錯誤: {save_err}", "warning")
                 
@@ -497,4 +654,4 @@ class PrivateMessagePoller:
 
 
 # 創建全局實例
-private_message_poller = PrivateMessagePoller()
+private_message_poller = PrivateMessagePoller(dedup_path=default_dedup_path('private_poller'))
@@ -18,6 +18,8 @@ from text_utils import safe_json_dumps
 # Re-use main.py's db and module accessors
 from database import db
 from config import config, IS_DEV_MODE
+from core.llm_gateway import get_llm_gateway, build_chat_request, LLMStreamCancelled
+from core.semantic_cache import get_response_cache
 
 def _get_module(name: str):
     """Safe lazy module accessor."""
@@ -103,10 +105,35 @@ class AiServiceMixin:
             print(f"[AI] 獲取 AI 模型失敗: {e}", file=__import__('sys').stderr)
             return None
 
-    async def _call_ai_for_text(self, model: Dict[str, Any], prompt: str, max_tokens: int = 500) -> Optional[str]:
+    async def _relay_ai_stream(
+        self, stream_key: str, provider: str, request: Dict[str, Any], timeout=None
+    ) -> Optional[str]:
+        """
+        🆕 P18-22: 流式生成並以 ai-token 事件逐塊推送
+
+        被取消時拋出 LLMStreamCancelled；失敗或沒有內容時返回 None，由調用方退回整段請求
+        """
+        try:
+            text = await get_llm_gateway().relay_stream(
+                stream_key, request, lambda frame: self.send_event('ai-token', frame),
+                provider=provider, timeout=timeout,
+            )
+        except Exception as e:
+            print(f"[AI] 流式調用失敗，改用整段請求: {e}", file=sys.stderr)
+            return None
+        if text is None:
+            raise LLMStreamCancelled(stream_key)
+        return text or None
+
+    async def _call_ai_for_text(
+        self, model: Dict[str, Any], prompt: str, max_tokens: int = 500, stream_key: Optional[str] = None,
+        use_cache: bool = True, temperature: Optional[float] = None
+    ) -> Optional[str]:
         """
         🆕 通用 AI 調用方法
         🔧 P0: 增加超時時間到 45 秒
+        🆕 P18-22: 指定 stream_key 時流式生成（ai-token 事件），取消時拋出 LLMStreamCancelled
+        🆕 P18-23: 相同 / 相近 prompt 復用生成結果（use_cache=False 強制重新生成）
         """
         import aiohttp
         
@@ -116,14 +143,49 @@ class AiServiceMixin:
         model_name = model.get('modelName', '')
         is_local = model.get('isLocal', False)
         
+        if use_cache:
+            generated = False
+            
+            async def generate():
+                nonlocal generated
+                generated = True
+                return await self._call_ai_for_text(
+                    model, prompt, max_tokens, stream_key, use_cache=False, temperature=temperature
+                )
+            
+            text = await get_response_cache().get_or_generate(
+                prompt,
+                generate,
+                model=f"{provider}:{model_name}",
+                params={'max_tokens': max_tokens, 'temperature': temperature},
+                semantic_text=prompt,
+            )
+            if stream_key and text and not generated:
+                # 緩存命中：仍按流式幀發出，等待該 streamId 的前端才能收尾
+                get_llm_gateway().replay_stream(stream_key, text, lambda frame: self.send_event('ai-token', frame))
+            return text
+        
         # 🔧 P0: 增加超時時間，與前端一致（使用配置常量）
         from config import AIConfig
         timeout = aiohttp.ClientTimeout(total=AIConfig.API_TIMEOUT_SECONDS)
         start_time = time.time()
+        # 未指定 temperature 時不下發，沿用各 provider / 網關的默認值
+        sampling = {} if temperature is None else {'temperature': temperature}
+        
+        if stream_key:
+            stream_provider = 'ollama' if is_local else provider
+            request = build_chat_request(
+                stream_provider, api_endpoint, api_key, model_name,
+                [{"role": "user", "content": prompt}], max_tokens=max_tokens, **sampling,
+            )
+            text = await self._relay_ai_stream(stream_key, stream_provider, request, timeout)
+            if text:
+                print(f"[AI] ✓ 流式調用完成，耗時 {time.time() - start_time:.1f}秒，返回長度 {len(text)}", file=sys.stderr)
+                return text
         print(f"[AI] 開始調用: provider={provider}, model={model_name}, endpoint={api_endpoint[:50] if api_endpoint else 'default'}...", file=sys.stderr)
         
         try:
-            async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with get_llm_gateway().session('ollama' if is_local else provider, timeout=timeout) as session:
                 if is_local or provider == 'ollama' or provider == 'custom':
                     # Ollama / 本地模型
                     endpoint = api_endpoint or 'http://localhost:11434'
@@ -140,7 +202,7 @@ class AiServiceMixin:
                         "model": model_name or "llama3",
                         "messages": [{"role": "user", "content": prompt}],
                         "stream": False,
-                        "options": {"num_predict": max_tokens}
+                        "options": {"num_predict": max_tokens, **sampling}
                     }) as resp:
                         if resp.status == 200:
                             data = await resp.json()
@@ -153,7 +215,7 @@ class AiServiceMixin:
                     
                     async with session.post(url, json={
                         "contents": [{"parts": [{"text": prompt}]}],
-                        "generationConfig": {"maxOutputTokens": max_tokens}
+                        "generationConfig": {"maxOutputTokens": max_tokens, **sampling}
                     }) as resp:
                         if resp.status == 200:
                             data = await resp.json()
@@ -176,7 +238,8 @@ class AiServiceMixin:
                     async with session.post(url, headers=headers, json={
                         "model": model_name or "gpt-3.5-turbo",
                         "messages": [{"role": "user", "content": prompt}],
-                        "max_tokens": max_tokens
+                        "max_tokens": max_tokens,
+                        **sampling
                     }) as resp:
                         elapsed = time.time() - start_time
                         if resp.status == 200:
@@ -203,7 +266,8 @@ class AiServiceMixin:
                     async with session.post(url, headers=headers, json={
                         "model": model_name or "deepseek-chat",
                         "messages": [{"role": "user", "content": prompt}],
-                        "max_tokens": max_tokens
+                        "max_tokens": max_tokens,
+                        **sampling
                     }) as resp:
                         if resp.status == 200:
                             data = await resp.json()
@@ -260,7 +324,7 @@ class AiServiceMixin:
         messages = []
         
         timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
+        async with get_llm_gateway().session('ollama' if is_local else provider, timeout=timeout) as session:
             if is_local or provider == 'ollama' or provider == 'custom':
                 # 本地 AI (Ollama)
                 endpoint = api_endpoint or 'http://localhost:11434'
@@ -611,8 +675,13 @@ class AiServiceMixin:
         # 沒有匹配的，隨機選一個
         return random.choice(available_roles) if available_roles else None
 
-    async def _call_local_ai(self, endpoint: str, model: str, system_prompt: str, user_message: str) -> str:
-        """直接調用本地/遠程 AI API"""
+    async def _call_local_ai(
+        self, endpoint: str, model: str, system_prompt: str, user_message: str, stream_key: Optional[str] = None
+    ) -> str:
+        """
+        直接調用本地/遠程 AI API
+        🆕 P18-22: 指定 stream_key 時流式生成（ai-token 事件），取消時拋出 LLMStreamCancelled
+        """
         import aiohttp
         import socket
         from urllib.parse import urlparse
@@ -657,6 +726,14 @@ class AiServiceMixin:
             messages.append({"role": "system", "content": system_prompt})
         messages.append({"role": "user", "content": user_message})
         
+        if stream_key:
+            request = build_chat_request('custom', endpoint, None, model, messages)
+            text = await self._relay_ai_stream(
+                stream_key, 'custom', request, aiohttp.ClientTimeout(total=90, connect=10)
+            )
+            if text:
+                return text
+        
         # 嘗試 OpenAI 兼容格式
         request_body = {
             "messages": messages,
@@ -671,7 +748,7 @@ class AiServiceMixin:
         
         try:
             start_time = time.time()
-            async with aiohttp.ClientSession() as session:
+            async with get_llm_gateway().session('custom') as session:
                 # 嘗試 /v1/chat/completions 端點
                 chat_url = endpoint.rstrip('/')
                 if not chat_url.endswith('/v1/chat/completions'):
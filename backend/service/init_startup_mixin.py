@@ -554,6 +554,9 @@ class InitStartupMixin:
             
             _qs.on_quota_change(_on_quota_change)
             print("[Backend] Quota change notification registered", file=sys.stderr)
+
+            # 🆕 P18-13: 配額賬本後台寫回（使用量 / 日誌 / 告警批量落庫）
+            asyncio.create_task(_qs.run_write_behind())
         except Exception as e:
             print(f"[Backend] Failed to register quota change callback: {e}", file=sys.stderr)
         
@@ -708,10 +711,50 @@ class InitStartupMixin:
                 
                 await asyncio.sleep(86400)  # 24 小時
         
+        # 🆕 P18-12: 線索去重持續增量掃描（只處理變更行）
+        async def continuous_lead_dedup():
+            await asyncio.sleep(120)  # 避開啟動高峰
+            try:
+                from core.lead_dedup import get_lead_dedup_service
+                await get_lead_dedup_service().run_continuous()
+            except Exception as e:
+                print(f"[LeadDedup] 增量去重任務退出: {e}", file=sys.stderr)
+        
+        # 🆕 P18-17: 安裝分析預聚合（首次回填在線程中進行）
+        async def ensure_analytics_rollup():
+            await asyncio.sleep(30)
+            try:
+                from core.analytics_rollup import get_analytics_rollup
+                from core.db_executor import run_bulk_db
+                ready = await run_bulk_db(get_analytics_rollup().ensure)
+                print(f"[Rollup] 分析預聚合已就緒: {ready}", file=sys.stderr)
+            except Exception as e:
+                print(f"[Rollup] 分析預聚合安裝失敗: {e}", file=sys.stderr)
+        
+        # 🆕 P18-19: 線索增量重評（規則變化時自動全量重評）
+        async def continuous_lead_rescoring():
+            await asyncio.sleep(180)
+            from core.lead_scoring import get_scoring_engine
+            from core.db_executor import db_connection, run_bulk_db
+
+            def _rescore():
+                with db_connection() as conn:
+                    return get_scoring_engine().rescore_changed(conn)
+
+            while True:
+                try:
+                    await run_bulk_db(_rescore)
+                except Exception as e:
+                    print(f"[LeadScoring] 增量重評失敗: {e}", file=sys.stderr)
+                await asyncio.sleep(600)
+        
         # 創建後台任務（不等待完成）
         asyncio.create_task(delayed_maintenance_tasks())
         asyncio.create_task(periodic_memory_cleanup())
         asyncio.create_task(daily_db_maintenance())
+        asyncio.create_task(continuous_lead_dedup())
+        asyncio.create_task(ensure_analytics_rollup())
+        asyncio.create_task(continuous_lead_rescoring())
         
         # 🔧 Phase 2 優化：初始化內存監控器
         try:
@@ -1208,6 +1251,8 @@ class InitStartupMixin:
                         account_phone=account_phone,
                         source_group=source_group
                     )
+                    from ai_context_manager import ai_context
+                    ai_context.invalidate(target_user_id, 'recent')
                     
                     return True
                 except Exception as e:
@@ -175,6 +175,7 @@ from trie_keyword_matcher import TrieKeywordMatcher
 from concurrent.futures import ThreadPoolExecutor
 import asyncio
 from private_message_handler import private_message_handler
+from core.peer_cache import get_peer_cache, normalize_peer_ref, chat_type_name
 from text_utils import sanitize_text, safe_get_name, safe_get_username, format_chat_info, format_user_info
 
 
@@ -218,6 +219,10 @@ class TelegramClientManager:
         self.message_handlers: Dict[str, MessageHandler] = {}  # phone -> MessageHandler
         # Store monitoring info for each account
         self.monitoring_info: Dict[str, Dict[str, Any]] = {}  # phone -> {chat_ids, keyword_sets, etc.}
+        # 🔧 批量成員檢查：帳號已加入群組索引（來自一次 get_dialogs）
+        self._joined_chat_index: Dict[str, Dict[str, Any]] = {}  # phone -> {chats, usernames, built_at}
+        self._joined_index_ttl = 60  # 索引有效期（秒）
+        self._membership_check_concurrency = 3  # 逐個 API 檢查的並發上限
         
         # 🆕 設置全局異常處理器（捕獲未處理的 Peer ID 錯誤等）
         setup_global_exception_handler()
@@ -2117,9 +2122,10 @@ class TelegramClientManager:
             is_member = False
             chat = None
             try:
-                chat = await client.get_chat(group_id)
+                # 🔧 通過共享 Peer 緩存解析，避免每次重新走網絡
+                chat = await get_peer_cache().resolve(client, phone, group_url)
                 # 獲取當前用戶在群組中的成員身份
-                me = await client.get_me()
+                me = getattr(client, 'me', None) or await client.get_me()
                 member = await client.get_chat_member(chat.id, me.id)
                 # 檢查是否是有效成員（不是 LEFT 或 BANNED）
                 from pyrogram.enums import ChatMemberStatus
@@ -2136,7 +2142,7 @@ class TelegramClientManager:
                     "already_member": True,
                     "chat_id": chat.id,
                     "chat_title": chat.title,
-                    "chat_type": str(chat.type)
+                    "chat_type": chat_type_name(chat)
                 }
             
             # 🆕 Phase4: 加入前主動等待 — 避免 FLOOD_WAIT
@@ -2157,6 +2163,8 @@ class TelegramClientManager:
                     chat = await client.join_chat(group_id)
                 
                 print(f"[TelegramClient] Successfully joined {group_id}: {chat.title}", file=sys.stderr)
+                await get_peer_cache().remember(client, phone, group_url, chat)
+                self.invalidate_joined_chat_index(phone)
                 
                 if self.event_callback:
                     self.event_callback("log-entry", {
@@ -2169,17 +2177,17 @@ class TelegramClientManager:
                     "already_member": False,
                     "chat_id": chat.id,
                     "chat_title": chat.title,
-                    "chat_type": str(chat.type)
+                    "chat_type": chat_type_name(chat)
                 }
             except UserAlreadyParticipant:
                 # Already a member
-                chat = await client.get_chat(group_id)
+                chat = await get_peer_cache().resolve(client, phone, group_url)
                 return {
                     "success": True,
                     "already_member": True,
                     "chat_id": chat.id,
                     "chat_title": chat.title,
-                    "chat_type": str(chat.type)
+                    "chat_type": chat_type_name(chat)
                 }
                 
         except FloodWait as e:
@@ -2358,7 +2366,7 @@ class TelegramClientManager:
                 try:
                     # 嘗試用邀請鏈接加入群組的方式來獲取信息
                     # 注意：get_chat 對邀請鏈接可能不起作用
-                    chat = await client.get_chat(invite_link_full)
+                    chat = await get_peer_cache().resolve(client, phone, invite_link_full)
                 except Exception as invite_err:
                     error_str = str(invite_err).lower()
                     print(f"[TelegramClient] Invite link check error: {invite_err}", file=sys.stderr)
@@ -2390,14 +2398,14 @@ class TelegramClientManager:
                             "reason": "私有群組，需要通過邀請鏈接加入"
                         }
             else:
-                # 普通用戶名/群組 ID
-                chat = await client.get_chat(group_id)
+                # 普通用戶名/群組 ID（優先使用共享 Peer 緩存）
+                chat = await get_peer_cache().resolve(client, phone, group_id)
             
             # 正確檢查成員身份：使用 get_chat_member 而不只是 get_chat
             # get_chat 對公開群組可以成功，但不代表帳號是成員
             try:
                 # 獲取當前用戶在群組中的成員身份
-                me = await client.get_me()
+                me = getattr(client, 'me', None) or await client.get_me()
                 member = await client.get_chat_member(chat.id, me.id)
                 
                 # 檢查是否是有效成員（不是 LEFT 或 BANNED）
@@ -2409,7 +2417,7 @@ class TelegramClientManager:
                         "can_join": True,
                         "chat_id": chat.id,
                         "chat_title": chat.title,
-                        "chat_type": str(chat.type),
+                        "chat_type": chat_type_name(chat),
                         "group_url": group_url,
                         "members_count": getattr(chat, 'members_count', 0) or 0
                     }
@@ -2433,7 +2441,7 @@ class TelegramClientManager:
                 if "not a participant" in error_str or "user_not_participant" in error_str:
                     # 嘗試獲取群組資訊以判斷是否可以加入
                     try:
-                        chat = await client.get_chat(group_id)
+                        chat = await get_peer_cache().resolve(client, phone, group_id, require_access=False)
                         return {
                             "is_member": False,
                             "can_join": True,
@@ -2502,10 +2510,160 @@ class TelegramClientManager:
                 "group_url": group_url
             }
     
+    async def _get_joined_chat_index(self, phone: str, force: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        構建帳號已加入群組的內存索引（一次 get_dialogs 遍歷）
+        
+        Returns:
+            {'chats': {chat_id: chat}, 'usernames': {username: chat_id}, 'built_at': ts}，失敗返回 None
+        """
+        import sys
+        from pyrogram.enums import ChatType
+        
+        cached = self._joined_chat_index.get(phone)
+        if cached and not force and time.time() - cached['built_at'] < self._joined_index_ttl:
+            return cached
+        
+        client = self.clients.get(phone)
+        if not client:
+            return None
+        
+        try:
+            from flood_wait_handler import flood_handler
+            # 長冷卻期內不等待，直接退回逐個檢查（逐個檢查同樣會立即返回無法檢查）
+            if flood_handler.get_remaining_cooldown(phone) > flood_handler.MAX_DELAY:
+                return None
+            await flood_handler.wait_before_operation(phone, 'get_dialogs')
+        except Exception:
+            pass
+        
+        chats: Dict[int, Any] = {}
+        usernames: Dict[str, int] = {}
+        peer_cache = get_peer_cache()
+        try:
+            if not client.is_connected:
+                await client.connect()
+            # 遍歷期間只寫內存，結束後一次寫回（不在每個 dialog 上同步寫 SQLite）
+            with peer_cache.batch():
+                async for dialog in client.get_dialogs():
+                    chat = dialog.chat
+                    if chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP, ChatType.CHANNEL):
+                        continue
+                    chats[chat.id] = chat
+                    if chat.username:
+                        usernames[chat.username.lower()] = chat.id
+                    # 順便填充共享 Peer 緩存（dialogs 已把 peer 寫入本地 session）
+                    await peer_cache.remember(client, phone, chat.username or chat.id, chat)
+        except FloodWait as e:
+            try:
+                from flood_wait_handler import flood_handler
+                flood_handler.record_flood_wait(phone, e.value)
+            except Exception:
+                pass
+            print(f"[TelegramClient] get_dialogs FloodWait {e.value}s for {phone}, fallback to per-group checks", file=sys.stderr)
+            return None
+        except Exception as e:
+            print(f"[TelegramClient] get_dialogs failed for {phone}: {e}", file=sys.stderr)
+            return None
+        
+        await peer_cache.flush_async()
+        index = {'chats': chats, 'usernames': usernames, 'built_at': time.time()}
+        self._joined_chat_index[phone] = index
+        return index
+    
+    def invalidate_joined_chat_index(self, phone: Optional[str] = None):
+        """使已加入群組索引失效（加群/退群後調用）"""
+        if phone is None:
+            self._joined_chat_index.clear()
+        else:
+            self._joined_chat_index.pop(phone, None)
+    
+    def _check_membership_locally(self, index: Dict[str, Any], group_url: Any) -> Optional[Dict[str, Any]]:
+        """
+        用已加入群組索引和 Peer 緩存在本地判斷成員狀態
+        
+        Returns:
+            與 check_group_membership 相同格式的結果；無法本地判斷時返回 None
+        """
+        ref = normalize_peer_ref(group_url)
+        chats = index['chats']
+        
+        chat_id = None
+        if ref.lstrip('-').isdigit():
+            chat_id = int(ref)
+        elif ref in index['usernames']:
+            chat_id = index['usernames'][ref]
+        else:
+            entry = get_peer_cache().get(ref)
+            if entry and not entry.negative:
+                chat_id = entry.id
+        
+        if chat_id is None:
+            return None
+        
+        chat = chats.get(chat_id)
+        if chat:
+            return {
+                "is_member": True,
+                "can_join": True,
+                "chat_id": chat.id,
+                "chat_title": chat.title,
+                "chat_type": chat_type_name(chat),
+                "group_url": group_url,
+                "members_count": getattr(chat, 'members_count', 0) or 0
+            }
+        
+        # 數字 ID 不在對話列表中：無法確定是否可加入，交給 API 檢查
+        if not ref.lstrip('-').isdigit():
+            entry = get_peer_cache().get(ref)
+            is_private = ref.startswith('+')
+            return {
+                "is_member": False,
+                "can_join": True,
+                "is_private": is_private,
+                "chat_id": chat_id,
+                "chat_title": entry.title if entry else None,
+                "group_url": group_url,
+                "reason": "需要邀請鏈接加入（私有群組）" if is_private else "未加入群組（可加入）"
+            }
+        return None
+    
+    async def _check_membership_with_flood_guard(self, phone: str, group_url: Any) -> Dict[str, Any]:
+        """
+        逐個 API 檢查（FloodWait 時記錄冷卻並重試一次）
+        
+        帳號冷卻期超過 MAX_DELAY 時不再等待，直接返回無法檢查，
+        避免批量檢查中剩餘的每個群組都睡滿冷卻期
+        """
+        from flood_wait_handler import flood_handler
+        
+        for attempt in range(2):
+            remaining = flood_handler.get_remaining_cooldown(phone)
+            if remaining > flood_handler.MAX_DELAY:
+                return {
+                    "is_member": False,
+                    "can_join": False,
+                    "group_url": group_url,
+                    "flood_wait": int(remaining),
+                    "reason": f"帳號 FloodWait 冷卻中（剩餘 {int(remaining)} 秒），暫時無法檢查"
+                }
+            await flood_handler.wait_before_operation(phone, 'get_chat')
+            result = await self.check_group_membership(phone, group_url)
+            wait_seconds = flood_handler.get_wait_time_from_error(result.get('error') or '')
+            if not wait_seconds:
+                return result
+            flood_handler.record_flood_wait(phone, wait_seconds)
+            if attempt == 0 and wait_seconds > flood_handler.MAX_DELAY:
+                return result
+        return result
+    
     async def check_all_groups_membership(self, phone: str, group_urls: list) -> Dict[str, Any]:
         """
         Check membership status for all groups
         
+        🔧 批量引擎：先用一次 get_dialogs 建立已加入群組索引在本地回答，
+        只對本地無法判斷的群組走 API（有並發上限並感知 FloodWait）
+        
         Args:
             phone: Account phone number
             group_urls: List of group URLs to check
@@ -2515,46 +2673,75 @@ class TelegramClientManager:
         """
         import sys
         
+        started = time.time()
         report = {
             "phone": phone,
             "total_groups": len(group_urls),
             "member_of": [],      # Groups the account is already in
             "can_join": [],       # Groups the account can join
             "cannot_join": [],    # Groups the account cannot join
-            "errors": []          # Groups with errors
+            "errors": [],         # Groups with errors
+            "stats": {"local": 0, "api": 0, "duration_ms": 0}
         }
         
-        for group_url in group_urls:
-            try:
-                result = await self.check_group_membership(phone, group_url)
-                
-                if result.get("is_member"):
-                    report["member_of"].append({
-                        "url": group_url,
-                        "chat_id": result.get("chat_id"),
-                        "title": result.get("chat_title", "Unknown")
-                    })
-                elif result.get("can_join"):
-                    report["can_join"].append({
-                        "url": group_url,
-                        "is_private": result.get("is_private", False),
-                        "reason": result.get("reason", "")
-                    })
-                else:
-                    report["cannot_join"].append({
-                        "url": group_url,
-                        "reason": result.get("reason") or result.get("error", "未知原因")
-                    })
-            except Exception as e:
+        results: Dict[int, Any] = {}
+        pending: list = []
+        
+        index = await self._get_joined_chat_index(phone) if phone in self.clients else None
+        for i, group_url in enumerate(group_urls):
+            local = self._check_membership_locally(index, group_url) if index else None
+            if local is not None:
+                results[i] = local
+                report["stats"]["local"] += 1
+            else:
+                pending.append(i)
+        
+        if pending:
+            semaphore = asyncio.Semaphore(self._membership_check_concurrency)
+            
+            async def check_one(i: int):
+                async with semaphore:
+                    try:
+                        results[i] = await self._check_membership_with_flood_guard(phone, group_urls[i])
+                    except Exception as e:
+                        results[i] = e
+            
+            await asyncio.gather(*(check_one(i) for i in pending))
+            report["stats"]["api"] = len(pending)
+        
+        for i, group_url in enumerate(group_urls):
+            result = results.get(i)
+            if isinstance(result, Exception) or result is None:
                 report["errors"].append({
                     "url": group_url,
-                    "error": str(e)
+                    "error": str(result)
+                })
+            elif result.get("is_member"):
+                report["member_of"].append({
+                    "url": group_url,
+                    "chat_id": result.get("chat_id"),
+                    "title": result.get("chat_title", "Unknown")
+                })
+            elif result.get("can_join"):
+                report["can_join"].append({
+                    "url": group_url,
+                    "is_private": result.get("is_private", False),
+                    "reason": result.get("reason", "")
                 })
+            else:
+                report["cannot_join"].append({
+                    "url": group_url,
+                    "reason": result.get("reason") or result.get("error", "未知原因")
+                })
+        
+        report["stats"]["duration_ms"] = int((time.time() - started) * 1000)
         
         print(f"[TelegramClient] Membership report for {phone}:", file=sys.stderr)
         print(f"  - Member of: {len(report['member_of'])} groups", file=sys.stderr)
         print(f"  - Can join: {len(report['can_join'])} groups", file=sys.stderr)
         print(f"  - Cannot join: {len(report['cannot_join'])} groups", file=sys.stderr)
+        print(f"  - Answered locally: {report['stats']['local']}, via API: {report['stats']['api']} "
+              f"({report['stats']['duration_ms']} ms)", file=sys.stderr)
         
         # 顯示無法加入的詳細原因
         for item in report['cannot_join']:
@@ -2635,9 +2822,9 @@ class TelegramClientManager:
                     result['success'] = True
                     result['joined'] = not join_result.get("already_member", True)
                 else:
-                    # Join failed, try get_chat directly
+                    # Join failed, try get_chat directly (via shared peer cache)
                     try:
-                        chat = await client.get_chat(group_url)
+                        chat = await get_peer_cache().resolve(client, phone, group_url)
                         result['chat_id'] = chat.id
                         result['chat_title'] = chat.title
                         result['success'] = True
@@ -2647,7 +2834,7 @@ class TelegramClientManager:
                         if match:
                             username = match.group(1)
                             try:
-                                chat = await client.get_chat(username)
+                                chat = await get_peer_cache().resolve(client, phone, username)
                                 result['chat_id'] = chat.id
                                 result['chat_title'] = chat.title
                                 result['success'] = True
@@ -2673,6 +2860,7 @@ class TelegramClientManager:
         # 使用 gather 並行處理所有群組
         tasks = [process_with_limit(url) for url in group_urls]
         results = await asyncio.gather(*tasks, return_exceptions=True)
+        await get_peer_cache().flush_async()
         
         # 處理結果
         for i, result in enumerate(results):
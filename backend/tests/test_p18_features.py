@@ -0,0 +1,2364 @@
+"""
+🔧 P18: 消息接收與數據管道性能優化 — 測試套件
+
+覆蓋：
+  P18-1: 私信事件驅動接收 + 水位線對賬
+  P18-2: 群組輪詢水位線增量拉取 + 自適應間隔
+  P18-3: 消息去重緩存（有序淘汰 + 持久化）
+  P18-4: 共享 Peer 解析緩存
+  P18-5: 批量群組成員檢查
+  P18-6: 成員批量 UPSERT
+  P18-7: 流式成員提取 + 斷點續傳
+  P18-8: 流式數據導出
+  P18-9: 集合式成員去重
+  P18-10: 統一聯繫人增量同步
+  P18-11: 批量操作執行引擎
+  P18-12: 線索去重規範化鍵 + MinHash 分桶 + 增量掃描
+  P18-13: 內存配額賬本 + 寫回持久化
+  P18-14: 限流器 O(1) 計數 + 空閒鍵回收 + 批量日誌
+  P18-15: 請求級 Token 聲明 + 驗證緩存 + 中間件開銷
+  P18-16: 可合併流式分佈 + 分片計數器
+  P18-17: 業務分析預聚合（觸發器增量維護）
+  P18-18: 漏斗分析 SQL 下推 + 階段轉換歷史
+  P18-19: 列式批量線索評分 + 增量重評
+  P18-20: 同步 SQLite 調用的數據庫線程池
+  P18-21: 統一 LLM 網關（連接池 / 端點並發 / 提供商統計）
+  P18-22: LLM 流式補全（ai-token 幀 / 取消 / TTFT）
+  P18-23: AI 生成結果緩存（精確 / 語義層、租戶隔離、temperature 繞過）
+  P18-24: 私信合併窗口 + LLM 在途上限 / 線索評分優先級調度
+  P18-25: AI 上下文分段緩存（版本化失效 / token 預算截斷）
+"""
+
+import asyncio
+import os
+import sys
+import pytest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+
+# ============================================================
+#  P18-1: 私信事件驅動接收
+# ============================================================
+
+class _FakeDialogClient:
+    """模擬 Pyrogram 客戶端：固定的對話與歷史消息"""
+
+    def __init__(self, chat_id, message_ids):
+        from pyrogram.enums import ChatType
+        self.is_connected = True
+        self.history_calls = 0
+        self._chat = SimpleNamespace(id=chat_id, type=ChatType.PRIVATE)
+        self._messages = [
+            SimpleNamespace(id=mid, outgoing=False, chat=self._chat)
+            for mid in sorted(message_ids, reverse=True)
+        ]
+        self.read_chat_history = AsyncMock()
+
+    async def get_dialogs(self, limit=50):
+        yield SimpleNamespace(
+            chat=self._chat,
+            unread_messages_count=len(self._messages),
+            top_message=self._messages[0],
+        )
+
+    async def get_chat_history(self, chat_id, limit=0):
+        self.history_calls += 1
+        for message in self._messages[:limit]:
+            yield message
+
+
+class TestPrivateMessageIntake:
+    """P18-1: 事件驅動私信接收"""
+
+    def _make_poller(self):
+        from private_message_poller import PrivateMessagePoller
+        poller = PrivateMessagePoller()
+        poller._process_message = AsyncMock(
+            side_effect=lambda phone, client, msg: poller._advance_watermark(phone, msg.chat.id, msg.id)
+        )
+        return poller
+
+    def test_watermark_only_advances(self):
+        poller = self._make_poller()
+        poller.note_message_seen('+1', 100, 50)
+        poller.note_message_seen('+1', 100, 40)
+        assert poller.get_watermark('+1', 100) == 50
+        assert poller.get_watermark('+1', 200) == 0
+        assert poller._is_processed('+1', 100, 40)
+
+    @pytest.mark.asyncio
+    async def test_reconcile_skips_dialogs_below_watermark(self):
+        poller = self._make_poller()
+        client = _FakeDialogClient(100, [1, 2, 3])
+        poller.note_message_seen('+1', 100, 3)
+
+        await poller._check_private_messages('+1', client)
+
+        assert client.history_calls == 0
+        poller._process_message.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_reconcile_fetches_only_newer_messages(self):
+        poller = self._make_poller()
+        client = _FakeDialogClient(100, [1, 2, 3, 4])
+        poller.note_message_seen('+1', 100, 2)
+
+        await poller._check_private_messages('+1', client)
+
+        processed = [c.args[2].id for c in poller._process_message.call_args_list]
+        assert processed == [3, 4]
+        assert poller.get_watermark('+1', 100) == 4
+        assert poller.get_stats()['reconciled_messages'] == 2
+
+
+# ============================================================
+#  P18-2: 群組輪詢水位線增量拉取
+# ============================================================
+
+class _FakeHistoryClient:
+    """模擬 get_chat_history 的 offset_id 翻頁語義"""
+
+    def __init__(self, message_ids):
+        self.is_connected = True
+        self.calls = 0
+        self._ids = sorted(message_ids, reverse=True)
+
+    async def get_chat_history(self, chat_id, limit=0, offset_id=0):
+        self.calls += 1
+        ids = [i for i in self._ids if not offset_id or i < offset_id]
+        for mid in ids[:limit]:
+            yield SimpleNamespace(id=mid)
+
+
+class TestGroupPollerWatermark:
+    """P18-2: 群組輪詢增量拉取"""
+
+    def _make_poller(self):
+        from group_message_poller import GroupMessagePoller
+        poller = GroupMessagePoller()
+        poller._fetch_batch = 5
+        return poller
+
+    @pytest.mark.asyncio
+    async def test_fetch_stops_at_watermark(self):
+        poller = self._make_poller()
+        client = _FakeHistoryClient(range(1, 31))
+        messages = await poller._fetch_new_messages(client, -100, watermark=27)
+        assert [m.id for m in messages] == [30, 29, 28]
+        assert client.calls == 1
+
+    @pytest.mark.asyncio
+    async def test_fetch_pages_through_burst(self):
+        poller = self._make_poller()
+        client = _FakeHistoryClient(range(1, 31))
+        messages = await poller._fetch_new_messages(client, -100, watermark=12)
+        assert [m.id for m in messages] == list(range(30, 12, -1))
+        assert client.calls == 4
+
+    @pytest.mark.asyncio
+    async def test_bootstrap_fetches_single_page(self):
+        poller = self._make_poller()
+        client = _FakeHistoryClient(range(1, 31))
+        messages = await poller._fetch_new_messages(client, -100, watermark=0)
+        assert len(messages) == 5
+        assert client.calls == 1
+
+    def test_adaptive_interval(self):
+        poller = self._make_poller()
+        intervals = [poller._next_interval('g', 0) for _ in range(20)]
+        assert intervals[0] > poller._polling_interval
+        assert intervals[-1] == poller._max_polling_interval
+        assert poller._next_interval('g', 3) == poller._polling_interval
+
+    def test_dedup_evicts_oldest_first(self):
+        poller = self._make_poller()
+        poller._processed.max_size = 3
+        for mid in range(1, 6):
+            poller._mark_processed('-1001', mid)
+        assert not poller._is_processed('-1001', 1)
+        assert not poller._is_processed('-1001', 2)
+        assert all(poller._is_processed('-1001', mid) for mid in (3, 4, 5))
+
+
+# ============================================================
+#  P18-3: 消息去重緩存
+# ============================================================
+
+class TestMessageDedupCache:
+    """P18-3: MessageDedupCache"""
+
+    def test_check_and_add(self):
+        from core.message_dedup import MessageDedupCache
+        cache = MessageDedupCache(max_size=10)
+        assert cache.check_and_add(1, 2, 3) is False
+        assert cache.check_and_add(1, 2, 3) is True
+        assert cache.get_stats()['hits'] == 1
+
+    def test_evicts_in_insertion_order(self):
+        from core.message_dedup import MessageDedupCache
+        cache = MessageDedupCache(max_size=100)
+        for i in range(250):
+            cache.add(7, i)
+        assert len(cache) == 100
+        assert not cache.contains(7, 149)
+        assert all(cache.contains(7, i) for i in range(150, 250))
+        assert cache.get_stats()['evictions'] == 150
+
+    def test_phone_key(self):
+        from core.message_dedup import phone_key
+        assert phone_key('+86 138-0000') == 861380000
+        assert phone_key(42) == 42
+        assert phone_key('') == 0
+
+    def test_persist_and_reload(self, tmp_path):
+        from core.message_dedup import MessageDedupCache
+        path = tmp_path / 'dedup.json'
+        cache = MessageDedupCache(max_size=3, persist_path=path)
+        for i in range(5):
+            cache.add(1, i)
+        assert cache.save()
+
+        reloaded = MessageDedupCache(max_size=3, persist_path=path)
+        assert len(reloaded) == 3
+        assert reloaded.contains(1, 4)
+        assert not reloaded.contains(1, 1)
+
+
+# ============================================================
+#  P18-4: 共享 Peer 解析緩存
+# ============================================================
+
+class _FakeResolveClient:
+    """模擬 get_chat / 本地 session 存儲"""
+
+    def __init__(self, error=None):
+        self.calls = 0
+        self.error = error
+        self.storage = SimpleNamespace(get_peer_by_id=AsyncMock(return_value=SimpleNamespace(access_hash=777)))
+
+    async def get_chat(self, target):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return SimpleNamespace(id=-1001, title='Test Group', type='supergroup',
+                               username='TestGroup', members_count=42)
+
+
+class TestPeerCache:
+    """P18-4: PeerCache"""
+
+    def test_normalize_peer_ref(self):
+        from core.peer_cache import normalize_peer_ref
+        assert normalize_peer_ref('https://t.me/TestGroup') == 'testgroup'
+        assert normalize_peer_ref('@TestGroup') == 'testgroup'
+        assert normalize_peer_ref('t.me/+AbCd') == '+AbCd'
+        assert normalize_peer_ref('https://t.me/joinchat/AbCd') == '+AbCd'
+        assert normalize_peer_ref(-1001) == '-1001'
+
+    def test_chat_type_is_normalized_for_network_and_cached_results(self):
+        from pyrogram.enums import ChatType
+        from core.peer_cache import PeerCache, chat_type_name
+        network_chat = SimpleNamespace(id=-1001, title='T', type=ChatType.SUPERGROUP)
+        entry = PeerCache().put('testgroup', network_chat)
+        assert chat_type_name(network_chat) == chat_type_name(entry) == entry.type == 'supergroup'
+
+    @pytest.mark.asyncio
+    async def test_resolve_hits_cache_for_same_account(self):
+        from core.peer_cache import PeerCache
+        cache = PeerCache()
+        client = _FakeResolveClient()
+
+        first = await cache.resolve(client, '+1', 'https://t.me/TestGroup')
+        second = await cache.resolve(client, '+1', '@testgroup')
+        by_id = cache.get(-1001)
+
+        assert client.calls == 1
+        assert first.id == second.id == by_id.id == -1001
+        assert cache.get_access_hash('+1', 'testgroup') == 777
+        # 其他帳號本地 session 沒有該 peer，需重新解析
+        await cache.resolve(client, '+2', 'testgroup')
+        assert client.calls == 2
+
+    @pytest.mark.asyncio
+    async def test_negative_cache(self):
+        from core.peer_cache import PeerCache, PeerNotFound
+
+        class UsernameNotOccupied(Exception):
+            pass
+
+        cache = PeerCache()
+        client = _FakeResolveClient(error=UsernameNotOccupied('[400 USERNAME_NOT_OCCUPIED]'))
+        with pytest.raises(UsernameNotOccupied):
+            await cache.resolve(client, '+1', 'missing_group')
+        with pytest.raises(PeerNotFound, match='USERNAME_NOT_OCCUPIED'):
+            await cache.resolve(client, '+1', 'missing_group')
+        assert client.calls == 1
+
+    @pytest.mark.asyncio
+    async def test_persists_across_instances(self, tmp_path):
+        from core.peer_cache import PeerCache
+        path = tmp_path / 'peers.db'
+        cache = PeerCache(db_path=path)
+        await cache.resolve(_FakeResolveClient(), '+1', 'testgroup')
+        assert cache.flush() > 0
+
+        reloaded = PeerCache(db_path=path)
+        client = _FakeResolveClient()
+        chat = await reloaded.resolve(client, '+1', 'https://t.me/testgroup')
+        assert chat.title == 'Test Group'
+        assert client.calls == 0
+
+    @pytest.mark.asyncio
+    async def test_batched_writes_flush_once_off_the_event_loop(self, tmp_path):
+        import threading
+        from core.peer_cache import PeerCache
+        cache = PeerCache(db_path=tmp_path / 'peers.db', flush_batch=1)
+        flush_threads = []
+        real_flush = cache.flush
+
+        def flush():
+            flush_threads.append(threading.current_thread())
+            return real_flush()
+
+        cache.flush = flush
+        with cache.batch():
+            for i in range(5):
+                cache.put(f'group{i}', SimpleNamespace(id=-100 - i, title=f'G{i}', type='supergroup'))
+        assert flush_threads == []
+        assert await cache.flush_async() == 5
+        assert len(flush_threads) == 1 and flush_threads[0] is not threading.main_thread()
+
+        # 批量之外達到閾值：後台寫回，不在事件循環線程中同步執行
+        cache.put('group9', SimpleNamespace(id=-200, title='G9', type='supergroup'))
+        await cache._flush_task
+        assert len(flush_threads) == 2 and flush_threads[1] is not threading.main_thread()
+        assert PeerCache(db_path=tmp_path / 'peers.db').get('group9').title == 'G9'
+
+    def test_expired_entries_are_dropped(self):
+        from core.peer_cache import PeerCache
+        cache = PeerCache(ttl=0)
+        cache.put('testgroup', SimpleNamespace(id=5, title='t', type='group'))
+        import time
+        time.sleep(0.01)
+        assert cache.get('testgroup') is None
+
+
+# ============================================================
+#  P18-5: 批量群組成員檢查
+# ============================================================
+
+class TestBulkMembershipCheck:
+    """P18-5: check_all_groups_membership 批量引擎"""
+
+    def _make_manager(self, dialogs):
+        from pyrogram.enums import ChatType
+        from telegram_client import TelegramClientManager
+
+        class _DialogsClient:
+            is_connected = True
+            dialog_calls = 0
+            storage = SimpleNamespace(get_peer_by_id=AsyncMock(return_value=SimpleNamespace(access_hash=1)))
+
+            async def get_dialogs(self):
+                self.dialog_calls += 1
+                for chat_id, username, title in dialogs:
+                    yield SimpleNamespace(chat=SimpleNamespace(
+                        id=chat_id, username=username, title=title,
+                        type=ChatType.SUPERGROUP, members_count=10))
+
+        manager = TelegramClientManager()
+        manager.clients['+1'] = _DialogsClient()
+        manager.check_group_membership = AsyncMock(return_value={
+            "is_member": False, "can_join": False, "reason": "不存在"
+        })
+        return manager
+
+    @pytest.mark.asyncio
+    async def test_answers_joined_groups_locally(self, monkeypatch):
+        import core.peer_cache as peer_cache_module
+        monkeypatch.setattr(peer_cache_module, '_peer_cache', peer_cache_module.PeerCache())
+        manager = self._make_manager([(-1001, 'alpha', 'Alpha'), (-1002, None, 'Beta')])
+
+        report = await manager.check_all_groups_membership(
+            '+1', ['https://t.me/Alpha', '-1002', '@unknown_group'])
+
+        assert [g['url'] for g in report['member_of']] == ['https://t.me/Alpha', '-1002']
+        assert report['cannot_join'][0]['url'] == '@unknown_group'
+        assert report['stats']['local'] == 2
+        assert report['stats']['api'] == 1
+        manager.check_group_membership.assert_awaited_once_with('+1', '@unknown_group')
+
+    @pytest.mark.asyncio
+    async def test_dialog_index_is_reused(self, monkeypatch):
+        import core.peer_cache as peer_cache_module
+        monkeypatch.setattr(peer_cache_module, '_peer_cache', peer_cache_module.PeerCache())
+        manager = self._make_manager([(-1001, 'alpha', 'Alpha')])
+
+        await manager.check_all_groups_membership('+1', ['alpha'])
+        await manager.check_all_groups_membership('+1', ['alpha'])
+        assert manager.clients['+1'].dialog_calls == 1
+
+        manager.invalidate_joined_chat_index('+1')
+        await manager.check_all_groups_membership('+1', ['alpha'])
+        assert manager.clients['+1'].dialog_calls == 2
+
+    @pytest.mark.asyncio
+    async def test_long_flood_wait_skips_remaining_checks(self, monkeypatch):
+        import core.peer_cache as peer_cache_module
+        from flood_wait_handler import flood_handler
+        monkeypatch.setattr(peer_cache_module, '_peer_cache', peer_cache_module.PeerCache())
+        monkeypatch.setattr(flood_handler, '_flood_wait_until', {})
+        manager = self._make_manager([])
+        manager.check_group_membership = AsyncMock(return_value={
+            "is_member": False, "can_join": False, "error": "FLOOD_WAIT (3600)"})
+        manager._membership_check_concurrency = 1
+        monkeypatch.setattr(flood_handler, 'OPERATION_DELAYS', {})
+        monkeypatch.setattr(flood_handler, 'BASE_DELAY', 0)
+
+        report = await asyncio.wait_for(
+            manager.check_all_groups_membership('+1', ['@g1', '@g2', '@g3']), timeout=5)
+
+        assert manager.check_group_membership.await_count == 1
+        skipped = [g for g in report['cannot_join'] if 'FloodWait' in g['reason']]
+        assert [g['url'] for g in skipped] == ['@g2', '@g3']
+
+
+# ============================================================
+#  P18-6: 成員批量 UPSERT
+# ============================================================
+
+class TestMemberBulkUpsert:
+    """P18-6: _save_members_batch 集合式寫入"""
+
+    @pytest.fixture
+    async def service(self, tmp_path, monkeypatch):
+        import member_extraction_service as mes
+        from database import Database
+        test_db = Database(tmp_path / 'members.db')
+        monkeypatch.setattr(mes, 'db', test_db)
+        svc = mes.MemberExtractionService()
+        svc.config['upsert_chunk_size'] = 2
+        yield svc, test_db
+        if test_db._connection:
+            await test_db._connection.close()
+
+    @staticmethod
+    def _member(user_id, chat_id, username=''):
+        from member_extraction_service import ExtractedMember
+        return ExtractedMember(user_id=user_id, username=username, source_chat_id=chat_id)
+
+    @pytest.mark.asyncio
+    async def test_insert_then_update_merges_groups(self, service):
+        import json
+        svc, test_db = service
+
+        new, updated = await svc._save_members_batch(
+            [self._member('1', '-100a'), self._member('2', '-100a'), self._member('3', '-100a')])
+        assert (new, updated) == (3, 0)
+
+        new, updated = await svc._save_members_batch(
+            [self._member('1', '-100b', 'renamed'), self._member('2', '-100a'), self._member('4', '-100b')])
+        assert (new, updated) == (1, 2)
+
+        rows = {r['user_id']: r for r in await test_db.fetch_all(
+            "SELECT user_id, username, groups FROM extracted_members")}
+        assert len(rows) == 4
+        assert json.loads(rows['1']['groups']) == ['-100a', '-100b']
+        assert rows['1']['username'] == 'renamed'
+        assert json.loads(rows['2']['groups']) == ['-100a']
+        assert svc.get_stats()['db_write']['rows'] == 6
+        assert svc.get_stats()['db_write']['fallback_batches'] == 0
+
+    @pytest.mark.asyncio
+    async def test_falls_back_without_unique_constraint(self, service):
+        svc, test_db = service
+        await test_db.execute("DROP TABLE extracted_members")
+        await test_db.execute("""
+            CREATE TABLE extracted_members (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, username TEXT,
+                first_name TEXT, last_name TEXT, phone TEXT, online_status TEXT,
+                last_online TEXT, is_bot INTEGER, is_premium INTEGER, is_verified INTEGER,
+                source_chat_id TEXT, source_chat_title TEXT, extracted_at TEXT,
+                extracted_by_phone TEXT, value_level TEXT, activity_score REAL,
+                groups TEXT DEFAULT '[]', created_at TEXT, updated_at TEXT)
+        """)
+
+        assert await svc._save_members_batch([self._member('1', '-100a')]) == (1, 0)
+        assert await svc._save_members_batch([self._member('1', '-100b')]) == (0, 1)
+        assert svc._bulk_upsert_supported is False
+
+
+# ============================================================
+#  P18-7: 流式成員提取 + 斷點續傳
+# ============================================================
+
+class _FakeMembersClient:
+    """模擬基礎群組：get_chat_members 在第 fail_at 個成員後拋出 FloodWait"""
+
+    def __init__(self, user_count, fail_at=None):
+        self.fail_at = fail_at
+        self.yielded = 0
+        self._users = [
+            SimpleNamespace(id=1000 + i, is_bot=False, username=f'u{i}', first_name='U',
+                            last_name='', photo=None, status=None)
+            for i in range(user_count)
+        ]
+
+    async def get_chat(self, chat_id):
+        return SimpleNamespace(id=-1005, title='Stream', members_count=len(self._users))
+
+    async def resolve_peer(self, chat_id):
+        return SimpleNamespace()
+
+    async def get_chat_members(self, chat_id, limit=0):
+        from pyrogram.errors import FloodWait
+        for index, user in enumerate(self._users[:limit]):
+            if self.fail_at is not None and index == self.fail_at:
+                raise FloodWait(value=1)
+            self.yielded += 1
+            yield SimpleNamespace(user=user, status=None, joined_date=None)
+
+
+class TestStreamingExtraction:
+    """P18-7: extract_members 流式保存與續傳"""
+
+    @pytest.fixture
+    async def service(self, tmp_path, monkeypatch):
+        import member_extraction_service as mes
+        import core.peer_cache as peer_cache_module
+        from database import Database
+        from flood_wait_handler import flood_handler
+        test_db = Database(tmp_path / 'stream.db')
+        monkeypatch.setattr(mes, 'db', test_db)
+        monkeypatch.setattr(peer_cache_module, '_peer_cache', peer_cache_module.PeerCache())
+        monkeypatch.setattr(flood_handler, 'wait_before_operation', AsyncMock())
+        monkeypatch.setattr(flood_handler, 'record_flood_wait', lambda *a, **k: None)
+        monkeypatch.setattr(flood_handler, 'get_available_accounts', lambda *a, **k: [])
+        svc = mes.MemberExtractionService()
+        svc.config.update({'save_interval': 10, 'result_preview_limit': 5,
+                           'pre_extraction_delay': 0, 'batch_delay': 0,
+                           'result_cache_enabled': False})
+        yield svc, test_db
+        if test_db._connection:
+            await test_db._connection.close()
+
+    @pytest.mark.asyncio
+    async def test_resumes_from_checkpoint_after_flood_wait(self, service):
+        svc, test_db = service
+        client = _FakeMembersClient(35, fail_at=23)
+        svc.set_clients({'+1': client})
+
+        first = await svc.extract_members('-1005', phone='+1')
+        assert first['error_code'] == 'FLOOD_WAIT'
+        checkpoint = await svc._load_checkpoint('-1005', '+1')
+        assert checkpoint['offset'] == 23
+        assert checkpoint['counters']['new_members'] == 23
+
+        client.fail_at = None
+        client.yielded = 0
+        second = await svc.extract_members('-1005', phone='+1')
+        assert second['success'] and second['resumed_from'] == 23
+        assert second['extracted'] == 35
+        assert second['new_members'] == 35
+        assert len(second['members']) == 5 and second['members_truncated']
+        assert await svc._load_checkpoint('-1005', '+1') is None
+
+        row = await test_db.fetch_one("SELECT COUNT(*) AS n FROM extracted_members")
+        assert row['n'] == 35
+
+    @pytest.mark.asyncio
+    async def test_checkpoint_shared_with_rotated_account(self, service):
+        svc, _ = service
+        svc.set_clients({'+1': _FakeMembersClient(30, fail_at=12)})
+        await svc.extract_members('-1005', phone='+1')
+
+        svc.set_clients({'+2': _FakeMembersClient(30)})
+        result = await svc.extract_members('-1005', phone='+2')
+        assert result['resumed_from'] == 12
+        assert result['extracted'] == 30
+
+
+# ============================================================
+#  P18-8: 流式數據導出
+# ============================================================
+
+class TestStreamingExport:
+    """P18-8: core.streaming_export + 成員導出"""
+
+    @pytest.fixture
+    def rows_db(self, tmp_path):
+        import sqlite3
+        path = tmp_path / 'export.db'
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, name TEXT, tags TEXT)")
+        conn.executemany("INSERT INTO t (name, tags) VALUES (?, ?)",
+                         [(f'n{i}', '["a","b"]') for i in range(2500)])
+        conn.commit()
+        conn.close()
+        return path
+
+    @pytest.mark.asyncio
+    async def test_ndjson_gzip_file_has_every_row(self, rows_db, tmp_path):
+        import gzip
+        import json
+        from core.streaming_export import iter_query_rows, export_to_file
+
+        out = tmp_path / 'out' / 'rows.ndjson.gz'
+        rows = iter_query_rows(rows_db, "SELECT * FROM t ORDER BY id", (), chunk_size=100)
+        count = await export_to_file(rows, out, fmt='ndjson', compress=True, flush_bytes=1024)
+
+        assert count == 2500
+        lines = gzip.decompress(out.read_bytes()).decode('utf-8').splitlines()
+        assert len(lines) == 2500
+        assert json.loads(lines[-1])['name'] == 'n2499'
+        assert not (tmp_path / 'out' / 'rows.ndjson.gz.part').exists()
+
+    @pytest.mark.asyncio
+    async def test_json_and_csv_encoding(self, rows_db):
+        import csv
+        import io
+        import json
+        from core.streaming_export import iter_query_rows, export_to_buffer
+
+        data = await export_to_buffer(
+            iter_query_rows(rows_db, "SELECT * FROM t WHERE id <= 3", ()), fmt='json', json_key='rows')
+        parsed = json.loads(data)
+        assert parsed['total_count'] == 3 and parsed['rows'][0]['name'] == 'n0'
+
+        data = await export_to_buffer(
+            iter_query_rows(rows_db, "SELECT * FROM t WHERE id <= 2", ()),
+            fmt='csv', columns=['name'])
+        assert list(csv.reader(io.StringIO(data.decode('utf-8')))) == [['name'], ['n0'], ['n1']]
+
+        empty = await export_to_buffer(
+            iter_query_rows(rows_db, "SELECT * FROM t WHERE id < 0", ()), fmt='csv', columns=['name'])
+        assert empty.decode('utf-8').strip() == 'name'
+
+    @pytest.mark.asyncio
+    async def test_member_export_has_no_row_cap(self, tmp_path, monkeypatch):
+        import member_extraction_service as mes
+        from database import Database
+        test_db = Database(tmp_path / 'members.db')
+        monkeypatch.setattr(mes, 'db', test_db)
+        svc = mes.MemberExtractionService()
+        await svc._save_members_batch([
+            mes.ExtractedMember(user_id=str(i), source_chat_id='-1') for i in range(10050)
+        ])
+
+        chunks = []
+
+        async def sink(chunk):
+            chunks.append(chunk)
+
+        assert await svc.export_members_csv(sink) == 10050
+        assert len(chunks) > 1   # 分塊推送，而非整體構建
+        assert len(b''.join(chunks).decode('utf-8').strip().splitlines()) == 10051
+
+        count = await svc.export_members_to_file(str(tmp_path / 'm.json'), 'json')
+        assert count == 10050
+        await test_db._connection.close()
+
+    @pytest.mark.asyncio
+    async def test_response_error_after_prepare_aborts_connection(self):
+        from unittest import mock
+        from aiohttp.test_utils import make_mocked_request
+        from core.streaming_export import export_to_response
+
+        async def rows():
+            yield {'id': 1}
+            raise RuntimeError('disk I/O error')
+
+        transport = mock.Mock()
+        request = make_mocked_request('GET', '/export', transport=transport)
+        response = await export_to_response(request, rows(), 'members', flush_bytes=1)
+        assert response.prepared
+        transport.close.assert_called_once()
+        request._payload_writer.write_eof.assert_not_called()
+
+
+# ============================================================
+#  P18-9: 集合式成員去重
+# ============================================================
+
+class TestMemberDedup:
+    """P18-9: deduplicate_members 計劃 + 分塊應用"""
+
+    @pytest.fixture
+    async def service(self, tmp_path, monkeypatch):
+        import member_extraction_service as mes
+        from database import Database
+        test_db = Database(tmp_path / 'dedup.db')
+        monkeypatch.setattr(mes, 'db', test_db)
+        # 模擬舊表：無 user_id 唯一約束
+        await test_db.execute("DROP TABLE extracted_members")
+        await test_db.execute("""
+            CREATE TABLE extracted_members (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT,
+                source_chat_id TEXT, groups TEXT DEFAULT '[]')
+        """)
+        rows = [('u1', '-1', '["-1"]'), ('u1', '-2', '["-2","-1"]'), ('u1', '-3', None),
+                ('u2', '-1', '["-1"]'), ('u2', '-1', '["-1"]'), ('u3', '-5', '["-5"]')]
+        for row in rows:
+            await test_db.execute(
+                "INSERT INTO extracted_members (user_id, source_chat_id, groups) VALUES (?, ?, ?)", row)
+        svc = mes.MemberExtractionService()
+        yield svc, test_db
+        await test_db._connection.close()
+
+    @pytest.mark.asyncio
+    async def test_dry_run_reports_without_changes(self, service):
+        svc, test_db = service
+        result = await svc.deduplicate_members()   # 默認只預覽
+        assert result['duplicate_users'] == 2
+        assert result['duplicate_rows'] == 3
+        assert {r['user_id'] for r in result['sample']} == {'u1', 'u2'}
+        row = await test_db.fetch_one("SELECT COUNT(*) AS n FROM extracted_members")
+        assert row['n'] == 6
+
+    @pytest.mark.asyncio
+    async def test_merges_groups_in_chunks_and_adds_unique_index(self, service):
+        import json
+        import sqlite3
+        svc, test_db = service
+        progress = []
+
+        result = await svc.deduplicate_members(dry_run=False, chunk_size=1, progress_callback=progress.append)
+
+        assert result['deleted'] == 3 and result['merged'] == 2
+        assert [p['processed'] for p in progress] == [1, 2]
+        rows = await test_db.fetch_all("SELECT id, user_id, groups FROM extracted_members ORDER BY id")
+        assert [(r['id'], r['user_id']) for r in rows] == [(1, 'u1'), (4, 'u2'), (6, 'u3')]
+        assert sorted(json.loads(rows[0]['groups'])) == ['-1', '-2', '-3']
+        assert json.loads(rows[1]['groups']) == ['-1']
+
+        assert result['unique_index'] is True
+        with pytest.raises(sqlite3.IntegrityError):
+            await test_db._connection.execute(
+                "INSERT INTO extracted_members (user_id) VALUES ('u1')")
+
+    @pytest.mark.asyncio
+    async def test_sync_fallback_without_aiosqlite(self, service, monkeypatch):
+        import member_extraction_service as mes
+        svc, test_db = service
+        monkeypatch.setattr(mes, 'HAS_AIOSQLITE', False)
+        result = await svc.deduplicate_members(dry_run=False, chunk_size=1)
+        assert result['deleted'] == 3 and result['unique_index'] is True
+        row = await test_db.fetch_one("SELECT COUNT(*) AS n FROM extracted_members")
+        assert row['n'] == 3
+
+    @pytest.mark.asyncio
+    async def test_merge_keeps_user_edits_from_every_row(self, tmp_path, monkeypatch):
+        import json
+        import member_extraction_service as mes
+        from database import Database
+        test_db = Database(tmp_path / 'edits.db')
+        monkeypatch.setattr(mes, 'db', test_db)
+        await test_db.execute("DROP TABLE extracted_members")
+        await test_db.execute("""
+            CREATE TABLE extracted_members (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, username TEXT,
+                source_chat_id TEXT, groups TEXT DEFAULT '[]', tags TEXT DEFAULT '[]', notes TEXT,
+                contacted INTEGER DEFAULT 0, contacted_at TEXT, response_status TEXT DEFAULT 'none',
+                value_level TEXT, activity_score REAL, updated_at TEXT)
+        """)
+        rows = [
+            ('u1', 'old_name', '-1', '["-1"]', '["vip"]', '老客戶', 1, '2026-01-02', 'replied', 'A', 0.9, '2026-01-01'),
+            ('u1', 'new_name', '-2', '["-2"]', '["usdt"]', None, 0, None, 'none', 'C', 0.2, '2026-02-01'),
+            ('u1', None, '-3', None, 'legacy-tag', '要報價', 0, None, None, None, 0.5, '2025-12-01'),
+        ]
+        for row in rows:
+            await test_db.execute(
+                "INSERT INTO extracted_members (user_id, username, source_chat_id, groups, tags, notes, contacted, "
+                "contacted_at, response_status, value_level, activity_score, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+        svc = mes.MemberExtractionService()
+        try:
+            result = await svc.deduplicate_members(dry_run=False)
+            assert result['deleted'] == 2 and result['unique_index'] is True
+            merged = await test_db.fetch_one("SELECT * FROM extracted_members WHERE user_id = 'u1'")
+            assert merged['id'] == 2                      # 保留最近更新的一行
+            assert merged['username'] == 'new_name' and merged['value_level'] == 'C'
+            assert sorted(json.loads(merged['tags'])) == ['legacy-tag', 'usdt', 'vip']
+            assert sorted(json.loads(merged['groups'])) == ['-1', '-2', '-3']
+            assert merged['notes'] == '老客戶\n要報價'
+            assert merged['contacted'] == 1 and merged['contacted_at'] == '2026-01-02'
+            assert merged['response_status'] == 'replied' and merged['activity_score'] == 0.9
+        finally:
+            await test_db._connection.close()
+
+    def test_schema_init_skips_unique_index_without_deleting(self, tmp_path, capsys):
+        import sqlite3
+        from database import Database
+        path = tmp_path / 'legacy.db'
+        Database(path)
+        conn = sqlite3.connect(path)
+        conn.execute("DROP INDEX idx_members_user_id_unique")
+        conn.execute("DROP TABLE extracted_members")
+        conn.execute("""
+            CREATE TABLE extracted_members (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, source_chat_id TEXT,
+                groups TEXT DEFAULT '[]', online_status TEXT, value_level TEXT, contacted INTEGER,
+                extracted_at TEXT)
+        """)
+        conn.executemany("INSERT INTO extracted_members (user_id, source_chat_id, groups) VALUES (?, ?, ?)",
+                         [('u1', '-1', '["-1"]'), ('u1', '-2', None), ('u2', '-1', '["-1"]')])
+        conn.commit()
+        conn.close()
+
+        Database(path)   # 啟動時只記錄重複，不刪除數據
+        assert '1 duplicate rows for 1 users' in capsys.readouterr().err
+        conn = sqlite3.connect(path)
+        assert conn.execute("SELECT COUNT(*) FROM extracted_members").fetchone()[0] == 3
+        assert conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'idx_members_user_id_unique'").fetchone() is None
+        conn.close()
+
+
+# ============================================================
+#  P18-10: 統一聯繫人增量同步
+# ============================================================
+
+class TestIncrementalContactSync:
+    """P18-10: sync_from_sources 變更日誌水位線 + 批量 UPSERT"""
+
+    @pytest.fixture
+    async def manager(self, tmp_path):
+        from database import Database
+        from unified_contacts import UnifiedContactsManager
+        test_db = Database(tmp_path / 'contacts.db')
+        manager = UnifiedContactsManager(test_db)
+        await manager.initialize()
+        yield manager, test_db
+        await test_db._connection.close()
+
+    @staticmethod
+    async def _add_member(test_db, user_id, first_name):
+        await test_db.execute(
+            "INSERT INTO extracted_members (user_id, first_name, source_chat_id) VALUES (?, ?, '-1')",
+            (user_id, first_name))
+
+    @pytest.mark.asyncio
+    async def test_only_changed_rows_are_resynced(self, manager):
+        manager, test_db = manager
+        for i in range(3):
+            await self._add_member(test_db, f'u{i}', f'Name{i}')
+
+        first = await manager.sync_from_sources()
+        assert first['incremental'] is False
+        assert first['synced'] == 3 and first['from_members'] == 3
+
+        idle = await manager.sync_from_sources()
+        assert idle['incremental'] is True
+        assert idle['synced'] == idle['updated'] == 0
+
+        await test_db.execute("UPDATE extracted_members SET first_name = 'Renamed' WHERE user_id = 'u1'")
+        await self._add_member(test_db, 'u9', 'New')
+        delta = await manager.sync_from_sources()
+        assert (delta['synced'], delta['updated'], delta['from_members']) == (1, 1, 2)
+
+        row = await test_db.fetch_one("SELECT display_name FROM unified_contacts WHERE telegram_id = 'u1'")
+        assert row['display_name'] == 'Renamed'
+        left = await test_db.fetch_one("SELECT COUNT(*) AS n FROM contact_change_log")
+        assert left['n'] == 0
+
+    @pytest.mark.asyncio
+    async def test_full_resync_keeps_manual_status(self, manager):
+        manager, test_db = manager
+        await self._add_member(test_db, 'u1', 'A')
+        await manager.sync_from_sources()
+        await test_db.execute("UPDATE unified_contacts SET status = 'negotiating' WHERE telegram_id = 'u1'")
+
+        stats = await manager.sync_from_sources(full=True)
+        assert stats['updated'] == 1
+        row = await test_db.fetch_one("SELECT status FROM unified_contacts WHERE telegram_id = 'u1'")
+        assert row['status'] == 'negotiating'
+
+    @pytest.mark.asyncio
+    async def test_rows_owned_by_another_tenant_count_as_conflicts(self, manager):
+        manager, test_db = manager
+        await self._add_member(test_db, 'u1', 'A')
+        await self._add_member(test_db, 'u2', 'B')
+        await manager.sync_from_sources()
+        await test_db.execute("UPDATE unified_contacts SET owner_user_id = 'other-tenant' WHERE telegram_id = 'u1'")
+
+        await test_db.execute("UPDATE extracted_members SET first_name = 'Renamed'")
+        stats = await manager.sync_from_sources()
+        assert (stats['updated'], stats['conflicts']) == (1, 1)
+        row = await test_db.fetch_one("SELECT display_name FROM unified_contacts WHERE telegram_id = 'u1'")
+        assert row['display_name'] == 'A'
+
+
+# ============================================================
+#  P18-11: 批量操作執行引擎
+# ============================================================
+
+class TestBulkBatchOperations:
+    """P18-11: BatchOperationManager 分塊事務 + 批量撤銷 + 限流進度"""
+
+    @pytest.fixture
+    async def manager(self, tmp_path):
+        from database import Database
+        from batch_operations import BatchOperationManager
+        test_db = Database(tmp_path / 'batch.db')
+        events = []
+        manager = BatchOperationManager(test_db, lambda name, data: events.append(data))
+        manager.BULK_CHUNK_SIZE = 2
+        await manager.initialize()
+        for i in range(5):
+            await test_db.execute(
+                "INSERT INTO extracted_members (user_id, response_status) VALUES (?, 'none')", (f'u{i}',))
+        yield manager, test_db, events
+        await test_db._connection.close()
+
+    @pytest.mark.asyncio
+    async def test_status_update_in_chunks_with_undo(self, manager):
+        manager, test_db, events = manager
+        result = await manager.batch_update_lead_status([1, 2, 3, 4, 5, 99], 'contacted')
+
+        assert (result['successCount'], result['failureCount']) == (5, 1)
+        assert result['results'][-1]['error'] == 'Lead not found'
+        assert result['results'][0]['old_value'] == 'none'
+        rows = await test_db.fetch_all("SELECT response_status FROM extracted_members")
+        assert {r['response_status'] for r in rows} == {'contacted'}
+        # 3 個分塊在節流窗口內：只發首個與最終進度
+        assert [e['current'] for e in events] == [2, 6]
+
+        undo = await manager.undo_operation(result['operationId'])
+        assert undo['success'] and len(undo['undoResults']) == 5
+        rows = await test_db.fetch_all("SELECT response_status FROM extracted_members")
+        assert {r['response_status'] for r in rows} == {'none'}
+
+    @pytest.mark.asyncio
+    async def test_add_tag_undo_keeps_preexisting_tags(self, manager):
+        manager, test_db, _ = manager
+        await test_db.execute(
+            "INSERT INTO lead_tags (lead_id, tag, created_at) VALUES (1, 'vip', '2026-01-01')")
+
+        result = await manager.batch_add_tag([1, 2, 3], 'vip')
+        assert result['successCount'] == 3
+        rows = await test_db.fetch_all("SELECT lead_id FROM lead_tags WHERE tag = 'vip' ORDER BY lead_id")
+        assert [r['lead_id'] for r in rows] == [1, 2, 3]
+
+        await manager.undo_operation(result['operationId'])
+        rows = await test_db.fetch_all("SELECT lead_id FROM lead_tags WHERE tag = 'vip'")
+        assert [r['lead_id'] for r in rows] == [1]
+
+    @pytest.mark.asyncio
+    async def test_missing_async_connection_fails_batch_once(self, manager, monkeypatch):
+        manager, test_db, events = manager
+        before = len(manager.operation_history)
+
+        async def no_aiosqlite():
+            raise ImportError("aiosqlite is required for async database operations")
+
+        monkeypatch.setattr(test_db, 'connect', no_aiosqlite)
+        with pytest.raises(RuntimeError, match='aiosqlite'):
+            await manager.batch_update_lead_status([1, 2, 3], 'interested')
+        assert len(manager.operation_history) == before
+        assert events == []
+
+    @pytest.mark.asyncio
+    async def test_dnc_and_delete(self, manager):
+        manager, test_db, _ = manager
+        dnc = await manager.batch_add_to_dnc([1, 2])
+        assert [r['old_value'] for r in dnc['results']] == [False, False]
+        row = await test_db.fetch_one("SELECT SUM(do_not_contact) AS n FROM extracted_members")
+        assert row['n'] == 2
+
+        deleted = await manager.batch_delete_leads([3, 4, 42])
+        assert (deleted['successCount'], deleted['failureCount']) == (2, 1)
+        row = await test_db.fetch_one("SELECT COUNT(*) AS n FROM extracted_members")
+        assert row['n'] == 3
+        assert {b['user_id'] for b in manager.operation_history[0].parameters['backup']} == {'u2', 'u3'}
+
+
+# ============================================================
+#  P18-12: 線索去重規範化鍵 + MinHash 分桶 + 增量掃描
+# ============================================================
+
+class TestLeadDedupEngine:
+    """P18-12: contact_dedup_keys 索引鍵 + LSH 模糊姓名 + 變更隊列"""
+
+    @pytest.fixture
+    def service(self, tmp_path):
+        import sqlite3
+        from core.lead_dedup import LeadDeduplicationService
+        db_path = str(tmp_path / 'dedup.db')
+        conn = sqlite3.connect(db_path)
+        conn.execute("""CREATE TABLE unified_contacts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, telegram_id TEXT, username TEXT,
+            display_name TEXT, first_name TEXT, last_name TEXT, phone TEXT, bio TEXT,
+            tags TEXT DEFAULT '', message_count INTEGER DEFAULT 0,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP)""")
+        conn.executemany(
+            "INSERT INTO unified_contacts (telegram_id, username, display_name, phone) VALUES (?, ?, ?, ?)", [
+                ('1', '@Alice', 'Alice Wonder', '+1 (555) 010-0001'),
+                ('2', 'alice', 'Someone', None),
+                ('3', 'carol', 'Carol', '001-555-010-0001'),
+                ('4', 'dave', 'Jonathan Smithers', None),
+                ('5', 'eve', 'smithers jonathan!', None),
+            ])
+        conn.commit()
+        conn.close()
+        svc = LeadDeduplicationService(db_path=db_path)
+        yield svc, db_path
+        svc.close()
+
+    def test_normalizers(self):
+        from core.lead_dedup import normalize_phone, normalize_username, name_fingerprint
+        assert normalize_phone('+1 (555) 010-0001') == normalize_phone('0015550100001') == '15550100001'
+        assert normalize_phone('12') is None
+        assert normalize_username('https://t.me/Alice') == normalize_username('@alice') == 'alice'
+        assert name_fingerprint('Smith,  John') == name_fingerprint('john smith') == 'john smith'
+
+    def test_scan_finds_exact_and_fuzzy_groups(self, service):
+        svc, _ = service
+        groups = {g.match_type: g for g in svc.scan_duplicates()}
+
+        assert (groups['fuzzy_username'].primary_id, groups['fuzzy_username'].duplicate_ids) == (1, [2])
+        assert groups['fuzzy_username'].details == {'username': 'alice', 'count': 2}
+        assert (groups['exact_phone'].primary_id, groups['exact_phone'].duplicate_ids) == (1, [3])
+        assert (groups['fuzzy_name'].primary_id, groups['fuzzy_name'].duplicate_ids) == (4, [5])
+
+    def test_incremental_scan_only_processes_changed_rows(self, service):
+        import sqlite3
+        svc, db_path = service
+        assert svc.scan_incremental()['processed'] == 5
+        assert svc.scan_incremental()['processed'] == 0
+
+        conn = sqlite3.connect(db_path)
+        conn.execute("UPDATE unified_contacts SET username = 'bob' WHERE id = 2")
+        conn.execute("UPDATE unified_contacts SET bio = 'ignored' WHERE id = 3")
+        conn.execute("INSERT INTO unified_contacts (telegram_id, username) VALUES ('6', 'BOB')")
+        conn.commit()
+        conn.close()
+
+        stats = svc.scan_incremental()
+        assert stats['processed'] == 2 and stats['pending'] == 0
+        usernames = {g.details['username']: g for g in svc.scan_duplicates() if g.match_type == 'fuzzy_username'}
+        assert set(usernames) == {'bob'}
+        assert usernames['bob'].duplicate_ids == [6]
+
+    def test_merge_removes_pairs(self, service):
+        svc, _ = service
+        svc.scan_incremental()
+        assert svc.merge_duplicates(4, [5])['merged'] == 1
+        assert 'fuzzy_name' not in {g.match_type for g in svc.scan_duplicates()}
+        assert svc.get_dedup_stats()['pending_scan'] == 0
+
+
+# ============================================================
+#  P18-13: 內存配額賬本
+# ============================================================
+
+class TestQuotaLedger:
+
+    @pytest.fixture
+    def quota(self, tmp_path):
+        import sqlite3
+        import threading
+        from core.quota_service import QuotaService
+        QuotaService._instance = None
+        QuotaService._lock = threading.Lock()
+        db_path = str(tmp_path / 'quota.db')
+        conn = sqlite3.connect(db_path)
+        conn.execute("CREATE TABLE users (id TEXT PRIMARY KEY, subscription_tier TEXT)")
+        conn.execute("CREATE TABLE accounts (id INTEGER PRIMARY KEY, owner_user_id TEXT, status TEXT)")
+        conn.execute("INSERT INTO users VALUES ('u1', 'bronze')")
+        conn.execute("INSERT INTO accounts (owner_user_id, status) VALUES ('u1', 'active')")
+        conn.commit()
+        conn.close()
+        service = QuotaService(db_path)
+
+        opened = []
+        real_get_db = service._get_db
+        def counting_get_db():
+            opened.append(1)
+            return real_get_db()
+        service._get_db = counting_get_db
+        yield service, db_path, opened
+        QuotaService._instance = None
+
+    def test_checks_are_served_from_ledger(self, quota):
+        service, _, opened = quota
+        first = service.check_quota('u1', 'tg_accounts')
+        loads = len(opened)
+        assert loads == 1 and first.used == 1
+        for _ in range(50):
+            service.check_quota('u1', 'tg_accounts')
+            service.check_quota('u1', 'daily_messages')
+        assert len(opened) == loads
+
+    def test_consume_is_buffered_then_flushed(self, quota):
+        import sqlite3
+        service, db_path, opened = quota
+        service._write_behind_active = True
+        service.check_quota('u1', 'ai_calls')
+        for _ in range(3):
+            ok, _ = service.consume_quota('u1', 'ai_calls', 2, context='t')
+            assert ok
+        assert len(opened) == 1
+        assert service.check_quota('u1', 'ai_calls').used == 6
+
+        assert service.flush_pending() == 4
+        conn = sqlite3.connect(db_path)
+        assert conn.execute("SELECT used FROM quota_usage WHERE user_id = 'u1' AND quota_type = 'ai_calls'").fetchone()[0] == 6
+        logs = conn.execute("SELECT before_value, after_value FROM quota_logs ORDER BY id").fetchall()
+        conn.close()
+        assert logs == [(0, 2), (2, 4), (4, 6)]
+
+        # 重新加載後與內存一致
+        service.invalidate_cache('u1')
+        assert service.check_quota('u1', 'ai_calls').used == 6
+
+    def test_usage_events_and_invalidation(self, quota):
+        service, _, _ = quota
+        service.apply_usage_event('u1', 'tg_accounts', 1)  # 未加載：忽略
+        assert service.check_quota('u1', 'tg_accounts').used == 1
+        service.apply_usage_event('u1', 'tg_accounts', 1)
+        assert service.check_quota('u1', 'tg_accounts').used == 2
+        service.apply_usage_event('u1', 'tg_accounts', -5)
+        assert service.check_quota('u1', 'tg_accounts').used == 0
+        service.invalidate_cache('u1')
+        assert 'u1' not in service._ledger
+        assert service.check_quota('u1', 'tg_accounts').used == 1
+
+    def test_reload_during_flush_keeps_in_flight_usage(self, quota):
+        import threading
+        service, _, _ = quota
+        service._write_behind_active = True
+        service.consume_quota('u1', 'ai_calls', 2)
+        in_commit, release = threading.Event(), threading.Event()
+        real_get_db = service._get_db
+
+        class StallingCommit:
+            def __init__(self, conn):
+                self._conn = conn
+
+            def __getattr__(self, name):
+                return getattr(self._conn, name)
+
+            def commit(self):
+                in_commit.set()
+                release.wait(5)
+                self._conn.commit()
+
+        service._get_db = lambda: StallingCommit(real_get_db())
+        flusher = threading.Thread(target=service.flush_pending)
+        flusher.start()
+        assert in_commit.wait(5)
+        # 增量已離開隊列但尚未提交：冷加載必須等寫回完成，不能讀到兩邊都沒有的狀態
+        loader = threading.Thread(target=service._load_ledger_entry, args=('u1',))
+        loader.start()
+        loader.join(0.2)
+        assert loader.is_alive()
+        release.set()
+        flusher.join(5)
+        loader.join(5)
+        assert service._ledger['u1'].usage['ai_calls'] == 2
+
+
+# ============================================================
+#  P18-14: 限流器熱路徑
+# ============================================================
+
+class TestRateLimiterHotPath:
+
+    @pytest.fixture
+    def limiter(self, tmp_path):
+        import threading
+        from core.rate_limiter import RateLimiter
+        RateLimiter._instance = None
+        RateLimiter._lock = threading.Lock()
+        yield RateLimiter(str(tmp_path / 'rl.db'))
+        RateLimiter._instance = None
+
+    def test_sliding_window_state_is_constant(self, monkeypatch):
+        from core import rate_limiter
+        counter = rate_limiter.SlidingWindowCounter()
+        now = [1000.0]
+        monkeypatch.setattr(rate_limiter.time, 'time', lambda: now[0])
+
+        results = [counter.check_and_increment('ip:a', 10, 60)[0] for _ in range(12)]
+        assert results.count(True) == 10
+        assert counter._windows['ip:a'][60][1:3] == [0, 10]
+
+        # 下一窗口過半：上一窗口權重 0.5 → 估算 5，可再放行 5 次
+        now[0] = 1050.0
+        assert counter.get_count('ip:a', 60) == 5
+        results = [counter.check_and_increment('ip:a', 10, 60)[0] for _ in range(7)]
+        assert results.count(True) == 5
+
+        now[0] = 2000.0
+        assert counter.expire() == 1 and len(counter) == 0
+
+    def test_denied_reset_time_is_when_capacity_returns(self, monkeypatch):
+        from core import rate_limiter
+        counter = rate_limiter.SlidingWindowCounter()
+        now = [600.0]
+        monkeypatch.setattr(rate_limiter.time, 'time', lambda: now[0])
+        for _ in range(4):
+            counter.check_and_increment('k', 4, 60)
+        allowed, _, reset_at = counter.check_and_increment('k', 4, 60)
+        assert not allowed
+        now[0] = reset_at
+        assert counter.check_and_increment('k', 4, 60)[0]
+
+    def test_token_buckets_expire_once_refilled(self, monkeypatch):
+        from core import rate_limiter
+        bucket = rate_limiter.TokenBucket()
+        now = [100.0]
+        monkeypatch.setattr(rate_limiter.time, 'time', lambda: now[0])
+        bucket.check_and_consume('burst:ip:a', rate=1.0, capacity=5)
+        assert bucket.expire(100.5) == 0
+        assert bucket.expire(101.0) == 1 and len(bucket) == 0
+
+    def test_rules_are_precompiled(self, limiter):
+        from core.rate_limiter import RateLimitRule, RateLimitScope
+        names = lambda path, method='GET', tier=None: [
+            c.rule.name for c in limiter._compiled_rules if c.matches(path, method, tier)
+        ]
+        assert 'ip_login' in names('/api/v1/auth/login')
+        assert 'ip_login' not in names('/api/v1/auth/login/extra')
+        assert 'ip_auth' in names('/api/v1/auth/me')
+        assert 'user_gold' not in names('/x', tier='bronze')
+
+        limiter.add_rule(RateLimitRule('post_only', RateLimitScope.IP, 1, 60, path_pattern='/p', methods=['post']))
+        assert 'post_only' in names('/p', 'POST') and 'post_only' not in names('/p', 'GET')
+        limiter.remove_rule('post_only')
+        assert 'post_only' not in names('/p', 'POST')
+
+    def test_rejections_are_logged_in_batches(self, limiter):
+        import sqlite3
+        limiter.LOG_FLUSH_INTERVAL = 3600
+        for _ in range(15):
+            limiter.check(ip='9.9.9.9', path='/api/v1/auth/login', method='POST')
+        assert len(limiter._log_queue) == 5
+
+        assert limiter.flush_logs() == 5
+        conn = sqlite3.connect(limiter.db_path)
+        rows = conn.execute("SELECT rule_name, COUNT(*) FROM rate_limit_logs GROUP BY rule_name").fetchall()
+        conn.close()
+        assert rows == [('ip_login', 5)]
+
+
+# ============================================================
+#  P18-15: 單次 JWT 驗證
+# ============================================================
+
+class TestRequestScopedAuth:
+
+    class _Request(dict):
+        def __init__(self, token=None):
+            super().__init__()
+            self.headers = {'Authorization': f'Bearer {token}'} if token else {}
+            self.query = {}
+            self.cookies = {}
+
+    @pytest.fixture(autouse=True)
+    def fresh_cache(self):
+        from auth import utils
+        utils.clear_token_cache()
+        yield
+        utils.clear_token_cache()
+
+    def test_verified_claims_are_cached(self, monkeypatch):
+        from auth import utils
+        token = utils.generate_access_token('u1', 'a@b.c', 'gold')
+        calls = []
+        real = utils._verify_token_signature
+        monkeypatch.setattr(utils, '_verify_token_signature', lambda t: calls.append(t) or real(t))
+
+        first = utils.verify_token(token)
+        first['sub'] = 'mutated'
+        second = utils.verify_token(token)
+        assert len(calls) == 1 and second['sub'] == 'u1'
+
+        assert utils.verify_token(token[:-2] + 'xx') is None
+        assert utils.verify_token(token[:-2] + 'xx') is None
+        assert len(calls) == 3  # 失敗結果不緩存
+
+    def test_cache_entries_expire_with_token(self, monkeypatch):
+        from datetime import timedelta
+        from auth import utils
+        token = utils.generate_token({'sub': 'u1'}, timedelta(seconds=-1))
+        assert utils.verify_token(token) is None
+
+        token = utils.generate_token({'sub': 'u2'}, timedelta(minutes=5))
+        assert utils.verify_token(token)['sub'] == 'u2'
+        key = next(iter(utils._token_cache))
+        utils._token_cache[key] = (0, utils._token_cache[key][1])
+        monkeypatch.setattr(utils, '_verify_token_signature', lambda t: None)
+        assert utils.verify_token(token) is None and not utils._token_cache
+
+    def test_claims_computed_once_per_request(self, monkeypatch):
+        from auth import utils, middleware
+        token = utils.generate_access_token('u1', 'a@b.c', 'gold')
+        calls = []
+        monkeypatch.setattr(middleware, 'verify_token', lambda t: calls.append(t) or utils.verify_token(t))
+
+        request = self._Request(token)
+        assert middleware.get_request_claims(request)['sub'] == 'u1'
+        assert middleware.get_request_claims(request)['role'] == 'gold'
+        assert len(calls) == 1
+        assert middleware.get_request_claims(self._Request()) is None
+
+    def test_middleware_overhead_reported(self):
+        from api.perf_metrics import ApiMetrics
+        metrics = ApiMetrics()
+        assert metrics.get_summary()['middleware_overhead'] == {'count': 0}
+        for ms in (0.2, 0.4, 0.6):
+            metrics.record_overhead(ms)
+        overhead = metrics.get_summary()['middleware_overhead']
+        assert overhead['count'] == 3 and overhead['p50_ms'] == 0.4 and overhead['max_ms'] == 0.6
+
+
+# ============================================================
+#  P18-16: 指標後端
+# ============================================================
+
+class TestStreamingMetrics:
+
+    def test_histogram_quantiles_within_relative_accuracy(self):
+        import random
+        from core.metrics import StreamingHistogram
+        rng = random.Random(7)
+        values = [rng.lognormvariate(3, 1.5) for _ in range(50000)]
+        hist = StreamingHistogram(relative_accuracy=0.01)
+        for v in values:
+            hist.add(v)
+        values.sort()
+        for q in (0.5, 0.95, 0.99):
+            exact = values[int(q * (len(values) - 1))]
+            assert abs(hist.quantile(q) - exact) / exact <= 0.011
+        assert hist.count == 50000 and hist.min == values[0] and hist.max == values[-1]
+        assert len(hist._positive) < 1000
+
+    def test_histogram_merge_matches_single_sketch(self):
+        from core.metrics import StreamingHistogram
+        a, b, whole = StreamingHistogram(), StreamingHistogram(), StreamingHistogram()
+        for v in range(1, 1001):
+            (a if v % 2 else b).add(v)
+            whole.add(v)
+        a.merge(b)
+        assert a.stats() == whole.stats()
+
+    def test_bucket_count_is_bounded(self):
+        from core.metrics import StreamingHistogram
+        hist = StreamingHistogram(max_buckets=64)
+        for exp in range(-300, 300):
+            hist.add(10.0 ** (exp / 10))
+        assert len(hist._positive) <= 64
+        assert hist.quantile(0.99) == pytest.approx(10.0 ** 29.3, rel=0.02)
+
+    def test_thread_sharded_counters_and_histograms(self):
+        import threading
+        from core.metrics import MetricsCollector
+        collector = MetricsCollector(history_sample_rate=0)
+
+        def work(offset):
+            for i in range(2000):
+                collector.increment('req', labels={'ep': 'a'})
+                collector.histogram('lat', offset + i % 100)
+
+        threads = [threading.Thread(target=work, args=(n * 100,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert collector.get_counter('req', {'ep': 'a'}) == 8000
+        stats = collector.get_histogram_stats('lat')
+        assert stats['count'] == 8000 and stats['min'] == 0 and stats['max'] == 399
+        assert collector.get_all_metrics()['counters'] == {'req{ep=a}': 8000}
+        assert collector.get_history('req', {'ep': 'a'}) == []
+
+
+# ============================================================
+#  P18-17: 業務分析預聚合
+# ============================================================
+
+class TestAnalyticsRollup:
+
+    @pytest.fixture
+    def db_path(self, tmp_path):
+        import sqlite3
+        path = str(tmp_path / 'analytics.db')
+        conn = sqlite3.connect(path)
+        conn.executescript("""
+            CREATE TABLE unified_contacts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, telegram_id TEXT, owner_user_id TEXT,
+                source_group_title TEXT, source_type TEXT, lead_score INTEGER DEFAULT 0,
+                intent_level TEXT DEFAULT 'none', status TEXT DEFAULT 'new',
+                funnel_stage TEXT DEFAULT 'awareness', created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE TABLE message_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, phone TEXT, user_id TEXT, text TEXT,
+                status TEXT DEFAULT 'pending', created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        conn.execute("INSERT INTO unified_contacts (telegram_id, owner_user_id, source_group_title, source_type, lead_score, intent_level) VALUES ('1', 'u1', 'G1', 'member', 80, 'hot')")
+        conn.execute("INSERT INTO unified_contacts (telegram_id, owner_user_id, source_group_title, source_type, lead_score) VALUES ('2', 'u1', 'G1', 'member', 40)")
+        conn.execute("INSERT INTO unified_contacts (telegram_id, owner_user_id, source_group_title, created_at) VALUES ('3', 'u2', 'G2', '2020-01-01 10:00:00')")
+        conn.execute("INSERT INTO message_queue (phone, user_id, text, status) VALUES ('+1', 'u1', 'a', 'completed')")
+        conn.execute("INSERT INTO message_queue (phone, user_id, text, status) VALUES ('+1', 'u1', 'b', 'pending')")
+        conn.commit()
+        conn.close()
+        return path
+
+    @staticmethod
+    def _execute(db_path, *statements):
+        import sqlite3
+        conn = sqlite3.connect(db_path)
+        for sql in statements:
+            conn.execute(sql)
+        conn.commit()
+        conn.close()
+
+    def test_backfill_matches_source_tables(self, db_path):
+        from core.analytics_rollup import AnalyticsRollup
+        from core.business_analytics import BusinessAnalytics
+        rollup = AnalyticsRollup(db_path)
+        assert rollup.ensure() == {'leads_daily': True, 'funnel': True, 'messages_hourly': True}
+
+        analytics = BusinessAnalytics(db_path)
+        sources = analytics.get_lead_source_analysis(days=30)
+        assert sources['total_leads'] == 2
+        assert sources['sources'] == [{
+            'source_group_title': 'G1', 'source_type': 'member', 'total_leads': 2,
+            'avg_score': 60.0, 'hot_leads': 1, 'warm_leads': 0, 'converted': 0,
+        }]
+        summary = analytics.get_summary_dashboard()
+        assert (summary['total_leads'], summary['hot_leads'], summary['messages_this_week']) == (3, 1, 2)
+        assert analytics.get_funnel_analysis(user_id='u2')['total_contacts'] == 1
+
+    def test_write_events_keep_rollups_current(self, db_path):
+        from core.analytics_rollup import AnalyticsRollup
+        rollup = AnalyticsRollup(db_path)
+        rollup.ensure()
+        self._execute(
+            db_path,
+            "UPDATE message_queue SET status = 'failed' WHERE text = 'b'",
+            "INSERT INTO message_queue (phone, user_id, text, status) VALUES ('+2', 'u1', 'c', 'completed')",
+            "UPDATE unified_contacts SET funnel_stage = 'interest', intent_level = 'warm' WHERE telegram_id = '2'",
+            "DELETE FROM unified_contacts WHERE telegram_id = '1'",
+        )
+        accounts = {r['phone']: (r['total'], r['sent'], r['failed']) for r in rollup.messages_by_account('2000')}
+        assert accounts == {'+1': (2, 1, 1), '+2': (1, 1, 0)}
+        assert rollup.funnel_counts('u1') == {'interest': 1}
+        assert rollup.lead_sources('2000', 'u1')[0]['warm_leads'] == 1
+        assert rollup.lead_totals('', 'u1') == {'total': 1, 'hot': 0}
+
+        # 重建結果與增量結果一致
+        before = rollup.message_trend('2000')
+        rollup.rebuild()
+        assert rollup.message_trend('2000') == before
+        assert rollup.funnel_counts('u1') == {'interest': 1}
+
+    def test_queries_never_backfill_and_messages_roll_up_by_account(self, db_path):
+        import sqlite3
+        from core.analytics_rollup import AnalyticsRollup
+        self._execute(
+            db_path,
+            "CREATE TABLE accounts (id INTEGER PRIMARY KEY, phone TEXT, owner_user_id TEXT)",
+            "INSERT INTO accounts (phone, owner_user_id) VALUES ('+1', 'tenant-a'), ('+2', 'tenant-b')",
+            "INSERT INTO message_queue (phone, user_id, text, status) VALUES ('+1', 'r2', 'c', 'completed')",
+            "INSERT INTO message_queue (phone, user_id, text, status) VALUES ('+2', 'r3', 'd', 'failed')",
+        )
+        rollup = AnalyticsRollup(db_path)
+        # 未安裝：直接聚合源表，不建表不回填
+        before = {r['phone']: (r['total'], r['sent']) for r in rollup.messages_by_account('2000')}
+        assert before == {'+1': (3, 2), '+2': (1, 0)}
+        assert rollup.lead_totals('', 'u1') == {'total': 2, 'hot': 1}
+        conn = sqlite3.connect(db_path)
+        assert conn.execute("SELECT name FROM sqlite_master WHERE name LIKE 'rollup_%'").fetchall() == []
+        conn.close()
+
+        rollup.ensure()
+        conn = sqlite3.connect(db_path)
+        # 不同收件人同一小時同一帳號只佔一行
+        assert conn.execute("SELECT COUNT(*) FROM rollup_messages_hourly").fetchone()[0] == 2
+        conn.close()
+        assert {r['phone']: (r['total'], r['sent']) for r in rollup.messages_by_account('2000')} == before
+        assert [r['phone'] for r in rollup.messages_by_account('2000', 'tenant-b')] == ['+2']
+
+    def test_missing_source_columns_disable_rollup(self, tmp_path, caplog):
+        import logging
+        import sqlite3
+        from core.analytics_rollup import AnalyticsRollup
+        path = str(tmp_path / 'old.db')
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE unified_contacts (id INTEGER PRIMARY KEY, created_at TEXT)")
+        conn.close()
+        rollup = AnalyticsRollup(path)
+        assert rollup.ensure() == {'leads_daily': False, 'funnel': False, 'messages_hourly': False}
+        with caplog.at_level(logging.WARNING, logger='core.analytics_rollup'):
+            assert rollup.lead_trend('2000') is None
+            assert rollup.lead_totals('', 'u1') is None
+        assert [r.getMessage() for r in caplog.records].count(
+            '[Rollup] leads_daily unavailable, analytics for it will be empty') == 1
+
+
+# ============================================================
+#  P18-18: 漏斗分析 SQL 下推
+# ============================================================
+
+class TestFunnelPushdown:
+
+    @pytest.fixture
+    async def engine(self, tmp_path, monkeypatch):
+        import analytics_engine
+        from database import Database
+        monkeypatch.setenv('ELECTRON_MODE', 'true')
+        analytics_engine.invalidate_funnel_cache()
+        test_db = Database(tmp_path / 'funnel.db')
+        await test_db.execute(
+            "INSERT INTO unified_contacts (telegram_id, contact_type, status, created_at) "
+            "VALUES ('1', 'user', 'new', '2026-03-01 10:00:00'), ('2', 'user', 'contacted', '2026-03-02 10:00:00'), "
+            "('3', 'user', 'lost', '2026-03-03 10:00:00'), ('4', 'group', 'new', '2026-03-03 10:00:00'), "
+            "('5', 'user', 'new', '2025-01-01 10:00:00')"
+        )
+        yield analytics_engine.AnalyticsEngine(test_db), test_db
+        if test_db._connection:
+            await test_db._connection.close()
+
+    @staticmethod
+    def _stages(result):
+        return {s['stage']: s for s in result['stages']}
+
+    @pytest.mark.asyncio
+    async def test_counts_by_range_and_normalized_status(self, engine):
+        from datetime import datetime
+        eng, _ = engine
+        result = await eng.analyze_funnel(start_date=datetime(2026, 3, 1), end_date=datetime(2026, 3, 31))
+        stages = self._stages(result)
+        assert result['totalLeads'] == 3
+        assert (stages['new']['count'], stages['contacted']['count'], stages['churned']['count']) == (1, 1, 1)
+        assert stages['new']['conversionRate'] == 33.33
+        assert result['period']['start'] == '2026-03-01T00:00:00'
+
+    @pytest.mark.asyncio
+    async def test_status_change_records_transition_and_invalidates_cache(self, engine):
+        from datetime import datetime
+        eng, test_db = engine
+        window = dict(start_date=datetime(2026, 3, 1), end_date=datetime(2100, 1, 1))
+        first = await eng.analyze_funnel(**window)
+        assert self._stages(first)['converted']['count'] == 0
+
+        # 種子記錄以 created_at 為起點，狀態變更時間由觸發器寫入
+        await test_db.execute(
+            "UPDATE lead_stage_transitions SET changed_at = '2026-03-01 10:00:00' WHERE contact_id = 1")
+        await test_db.execute("UPDATE unified_contacts SET status = 'converted' WHERE telegram_id = '1'")
+        await test_db.execute("UPDATE unified_contacts SET status = 'converted' WHERE telegram_id = '1'")
+        await test_db.execute(
+            "UPDATE lead_stage_transitions SET changed_at = '2026-03-01 16:00:00' WHERE to_status = 'converted'")
+        rows = await test_db.fetch_all(
+            "SELECT from_status, to_status FROM lead_stage_transitions WHERE contact_id = 1 ORDER BY id")
+        assert [(r['from_status'], r['to_status']) for r in rows] == [(None, 'new'), ('new', 'converted')]
+
+        second = await eng.analyze_funnel(**window)
+        stages = self._stages(second)
+        assert stages['converted']['count'] == 1
+        assert stages['new']['avgTimeHours'] == 6.0
+        assert second['totalConversionRate'] == 33.33
+
+    @pytest.mark.asyncio
+    async def test_seed_only_when_history_table_is_created(self, engine):
+        import analytics_engine
+        eng, test_db = engine
+        await eng._ensure_transition_history()
+        count = "SELECT COUNT(*) AS n FROM lead_stage_transitions"
+        assert (await test_db.fetch_one(count))['n'] == 5
+
+        # 重啟後表已存在：不再補種子，即使表中只有觸發器寫入的記錄
+        await test_db.execute("DELETE FROM lead_stage_transitions")
+        await test_db.execute("UPDATE unified_contacts SET status = 'contacted' WHERE telegram_id = '1'")
+        analytics_engine._history_installed.clear()
+        await eng._ensure_transition_history()
+        rows = await test_db.fetch_all("SELECT from_status, to_status FROM lead_stage_transitions")
+        assert [(r['from_status'], r['to_status']) for r in rows] == [('new', 'contacted')]
+
+
+# ============================================================
+#  P18-19: 列式批量線索評分
+# ============================================================
+
+class TestColumnarLeadScoring:
+
+    _LEADS = [
+        {'telegram_id': '1', 'username': 'alice', 'first_name': 'A', 'phone': '+1', 'has_photo': 1,
+         'message_count': 3, 'interactions_count': 8, 'matched_keywords': '["a", "b"]',
+         'source_group_title': 'G', 'ad_risk_score': 0.1, 'account_age_days': 45},
+        {'telegram_id': '2', 'display_name': 'B', 'is_bot': 1, 'matched_keywords': '[]',
+         'triggered_keyword': 'x', 'ad_risk_score': 0.9, 'is_premium': 'true'},
+        {'telegram_id': '3', 'username': '', 'matched_keywords': 'null', 'account_age_days': 30},
+        {'telegram_id': '4', 'triggered_keyword': 'buy', 'matched_keywords': '["only"]', 'is_verified': '1'},
+    ]
+
+    @pytest.fixture
+    def conn(self, tmp_path):
+        import sqlite3
+        conn = sqlite3.connect(str(tmp_path / 'scoring.db'))
+        conn.execute("""
+            CREATE TABLE unified_contacts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, telegram_id TEXT, username TEXT,
+                display_name TEXT, first_name TEXT, phone TEXT, has_photo INTEGER DEFAULT 0,
+                is_premium INTEGER DEFAULT 0, message_count INTEGER DEFAULT 0,
+                interactions_count INTEGER DEFAULT 0, matched_keywords TEXT DEFAULT '[]',
+                triggered_keyword TEXT, source_group_title TEXT, is_bot INTEGER DEFAULT 0,
+                ad_risk_score REAL DEFAULT 0, is_verified INTEGER DEFAULT 0, account_age_days INTEGER,
+                last_seen TIMESTAMP, lead_score INTEGER DEFAULT 0, intent_level TEXT DEFAULT 'none',
+                value_level TEXT DEFAULT 'C', intent_score INTEGER DEFAULT 0, quality_score INTEGER DEFAULT 0,
+                activity_score REAL DEFAULT 0.5, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        for lead in self._LEADS:
+            keys = ', '.join(lead)
+            conn.execute(f"INSERT INTO unified_contacts ({keys}) VALUES ({', '.join('?' * len(lead))})",
+                         tuple(lead.values()))
+        conn.commit()
+        yield conn
+        conn.close()
+
+    def test_sql_scores_match_row_scoring(self, conn):
+        import sqlite3
+        from core.lead_scoring import LeadScoringEngine
+        engine = LeadScoringEngine()
+        stats = engine.score_contacts(conn, chunk_size=3, collect=10)
+        assert (stats['scored'], stats['updated']) == (4, 4)
+
+        conn.row_factory = sqlite3.Row
+        rows = [dict(r) for r in conn.execute('SELECT * FROM unified_contacts ORDER BY id')]
+        for row, result in zip(rows, stats['results']):
+            expected = engine.score_lead(row)
+            assert row['lead_score'] == expected['lead_score']
+            assert (row['intent_level'], row['activity_score']) == (expected['intent_level'], expected['activity_score'])
+            assert {k: result[k] for k in expected} == expected
+        assert engine.batch_score(rows) == [engine.score_lead(r) for r in rows]
+
+        # 分數不變時不回寫
+        assert engine.score_contacts(conn)['updated'] == 0
+
+    def test_incremental_rescore_uses_change_queue(self, conn):
+        from core.lead_scoring import LeadScoringEngine
+        engine = LeadScoringEngine()
+        assert engine.rescore_changed(conn)['mode'] == 'full'
+        assert engine.rescore_changed(conn)['scored'] == 0
+
+        conn.execute("UPDATE unified_contacts SET phone = '+3', message_count = 2 WHERE telegram_id = '3'")
+        conn.execute("UPDATE unified_contacts SET lead_score = lead_score WHERE telegram_id = '1'")
+        conn.execute("INSERT INTO unified_contacts (telegram_id, username) VALUES ('5', 'eve')")
+        conn.commit()
+        stats = engine.rescore_changed(conn)
+        assert (stats['mode'], stats['scored'], stats['updated']) == ('incremental', 2, 2)
+
+        # 規則變化觸發全量重評
+        custom = LeadScoringEngine(rules=[{'field': 'has_phone', 'points': 20, 'category': 'profile'}])
+        assert custom.rescore_changed(conn)['mode'] == 'full'
+        scores = dict(conn.execute('SELECT telegram_id, lead_score FROM unified_contacts'))
+        assert scores == {'1': 20, '2': 0, '3': 20, '4': 0, '5': 0}
+
+
+# ============================================================
+#  P18-20: 數據庫線程池
+# ============================================================
+
+class TestDBExecutor:
+
+    @pytest.fixture
+    def executor(self):
+        from core.db_executor import DBExecutor
+        executor = DBExecutor(max_workers=1)
+        yield executor
+        executor.shutdown()
+
+    @pytest.mark.asyncio
+    async def test_worker_reuses_connection_and_keeps_context(self, executor, tmp_path):
+        import contextvars
+        import threading
+        path = str(tmp_path / 'offload.db')
+        marker = contextvars.ContextVar('marker', default=None)
+        marker.set('tenant-a')
+
+        def work(value):
+            with executor.connection(path) as conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS t (v INTEGER)')
+                conn.execute('INSERT INTO t VALUES (?)', (value,))
+                if value == 2:
+                    conn.commit()
+                # value 1 未提交：退出時回滾
+                return id(conn), marker.get(), threading.current_thread().name
+
+        first = await executor.run(work, 1)
+        second = await executor.run(work, 2)
+        assert first[0] == second[0]
+        assert first[1] == 'tenant-a' and first[2].startswith('db-offload')
+
+        def count():
+            with executor.connection(path) as conn:
+                return conn.execute('SELECT COUNT(*) FROM t').fetchone()[0]
+        assert await executor.run(count) == 1
+        assert count() == 1  # 非工作線程使用臨時連接
+
+        stats = executor.get_stats()
+        assert (stats['submitted'], stats['completed'], stats['pending'], stats['connections']) == (3, 3, 0, 1)
+        assert stats['run_ms']['count'] == 3
+
+    @pytest.mark.asyncio
+    async def test_failures_are_counted_and_raised(self, executor):
+        def boom():
+            raise ValueError('bad query')
+        with pytest.raises(ValueError):
+            await executor.run(boom)
+        assert executor.get_stats()['failed'] == 1
+
+    @pytest.mark.asyncio
+    async def test_bulk_jobs_use_separate_pool(self, monkeypatch, tmp_path):
+        import threading
+        from core import db_executor
+        main, bulk = db_executor.DBExecutor(1), db_executor.DBExecutor(1, 'db-bulk')
+        monkeypatch.setattr(db_executor, '_db_executor', main)
+        monkeypatch.setattr(db_executor, '_bulk_executor', bulk)
+        path = str(tmp_path / 'bulk.db')
+        release = threading.Event()
+
+        def slow_backfill():
+            with db_executor.db_connection(path) as conn:
+                conn.execute('SELECT 1')
+                release.wait(5)
+                return threading.current_thread().name
+
+        try:
+            job = asyncio.ensure_future(db_executor.run_bulk_db(slow_backfill))
+            # 批量任務未結束時，熱路徑查詢仍然立即執行
+            assert await asyncio.wait_for(db_executor.run_db(lambda: 'hot'), 2) == 'hot'
+            release.set()
+            assert (await job).startswith('db-bulk')
+            assert bulk.get_stats()['connections'] == 1 and main.get_stats()['connections'] == 0
+        finally:
+            release.set()
+            db_executor.shutdown_db_executors()
+
+
+# ============================================================
+#  P18-21: LLM 網關
+# ============================================================
+
+class TestLLMGateway:
+
+    @pytest.fixture
+    async def llm_server(self):
+        from aiohttp import web
+        state = {'active': 0, 'peak': 0, 'peers': set()}
+
+        async def chat(request):
+            state['active'] += 1
+            state['peak'] = max(state['peak'], state['active'])
+            state['peers'].add(request.transport.get_extra_info('peername'))
+            await asyncio.sleep(0.02)
+            state['active'] -= 1
+            return web.json_response({
+                'choices': [{'message': {'content': 'hi'}}],
+                'usage': {'prompt_tokens': 7, 'completion_tokens': 3},
+            })
+
+        async def fail(request):
+            return web.json_response({'error': 'quota'}, status=429)
+
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', chat)
+        app.router.add_post('/fail', fail)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        yield f'http://127.0.0.1:{port}', state
+        await runner.cleanup()
+
+    def test_provider_and_usage_normalization(self):
+        from core.llm_gateway import normalize_provider, endpoint_key, extract_usage
+        assert normalize_provider('GPT') == 'openai'
+        assert normalize_provider('anthropic') == 'claude'
+        assert normalize_provider('google') == 'gemini'
+        assert normalize_provider('my-vllm') == 'custom'
+        assert endpoint_key('https://api.openai.com/v1/chat') == 'https://api.openai.com:443'
+        assert extract_usage({'usage': {'input_tokens': 5, 'output_tokens': 2}}) == (5, 2)
+        assert extract_usage({'usageMetadata': {'promptTokenCount': 4, 'candidatesTokenCount': 1}}) == (4, 1)
+        assert extract_usage({'prompt_eval_count': 9, 'eval_count': 6}) == (9, 6)
+
+    def test_low_concurrency_only_for_local_endpoints(self):
+        from core.llm_gateway import LLMGateway, is_local_endpoint
+        assert is_local_endpoint('ollama', 'http://gpu-box.ts.net:11434')
+        assert is_local_endpoint('custom', 'http://127.0.0.1:8000')
+        assert is_local_endpoint('custom', 'http://localhost:8000')
+        assert not is_local_endpoint('custom', 'https://proxy.example.com:443')
+
+        async def limits():
+            gateway = LLMGateway(endpoint_concurrency=8, local_concurrency=2)
+            return (gateway._semaphore('custom', 'https://proxy.example.com:443')._value,
+                    gateway._semaphore('custom', 'http://127.0.0.1:8000')._value)
+        assert asyncio.run(limits()) == (8, 2)
+
+    @pytest.mark.asyncio
+    async def test_pooled_session_limits_and_metrics(self, llm_server):
+        from core.llm_gateway import LLMGateway
+        base, state = llm_server
+        gateway = LLMGateway(endpoint_concurrency=2)
+
+        async def call():
+            async with gateway.session('openai') as session:
+                async with session.post(f'{base}/v1/chat/completions', json={}) as resp:
+                    return (await resp.json())['choices'][0]['message']['content']
+
+        try:
+            assert await asyncio.gather(*[call() for _ in range(6)]) == ['hi'] * 6
+            # 同一端點最多 2 個並發，連接被後續請求複用
+            assert state['peak'] == 2
+            assert len(state['peers']) <= 2
+
+            async with gateway.session('openai').post(f'{base}/fail', json={}) as resp:
+                assert resp.status == 429
+
+            stats = gateway.get_stats()
+            openai = stats['providers']['openai']
+            assert (openai['requests'], openai['errors'], openai['in_flight']) == (7, 1, 0)
+            assert (openai['prompt_tokens'], openai['completion_tokens']) == (42, 18)
+            assert openai['status'] == {200: 6, 429: 1}
+            assert openai['latency_ms']['count'] == 7
+            assert stats['sessions'] == 1
+        finally:
+            await gateway.close()
+        assert gateway.get_stats()['sessions'] == 0
+
+
+# ============================================================
+#  P18-22: LLM 流式補全
+# ============================================================
+
+class TestLLMStreaming:
+
+    @pytest.fixture
+    async def stream_server(self):
+        from aiohttp import web
+        import json as _json
+
+        async def openai_sse(request):
+            body = await request.json()
+            assert body['stream'] is True
+            resp = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+            await resp.prepare(request)
+            for piece in ['你', '好', '！']:
+                chunk = {'choices': [{'delta': {'content': piece}}]}
+                await resp.write(f"data: {_json.dumps(chunk)}\n\n".encode())
+            usage = {'choices': [], 'usage': {'prompt_tokens': 12, 'completion_tokens': 3}}
+            await resp.write(f"data: {_json.dumps(usage)}\n\ndata: [DONE]\n\n".encode())
+            return resp
+
+        async def claude_sse(request):
+            resp = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+            await resp.prepare(request)
+            events = [
+                {'type': 'message_start', 'message': {'usage': {'input_tokens': 20, 'output_tokens': 1}}},
+                {'type': 'content_block_delta', 'delta': {'type': 'text_delta', 'text': 'Hi'}},
+                {'type': 'content_block_delta', 'delta': {'type': 'text_delta', 'text': ' there'}},
+                {'type': 'message_delta', 'usage': {'output_tokens': 4}},
+                {'type': 'message_stop'},
+            ]
+            for e in events:
+                await resp.write(f"event: {e['type']}\ndata: {_json.dumps(e)}\n\n".encode())
+            return resp
+
+        async def ollama_slow(request):
+            resp = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+            await resp.prepare(request)
+            await resp.write((_json.dumps({'message': {'content': 'first'}, 'done': False}) + '\n').encode())
+            await asyncio.sleep(1.5)
+            await resp.write((_json.dumps({'message': {'content': 'late'}, 'done': True}) + '\n').encode())
+            return resp
+
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', openai_sse)
+        app.router.add_post('/v1/messages', claude_sse)
+        app.router.add_post('/api/chat', ollama_slow)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        yield f'http://127.0.0.1:{port}'
+        await runner.cleanup()
+
+    def test_build_chat_request_per_provider(self):
+        from core.llm_gateway import build_chat_request
+        msgs = [{'role': 'system', 'content': 'sys'}, {'role': 'user', 'content': 'hi'}]
+        claude = build_chat_request('anthropic', '', 'k', '', msgs)
+        assert claude['fmt'] == 'claude' and claude['json']['system'] == 'sys'
+        assert claude['json']['messages'] == [{'role': 'user', 'content': 'hi'}]
+        gemini = build_chat_request('gemini', '', 'k', 'g1', msgs)
+        assert ':streamGenerateContent?alt=sse' in gemini['url'] and gemini['fmt'] == 'gemini'
+        ollama = build_chat_request('custom', 'http://host:11434/api/generate', None, 'q', msgs)
+        assert ollama['url'] == 'http://host:11434/api/chat' and ollama['fmt'] == 'ollama'
+        custom = build_chat_request('custom', 'http://host:3002', None, 'q', msgs)
+        assert custom['url'] == 'http://host:3002/v1/chat/completions' and custom['fmt'] == 'openai'
+        openai = build_chat_request('openai', '', 'k', '', msgs)
+        assert openai['url'] == 'https://api.openai.com/v1/chat/completions'
+        assert openai['json']['stream_options'] == {'include_usage': True}
+
+    def test_parse_gemini_chunk(self):
+        from core.llm_gateway import parse_stream_chunk
+        chunk = {'candidates': [{'content': {'parts': [{'text': 'a'}, {'text': 'b'}]}}],
+                 'usageMetadata': {'promptTokenCount': 3, 'candidatesTokenCount': 2}}
+        assert parse_stream_chunk('gemini', chunk) == ('ab', 3, 2, False)
+
+    @pytest.mark.asyncio
+    async def test_relay_emits_frames_and_records_ttft(self, stream_server):
+        from core.llm_gateway import LLMGateway, build_chat_request
+        gateway = LLMGateway()
+        frames = []
+        try:
+            req = build_chat_request('deepseek', f'{stream_server}/v1', 'k', 'm', [{'role': 'user', 'content': 'x'}])
+            text = await gateway.relay_stream('chat:u1', req, frames.append, provider='deepseek')
+            assert text == '你好！'
+            assert [f['token'] for f in frames if not f['done']] == ['你', '好', '！']
+            assert [f['seq'] for f in frames if not f['done']] == [0, 1, 2]
+            assert frames[-1]['done'] and not frames[-1]['cancelled'] and frames[-1]['ttftMs'] is not None
+
+            req = build_chat_request('claude', '', 'k', '', [{'role': 'user', 'content': 'x'}])
+            req['url'] = f'{stream_server}/v1/messages'
+            assert await gateway.relay_stream('chat:u2', req, frames.append, provider='claude') == 'Hi there'
+
+            stats = gateway.get_stats()['providers']
+            assert (stats['deepseek']['prompt_tokens'], stats['deepseek']['completion_tokens']) == (12, 3)
+            assert (stats['claude']['prompt_tokens'], stats['claude']['completion_tokens']) == (20, 4)
+            assert stats['deepseek']['ttft_ms']['count'] == 1 and stats['deepseek']['errors'] == 0
+        finally:
+            await gateway.close()
+
+    @pytest.mark.asyncio
+    async def test_cancel_stream_when_conversation_moves_on(self, stream_server):
+        from core.llm_gateway import LLMGateway, build_chat_request
+        gateway = LLMGateway()
+        frames = []
+        try:
+            req = build_chat_request('ollama', stream_server, None, 'q', [{'role': 'user', 'content': 'x'}])
+            task = asyncio.ensure_future(gateway.relay_stream('chat:u1', req, frames.append, provider='ollama'))
+            for _ in range(100):
+                if frames:
+                    break
+                await asyncio.sleep(0.02)
+            assert frames[0]['token'] == 'first'
+            assert gateway.cancel_stream('chat:u1') is True
+            assert await asyncio.wait_for(task, 2) is None
+            assert frames[-1]['done'] and frames[-1]['cancelled']
+            assert gateway.cancel_stream('chat:u1') is False
+
+            stats = gateway.get_stats()
+            assert stats['providers']['ollama']['cancelled'] == 1
+            assert stats['providers']['ollama']['errors'] == 0
+            assert stats['providers']['ollama']['in_flight'] == 0
+            assert stats['active_streams'] == 0
+        finally:
+            await gateway.close()
+
+
+# ============================================================
+#  P18-23: AI 生成結果緩存
+# ============================================================
+
+class TestSemanticResponseCache:
+
+    @staticmethod
+    def _counter(prefix='r'):
+        calls = []
+
+        async def generate():
+            calls.append(1)
+            return f'{prefix}{len(calls)}'
+        return generate, calls
+
+    @pytest.mark.asyncio
+    async def test_exact_hits_are_normalized_and_tenant_scoped(self):
+        from core.semantic_cache import SemanticResponseCache
+        cache = SemanticResponseCache(semantic=False)
+        gen, calls = self._counter()
+        params = {'max_tokens': 500}
+        assert await cache.get_or_generate('寫一段  文案', gen, model='m', params=params, tenant='a') == 'r1'
+        assert await cache.get_or_generate(' 寫一段 文案\n', gen, model='m', params=params, tenant='a') == 'r1'
+        # 其他租戶 / 其他模型參數不共享
+        assert await cache.get_or_generate('寫一段 文案', gen, model='m', params=params, tenant='b') == 'r2'
+        assert await cache.get_or_generate('寫一段 文案', gen, model='m', params={'max_tokens': 100}, tenant='a') == 'r3'
+        stats = cache.get_stats()
+        assert (stats['exact_hits'], stats['misses'], stats['size']) == (1, 3, 3)
+
+    @pytest.mark.asyncio
+    async def test_bypass_ttl_and_size_bounds(self):
+        from core.semantic_cache import SemanticResponseCache
+        cache = SemanticResponseCache(max_entries=2, ttl=60, max_temperature=0.9, semantic=False)
+        gen, calls = self._counter()
+        hot = {'temperature': 1.2}
+        await cache.get_or_generate('p', gen, params=hot, tenant='t')
+        await cache.get_or_generate('p', gen, params=hot, tenant='t')
+        await cache.get_or_generate('p', gen, tenant='t', bypass=True)
+        assert len(calls) == 3 and cache.get_stats()['bypassed'] == 3 and cache.get_stats()['size'] == 0
+
+        for prompt in ('a', 'b', 'c'):
+            await cache.get_or_generate(prompt, gen, tenant='t')
+        assert cache.get_stats()['size'] == 2
+        before = len(calls)
+        await cache.get_or_generate('a', gen, tenant='t')   # 已被 LRU 淘汰
+        assert len(calls) == before + 1
+
+        for entry in cache._entries.values():
+            entry.expires_at = 0
+        await cache.get_or_generate('a', gen, tenant='t')
+        assert len(calls) == before + 2
+
+        async def empty():
+            return None
+        await cache.get_or_generate('nothing', empty, tenant='t')
+        assert await cache.get_or_generate('nothing', gen, tenant='t') is not None
+
+    @pytest.mark.asyncio
+    async def test_semantic_tier_requires_same_numbers(self):
+        from knowledge_base.search_engine import KnowledgeSearchEngine
+        from core.semantic_cache import SemanticResponseCache
+        engine = KnowledgeSearchEngine()
+        cache = SemanticResponseCache(semantic=True, threshold=0.8, embedder=engine._simple_embedding)
+        gen, calls = self._counter()
+        first = await cache.get_or_generate(
+            '你們的跨境收款費率是多少', gen, semantic_text='你們的跨境收款費率是多少', context='faq', tenant='t')
+        again = await cache.get_or_generate(
+            '請問你們的跨境收款費率是多少？', gen, semantic_text='請問你們的跨境收款費率是多少？', context='faq', tenant='t')
+        assert first == again == 'r1'
+        assert cache.get_stats()['semantic_hits'] == 1
+
+        # 相似度 > 0.95，但條數不同，不能復用
+        template = '請根據以下業務描述生成 {} 條常見問答，每條包含客戶常見問題和專業回答，業務：跨境支付與代收代付'
+        five, eight = template.format(5), template.format(8)
+        await cache.get_or_generate(five, gen, semantic_text=five, context='faq', tenant='t')
+        assert await cache.get_or_generate(eight, gen, semantic_text=eight, context='faq', tenant='t') == 'r3'
+        # 不同上下文（系統提示）不做語義復用
+        assert await cache.get_or_generate(
+            '請問你們的跨境收款費率是多少', gen, semantic_text='請問你們的跨境收款費率是多少', context='sales', tenant='t') == 'r4'
+
+    @pytest.mark.asyncio
+    async def test_streaming_cache_hit_replays_frames(self, monkeypatch):
+        import service.ai_service_mixin as mixin_mod
+        from core.semantic_cache import SemanticResponseCache
+        cache = SemanticResponseCache(semantic=False)
+        monkeypatch.setattr(mixin_mod, 'get_response_cache', lambda: cache)
+        calls, events = [], []
+
+        class Service(mixin_mod.AiServiceMixin):
+            def send_event(self, name, payload):
+                events.append((name, payload))
+
+            async def _call_ai_for_text(self, model, prompt, max_tokens=500, stream_key=None,
+                                        use_cache=True, temperature=None):
+                if use_cache:
+                    return await super()._call_ai_for_text(
+                        model, prompt, max_tokens, stream_key, use_cache, temperature)
+                calls.append(temperature)
+                return f'reply{len(calls)}'
+
+        svc, model = Service(), {'provider': 'openai', 'modelName': 'm'}
+        assert await svc._call_ai_for_text(model, 'p', stream_key='s1') == 'reply1'
+        assert events == []   # 未命中時由真實流式調用推送幀
+        assert await svc._call_ai_for_text(model, 'p', stream_key='s1') == 'reply1'
+        assert [e[0] for e in events] == ['ai-token', 'ai-token']
+        assert events[0][1]['token'] == 'reply1' and events[1][1]['done'] and events[1][1]['cached']
+        # 溫度不同不共享緩存
+        assert await svc._call_ai_for_text(model, 'p', temperature=0.2) == 'reply2'
+        assert calls == [None, 0.2]   # 未指定時不下發 temperature
+
+    @pytest.mark.asyncio
+    async def test_variety_seeking_generation_bypasses_cache(self):
+        from domain.ai.generation_handlers_impl import handle_ai_generate_text
+        seen, events = [], []
+
+        class Service:
+            async def check_quota(self, *args):
+                return {'allowed': True}
+
+            async def _get_default_ai_model(self):
+                return {'provider': 'openai', 'modelName': 'm'}
+
+            async def _call_ai_for_text(self, model, prompt, max_tokens=500, stream_key=None, use_cache=True):
+                seen.append(use_cache)
+                return 'text'
+
+            def send_event(self, name, payload):
+                events.append(payload)
+
+        svc = Service()
+        await handle_ai_generate_text(svc, {'prompt': 'p', 'count': 1})
+        await handle_ai_generate_text(svc, {'prompt': 'p', 'count': 5})
+        await handle_ai_generate_text(svc, {'prompt': 'p', 'regenerate': True})
+        assert seen == [True, False, False]
+        assert all(e['success'] for e in events)
+
+
+# ============================================================
+#  P18-24: 私信合併 + LLM 調度
+# ============================================================
+
+class TestLLMScheduling:
+
+    @pytest.mark.asyncio
+    async def test_coalescer_merges_burst_into_one_reply(self):
+        from core.llm_scheduler import MessageCoalescer
+        coalescer = MessageCoalescer(window=0.05, max_wait=1)
+
+        async def send(text, delay):
+            await asyncio.sleep(delay)
+            return await coalescer.coalesce('a:1', text)
+
+        results = await asyncio.gather(send('你好', 0), send('在嗎', 0.01), send('費率多少', 0.02),
+                                       coalescer.coalesce('a:2', '別的用戶'))
+        assert results == [None, None, '你好\n在嗎\n費率多少', '別的用戶']
+        stats = coalescer.get_stats()
+        assert stats['replies'] == 2 and stats['merged'] == 2 and stats['open_batches'] == 0
+
+        # 持續連發時從第一條起最多等待 max_wait
+        capped = MessageCoalescer(window=0.05, max_wait=0.08)
+        started = asyncio.get_running_loop().time()
+        tasks = []
+        for n in range(6):
+            tasks.append(asyncio.ensure_future(capped.coalesce('k', str(n))))
+            await asyncio.sleep(0.03)
+        results = await asyncio.gather(*tasks)
+        flushed = [r for r in results if r]
+        assert len(flushed) >= 2 and ''.join(r.replace('\n', '') for r in flushed) == '012345'
+        assert asyncio.get_running_loop().time() - started < 0.5
+
+        assert await MessageCoalescer(window=0).coalesce('k', 'x') == 'x'
+
+    @pytest.mark.asyncio
+    async def test_scheduler_bounds_in_flight_and_orders_by_priority(self):
+        from core.llm_scheduler import LLMScheduler, llm_priority
+        scheduler = LLMScheduler(max_in_flight=2, max_queued=10)
+        order, peak, running = [], [0], [0]
+
+        async def job(name, priority):
+            with llm_priority(priority):
+                async with scheduler.slot():
+                    running[0] += 1
+                    peak[0] = max(peak[0], running[0])
+                    order.append(name)
+                    await asyncio.sleep(0.02)
+                    running[0] -= 1
+
+        await asyncio.gather(job('a', 0), job('b', 0), job('low', 10), job('high', 90), job('mid', 50))
+        assert peak[0] == 2
+        assert order[:2] == ['a', 'b'] and order[2:] == ['high', 'mid', 'low']
+        stats = scheduler.get_stats()
+        assert stats['in_flight'] == 0 and stats['queued'] == 0 and stats['granted'] == 5
+
+    @pytest.mark.asyncio
+    async def test_scheduler_sheds_lowest_priority_when_queue_full(self):
+        from core.llm_scheduler import LLMScheduler, LLMSchedulerFull
+        scheduler = LLMScheduler(max_in_flight=1, max_queued=2)
+        await scheduler.acquire(0)
+        low = asyncio.ensure_future(scheduler.acquire(1))
+        mid = asyncio.ensure_future(scheduler.acquire(5))
+        await asyncio.sleep(0)
+        with pytest.raises(LLMSchedulerFull):
+            await scheduler.acquire(0)          # 比所有等待者都低，直接拒絕
+        high = asyncio.ensure_future(scheduler.acquire(9))
+        await asyncio.sleep(0)
+        with pytest.raises(LLMSchedulerFull):
+            await low                           # 被擠出
+
+        scheduler.release()
+        await high
+        assert not mid.done()
+        # 排隊中被取消的請求不占名額
+        cancelled = asyncio.ensure_future(scheduler.acquire(7))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        scheduler.release()
+        await mid
+        scheduler.release()
+        stats = scheduler.get_stats()
+        assert stats['in_flight'] == 0 and stats['queued'] == 0 and stats['rejected'] == 2
+
+    @pytest.mark.asyncio
+    async def test_scheduler_keeps_queues_per_event_loop(self):
+        import threading
+        from core.llm_scheduler import LLMScheduler
+        scheduler = LLMScheduler(max_in_flight=1, max_queued=5)
+        held, done = threading.Event(), threading.Event()
+
+        async def other_loop():
+            async with scheduler.slot(0):
+                held.set()
+                await asyncio.get_running_loop().run_in_executor(None, done.wait, 5)
+
+        thread = threading.Thread(target=lambda: asyncio.run(other_loop()))
+        thread.start()
+        try:
+            assert await asyncio.get_running_loop().run_in_executor(None, held.wait, 5)
+            # 另一個循環占用的名額不會讓本循環的 future 排進同一個堆
+            await asyncio.wait_for(scheduler.acquire(0), 1)
+            assert scheduler.get_stats()['in_flight'] == 2
+            scheduler.release()
+        finally:
+            done.set()
+            thread.join(5)
+        assert scheduler.get_stats()['in_flight'] == 0
+
+    @pytest.mark.asyncio
+    async def test_gateway_requests_go_through_scheduler(self):
+        from aiohttp import web
+        from core.llm_gateway import LLMGateway
+        from core.llm_scheduler import LLMScheduler
+        active, peak = [0], [0]
+
+        async def handler(request):
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+            await asyncio.sleep(0.02)
+            active[0] -= 1
+            return web.json_response({'ok': True})
+
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        gateway = LLMGateway(endpoint_concurrency=8, scheduler=LLMScheduler(max_in_flight=2))
+        try:
+            async def call():
+                async with gateway.session('openai').post(f'http://127.0.0.1:{port}/v1/chat/completions', json={}) as resp:
+                    return (await resp.json())['ok']
+            assert all(await asyncio.gather(*(call() for _ in range(6))))
+            assert peak[0] == 2
+            assert gateway.get_stats()['scheduler']['granted'] == 6
+        finally:
+            await gateway.close()
+            await runner.cleanup()
+
+    @pytest.mark.asyncio
+    async def test_poller_coalesces_burst_with_lead_priority(self, monkeypatch):
+        import private_message_poller as pmp
+        from core.llm_scheduler import MessageCoalescer, current_priority
+        poller = pmp.PrivateMessagePoller(coalescer=MessageCoalescer(window=0.05, max_wait=1))
+        replies = []
+
+        async def fake_reply(phone, client, user, text, chat_id):
+            replies.append((text, current_priority()))
+        monkeypatch.setattr(poller, '_send_ai_reply', fake_reply)
+        monkeypatch.setattr(pmp.ai_auto_chat, 'get_lead_score', AsyncMock(return_value=72))
+
+        user = SimpleNamespace(id=42, username='u', first_name='U')
+        for text in ('第一條', '第二條', '第三條'):
+            poller._schedule_reply('+100', None, user, text, 42, 'full')
+        assert poller.get_stats()['pending_replies'] == 3
+        await asyncio.gather(*list(poller._reply_tasks))
+        assert replies == [('第一條\n第二條\n第三條', 72.0)]
+        assert poller.get_stats()['coalesced_messages'] == 2
+
+
+# ============================================================
+#  P18-25: AI 上下文分段緩存
+# ============================================================
+
+class TestContextSegmentCache:
+
+    @pytest.fixture
+    def ctx(self, monkeypatch):
+        import ai_context_manager as acm
+        fake = SimpleNamespace(
+            get_user_profile=AsyncMock(return_value={'username': 'alice', 'funnel_stage': 'interested', 'interest_level': 3}),
+            get_ai_memories=AsyncMock(side_effect=lambda user_id, memory_type=None, limit=5: (
+                [{'memory_type': 'summary', 'content': '上次聊了費率'}] if memory_type == 'summary'
+                else [{'memory_type': 'fact', 'content': '用戶需求: 換匯'}])),
+            get_chat_history=AsyncMock(side_effect=lambda user_id, limit=20: [
+                {'role': 'user' if n % 2 == 0 else 'assistant', 'content': f'消息{n}'} for n in range(limit)]),
+            add_chat_message=AsyncMock(return_value=1),
+            add_ai_memory=AsyncMock(return_value=7),
+            update_user_profile=AsyncMock(return_value=True),
+            get_chat_stats=AsyncMock(return_value={'total_messages': 1}),
+        )
+        monkeypatch.setattr(acm, 'db', fake)
+        return acm.AIContextManager(), fake
+
+    @pytest.mark.asyncio
+    async def test_only_invalidated_segments_are_rebuilt(self, ctx):
+        manager, fake = ctx
+        first = await manager.build_context('u1', system_prompt='你是客服', max_messages=4)
+        assert first[0]['content'] == '你是客服'
+        assert '【用戶資料】' in first[1]['content'] and '【歷史對話摘要】' in first[1]['content']
+        assert [m['content'] for m in first[2:]] == ['消息0', '消息1', '消息2', '消息3']
+
+        again = await manager.build_context('u1', system_prompt='你是客服', max_messages=4)
+        assert again == first
+        assert fake.get_user_profile.await_count == 1 and fake.get_chat_history.await_count == 1
+        assert manager.get_cache_stats()['segment_hits'] == 4
+
+        await manager.add_message('u1', 'user', '新消息')
+        await manager.build_context('u1', max_messages=4)
+        assert fake.get_chat_history.await_count == 2
+        assert fake.get_user_profile.await_count == 1 and fake.get_ai_memories.await_count == 2
+
+        await manager.extract_and_save_memory('u1', '偏好 USDT', memory_type='preference')
+        await manager._auto_update_profile('u1', {'sentiment': 'positive', 'auto_tags': []})
+        await manager.build_context('u1', max_messages=4)
+        assert fake.get_user_profile.await_count == 3   # _auto_update_profile 讀一次 + 重建一次
+        assert fake.get_ai_memories.await_count == 3    # 只重建 memories，summary 段仍命中
+        assert fake.get_chat_history.await_count == 2
+
+        # 窗口大小變化時 recent 段重建；其他用戶互不影響
+        await manager.build_context('u1', max_messages=6)
+        assert fake.get_chat_history.await_count == 3
+        await manager.build_context('u2', max_messages=4)
+        assert fake.get_user_profile.await_count == 4
+
+    @pytest.mark.asyncio
+    async def test_token_budget_truncates_history_and_background(self, ctx):
+        from ai_context_manager import estimate_tokens
+        manager, fake = ctx
+        fake.get_chat_history.side_effect = lambda user_id, limit=20: [
+            {'role': 'user', 'content': f'{n}' + '長' * 50} for n in range(limit)]
+        manager.max_context_tokens = 200
+        messages = await manager.build_context('u1', system_prompt='系統', max_messages=20)
+        history = [m['content'] for m in messages if m['role'] == 'user']
+        assert 0 < len(history) < 20 and history[-1].startswith('19')   # 保留最新的
+        assert sum(estimate_tokens(m['content']) for m in messages) <= 200
+
+        manager.max_context_tokens = 10
+        messages = await manager.build_context('u1', max_messages=20)
+        assert [m['content'][:2] for m in messages if m['role'] == 'user'] == ['19']   # 至少保留最新一條
+        assert estimate_tokens('abcdefgh') == 2 and estimate_tokens('你好ab') == 3
+
+    @pytest.mark.asyncio
+    async def test_operator_edits_and_funnel_transitions_invalidate_profile(self, monkeypatch):
+        import auto_funnel_manager as afm
+        from ai_context_manager import ai_context
+        from domain.contacts import tracking_handlers_impl as tracking
+        fake = SimpleNamespace(
+            get_user_profile=AsyncMock(return_value={'funnel_stage': 'new'}),
+            update_funnel_stage=AsyncMock(return_value=True),
+            update_user_profile=AsyncMock(return_value=True),
+            set_user_funnel_stage=AsyncMock(return_value=True),
+        )
+        monkeypatch.setattr(afm, 'db', fake)
+        monkeypatch.setattr(tracking, 'db', fake)
+        before = ai_context._segment_version('u-funnel', 'profile')
+
+        result = await afm.AutoFunnelManager().transition_stage('u-funnel', 'interested', 'test')
+        assert result['success']
+        assert ai_context._segment_version('u-funnel', 'profile') == before + 1
+
+        handler = SimpleNamespace(send_log=lambda *a, **k: None, send_event=lambda *a, **k: None)
+        await tracking.handle_update_user_profile(handler, {'userId': 'u-funnel', 'data': {'funnel_stage': 'hot'}})
+        assert ai_context._segment_version('u-funnel', 'profile') == before + 2
+        assert ai_context._segment_version('u-funnel', 'recent') == 0
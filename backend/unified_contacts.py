@@ -12,6 +12,7 @@
 
 import sys
 import json
+import time
 import asyncio
 from datetime import datetime, timedelta
 from typing import Dict, Any, Optional, List, Tuple
@@ -68,6 +69,99 @@ DEFAULT_TAGS = [
 ]
 
 
+# 🆕 P18-10: 增量同步的來源（變更日誌 source → 來源表）
+SYNC_SOURCES = {
+    'members': 'extracted_members',
+    'resources': 'discovered_resources',
+    'leads': 'leads',
+}
+
+SYNC_CHUNK_SIZE = 500
+
+# 只有租戶歸屬一致（或尚無歸屬）時才更新，與原先的逐行 UPDATE 條件一致
+_OWNER_GUARD = "WHERE unified_contacts.owner_user_id = excluded.owner_user_id OR unified_contacts.owner_user_id IS NULL"
+# 帶 _OWNER_GUARD 的來源：命中其他租戶的行時不會更新，統計為 conflicts
+_OWNER_GUARDED_SOURCES = frozenset({'members', 'resources'})
+
+_UPSERT_SQL = {
+    'members': f"""
+        INSERT INTO unified_contacts (
+            telegram_id, username, display_name, first_name, last_name, phone,
+            contact_type, source_type, source_id, source_name,
+            status, tags, activity_score, value_level,
+            is_bot, is_premium, is_verified, last_seen,
+            created_at, updated_at, synced_at, captured_at, owner_user_id
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(telegram_id) DO UPDATE SET
+            username = COALESCE(excluded.username, username),
+            display_name = COALESCE(excluded.display_name, display_name),
+            first_name = excluded.first_name,
+            last_name = excluded.last_name,
+            phone = COALESCE(excluded.phone, phone),
+            source_id = COALESCE(excluded.source_id, source_id),
+            source_name = COALESCE(excluded.source_name, source_name),
+            status = CASE WHEN status = 'new' THEN excluded.status ELSE status END,
+            tags = excluded.tags,
+            activity_score = excluded.activity_score,
+            value_level = excluded.value_level,
+            is_bot = excluded.is_bot,
+            is_premium = excluded.is_premium,
+            is_verified = excluded.is_verified,
+            last_seen = COALESCE(excluded.last_seen, last_seen),
+            updated_at = excluded.updated_at,
+            synced_at = excluded.synced_at,
+            owner_user_id = excluded.owner_user_id
+        {_OWNER_GUARD}
+    """,
+    'resources': f"""
+        INSERT INTO unified_contacts (
+            telegram_id, username, display_name,
+            contact_type, source_type, source_id, source_name,
+            status, ai_score, activity_score, member_count, bio,
+            created_at, updated_at, synced_at, captured_at, owner_user_id
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(telegram_id) DO UPDATE SET
+            username = COALESCE(excluded.username, username),
+            display_name = COALESCE(excluded.display_name, display_name),
+            contact_type = excluded.contact_type,
+            source_type = 'resource',
+            ai_score = excluded.ai_score,
+            activity_score = excluded.activity_score,
+            member_count = excluded.member_count,
+            bio = COALESCE(excluded.bio, bio),
+            updated_at = excluded.updated_at,
+            synced_at = excluded.synced_at,
+            owner_user_id = excluded.owner_user_id
+        {_OWNER_GUARD}
+    """,
+    'leads': """
+        INSERT INTO unified_contacts (
+            telegram_id, username, display_name, first_name, last_name, phone,
+            contact_type, source_type, source_id, source_name,
+            status, tags, message_count, last_contact_at, bio,
+            created_at, updated_at, synced_at, captured_at
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(telegram_id) DO UPDATE SET
+            username = COALESCE(excluded.username, username),
+            display_name = COALESCE(excluded.display_name, display_name),
+            first_name = COALESCE(excluded.first_name, first_name),
+            last_name = COALESCE(excluded.last_name, last_name),
+            phone = COALESCE(excluded.phone, phone),
+            source_type = CASE WHEN source_type = 'member' THEN source_type ELSE excluded.source_type END,
+            source_id = COALESCE(excluded.source_id, source_id),
+            source_name = COALESCE(excluded.source_name, source_name),
+            status = CASE WHEN status IN ('new', 'contacted') THEN excluded.status ELSE status END,
+            tags = CASE WHEN tags = '[]' OR tags IS NULL THEN excluded.tags ELSE tags END,
+            message_count = CASE WHEN excluded.message_count > message_count
+                                 THEN excluded.message_count ELSE message_count END,
+            last_contact_at = COALESCE(excluded.last_contact_at, last_contact_at),
+            bio = COALESCE(excluded.bio, bio),
+            updated_at = excluded.updated_at,
+            synced_at = excluded.synced_at
+    """,
+}
+
+
 class UnifiedContactsManager:
     """統一聯繫人管理器"""
     
@@ -113,6 +207,7 @@ class UnifiedContactsManager:
                 CREATE INDEX IF NOT EXISTS idx_unified_contacts_ai_score 
                 ON unified_contacts(ai_score DESC)
             ''')
+            await self._ensure_change_tracking()
             
             self._initialized = True
             print(f"[UnifiedContacts] Initialized successfully", file=sys.stderr)
@@ -121,432 +216,385 @@ class UnifiedContactsManager:
             print(f"[UnifiedContacts] Initialize error: {e}", file=sys.stderr)
             raise
     
-    async def sync_from_sources(self) -> Dict[str, int]:
+    # ==================== 🆕 P18-10: 增量同步 ====================
+    
+    async def _ensure_change_tracking(self):
+        """創建變更日誌、水位線表與來源表觸發器（INSERT/UPDATE 時記錄行 ID）"""
+        await self.db.execute('''
+            CREATE TABLE IF NOT EXISTS contact_change_log (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                source TEXT NOT NULL,
+                row_id INTEGER NOT NULL
+            )
+        ''')
+        await self.db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_contact_change_log_source
+            ON contact_change_log(source, seq)
+        ''')
+        await self.db.execute('''
+            CREATE TABLE IF NOT EXISTS contact_sync_watermarks (
+                source TEXT PRIMARY KEY,
+                last_seq INTEGER DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        for source, table in SYNC_SOURCES.items():
+            exists = await self.db.fetch_one(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,)
+            )
+            if not exists:
+                continue
+            for event in ('INSERT', 'UPDATE'):
+                await self.db.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS trg_contact_sync_{source}_{event.lower()}
+                    AFTER {event} ON {table}
+                    BEGIN
+                        INSERT INTO contact_change_log (source, row_id) VALUES ('{source}', NEW.id);
+                    END
+                ''')
+    
+    async def sync_from_sources(self, full: bool = False) -> Dict[str, int]:
         """
-        從來源表同步數據到統一視圖
+        從來源表同步數據到統一視圖 - 🆕 P18-10：增量同步
+        
+        每個來源按變更日誌水位線（seq）只處理自上次同步後新增/修改的行；
+        首次同步或 full=True 時全量掃描。所有變更以批量 UPSERT
+        在同一事務中寫入，水位線與日誌清理一併提交。
         
         Returns:
-            同步統計 {synced: int, updated: int, errors: int}
+            同步統計 {synced: int, updated: int, conflicts: int, errors: int, ...}
+            conflicts 為 telegram_id 已歸屬其他租戶、因此未更新的行數
         """
-        print(f"[UnifiedContacts] sync_from_sources() called", file=sys.stderr)
         await self.initialize()
         
-        stats = {'synced': 0, 'updated': 0, 'errors': 0, 'from_members': 0, 'from_resources': 0, 'from_leads': 0}
+        stats = {
+            'synced': 0, 'updated': 0, 'conflicts': 0, 'errors': 0,
+            'from_members': 0, 'from_resources': 0, 'from_leads': 0,
+            'incremental': not full,
+        }
+        started = time.time()
         now = datetime.now().isoformat()
+        owner_id = self._owner_id()
         
+        await self.db.connect()
+        conn = self.db._connection
         try:
-            # 1. 同步 extracted_members (用戶)
-            print(f"[UnifiedContacts] Fetching extracted_members...", file=sys.stderr)
-            members = await self.db.fetch_all('''
-                SELECT * FROM extracted_members ORDER BY created_at DESC
-            ''')
-            print(f"[UnifiedContacts] Found {len(members)} members to sync", file=sys.stderr)
-            
-            for member in members:
-                try:
-                    telegram_id = member.get('user_id')
-                    if not telegram_id:
-                        continue
-                    
-                    # 構建顯示名稱
-                    first_name = member.get('first_name', '') or ''
-                    last_name = member.get('last_name', '') or ''
-                    display_name = f"{first_name} {last_name}".strip() or member.get('username') or telegram_id
-                    
-                    # 解析標籤
-                    tags = member.get('tags', '[]')
-                    if isinstance(tags, str):
-                        try:
-                            tags = json.loads(tags)
-                        except:
-                            tags = []
-                    
-                    # 狀態映射
-                    status = 'new'
-                    if member.get('contacted'):
-                        status = 'contacted'
-                    if member.get('response_status') == 'replied':
-                        status = 'interested'
-                    
-                    owner_id = self._owner_id()
-                    existing = await self.db.fetch_one(
-                        'SELECT id FROM unified_contacts WHERE telegram_id = ? AND (owner_user_id = ? OR owner_user_id IS NULL)',
-                        (telegram_id, owner_id)
-                    )
-                    if existing:
-                        await self.db.execute('''
-                            UPDATE unified_contacts SET
-                                username = COALESCE(?, username),
-                                display_name = COALESCE(?, display_name),
-                                first_name = ?,
-                                last_name = ?,
-                                phone = COALESCE(?, phone),
-                                source_type = CASE WHEN source_type = 'member' THEN 'member' ELSE source_type END,
-                                source_id = COALESCE(?, source_id),
-                                source_name = COALESCE(?, source_name),
-                                status = CASE WHEN status = 'new' THEN ? ELSE status END,
-                                tags = ?,
-                                activity_score = ?,
-                                value_level = ?,
-                                is_bot = ?,
-                                is_premium = ?,
-                                is_verified = ?,
-                                last_seen = COALESCE(?, last_seen),
-                                updated_at = ?,
-                                synced_at = ?,
-                                owner_user_id = ?
-                            WHERE telegram_id = ? AND (owner_user_id = ? OR owner_user_id IS NULL)
-                        ''', (
-                            member.get('username'),
-                            display_name,
-                            first_name,
-                            last_name,
-                            member.get('phone'),
-                            member.get('source_chat_id'),
-                            member.get('source_chat_title'),
-                            status,
-                            json.dumps(tags) if isinstance(tags, list) else tags,
-                            member.get('activity_score', 0.5),
-                            member.get('value_level', 'C'),
-                            member.get('is_bot', 0),
-                            member.get('is_premium', 0),
-                            member.get('is_verified', 0),
-                            member.get('last_online'),
-                            now,
-                            now,
-                            owner_id,
-                            telegram_id,
-                            owner_id,
-                        ))
-                        stats['updated'] += 1
-                    else:
-                        print(f"[UnifiedContacts] INSERT member: {telegram_id}, {display_name}", file=sys.stderr)
-                        result = await self.db.execute('''
-                            INSERT INTO unified_contacts (
-                                telegram_id, username, display_name, first_name, last_name, phone,
-                                contact_type, source_type, source_id, source_name,
-                                status, tags, activity_score, value_level,
-                                is_bot, is_premium, is_verified, last_seen,
-                                created_at, updated_at, synced_at, captured_at, owner_user_id
-                            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        ''', (
-                            telegram_id,
-                            member.get('username'),
-                            display_name,
-                            first_name,
-                            last_name,
-                            member.get('phone'),
-                            'user',
-                            'member',
-                            member.get('source_chat_id'),
-                            member.get('source_chat_title'),
-                            status,
-                            json.dumps(tags) if isinstance(tags, list) else tags,
-                            member.get('activity_score', 0.5),
-                            member.get('value_level', 'C'),
-                            member.get('is_bot', 0),
-                            member.get('is_premium', 0),
-                            member.get('is_verified', 0),
-                            member.get('last_online'),
-                            member.get('created_at', now),
-                            now,
-                            now,
-                            member.get('extracted_at', now),
-                            owner_id,
-                        ))
-                        print(f"[UnifiedContacts] INSERT result: {result}", file=sys.stderr)
-                        if result == 0:
-                            print(f"[UnifiedContacts] WARNING: INSERT returned 0 for {telegram_id}", file=sys.stderr)
-                        stats['synced'] += 1
-                    
-                    stats['from_members'] += 1
-                    
-                except Exception as e:
-                    print(f"[UnifiedContacts] Sync member error: {e}", file=sys.stderr)
-                    stats['errors'] += 1
-            
-            # 2. 同步 discovered_resources (群組/頻道)
-            resources = await self.db.fetch_all('''
-                SELECT * FROM discovered_resources ORDER BY discovered_at DESC
-            ''')
-            
-            for resource in resources:
+            for source, table in SYNC_SOURCES.items():
+                last_seq, high_seq = await self._sync_bounds(conn, source)
+                if full or last_seq is None:
+                    # 全量：high_seq 先確定，掃描期間的新變更 seq 更大，下次增量會處理
+                    last_seq = None
+                    stats['incremental'] = False
+                
                 try:
-                    telegram_id = resource.get('telegram_id')
-                    if not telegram_id:
-                        continue
-                    
-                    # 資源類型映射
-                    resource_type = resource.get('resource_type', 'group')
-                    contact_type = 'group' if resource_type in ['group', 'supergroup'] else 'channel'
-                    
-                    display_name = resource.get('title') or resource.get('username') or telegram_id
-                    
-                    # 狀態映射
-                    status = resource.get('status', 'new')
-                    if status == 'discovered':
-                        status = 'new'
-                    elif status == 'joined':
-                        status = 'contacted'
-                    
-                    owner_id = self._owner_id()
-                    existing = await self.db.fetch_one(
-                        'SELECT id FROM unified_contacts WHERE telegram_id = ? AND (owner_user_id = ? OR owner_user_id IS NULL)',
-                        (telegram_id, owner_id)
-                    )
-                    if existing:
-                        await self.db.execute('''
-                            UPDATE unified_contacts SET
-                                username = COALESCE(?, username),
-                                display_name = COALESCE(?, display_name),
-                                contact_type = ?,
-                                source_type = 'resource',
-                                ai_score = ?,
-                                activity_score = ?,
-                                member_count = ?,
-                                bio = COALESCE(?, bio),
-                                updated_at = ?,
-                                synced_at = ?,
-                                owner_user_id = ?
-                            WHERE telegram_id = ? AND (owner_user_id = ? OR owner_user_id IS NULL)
-                        ''', (
-                            resource.get('username'),
-                            display_name,
-                            contact_type,
-                            resource.get('overall_score', 0.5),
-                            resource.get('activity_score', 0.5),
-                            resource.get('member_count', 0),
-                            resource.get('description'),
-                            now,
-                            now,
-                            owner_id,
-                            telegram_id,
-                            owner_id,
-                        ))
-                        stats['updated'] += 1
-                    else:
-                        await self.db.execute('''
-                            INSERT INTO unified_contacts (
-                                telegram_id, username, display_name,
-                                contact_type, source_type, source_id, source_name,
-                                status, ai_score, activity_score, member_count, bio,
-                                created_at, updated_at, synced_at, captured_at, owner_user_id
-                            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        ''', (
-                            telegram_id,
-                            resource.get('username'),
-                            display_name,
-                            contact_type,
-                            'resource',
-                            resource.get('discovery_keyword'),
-                            resource.get('discovery_source'),
-                            status,
-                            resource.get('overall_score', 0.5),
-                            resource.get('activity_score', 0.5),
-                            resource.get('member_count', 0),
-                            resource.get('description'),
-                            resource.get('discovered_at', now),
-                            now,
-                            now,
-                            resource.get('discovered_at', now),
-                            owner_id,
-                        ))
-                        stats['synced'] += 1
-                    stats['from_resources'] += 1
-
+                    async for rows in self._iter_source_rows(conn, source, table, last_seq, high_seq):
+                        params = []
+                        for row in rows:
+                            try:
+                                item = self._source_row_params(source, row, now, owner_id)
+                            except Exception as e:
+                                print(f"[UnifiedContacts] Sync {source} row error: {e}", file=sys.stderr)
+                                stats['errors'] += 1
+                                continue
+                            if item:
+                                params.append(item)
+                        
+                        inserted, updated, conflicts, errors = await self._bulk_upsert(
+                            conn, _UPSERT_SQL[source], params,
+                            owner_id=owner_id, check_owner=source in _OWNER_GUARDED_SOURCES
+                        )
+                        stats['synced'] += inserted
+                        stats['updated'] += updated
+                        stats['conflicts'] += conflicts
+                        stats['errors'] += errors
+                        stats[f'from_{source}'] += inserted + updated
                 except Exception as e:
-                    print(f"[UnifiedContacts] Sync resource error: {e}", file=sys.stderr)
-                    stats['errors'] += 1
-            
-            # 3. 🆕 同步 leads (發送控制台數據)
-            try:
-                leads = await self.db.fetch_all('''
-                    SELECT * FROM leads ORDER BY timestamp DESC
-                ''')
-                print(f"[UnifiedContacts] Found {len(leads)} leads to sync", file=sys.stderr)
-            except Exception as e:
-                print(f"[UnifiedContacts] Leads table query error: {e}", file=sys.stderr)
-                leads = []
-            
-            for lead in leads:
-                try:
-                    # leads 表使用 userId 欄位
-                    user_id = lead.get('userId') or lead.get('user_id')
-                    if not user_id:
-                        continue
-                    
-                    telegram_id = str(user_id)
-                    
-                    # 構建顯示名稱
-                    first_name = lead.get('firstName', '') or lead.get('first_name', '') or ''
-                    last_name = lead.get('lastName', '') or lead.get('last_name', '') or ''
-                    display_name = f"{first_name} {last_name}".strip() or lead.get('username') or telegram_id
-                    
-                    # 解析標籤
-                    tags = lead.get('tags', '[]')
-                    if isinstance(tags, str):
-                        try:
-                            tags = json.loads(tags)
-                        except:
-                            tags = []
-                    
-                    # 狀態映射：Lead狀態 → Contact狀態
-                    lead_status = lead.get('status', 'New')
-                    status = LEAD_STATUS_MAPPING.get(lead_status, 'new')
-                    
-                    # 來源信息
-                    source_type = lead.get('sourceType', 'lead')
-                    if source_type == 'group_extract':
-                        source_type = 'member'
-                    elif source_type == 'keyword_trigger':
-                        source_type = 'lead'
-                    else:
-                        source_type = 'lead'
-                    
-                    source_name = lead.get('sourceChatTitle') or lead.get('sourceGroup') or '發送控制台'
-                    source_id = lead.get('sourceChatId') or lead.get('campaignId')
-                    
-                    # 計算互動數據
-                    interaction_history = lead.get('interactionHistory', [])
-                    if isinstance(interaction_history, str):
-                        try:
-                            interaction_history = json.loads(interaction_history)
-                        except:
-                            interaction_history = []
-                    message_count = len(interaction_history) if isinstance(interaction_history, list) else 0
-                    
-                    # 獲取最後聯繫時間
-                    last_contact_at = None
-                    if interaction_history and len(interaction_history) > 0:
-                        last_interaction = interaction_history[-1] if isinstance(interaction_history, list) else None
-                        if last_interaction and isinstance(last_interaction, dict):
-                            last_contact_at = last_interaction.get('timestamp')
-                    
-                    # 嘗試插入或更新
-                    existing = await self.db.fetch_one(
-                        'SELECT id, source_type FROM unified_contacts WHERE telegram_id = ?',
-                        (telegram_id,)
-                    )
-                    
-                    if existing:
-                        # 更新現有記錄，但保留更有價值的狀態
-                        # 如果來源是 lead 且現有狀態較新，則更新
-                        await self.db.execute('''
-                            UPDATE unified_contacts SET
-                                username = COALESCE(?, username),
-                                display_name = COALESCE(?, display_name),
-                                first_name = COALESCE(?, first_name),
-                                last_name = COALESCE(?, last_name),
-                                phone = COALESCE(?, phone),
-                                source_type = CASE 
-                                    WHEN source_type = 'member' THEN source_type 
-                                    ELSE ? 
-                                END,
-                                source_id = COALESCE(?, source_id),
-                                source_name = COALESCE(?, source_name),
-                                status = CASE 
-                                    WHEN status IN ('new', 'contacted') THEN ? 
-                                    ELSE status 
-                                END,
-                                tags = CASE 
-                                    WHEN tags = '[]' OR tags IS NULL THEN ? 
-                                    ELSE tags 
-                                END,
-                                message_count = CASE 
-                                    WHEN ? > message_count THEN ? 
-                                    ELSE message_count 
-                                END,
-                                last_contact_at = COALESCE(?, last_contact_at),
-                                bio = COALESCE(?, bio),
-                                updated_at = ?,
-                                synced_at = ?
-                            WHERE telegram_id = ?
-                        ''', (
-                            lead.get('username'),
-                            display_name,
-                            first_name,
-                            last_name,
-                            lead.get('phone'),
-                            source_type,
-                            str(source_id) if source_id else None,
-                            source_name,
-                            status,
-                            json.dumps(tags) if isinstance(tags, list) else tags,
-                            message_count,
-                            message_count,
-                            last_contact_at,
-                            lead.get('bio'),
-                            now,
-                            now,
-                            telegram_id
-                        ))
-                        stats['updated'] += 1
-                    else:
-                        # 插入新記錄 - 🔧 FIX: 添加 captured_at 列
-                        await self.db.execute('''
-                            INSERT INTO unified_contacts (
-                                telegram_id, username, display_name, first_name, last_name, phone,
-                                contact_type, source_type, source_id, source_name,
-                                status, tags, message_count, last_contact_at, bio,
-                                created_at, updated_at, synced_at, captured_at
-                            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        ''', (
-                            telegram_id,
-                            lead.get('username'),
-                            display_name,
-                            first_name,
-                            last_name,
-                            lead.get('phone'),
-                            'user',
-                            source_type,
-                            str(source_id) if source_id else None,
-                            source_name,
-                            status,
-                            json.dumps(tags) if isinstance(tags, list) else tags,
-                            message_count,
-                            last_contact_at,
-                            lead.get('bio'),
-                            lead.get('timestamp', now),
-                            now,
-                            now,
-                            lead.get('timestamp', now)  # 🔧 FIX: captured_at
-                        ))
-                        stats['synced'] += 1
-                    
-                    stats['from_leads'] += 1
-                    
-                except Exception as e:
-                    print(f"[UnifiedContacts] Sync lead error: {e}", file=sys.stderr)
-                    stats['errors'] += 1
-            
-            print(f"[UnifiedContacts] Sync completed: {stats}", file=sys.stderr)
-            
-            # 🔧 FIX: 顯式調用 commit 確保數據被提交
-            try:
-                if hasattr(self.db, '_connection') and self.db._connection:
-                    await self.db._connection.commit()
-                    print(f"[UnifiedContacts] Explicit commit called", file=sys.stderr)
-            except Exception as ce:
-                print(f"[UnifiedContacts] Commit error: {ce}", file=sys.stderr)
-            
-            # 🔧 驗證：檢查數據是否真的寫入了
-            try:
-                verify_result = await self.db.fetch_one("SELECT COUNT(*) as cnt FROM unified_contacts")
-                actual_count = verify_result['cnt'] if verify_result else 0
-                print(f"[UnifiedContacts] VERIFY: unified_contacts now has {actual_count} records", file=sys.stderr)
-                if actual_count == 0 and stats['synced'] > 0:
-                    print(f"[UnifiedContacts] WARNING: synced={stats['synced']} but table is empty! Data may not have been committed.", file=sys.stderr)
-            except Exception as ve:
-                print(f"[UnifiedContacts] Verify error: {ve}", file=sys.stderr)
-            
-            return stats
+                    # 來源表不存在（如舊庫沒有 leads）
+                    print(f"[UnifiedContacts] {table} query error: {e}", file=sys.stderr)
+                    continue
+                
+                await conn.execute('''
+                    INSERT INTO contact_sync_watermarks (source, last_seq, updated_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(source) DO UPDATE SET
+                        last_seq = excluded.last_seq, updated_at = excluded.updated_at
+                ''', (source, high_seq))
+                await conn.execute(
+                    'DELETE FROM contact_change_log WHERE source = ? AND seq <= ?', (source, high_seq)
+                )
             
+            await conn.commit()
         except Exception as e:
             print(f"[UnifiedContacts] Sync error: {e}", file=sys.stderr)
             import traceback
             traceback.print_exc(file=sys.stderr)
+            await conn.rollback()
             stats['errors'] += 1
             return stats
+        
+        stats['duration_ms'] = int((time.time() - started) * 1000)
+        print(f"[UnifiedContacts] Sync completed: {stats}", file=sys.stderr)
+        return stats
+    
+    async def _sync_bounds(self, conn, source: str) -> Tuple[Optional[int], int]:
+        """
+        Returns:
+            (上次同步的水位線，未同步過為 None；當前變更日誌最大 seq)
+        """
+        cursor = await conn.execute(
+            'SELECT last_seq FROM contact_sync_watermarks WHERE source = ?', (source,)
+        )
+        mark = await cursor.fetchone()
+        cursor = await conn.execute(
+            'SELECT COALESCE(MAX(seq), 0) FROM contact_change_log WHERE source = ?', (source,)
+        )
+        high_seq = (await cursor.fetchone())[0]
+        return (mark[0] or 0) if mark else None, high_seq
+    
+    async def _iter_source_rows(
+        self, conn, source: str, table: str, last_seq: Optional[int], high_seq: int
+    ):
+        """
+        分塊產出需要同步的來源行
+        
+        last_seq 為 None 時按 id 鍵集分頁全量掃描；否則只讀取
+        變更日誌中 (last_seq, high_seq] 範圍內涉及的行。
+        """
+        if last_seq is None:
+            last_id = 0
+            while True:
+                cursor = await conn.execute(
+                    f'SELECT * FROM {table} WHERE id > ? ORDER BY id LIMIT ?',
+                    (last_id, SYNC_CHUNK_SIZE)
+                )
+                rows = [dict(r) for r in await cursor.fetchall()]
+                if not rows:
+                    return
+                last_id = rows[-1]['id']
+                yield rows
+        
+        if high_seq <= last_seq:
+            return
+        cursor = await conn.execute('''
+            SELECT DISTINCT row_id FROM contact_change_log
+            WHERE source = ? AND seq > ? AND seq <= ?
+            ORDER BY row_id
+        ''', (source, last_seq, high_seq))
+        row_ids = [r[0] for r in await cursor.fetchall()]
+        for i in range(0, len(row_ids), SYNC_CHUNK_SIZE):
+            chunk = row_ids[i:i + SYNC_CHUNK_SIZE]
+            placeholders = ','.join('?' for _ in chunk)
+            cursor = await conn.execute(
+                f'SELECT * FROM {table} WHERE id IN ({placeholders}) ORDER BY id', chunk
+            )
+            yield [dict(r) for r in await cursor.fetchall()]
+    
+    async def _bulk_upsert(
+        self, conn, sql: str, params: List[tuple],
+        owner_id: Optional[str] = None, check_owner: bool = False
+    ) -> Tuple[int, int, int, int]:
+        """
+        分塊 executemany UPSERT（不提交，由調用方統一提交）
+        
+        Args:
+            check_owner: sql 帶 _OWNER_GUARD 時為 True，已歸屬其他租戶的行不計入更新
+        
+        Returns:
+            (新增數, 更新數, 租戶衝突數, 錯誤數)
+        """
+        inserted = updated = conflicts = errors = 0
+        for i in range(0, len(params), SYNC_CHUNK_SIZE):
+            chunk = params[i:i + SYNC_CHUNK_SIZE]
+            ids = list({p[0] for p in chunk})
+            placeholders = ','.join('?' for _ in ids)
+            cursor = await conn.execute(
+                f'SELECT telegram_id, owner_user_id FROM unified_contacts WHERE telegram_id IN ({placeholders})', ids
+            )
+            owners = {r[0]: r[1] for r in await cursor.fetchall()}
+            existing = set(owners)
+            foreign = {
+                tid for tid, owner in owners.items()
+                if check_owner and owner is not None and owner != owner_id
+            }
+            if foreign:
+                sample = ', '.join(sorted(str(t) for t in foreign)[:5])
+                print(f"[UnifiedContacts] {len(foreign)} contacts belong to another owner, not updated "
+                      f"(owner={owner_id}): {sample}", file=sys.stderr)
+            try:
+                await conn.executemany(sql, chunk)
+            except Exception as e:
+                # 逐條重試，定位壞行（UPSERT 冪等，已寫入的行重複執行無副作用）
+                print(f"[UnifiedContacts] Bulk upsert failed, retrying row by row: {e}", file=sys.stderr)
+                ok_ids = set()
+                for row in chunk:
+                    try:
+                        await conn.execute(sql, row)
+                        ok_ids.add(row[0])
+                    except Exception as row_err:
+                        print(f"[UnifiedContacts] Upsert {row[0]} error: {row_err}", file=sys.stderr)
+                        errors += 1
+                ids = [i for i in ids if i in ok_ids]
+            new_ids = set(ids) - existing
+            skipped = foreign & set(ids)
+            inserted += len(new_ids)
+            conflicts += len(skipped)
+            updated += len(ids) - len(new_ids) - len(skipped)
+        return inserted, updated, conflicts, errors
+    
+    def _source_row_params(self, source: str, row: Dict[str, Any], now: str, owner_id: str) -> Optional[tuple]:
+        """將來源行轉為對應 UPSERT 語句的參數元組（無 telegram_id 時返回 None）"""
+        if source == 'members':
+            return self._member_params(row, now, owner_id)
+        if source == 'resources':
+            return self._resource_params(row, now, owner_id)
+        return self._lead_params(row, now)
+    
+    @staticmethod
+    def _parse_tags(tags) -> str:
+        if isinstance(tags, str):
+            try:
+                tags = json.loads(tags)
+            except:
+                tags = []
+        return json.dumps(tags) if isinstance(tags, list) else tags
+    
+    def _member_params(self, member: Dict[str, Any], now: str, owner_id: str) -> Optional[tuple]:
+        telegram_id = member.get('user_id')
+        if not telegram_id:
+            return None
+        
+        # 構建顯示名稱
+        first_name = member.get('first_name', '') or ''
+        last_name = member.get('last_name', '') or ''
+        display_name = f"{first_name} {last_name}".strip() or member.get('username') or telegram_id
+        
+        # 狀態映射
+        status = 'new'
+        if member.get('contacted'):
+            status = 'contacted'
+        if member.get('response_status') == 'replied':
+            status = 'interested'
+        
+        return (
+            str(telegram_id),
+            member.get('username'),
+            display_name,
+            first_name,
+            last_name,
+            member.get('phone'),
+            'user',
+            'member',
+            member.get('source_chat_id'),
+            member.get('source_chat_title'),
+            status,
+            self._parse_tags(member.get('tags', '[]')),
+            member.get('activity_score', 0.5),
+            member.get('value_level', 'C'),
+            member.get('is_bot', 0),
+            member.get('is_premium', 0),
+            member.get('is_verified', 0),
+            member.get('last_online'),
+            member.get('created_at') or now,
+            now,
+            now,
+            member.get('extracted_at') or now,
+            owner_id,
+        )
+    
+    def _resource_params(self, resource: Dict[str, Any], now: str, owner_id: str) -> Optional[tuple]:
+        telegram_id = resource.get('telegram_id')
+        if not telegram_id:
+            return None
+        
+        # 資源類型映射
+        resource_type = resource.get('resource_type', 'group')
+        contact_type = 'group' if resource_type in ['group', 'supergroup'] else 'channel'
+        display_name = resource.get('title') or resource.get('username') or telegram_id
+        
+        # 狀態映射
+        status = resource.get('status', 'new')
+        if status == 'discovered':
+            status = 'new'
+        elif status == 'joined':
+            status = 'contacted'
+        
+        return (
+            str(telegram_id),
+            resource.get('username'),
+            display_name,
+            contact_type,
+            'resource',
+            resource.get('discovery_keyword'),
+            resource.get('discovery_source'),
+            status,
+            resource.get('overall_score', 0.5),
+            resource.get('activity_score', 0.5),
+            resource.get('member_count', 0),
+            resource.get('description'),
+            resource.get('discovered_at') or now,
+            now,
+            now,
+            resource.get('discovered_at') or now,
+            owner_id,
+        )
+    
+    def _lead_params(self, lead: Dict[str, Any], now: str) -> Optional[tuple]:
+        # leads 表使用 userId 欄位
+        user_id = lead.get('userId') or lead.get('user_id')
+        if not user_id:
+            return None
+        telegram_id = str(user_id)
+        
+        # 構建顯示名稱
+        first_name = lead.get('firstName', '') or lead.get('first_name', '') or ''
+        last_name = lead.get('lastName', '') or lead.get('last_name', '') or ''
+        display_name = f"{first_name} {last_name}".strip() or lead.get('username') or telegram_id
+        
+        # 狀態映射：Lead狀態 → Contact狀態
+        status = LEAD_STATUS_MAPPING.get(lead.get('status', 'New'), 'new')
+        
+        # 來源信息
+        source_type = 'member' if lead.get('sourceType', 'lead') == 'group_extract' else 'lead'
+        source_name = lead.get('sourceChatTitle') or lead.get('sourceGroup') or '發送控制台'
+        source_id = lead.get('sourceChatId') or lead.get('campaignId')
+        
+        # 計算互動數據
+        interaction_history = lead.get('interactionHistory', [])
+        if isinstance(interaction_history, str):
+            try:
+                interaction_history = json.loads(interaction_history)
+            except:
+                interaction_history = []
+        if not isinstance(interaction_history, list):
+            interaction_history = []
+        message_count = len(interaction_history)
+        
+        # 獲取最後聯繫時間
+        last_contact_at = None
+        if interaction_history and isinstance(interaction_history[-1], dict):
+            last_contact_at = interaction_history[-1].get('timestamp')
+        
+        return (
+            telegram_id,
+            lead.get('username'),
+            display_name,
+            first_name,
+            last_name,
+            lead.get('phone'),
+            'user',
+            source_type,
+            str(source_id) if source_id else None,
+            source_name,
+            status,
+            self._parse_tags(lead.get('tags', '[]')),
+            message_count,
+            last_contact_at,
+            lead.get('bio'),
+            lead.get('timestamp') or now,
+            now,
+            now,
+            lead.get('timestamp') or now,
+        )
     
     async def get_contacts(
         self,
@@ -567,8 +615,53 @@ class UnifiedContactsManager:
         """
         await self.initialize()
         
+        where_clause, params = self._contact_filter_clause(
+            contact_type, source_type, status, tags, search
+        )
+        
+        # 獲取總數
+        count_sql = f'SELECT COUNT(*) as total FROM unified_contacts {where_clause}'
+        count_result = await self.db.fetch_one(count_sql, tuple(params))
+        total = count_result['total'] if count_result else 0
+        
+        # 獲取數據
+        sql = f'''
+            SELECT * FROM unified_contacts 
+            {where_clause}
+            ORDER BY {order_by}
+            LIMIT ? OFFSET ?
+        '''
+        params.extend([limit, offset])
+        
+        results = await self.db.fetch_all(sql, tuple(params))
+        contacts = [self._decode_contact_row(dict(row)) for row in results]
+        
+        return contacts, total
+    
+    @staticmethod
+    def _decode_contact_row(contact: Dict[str, Any]) -> Dict[str, Any]:
+        """解析 JSON 欄位（tags / metadata）"""
+        try:
+            contact['tags'] = json.loads(contact.get('tags', '[]'))
+        except:
+            contact['tags'] = []
+        try:
+            contact['metadata'] = json.loads(contact.get('metadata', '{}'))
+        except:
+            contact['metadata'] = {}
+        return contact
+    
+    @staticmethod
+    def _contact_filter_clause(
+        contact_type: str = None,
+        source_type: str = None,
+        status: str = None,
+        tags: List[str] = None,
+        search: str = None
+    ) -> Tuple[str, List[Any]]:
+        """構建聯繫人查詢的 WHERE 子句與參數"""
         conditions = []
-        params = []
+        params: List[Any] = []
         
         if contact_type:
             conditions.append('contact_type = ?')
@@ -600,38 +693,29 @@ class UnifiedContactsManager:
         where_clause = ''
         if conditions:
             where_clause = 'WHERE ' + ' AND '.join(conditions)
+        return where_clause, params
+    
+    async def iter_contacts_for_export(
+        self,
+        contact_type: str = None,
+        source_type: str = None,
+        status: str = None,
+        tags: List[str] = None,
+        search: str = None
+    ):
+        """
+        🆕 P18-8: 流式讀取全部符合條件的聯繫人（獨立只讀游標，無行數上限）
         
-        # 獲取總數
-        count_sql = f'SELECT COUNT(*) as total FROM unified_contacts {where_clause}'
-        count_result = await self.db.fetch_one(count_sql, tuple(params))
-        total = count_result['total'] if count_result else 0
-        
-        # 獲取數據
-        sql = f'''
-            SELECT * FROM unified_contacts 
-            {where_clause}
-            ORDER BY {order_by}
-            LIMIT ? OFFSET ?
-        '''
-        params.extend([limit, offset])
-        
-        results = await self.db.fetch_all(sql, tuple(params))
-        
-        # 解析 JSON 欄位
-        contacts = []
-        for row in results:
-            contact = dict(row)
-            try:
-                contact['tags'] = json.loads(contact.get('tags', '[]'))
-            except:
-                contact['tags'] = []
-            try:
-                contact['metadata'] = json.loads(contact.get('metadata', '{}'))
-            except:
-                contact['metadata'] = {}
-            contacts.append(contact)
-        
-        return contacts, total
+        配合 core.streaming_export 的 export_to_file / export_to_response 使用
+        """
+        from core.streaming_export import iter_query_rows
+        await self.initialize()
+        where_clause, params = self._contact_filter_clause(
+            contact_type, source_type, status, tags, search
+        )
+        sql = f'SELECT * FROM unified_contacts {where_clause} ORDER BY id'
+        async for row in iter_query_rows(self.db.db_path, sql, params):
+            yield row
     
     async def get_stats(self) -> Dict[str, Any]:
         """獲取統計數據"""
@@ -2430,17 +2430,38 @@ export class MemberDatabaseComponent implements OnInit, OnDestroy {
    * 智能去重 - 跨群組合併重複成員
    */
   deduplicateMembers(): void {
-    this.toastService.info('🔄 正在執行智能去重...');
-    this.ipcService.send('deduplicate-members', {});
+    this.toastService.info('🔍 正在檢查重複成員...');
+    // 先預覽（dryRun），確認後才真正合併
+    this.ipcService.send('deduplicate-members', { dryRun: true });
     
     // 監聽去重結果
     const cleanup = this.ipcService.on('members-deduplicated', (data: any) => {
       cleanup();
-      if (data.success) {
-        this.toastService.success(`✅ 去重完成！合併了 ${data.mergedCount || 0} 個重複成員`);
-        this.loadMembers(); // 重新載入數據
-      } else {
+      if (!data.success) {
         this.toastService.error(`去重失敗: ${data.error}`);
+        return;
+      }
+      if (!data.dry_run) {
+        this.toastService.success(`✅ 去重完成！合併了 ${data.merged || 0} 個重複成員`);
+        this.loadMembers(); // 重新載入數據
+        return;
+      }
+      if (!data.duplicate_users) {
+        this.toastService.success('✅ 沒有重複成員');
+        return;
+      }
+      if (confirm(`發現 ${data.duplicate_users} 個成員有 ${data.duplicate_rows} 條重複記錄，標籤、備註和聯繫狀態會合併到保留的記錄中。確定合併嗎？`)) {
+        this.toastService.info('🔄 正在執行智能去重...');
+        const done = this.ipcService.on('members-deduplicated', (result: any) => {
+          done();
+          if (result.success) {
+            this.toastService.success(`✅ 去重完成！合併了 ${result.merged || 0} 個重複成員`);
+            this.loadMembers(); // 重新載入數據
+          } else {
+            this.toastService.error(`去重失敗: ${result.error}`);
+          }
+        });
+        this.ipcService.send('deduplicate-members', { dryRun: false });
       }
     });
   }
@@ -159,6 +159,8 @@ export class UnifiedExtractionService {
   
   // 🆕 P3 優化：提取開始時間（用於計算速度）
   private _extractionStartTime: number = 0;
+  // 🆕 P18-8: 分塊導出的內容，按文件名暫存到 members-exported
+  private _exportChunks = new Map<string, string[]>();
   private _lastProgressUpdate: { time: number; count: number } = { time: 0, count: 0 };
   
   private setupListeners() {
@@ -285,11 +287,26 @@ export class UnifiedExtractionService {
       }
     });
     
+    // 🆕 P18-8：分塊接收導出內容
+    this.ipc.on('members-export-chunk', (data: any) => {
+      const parts = this._exportChunks.get(data.filename) || [];
+      parts.push(data.chunk);
+      this._exportChunks.set(data.filename, parts);
+    });
+    
     // 🆕 P4：監聽導出完成
     this.ipc.on('members-exported', (data: any) => {
-      if (data.success && data.content) {
+      const parts: string[] = data.chunked
+        ? this._exportChunks.get(data.filename) || []
+        : data.content ? [data.content] : [];
+      if (data.chunked) {
+        this._exportChunks.delete(data.filename);
+      } else if (!data.success) {
+        this._exportChunks.clear();
+      }
+      if (data.success && parts.length) {
         // 創建下載
-        const blob = new Blob([data.content], { 
+        const blob = new Blob(parts, { 
           type: data.format === 'json' ? 'application/json' : 'text/csv' 
         });
         const url = URL.createObjectURL(blob);
@@ -306,7 +323,9 @@ export class UnifiedExtractionService {
     
     // 🆕 P4：監聽去重完成
     this.ipc.on('members-deduplicated', (data: any) => {
-      if (data.success) {
+      if (data.success && data.dry_run) {
+        this.toast.info(`🔍 去重預覽: ${data.duplicate_users} 個成員有 ${data.duplicate_rows} 條重複記錄`);
+      } else if (data.success) {
         this.toast.success(`✅ 去重完成: 合併 ${data.merged} 個，刪除 ${data.deleted} 條`);
       } else {
         this.toast.error(`去重失敗: ${data.error}`);
@@ -577,9 +596,9 @@ export class UnifiedExtractionService {
   /**
    * 去重成員數據
    */
-  deduplicateMembers(): void {
-    this.ipc.send('deduplicate-members', {});
-    this.toast.info('正在執行去重...');
+  deduplicateMembers(dryRun = true): void {
+    this.ipc.send('deduplicate-members', { dryRun });
+    this.toast.info(dryRun ? '正在檢查重複成員...' : '正在執行去重...');
   }
   
   /**